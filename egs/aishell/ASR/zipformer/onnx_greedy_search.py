@@ -0,0 +1 @@
+../../../librispeech/ASR/zipformer/onnx_greedy_search.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../bookbot/ASR_v6/zipformer/onnx_greedy_search.py
\ No newline at end of file
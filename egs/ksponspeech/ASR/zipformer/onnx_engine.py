@@ -0,0 +1 @@
+../../../librispeech/ASR/zipformer/onnx_engine.py
\ No newline at end of file
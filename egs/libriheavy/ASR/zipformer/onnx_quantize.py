@@ -0,0 +1 @@
+../../../librispeech/ASR/zipformer/onnx_quantize.py
\ No newline at end of file
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This file packs the precomputed features of the given cuts into a feature
+store, i.e., a few large memory-mappable shard files with an index.
+
+Usage:
+
+  ./local/build_feature_store.py \
+    --cuts data/fbank/librispeech_cuts_train-all-shuf.jsonl.gz \
+    --out-dir data/fbank/feature_store_train
+
+Then pass `--feature-store-dir data/fbank/feature_store_train` to train.py.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+from lhotse import load_manifest_lazy
+
+from icefall.feature_store import write_feature_store
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cuts",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="The cut manifests with precomputed features, "
+        "e.g., data/fbank/librispeech_cuts_train-clean-100.jsonl.gz",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        required=True,
+        help="The directory to write the feature store to.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1024,
+        help="The maximum size of a shard file in MB.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float32",
+        help="The dtype of the stored features, float32 or float16. "
+        "float16 halves the size of the store.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.info(vars(args))
+
+    def cuts():
+        for filename in args.cuts:
+            logging.info(f"Loading {filename}")
+            yield from load_manifest_lazy(filename)
+
+    if (args.out_dir / "meta.json").is_file():
+        logging.info(f"{args.out_dir} already exists - skipping")
+        return
+
+    num_cuts = write_feature_store(
+        cuts(),
+        out_dir=args.out_dir,
+        shard_size=args.shard_size << 20,
+        dtype=args.dtype,
+    )
+    logging.info(f"Wrote {num_cuts} cuts to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
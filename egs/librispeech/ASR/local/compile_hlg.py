@@ -35,6 +35,7 @@ from pathlib import Path
 import k2
 import torch
 
+from icefall.graph_cache import GraphCache, get_lang_files, get_lm_file
 from icefall.lexicon import Lexicon
 
 
@@ -54,6 +55,16 @@ def get_args():
         """,
     )
 
+    parser.add_argument(
+        "--graph-cache-dir",
+        type=str,
+        default="",
+        help="""If not empty, look up HLG in this cache directory before
+        compiling it, and save the compiled HLG to it. The key is a hash of
+        the lexicon, the BPE model and the LM. See icefall/graph_cache.py.
+        """,
+    )
+
     return parser.parse_args()
 
 
@@ -154,7 +165,15 @@ def main():
 
     logging.info(f"Processing {lang_dir}")
 
-    HLG = compile_HLG(lang_dir, args.lm)
+    if args.graph_cache_dir:
+        HLG = GraphCache(args.graph_cache_dir).get_or_compile(
+            name="HLG",
+            filenames=get_lang_files(lang_dir) + [get_lm_file("data/lm", args.lm)],
+            compile_fn=lambda: compile_HLG(lang_dir, args.lm),
+            lm=args.lm,
+        )
+    else:
+        HLG = compile_HLG(lang_dir, args.lm)
     logging.info(f"Saving HLG.pt to {lang_dir}")
     torch.save(HLG.as_dict(), f"{lang_dir}/HLG.pt")
 
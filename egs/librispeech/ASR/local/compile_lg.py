@@ -34,6 +34,7 @@ from pathlib import Path
 import k2
 import torch
 
+from icefall.graph_cache import GraphCache, get_lang_files, get_lm_file
 from icefall.lexicon import Lexicon
 
 
@@ -53,6 +54,16 @@ def get_args():
         """,
     )
 
+    parser.add_argument(
+        "--graph-cache-dir",
+        type=str,
+        default="",
+        help="""If not empty, look up LG in this cache directory before
+        compiling it, and save the compiled LG to it. The key is a hash of
+        the lexicon, the BPE model and the LM. See icefall/graph_cache.py.
+        """,
+    )
+
     return parser.parse_args()
 
 
@@ -134,7 +145,15 @@ def main():
 
     logging.info(f"Processing {lang_dir}")
 
-    LG = compile_LG(lang_dir, args.lm)
+    if args.graph_cache_dir:
+        LG = GraphCache(args.graph_cache_dir).get_or_compile(
+            name="LG",
+            filenames=get_lang_files(lang_dir) + [get_lm_file("data/lm", args.lm)],
+            compile_fn=lambda: compile_LG(lang_dir, args.lm),
+            lm=args.lm,
+        )
+    else:
+        LG = compile_LG(lang_dir, args.lm)
     logging.info(f"Saving LG.pt to {lang_dir}")
     torch.save(LG.as_dict(), f"{lang_dir}/LG.pt")
 
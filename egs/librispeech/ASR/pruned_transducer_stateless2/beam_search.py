@@ -17,6 +17,7 @@
 
 import math
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple, Union
 
@@ -25,7 +26,15 @@ import sentencepiece as spm
 import torch
 from torch import nn
 
-from icefall import ContextGraph, ContextState, NgramLm, NgramLmStateCost
+from icefall import (
+    ContextGraph,
+    ContextState,
+    CsrNgramLm,
+    CsrNgramLmStateCost,
+    FrozenContextGraph,
+    NgramLm,
+    NgramLmStateCost,
+)
 from icefall.decode import Nbest, one_best_decoding
 from icefall.lm_wrapper import LmScorer
 from icefall.rnn_lm.model import RnnLmModel
@@ -804,10 +813,10 @@ class Hypothesis:
     state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
 
     # N-gram LM state
-    state_cost: Optional[NgramLmStateCost] = None
+    state_cost: Optional[Union[NgramLmStateCost, CsrNgramLmStateCost]] = None
 
     # Context graph state
-    context_state: Optional[ContextState] = None
+    context_state: Optional[Union[ContextState, int]] = None
 
     num_tailing_blanks: int = 0
 
@@ -959,6 +968,102 @@ def get_hyps_shape(hyps: List[HypothesisList]) -> k2.RaggedShape:
     return ans
 
 
+class DecoderOutCache(object):
+    """An LRU cache of the projected decoder output, i.e.,
+    `model.joiner.decoder_proj(model.decoder(...))`, keyed by the last
+    `context_size` tokens of a hypothesis.
+
+    The stateless decoder depends only on the last `context_size` tokens,
+    so hypotheses ending in the same tokens share the same decoder output.
+    Since most hypotheses do not change between two frames (blank steps),
+    the decoder is run only on contexts that are not in the cache.
+
+    Caution:
+      The cached values are only valid for the model the cache is created
+      with. The model should be in eval mode and must not change.
+    """
+
+    def __init__(self, model: nn.Module, max_size: int = 10000) -> None:
+        """
+        Args:
+          model:
+            The transducer model.
+          max_size:
+            Maximum number of contexts kept in the cache. If it is exceeded,
+            the least recently used contexts are evicted.
+        """
+        assert max_size > 0, max_size
+        self.model = model
+        self.max_size = max_size
+        self._data: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    def __call__(self, contexts: List[List[int]]) -> torch.Tensor:
+        """Return the projected decoder output of the given contexts.
+
+        Args:
+          contexts:
+            A list of contexts. Each one contains `context_size` tokens.
+        Returns:
+          Return a tensor of shape (len(contexts), 1, joiner_dim).
+        """
+        keys = [tuple(c) for c in contexts]
+
+        missing = []
+        missing_set = set()
+        for key in keys:
+            if key in self._data:
+                self._data.move_to_end(key)
+            elif key not in missing_set:
+                missing.append(key)
+                missing_set.add(key)
+
+        self.num_lookups += len(keys)
+        self.num_hits += len(keys) - len(missing)
+
+        if missing:
+            device = next(self.model.parameters()).device
+            decoder_input = torch.tensor(missing, device=device, dtype=torch.int64)
+            decoder_out = self.model.decoder(decoder_input, need_pad=False)
+            decoder_out = self.model.joiner.decoder_proj(decoder_out)
+            # decoder_out is of shape (len(missing), 1, joiner_dim).
+            # Clone the rows so that a cached row does not keep the whole
+            # batch alive after the other rows are evicted.
+            for key, out in zip(missing, decoder_out):
+                self._data[key] = out.clone()
+
+        ans = torch.stack([self._data[key] for key in keys])
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+        return ans
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the fraction of lookups that do not run the decoder."""
+        if self.num_lookups == 0:
+            return 0.0
+        return self.num_hits / self.num_lookups
+
+    def clear(self) -> None:
+        """Remove all cached contexts and reset the statistics."""
+        self._data.clear()
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __str__(self) -> str:
+        return (
+            f"DecoderOutCache(size={len(self)}, max_size={self.max_size}, "
+            f"lookups={self.num_lookups}, hit_rate={self.hit_rate:.4f})"
+        )
+
+
 def keywords_search(
     model: nn.Module,
     encoder_out: torch.Tensor,
@@ -1198,11 +1303,12 @@ def modified_beam_search(
     model: nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
     beam: int = 4,
     temperature: float = 1.0,
     blank_penalty: float = 0.0,
     return_timestamps: bool = False,
+    decoder_out_cache: Optional[DecoderOutCache] = None,
 ) -> Union[List[List[int]], DecodingResults]:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -1214,12 +1320,18 @@ def modified_beam_search(
       encoder_out_lens:
         A 1-D tensor of shape (N,), containing number of valid frames in
         encoder_out before padding.
+      context_graph:
+        Optional. A ContextGraph or FrozenContextGraph for contextual biasing.
+        The states of a FrozenContextGraph are advanced in batches.
       beam:
         Number of active paths during the beam search.
       temperature:
         Softmax temperature.
       return_timestamps:
         Whether to return timestamps.
+      decoder_out_cache:
+        If not None, the decoder output is looked up in this cache and the
+        decoder is only run on contexts that are not in it.
     Returns:
       If return_timestamps is False, return the decoded result.
       Else, return a DecodingResults object containing
@@ -1281,16 +1393,20 @@ def modified_beam_search(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )  # (num_hyps, 1)
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
+        if decoder_out_cache is not None:
+            decoder_out = decoder_out_cache(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps]
+            ).unsqueeze(1)
+        else:
+            decoder_input = torch.tensor(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+            decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
         # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
-
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
         # as index, so we use `to(torch.int64)` below.
         current_encoder_out = torch.index_select(
@@ -1324,13 +1440,39 @@ def modified_beam_search(
         )
         ragged_log_probs = k2.RaggedTensor(shape=log_probs_shape, value=log_probs)
 
+        topk = []
         for i in range(batch_size):
-            topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
+            # There may be fewer than `beam` candidates, e.g., at the first
+            # frame if beam > vocab_size
+            candidates = ragged_log_probs[i]
+            topk_log_probs, topk_indexes = candidates.topk(
+                min(beam, candidates.numel())
+            )
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
                 topk_token_indexes = (topk_indexes % vocab_size).tolist()
+            topk.append((topk_log_probs, topk_hyp_indexes, topk_token_indexes))
+
+        if isinstance(context_graph, FrozenContextGraph):
+            # Advance the context states of all the non-blank tokens at once
+            context_states = []
+            context_tokens = []
+            for i, (_, topk_hyp_indexes, topk_token_indexes) in enumerate(topk):
+                for hyp_idx, new_token in zip(topk_hyp_indexes, topk_token_indexes):
+                    if new_token not in (blank_id, unk_id):
+                        context_states.append(A[i][hyp_idx].context_state)
+                        context_tokens.append(new_token)
+            context_scores, context_states, _ = context_graph.forward(
+                context_states, context_tokens
+            )
+            context_scores = context_scores.tolist()
+            context_states = context_states.tolist()
+        count = 0  # index into context_scores and context_states
+
+        for i in range(batch_size):
+            topk_log_probs, topk_hyp_indexes, topk_token_indexes = topk[i]
 
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
@@ -1343,10 +1485,15 @@ def modified_beam_search(
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
                     new_timestamp.append(t)
-                    if context_graph is not None:
+                    if isinstance(context_graph, FrozenContextGraph):
+                        context_score = context_scores[count]
+                        new_context_state = context_states[count]
+                        count += 1
+                    elif context_graph is not None:
                         (
                             context_score,
                             new_context_state,
+                            _,
                         ) = context_graph.forward_one_step(hyp.context_state, new_token)
 
                 new_log_prob = topk_log_probs[k] + context_score
@@ -1400,6 +1547,233 @@ def modified_beam_search(
         )
 
 
+def modified_beam_search_tensorized(
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    beam: int = 4,
+    temperature: float = 1.0,
+    blank_penalty: float = 0.0,
+    return_timestamps: bool = False,
+) -> Union[List[List[int]], DecodingResults]:
+    """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
+
+    It gives the same results as :func:`modified_beam_search` without
+    context biasing, but it does not create any `Hypothesis` objects.
+    The hypotheses of the whole batch are kept in preallocated tensors
+    of shape (N, beam, ...). Hypotheses with the same token sequence are
+    merged by comparing rolling hashes of their tokens, and the best
+    paths are recovered at the end by following back-pointers.
+
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C).
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      beam:
+        Number of active paths during the beam search.
+      temperature:
+        Softmax temperature.
+      blank_penalty:
+        The score used to penalize blank probability.
+      return_timestamps:
+        Whether to return timestamps.
+    Returns:
+      If return_timestamps is False, return the decoded result.
+      Else, return a DecodingResults object containing
+      decoded result and corresponding timestamps.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens.cpu(),
+        batch_first=True,
+        enforce_sorted=False,
+    )
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+    device = next(model.parameters()).device
+
+    batch_size_list = packed_encoder_out.batch_sizes.tolist()
+    N = encoder_out.size(0)
+    T = len(batch_size_list)
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    assert N == batch_size_list[0], (N, batch_size_list)
+
+    # contexts[n][k] contains the last context_size tokens of the k-th
+    # hypothesis of the n-th utterance
+    contexts = torch.full((N, beam, context_size), -1, dtype=torch.int64, device=device)
+    contexts[:, :, -1] = blank_id
+
+    # Only the first hypothesis of each utterance is active at the beginning.
+    # Inactive hypotheses have a log_prob of -inf.
+    hyp_log_probs = torch.full(
+        (N, beam), float("-inf"), dtype=torch.float32, device=device
+    )
+    hyp_log_probs[:, 0] = 0
+
+    # Number of decoded tokens, i.e., len(hyp.ys) - context_size
+    hyp_lens = torch.zeros(N, beam, dtype=torch.int64, device=device)
+
+    # Two independent rolling hashes of the decoded tokens. Two hypotheses
+    # are considered to be the same if they have the same length and hashes.
+    hyp_hashes = torch.zeros(N, beam, 2, dtype=torch.int64, device=device)
+    hash_bases = torch.tensor([1000003, 999983], dtype=torch.int64, device=device)
+    hash_modulus = 2147483647
+
+    # back_pointers[t][n][k] is the index of the hypothesis at frame t-1
+    # that the k-th hypothesis of the n-th utterance at frame t extends,
+    # and emitted_tokens[t][n][k] is the token it appends at frame t,
+    # or -1 if it appends nothing.
+    back_pointers = torch.zeros(T, N, beam, dtype=torch.int64, device=device)
+    emitted_tokens = torch.full((T, N, beam), -1, dtype=torch.int64, device=device)
+
+    # is_earlier[i][j] is True if j < i
+    is_earlier = torch.ones(beam, beam, dtype=torch.bool, device=device).tril(-1)
+
+    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+
+    offset = 0
+    for t, batch_size in enumerate(batch_size_list):
+        start = offset
+        end = offset + batch_size
+        current_encoder_out = encoder_out.data[start:end]
+        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
+        # current_encoder_out's shape is (batch_size, 1, 1, encoder_out_dim)
+        offset = end
+
+        decoder_input = contexts[:batch_size].reshape(-1, context_size)
+        # (batch_size * beam, context_size)
+
+        decoder_out = model.decoder(decoder_input, need_pad=False)
+        decoder_out = model.joiner.decoder_proj(decoder_out)
+        decoder_out = decoder_out.reshape(batch_size, beam, 1, -1)
+        # decoder_out is of shape (batch_size, beam, 1, joiner_dim)
+
+        logits = model.joiner(
+            current_encoder_out,
+            decoder_out,
+            project_input=False,
+        )  # (batch_size, beam, 1, vocab_size)
+
+        logits = logits.squeeze(2)  # (batch_size, beam, vocab_size)
+
+        if blank_penalty != 0:
+            logits[:, :, 0] -= blank_penalty
+
+        log_probs = (logits / temperature).log_softmax(dim=-1)
+
+        log_probs.add_(hyp_log_probs[:batch_size].unsqueeze(-1))
+
+        vocab_size = log_probs.size(-1)
+
+        # topk_log_probs is sorted in descending order
+        topk_log_probs, topk_indexes = log_probs.reshape(batch_size, -1).topk(beam)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            topk_hyp_indexes = topk_indexes // vocab_size
+            topk_token_indexes = topk_indexes % vocab_size
+        # (batch_size, beam)
+
+        emitted = (topk_token_indexes != blank_id) & (topk_token_indexes != unk_id)
+
+        prev_hashes = torch.gather(
+            hyp_hashes[:batch_size],
+            dim=1,
+            index=topk_hyp_indexes.unsqueeze(-1).expand(-1, -1, 2),
+        )
+        new_hashes = (
+            prev_hashes * hash_bases + topk_token_indexes.unsqueeze(-1) + 1
+        ) % hash_modulus
+        new_hashes = torch.where(emitted.unsqueeze(-1), new_hashes, prev_hashes)
+
+        new_lens = torch.gather(hyp_lens[:batch_size], dim=1, index=topk_hyp_indexes)
+        new_lens += emitted
+
+        # same[n][i][j] is True if the i-th and the j-th new hypotheses
+        # of the n-th utterance have the same tokens
+        is_valid = topk_log_probs > float("-inf")
+        same = (new_hashes.unsqueeze(2) == new_hashes.unsqueeze(1)).all(dim=-1)
+        same &= new_lens.unsqueeze(2) == new_lens.unsqueeze(1)
+        same &= is_valid.unsqueeze(2) & is_valid.unsqueeze(1)
+
+        # Like HypothesisList.add(), the first one (i.e., the most probable
+        # one) of the same hypotheses is kept, and its log_prob is the
+        # log-sum-exp of all of them. The others are deactivated.
+        is_duplicate = (same & is_earlier).any(dim=-1)
+        new_log_probs = (
+            topk_log_probs.unsqueeze(1)
+            .expand(-1, beam, -1)
+            .masked_fill(~same, float("-inf"))
+            .logsumexp(dim=-1)
+        )
+        new_log_probs.masked_fill_(is_duplicate, float("-inf"))
+
+        prev_contexts = torch.gather(
+            contexts[:batch_size],
+            dim=1,
+            index=topk_hyp_indexes.unsqueeze(-1).expand(-1, -1, context_size),
+        )
+        new_contexts = torch.cat(
+            [prev_contexts[:, :, 1:], topk_token_indexes.unsqueeze(-1)], dim=-1
+        )
+
+        contexts[:batch_size] = torch.where(
+            emitted.unsqueeze(-1), new_contexts, prev_contexts
+        )
+        hyp_log_probs[:batch_size] = new_log_probs
+        hyp_lens[:batch_size] = new_lens
+        hyp_hashes[:batch_size] = new_hashes
+        back_pointers[t, :batch_size] = topk_hyp_indexes
+        emitted_tokens[t, :batch_size] = topk_token_indexes.masked_fill(~emitted, -1)
+
+    # See HypothesisList.get_most_probable(length_norm=True)
+    best_hyp_indexes = (hyp_log_probs / (hyp_lens + context_size)).argmax(dim=1)
+
+    # Number of frames of each utterance in the sorted order
+    sorted_lens = encoder_out_lens.to(device)[
+        packed_encoder_out.sorted_indices.to(device)
+    ]
+
+    # Follow the back-pointers from the last frame of each utterance.
+    # Frames after the end of an utterance contain no emitted tokens.
+    utt_indexes = torch.arange(N, device=device)
+    best_tokens = torch.full((T, N), -1, dtype=torch.int64, device=device)
+    k = best_hyp_indexes
+    for t in range(T - 1, -1, -1):
+        best_tokens[t] = emitted_tokens[t, utt_indexes, k]
+        k = torch.where(t < sorted_lens, back_pointers[t, utt_indexes, k], k)
+
+    sorted_ans = []
+    sorted_timestamps = []
+    for tokens in best_tokens.t().tolist():
+        sorted_ans.append([token for token in tokens if token >= 0])
+        sorted_timestamps.append([t for t, token in enumerate(tokens) if token >= 0])
+
+    ans = []
+    ans_timestamps = []
+    unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
+    for i in range(N):
+        ans.append(sorted_ans[unsorted_indices[i]])
+        ans_timestamps.append(sorted_timestamps[unsorted_indices[i]])
+
+    if not return_timestamps:
+        return ans
+    else:
+        return DecodingResults(
+            hyps=ans,
+            timestamps=ans_timestamps,
+        )
+
+
 def modified_beam_search_lm_rescore(
     model: nn.Module,
     encoder_out: torch.Tensor,
@@ -2626,7 +3000,7 @@ def modified_beam_search_LODR(
     model: nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
-    LODR_lm: NgramLm,
+    LODR_lm: Union[NgramLm, CsrNgramLm],
     LODR_lm_scale: float,
     LM: LmScorer,
     beam: int = 4,
@@ -2647,7 +3021,9 @@ def modified_beam_search_LODR(
             A 1-D tensor of shape (N,), containing the number of
             valid frames in encoder_out before padding.
         LODR_lm:
-            A low order n-gram LM, whose score will be subtracted during shallow fusion
+            A low order n-gram LM, whose score will be subtracted during shallow fusion.
+            If it is a CsrNgramLm, the n-gram states of all hypotheses are
+            advanced with one batched call per frame.
         LODR_lm_scale:
             The scale of the LODR_lm
         LM:
@@ -2696,8 +3072,10 @@ def modified_beam_search_LODR(
                 log_prob=torch.zeros(1, dtype=torch.float32, device=device),
                 state=init_states,  # state of the NN LM
                 lm_score=init_score.reshape(-1),
-                state_cost=NgramLmStateCost(
-                    LODR_lm
+                state_cost=(
+                    CsrNgramLmStateCost(LODR_lm)
+                    if isinstance(LODR_lm, CsrNgramLm)
+                    else NgramLmStateCost(LODR_lm)
                 ),  # state of the source domain ngram
                 context_state=None if context_graph is None else context_graph.root,
             )
@@ -2775,6 +3153,8 @@ def modified_beam_search_LODR(
         token_list = []
         hs = []
         cs = []
+        ngram_states = []
+        ngram_tokens = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -2788,6 +3168,8 @@ def modified_beam_search_LODR(
 
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
+                    ngram_states.append(hyp.state_cost)
+                    ngram_tokens.append(new_token)
                     if LM.lm_type == "rnn":
                         token_list.append([new_token])
                         # store the LSTM states
@@ -2824,6 +3206,12 @@ def modified_beam_search_LODR(
 
             scores, lm_states = LM.score_token(tokens_to_score, x_lens, state)
 
+        if isinstance(LODR_lm, CsrNgramLm) and len(ngram_tokens) != 0:
+            # advance the n-gram states of all new non-blank tokens at once
+            ngram_states = CsrNgramLmStateCost.cat(ngram_states).forward(ngram_tokens)
+        else:
+            ngram_states = None
+
         count = 0  # index, used to locate score and lm states
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
@@ -2853,10 +3241,14 @@ def modified_beam_search_LODR(
                         (
                             context_score,
                             new_context_state,
+                            _,
                         ) = context_graph.forward_one_step(hyp.context_state, new_token)
 
                     ys.append(new_token)
-                    state_cost = hyp.state_cost.forward_one_step(new_token)
+                    if ngram_states is not None:
+                        state_cost = ngram_states[count]
+                    else:
+                        state_cost = hyp.state_cost.forward_one_step(new_token)
 
                     # calculate the score of the latest token
                     current_ngram_score = state_cost.lm_score - hyp.state_cost.lm_score
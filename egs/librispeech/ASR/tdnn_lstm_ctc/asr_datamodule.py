@@ -21,7 +21,7 @@ import inspect
 import logging
 from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import torch
 from lhotse import CutSet, Fbank, FbankConfig, load_manifest, load_manifest_lazy
@@ -41,6 +41,8 @@ from lhotse.dataset.input_strategies import (  # noqa F401 For AudioSamples
 from lhotse.utils import fix_random_seed
 from torch.utils.data import DataLoader
 
+from icefall.batch_tuner import BucketedDynamicBucketingSampler
+from icefall.feature_store import FeatureStoreInput
 from icefall.utils import str2bool
 
 
@@ -183,6 +185,32 @@ class LibriSpeechAsrDataModule:
             "collect the batches.",
         )
 
+        group.add_argument(
+            "--persistent-workers",
+            type=str2bool,
+            default=True,
+            help="When enabled, the training dataloader workers are kept "
+            "alive across epochs instead of being restarted.",
+        )
+
+        group.add_argument(
+            "--prefetch-factor",
+            type=int,
+            default=4,
+            help="Number of batches loaded in advance by each training "
+            "dataloader worker.",
+        )
+
+        group.add_argument(
+            "--feature-store-dir",
+            type=Path,
+            default=None,
+            help="If given, the training features are read from this feature "
+            "store, built by ./local/build_feature_store.py, instead of from "
+            "the storage of each cut. Cuts not in the store, e.g., cuts "
+            "mixed with MUSAN noise, are still read from their own storage.",
+        )
+
         group.add_argument(
             "--enable-spec-aug",
             type=str2bool,
@@ -219,6 +247,8 @@ class LibriSpeechAsrDataModule:
         self,
         cuts_train: CutSet,
         sampler_state_dict: Optional[Dict[str, Any]] = None,
+        duration_bins: Optional[List[float]] = None,
+        max_durations: Optional[List[float]] = None,
     ) -> DataLoader:
         """
         Args:
@@ -226,6 +256,12 @@ class LibriSpeechAsrDataModule:
             CutSet for training.
           sampler_state_dict:
             The state dict for the training sampler.
+          duration_bins:
+            If not None, the duration bins of the bucketing sampler.
+          max_durations:
+            If not None, the maximum duration of the batches of each of the
+            ``len(duration_bins) + 1`` buckets, which replaces
+            --max-duration. See icefall/batch_tuner.py.
         """
         transforms = []
         if self.args.enable_musan:
@@ -278,9 +314,15 @@ class LibriSpeechAsrDataModule:
         else:
             logging.info("Disable SpecAugment")
 
+        if self.args.feature_store_dir is not None:
+            logging.info(f"Using feature store {self.args.feature_store_dir}")
+            input_strategy = FeatureStoreInput(self.args.feature_store_dir)
+        else:
+            input_strategy = eval(self.args.input_strategy)()
+
         logging.info("About to create train dataset")
         train = K2SpeechRecognitionDataset(
-            input_strategy=eval(self.args.input_strategy)(),
+            input_strategy=input_strategy,
             cut_transforms=transforms,
             input_transforms=input_transforms,
             return_cuts=self.args.return_cuts,
@@ -304,7 +346,18 @@ class LibriSpeechAsrDataModule:
                 return_cuts=self.args.return_cuts,
             )
 
-        if self.args.bucketing_sampler:
+        if self.args.bucketing_sampler and max_durations is not None:
+            logging.info("Using DynamicBucketingSampler with per-bucket durations.")
+            train_sampler = BucketedDynamicBucketingSampler(
+                cuts_train,
+                duration_bins=duration_bins,
+                max_durations=max_durations,
+                shuffle=self.args.shuffle,
+                buffer_size=self.args.num_buckets * 2000,
+                shuffle_buffer_size=self.args.num_buckets * 5000,
+                drop_last=self.args.drop_last,
+            )
+        elif self.args.bucketing_sampler:
             logging.info("Using DynamicBucketingSampler.")
             train_sampler = DynamicBucketingSampler(
                 cuts_train,
@@ -333,13 +386,23 @@ class LibriSpeechAsrDataModule:
         seed = torch.randint(0, 100000, ()).item()
         worker_init_fn = _SeedWorkers(seed)
 
+        if self.args.num_workers > 0:
+            # Workers keep their memory-mapped files and random state
+            # across epochs.
+            prefetch_kwargs = dict(
+                persistent_workers=self.args.persistent_workers,
+                prefetch_factor=self.args.prefetch_factor,
+            )
+        else:
+            prefetch_kwargs = dict()
+
         train_dl = DataLoader(
             train,
             sampler=train_sampler,
             batch_size=None,
             num_workers=self.args.num_workers,
-            persistent_workers=False,
             worker_init_fn=worker_init_fn,
+            **prefetch_kwargs,
         )
 
         return train_dl
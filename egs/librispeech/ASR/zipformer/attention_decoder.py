@@ -17,7 +17,7 @@
 
 
 import math
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import k2
 import torch
@@ -157,6 +157,225 @@ class AttentionDecoderModel(nn.Module):
         nll = nll.view(batch_size, -1)
         return nll
 
+    def nll_shared(
+        self,
+        encoder_out: torch.Tensor,
+        encoder_out_lens: torch.Tensor,
+        token_ids: List[List[int]],
+        path_to_utt_map: torch.Tensor,
+        memory_budget: int = 2**30,
+        max_tree_nodes: int = 256,
+    ) -> torch.Tensor:
+        """Compute the negative log likelihood of n-best paths, the same as
+        `self.nll(...).sum(dim=1)` on an encoder output expanded to one row
+        per path, without expanding it.
+
+        The keys and values of the cross-attention are computed once per
+        utterance. The paths of an utterance are put in prefix trees, in which
+        each token of a common prefix is computed only once, and the trees are
+        decoded in batches whose estimated memory use is below
+        `memory_budget`. Since the self-attention of a tree is over all of its
+        nodes, trees are also limited to `max_tree_nodes` nodes.
+
+        Args:
+          encoder_out: (batch, num_frames, encoder_dim)
+          encoder_out_lens: (batch,)
+          token_ids: A list of token id list, one per path.
+          path_to_utt_map: (num_paths,), the utterance of each path.
+          memory_budget: Memory, in bytes, that the decoding of a batch of
+            prefix trees may use.
+          max_tree_nodes: The maximum number of nodes of a prefix tree, unless
+            it has a single path.
+
+        Return: A tensor of shape (num_paths,).
+        """
+        assert len(token_ids) == path_to_utt_map.numel(), (
+            len(token_ids),
+            path_to_utt_map.shape,
+        )
+        device = encoder_out.device
+        src_len = encoder_out.size(1)
+        num_paths = len(token_ids)
+
+        memory_kv = self.decoder.memory_kv(encoder_out)
+        memory_mask = make_pad_mask(encoder_out_lens, max_len=src_len)
+
+        utt_to_paths: Dict[int, List[int]] = dict()
+        for i, utt in enumerate(path_to_utt_map.tolist()):
+            utt_to_paths.setdefault(utt, []).append(i)
+
+        # Sort the paths of each utterance, so that paths with a common prefix
+        # are in the same tree when an utterance is split into several trees.
+        trees = []
+        for utt, paths in utt_to_paths.items():
+            tree = _PrefixTree(utt, self.sos_id)
+            for i in sorted(paths, key=lambda i: token_ids[i]):
+                num_nodes = tree.num_nodes + tree.num_new_nodes(token_ids[i])
+                if tree.num_paths > 0 and (
+                    num_nodes > max_tree_nodes
+                    or self._tree_bytes(num_nodes, src_len) > memory_budget
+                ):
+                    trees.append(tree)
+                    tree = _PrefixTree(utt, self.sos_id)
+                tree.add(i, token_ids[i], self.eos_id)
+            trees.append(tree)
+
+        nll = torch.zeros(num_paths, dtype=encoder_out.dtype, device=device)
+
+        start = 0
+        while start < len(trees):
+            end = start + 1
+            num_nodes = trees[start].num_nodes
+            while end < len(trees):
+                n = max(num_nodes, trees[end].num_nodes)
+                if (end - start + 1) * self._tree_bytes(n, src_len) > memory_budget:
+                    break
+                num_nodes = n
+                end += 1
+            self._tree_nll(trees[start:end], num_nodes, memory_kv, memory_mask, nll)
+            start = end
+
+        return nll
+
+    def _tree_bytes(self, num_nodes: int, src_len: int) -> int:
+        """Estimate the memory used to decode a prefix tree with `num_nodes`
+        nodes, including its copy of the cross-attention keys and values."""
+        layer = self.decoder.layers[0]
+        num_heads = layer.self_attn.num_heads
+        attention_dim = layer.self_attn.attention_dim
+        feedforward_dim = layer.feed_forward[0].out_features
+        d_model = self.decoder.embed.embedding_dim
+        vocab_size = self.decoder.output_layer.out_features
+
+        # attention weights, output logits and other activations of a node
+        node_size = num_heads * (num_nodes + src_len)
+        node_size += vocab_size + feedforward_dim + 8 * d_model
+        kv_size = 2 * self.decoder.num_layers * src_len * attention_dim
+        return 4 * (num_nodes * node_size + kv_size) + num_nodes * num_nodes
+
+    def _tree_nll(
+        self,
+        trees: List["_PrefixTree"],
+        num_nodes: int,
+        memory_kv: List[Tuple[torch.Tensor, torch.Tensor]],
+        memory_mask: torch.Tensor,
+        nll: torch.Tensor,
+    ) -> None:
+        """Decode a batch of prefix trees and add the negative log likelihood
+        of their paths to `nll`."""
+        device = nll.device
+        batch_size = len(trees)
+
+        tokens = torch.full((batch_size, num_nodes), self.eos_id, dtype=torch.int64)
+        pos = torch.zeros((batch_size, num_nodes), dtype=torch.int64)
+        # Padding nodes are their own parents, so that they attend to
+        # themselves only.
+        parents = torch.arange(num_nodes).repeat(batch_size, 1)
+        for i, tree in enumerate(trees):
+            n = tree.num_nodes
+            tokens[i, :n] = torch.tensor(tree.tokens)
+            pos[i, :n] = torch.tensor(tree.depths)
+            parents[i, :n] = torch.tensor(tree.parents)
+        tokens = tokens.to(device)
+        pos = pos.to(device)
+        parents = parents.to(device)
+
+        # A node attends to itself and to its ancestors
+        max_depth = max(max(tree.depths) for tree in trees)
+        ancestors = torch.zeros(
+            (batch_size, num_nodes, num_nodes), dtype=torch.bool, device=device
+        )
+        cur = torch.arange(num_nodes, device=device).repeat(batch_size, 1)
+        for _ in range(max_depth + 1):
+            ancestors.scatter_(2, cur.unsqueeze(2), True)
+            cur = parents.gather(1, cur)
+        attn_mask = ~ancestors
+
+        utts = torch.tensor([tree.utt for tree in trees], device=device)
+        kv = [(k.index_select(0, utts), v.index_select(0, utts)) for k, v in memory_kv]
+        memory_attn_mask = memory_mask.index_select(0, utts).unsqueeze(1)
+
+        logits = self.decoder.forward_with_memory_kv(
+            x=tokens,
+            pos=pos,
+            attn_mask=attn_mask,
+            memory_kv=kv,
+            memory_attn_mask=memory_attn_mask,
+        )
+        log_probs = logits.log_softmax(dim=-1)
+
+        rows, nodes, targets, paths = [], [], [], []
+        for i, tree in enumerate(trees):
+            rows += [i] * len(tree.target_nodes)
+            nodes += tree.target_nodes
+            targets += tree.targets
+            paths += tree.target_paths
+        rows = torch.tensor(rows, device=device)
+        nodes = torch.tensor(nodes, device=device)
+        targets = torch.tensor(targets, device=device)
+        paths = torch.tensor(paths, device=device)
+
+        scores = log_probs[rows, nodes, targets]
+        nll.index_add_(0, paths, -scores.to(nll.dtype))
+
+
+class _PrefixTree(object):
+    """The paths of an utterance, with common prefixes merged.
+
+    Node 0 is the SOS node. Every other node is a token of a path, and its
+    input is the token and its position is its depth in the tree. The log
+    likelihood of a path is the sum of the log probabilities of its tokens,
+    predicted at the parent nodes, and of EOS, predicted at its last node.
+    """
+
+    def __init__(self, utt: int, sos_id: int):
+        self.utt = utt
+        self.tokens = [sos_id]
+        self.parents = [0]
+        self.depths = [0]
+        self.children: List[Dict[int, int]] = [dict()]
+        self.num_paths = 0
+
+        # The (node, target, path) triples to score
+        self.target_nodes: List[int] = []
+        self.targets: List[int] = []
+        self.target_paths: List[int] = []
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.tokens)
+
+    def num_new_nodes(self, token_ids: List[int]) -> int:
+        """Return the number of nodes that adding `token_ids` would create."""
+        node = 0
+        for i, t in enumerate(token_ids):
+            if t not in self.children[node]:
+                return len(token_ids) - i
+            node = self.children[node][t]
+        return 0
+
+    def add(self, path: int, token_ids: List[int], eos_id: int) -> None:
+        node = 0
+        for t in token_ids:
+            self.target_nodes.append(node)
+            self.targets.append(t)
+            self.target_paths.append(path)
+
+            child = self.children[node].get(t)
+            if child is None:
+                child = self.num_nodes
+                self.children[node][t] = child
+                self.tokens.append(t)
+                self.parents.append(node)
+                self.depths.append(self.depths[node] + 1)
+                self.children.append(dict())
+            node = child
+
+        self.target_nodes.append(node)
+        self.targets.append(eos_id)
+        self.target_paths.append(path)
+        self.num_paths += 1
+
 
 class TransformerDecoder(nn.Module):
     """Transfomer decoder module.
@@ -260,6 +479,64 @@ class TransformerDecoder(nn.Module):
 
         return x
 
+    def memory_kv(
+        self, memory: torch.Tensor
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Compute the keys and values of the cross-attention of each layer.
+
+        Args:
+          memory:
+            Memory sequence of shape (batch, src_len, memory_dim).
+
+        Returns:
+          A list with the (key, value) pair of each layer, see
+          :meth:`MultiHeadAttention.project_kv`.
+        """
+        memory = memory.permute(1, 0, 2)  # (src_len, batch, memory_dim)
+        return [mod.src_attn.project_kv(memory, memory) for mod in self.layers]
+
+    def forward_with_memory_kv(
+        self,
+        x: torch.Tensor,
+        pos: torch.Tensor,
+        attn_mask: torch.Tensor,
+        memory_kv: List[Tuple[torch.Tensor, torch.Tensor]],
+        memory_attn_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """Like :meth:`forward`, but with the positions and the self-attention
+        mask given explicitly and with precomputed cross-attention keys and
+        values, e.g., to decode prefix trees of tokens.
+
+        Args:
+          x: Input tensor of shape (batch, tgt_len).
+          pos: The position of each token, of shape (batch, tgt_len).
+          attn_mask: A binary mask of shape (batch, tgt_len, tgt_len), True for
+            the tokens that a token does not attend to.
+          memory_kv: The output of :meth:`memory_kv`.
+          memory_attn_mask: A binary mask of shape (batch, 1, src_len), True for
+            the padding frames of the memory.
+
+        Returns:
+            Decoded token logits before softmax (batch, tgt_len, vocab_size)
+        """
+        x = self.embed(x)  # (batch, tgt_len, embed_dim)
+        x = self.pos(x, pos=pos)  # (batch, tgt_len, embed_dim)
+
+        x = x.permute(1, 0, 2)  # (tgt_len, batch, embed_dim)
+
+        for i, mod in enumerate(self.layers):
+            x = mod(
+                x,
+                attn_mask=attn_mask,
+                memory_attn_mask=memory_attn_mask,
+                memory_kv=memory_kv[i],
+            )
+
+        x = x.permute(1, 0, 2)  # (batch, tgt_len, vocab_size)
+        x = self.output_layer(x)
+
+        return x
+
 
 class DecoderLayer(nn.Module):
     """Single decoder layer module.
@@ -310,6 +587,7 @@ class DecoderLayer(nn.Module):
         attn_mask: Optional[torch.Tensor] = None,
         memory: Optional[torch.Tensor] = None,
         memory_attn_mask: Optional[torch.Tensor] = None,
+        memory_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -321,6 +599,8 @@ class DecoderLayer(nn.Module):
             memory_attn_mask: A binary mask for cross-attention module indicating which
                 elements will be filled with -inf.
                 Its shape is (batch, 1, src_len) or (batch, tgt_len, src_len).
+            memory_kv: Optional keys and values of the cross-attention module
+                computed from the memory, used instead of `memory`.
         """
         # self-attn module
         qkv = self.norm_self_attn(x)
@@ -332,7 +612,11 @@ class DecoderLayer(nn.Module):
         # cross-attn module
         q = self.norm_src_attn(x)
         src_attn_out = self.src_attn(
-            query=q, key=memory, value=memory, attn_mask=memory_attn_mask
+            query=q,
+            key=memory,
+            value=memory,
+            attn_mask=memory_attn_mask,
+            kv=memory_kv,
         )
         x = x + self.dropout(src_attn_out)
 
@@ -384,13 +668,40 @@ class MultiHeadAttention(nn.Module):
 
         self.out_proj = nn.Linear(attention_dim, embed_dim, bias=True)
 
+    def project_kv(
+        self, key: torch.Tensor, value: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compute the keys and values of the attention.
+
+        Args:
+            key: Key tensor of shape (src_len, batch, embed_dim or memory_dim).
+            value: Value tensor of shape (src_len, batch, embed_dim or memory_dim).
+
+        Returns:
+            Return a tuple (k, v), with k of shape (batch, head, head_dim, src_len)
+            and v of shape (batch, head, src_len, head_dim).
+        """
+        num_heads = self.num_heads
+        head_dim = self.head_dim
+        src_len, batch, _ = key.shape
+
+        k = self.linear_k(key)  # (src_len, batch, num_heads * head_dim)
+        v = self.linear_v(value)  # (src_len, batch, num_heads * head_dim)
+
+        k = k.reshape(src_len, batch, num_heads, head_dim)
+        k = k.permute(1, 2, 3, 0)  # (batch, head, head_dim, src_len)
+        v = v.reshape(src_len, batch, num_heads, head_dim)
+        v = v.permute(1, 2, 0, 3)  # (batch, head, src_len, head_dim)
+        return k, v
+
     def forward(
         self,
         query: torch.Tensor,
-        key: torch.Tensor,
-        value: torch.Tensor,
+        key: Optional[torch.Tensor],
+        value: Optional[torch.Tensor],
         key_padding_mask: Optional[torch.Tensor] = None,
         attn_mask: Optional[torch.Tensor] = None,
+        kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> torch.Tensor:
         """Compute dot product attention.
 
@@ -402,6 +713,8 @@ class MultiHeadAttention(nn.Module):
                 Its shape is (batch, src_len).
             attn_mask: A binary mask indicating which elements will be filled with -inf.
                 Its shape is (batch, 1, src_len) or (batch, tgt_len, src_len).
+            kv: Optional keys and values returned by :meth:`project_kv`. If
+                given, `key` and `value` are not used.
 
         Returns:
             Output tensor of shape (tgt_len, batch, embed_dim).
@@ -410,18 +723,16 @@ class MultiHeadAttention(nn.Module):
         head_dim = self.head_dim
 
         tgt_len, batch, _ = query.shape
-        src_len = key.shape[0]
 
         q = self.linear_q(query)  # (tgt_len, batch, num_heads * head_dim)
-        k = self.linear_k(key)  # (src_len, batch, num_heads * head_dim)
-        v = self.linear_v(value)  # (src_len, batch, num_heads * head_dim)
-
         q = q.reshape(tgt_len, batch, num_heads, head_dim)
         q = q.permute(1, 2, 0, 3)  # (batch, head, tgt_len, head_dim)
-        k = k.reshape(src_len, batch, num_heads, head_dim)
-        k = k.permute(1, 2, 3, 0)  # (batch, head, head_dim, src_len)
-        v = v.reshape(src_len, batch, num_heads, head_dim)
-        v = v.reshape(src_len, batch * num_heads, head_dim).transpose(0, 1)
+
+        if kv is None:
+            kv = self.project_kv(key, value)
+        k, v = kv
+        src_len = k.shape[-1]
+        v = v.reshape(batch * num_heads, src_len, head_dim)
 
         # Note: could remove the scaling operation when using ScaledAdam
         # (batch, head, tgt_len, src_len)
@@ -514,17 +825,22 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.pe = pe.to(device=x.device, dtype=x.dtype)
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, pos: Optional[torch.Tensor] = None):
         """Add positional encoding.
 
         Args:
             x (torch.Tensor): Input tensor (batch, time, `*`).
+            pos (torch.Tensor): Optional positions (batch, time) of the inputs.
+                If None, the positions are 0, 1, ..., time - 1.
 
         Returns:
             torch.Tensor: Encoded tensor (batch, time, `*`).
         """
         self.extend_pe(x)
-        x = x * self.xscale + self.pe[:, : x.size(1)]
+        if pos is None:
+            x = x * self.xscale + self.pe[:, : x.size(1)]
+        else:
+            x = x * self.xscale + self.pe[0, pos]
         return self.dropout(x)
 
 
@@ -579,5 +895,55 @@ def _test_attention_decoder_model():
     print(nll)
 
 
+def _test_nll_shared():
+    torch.manual_seed(20240101)
+    m = AttentionDecoderModel(
+        vocab_size=20,
+        decoder_dim=32,
+        num_decoder_layers=2,
+        attention_dim=32,
+        num_heads=4,
+        feedforward_dim=64,
+        memory_dim=24,
+        sos_id=1,
+        eos_id=1,
+    )
+    m.eval()
+
+    encoder_out = torch.randn(3, 30, 24)
+    encoder_out_lens = torch.tensor([30, 17, 25])
+    token_ids = [
+        [2, 3, 4],
+        [5, 6],
+        [2, 3, 5, 7],
+        [2, 3, 4],
+        [],
+        [8],
+        [9, 10, 11, 12, 13],
+        [9, 10],
+    ]
+    path_to_utt_map = torch.tensor([0, 1, 0, 0, 1, 1, 2, 2])
+
+    with torch.no_grad():
+        expected = m.nll(
+            encoder_out.index_select(0, path_to_utt_map),
+            encoder_out_lens.index_select(0, path_to_utt_map),
+            token_ids,
+        ).sum(dim=1)
+
+        # A large budget puts all trees in one batch; a small one gives a tree
+        # per path.
+        for memory_budget in [2**30, 1]:
+            nll = m.nll_shared(
+                encoder_out,
+                encoder_out_lens,
+                token_ids,
+                path_to_utt_map,
+                memory_budget=memory_budget,
+            )
+            assert torch.allclose(nll, expected, atol=1e-4), (nll, expected)
+
+
 if __name__ == "__main__":
     _test_attention_decoder_model()
+    _test_nll_shared()
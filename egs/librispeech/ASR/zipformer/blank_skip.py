@@ -0,0 +1,199 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Blank skipping for transducer decoding.
+
+The CTC head of the model tells which encoder frames are blank with high
+confidence. Those frames are removed from the encoder output before the
+transducer search, so the joiner, and the decoder, run only on the rest.
+This is the decoding counterpart of ../pruned_transducer_stateless7_ctc_bs,
+where the frames are also removed in training.
+
+:func:`skip_blank_frames` works on a batch of utterances or on a chunk of
+streams. It also returns the index of each kept frame in the input, so that
+timestamps of the search can be mapped back with :func:`remap_timestamps`.
+"""
+
+import math
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+
+from icefall.utils import make_pad_mask
+
+
+def skip_blank_frames(
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    ctc_output: torch.Tensor,
+    threshold: float,
+    blank_id: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Remove the frames whose CTC blank probability is larger than
+    `threshold`. At least one frame, the one with the smallest blank
+    probability, is kept for each sequence.
+
+    Args:
+      encoder_out:
+        The encoder output of shape (N, T, C).
+      encoder_out_lens:
+        A tensor of shape (N,) with the number of frames of each sequence
+        before padding.
+      ctc_output:
+        The CTC log-probs of shape (N, T, vocab_size).
+      threshold:
+        A probability in (0, 1).
+      blank_id:
+        The ID of the blank symbol.
+    Returns:
+      Return a tuple (out, out_lens, frame_index):
+
+        - out, of shape (N, T', C), contains the kept frames in order.
+        - out_lens, of shape (N,), contains the number of kept frames.
+        - frame_index, of shape (N, T'), contains the index in encoder_out of
+          each frame of out. It is -1 for padding frames.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert 0 < threshold < 1, threshold
+    N, T, C = encoder_out.shape
+    device = encoder_out.device
+
+    blank_log_prob = ctc_output[:, :, blank_id]
+    valid = ~make_pad_mask(encoder_out_lens, max_len=T)
+    keep = (blank_log_prob <= math.log(threshold)) & valid
+
+    # Keep the least blank frame, so that no sequence becomes empty
+    least_blank = blank_log_prob.masked_fill(~valid, float("inf")).argmin(dim=1)
+    keep[torch.arange(N, device=device), least_blank] |= encoder_out_lens > 0
+
+    out_lens = keep.sum(dim=1)
+    max_len = int(out_lens.max()) if N > 0 else 0
+
+    # Position of each kept frame in the output
+    dest = keep.cumsum(dim=1) - 1
+    rows, cols = keep.nonzero(as_tuple=True)
+    out = encoder_out.new_zeros(N, max_len, C)
+    out[rows, dest[rows, cols]] = encoder_out[rows, cols]
+    frame_index = torch.full((N, max_len), -1, dtype=torch.int64, device=device)
+    frame_index[rows, dest[rows, cols]] = cols
+
+    return out, out_lens.to(encoder_out_lens.dtype), frame_index
+
+
+def remap_timestamps(
+    timestamps: List[List[int]], frame_index: torch.Tensor, offset: int = 0
+) -> List[List[int]]:
+    """Map timestamps, in frames of the output of :func:`skip_blank_frames`,
+    back to frames of its input.
+
+    Args:
+      timestamps:
+        timestamps[i] contains the frame indexes of the tokens of sequence i,
+        e.g., the timestamps of `DecodingResults`.
+      frame_index:
+        The frame_index returned by :func:`skip_blank_frames`.
+      offset:
+        It is added to the result, e.g., the number of frames decoded
+        before the current chunk in streaming decoding.
+    """
+    frame_index = frame_index.tolist()
+    return [[frame_index[i][t] + offset for t in ts] for i, ts in enumerate(timestamps)]
+
+
+class BlankSkipStats(object):
+    """Statistics to report the trade-off of blank skipping: the fraction of
+    frames kept and the real time factor (RTF) of decoding."""
+
+    def __init__(self) -> None:
+        self.num_frames = 0
+        self.num_kept_frames = 0
+        self.audio_seconds = 0.0
+        self.elapsed_seconds = 0.0
+
+    def add_frames(self, num_frames: torch.Tensor, num_kept_frames: torch.Tensor):
+        """Add the number of frames of each sequence before and after
+        :func:`skip_blank_frames`."""
+        self.num_frames += int(num_frames.sum())
+        self.num_kept_frames += int(num_kept_frames.sum())
+
+    def add_time(self, audio_seconds: float, elapsed_seconds: float) -> None:
+        """Add the duration of the decoded audio and the time it took."""
+        self.audio_seconds += audio_seconds
+        self.elapsed_seconds += elapsed_seconds
+
+    @property
+    def rtf(self) -> float:
+        return self.elapsed_seconds / max(self.audio_seconds, 1e-9)
+
+    @property
+    def kept_ratio(self) -> float:
+        if self.num_frames == 0:
+            return 1.0
+        return self.num_kept_frames / self.num_frames
+
+    def __str__(self) -> str:
+        return (
+            f"RTF: {self.rtf:.4f} ({self.elapsed_seconds:.1f} seconds to decode "
+            f"{self.audio_seconds:.1f} seconds of audio), "
+            f"frames kept by blank skipping: {self.kept_ratio:.2%}"
+        )
+
+    def write(self, filename: Path) -> None:
+        with open(filename, "w") as f:
+            print("RTF\tkept_frames", file=f)
+            print(f"{self.rtf:.4f}\t{self.kept_ratio:.4f}", file=f)
+
+
+def _test_skip_blank_frames():
+    N, T, C, V = 3, 6, 2, 4
+    encoder_out = torch.arange(N * T, dtype=torch.float32).reshape(N, T, 1)
+    encoder_out = encoder_out.expand(N, T, C).contiguous()
+    encoder_out_lens = torch.tensor([6, 4, 3])
+
+    blank_prob = torch.tensor(
+        [
+            [0.99, 0.5, 0.99, 0.2, 0.95, 0.1],
+            [0.99, 0.98, 0.97, 0.96, 0.1, 0.1],  # the last two are padding
+            [0.5, 0.99, 0.3, 0.1, 0.1, 0.1],
+        ]
+    )
+    ctc_output = torch.full((N, T, V), 1e-3).log()
+    ctc_output[:, :, 0] = blank_prob.log()
+
+    out, out_lens, frame_index = skip_blank_frames(
+        encoder_out, encoder_out_lens, ctc_output, threshold=0.9
+    )
+    assert out_lens.tolist() == [3, 1, 2], out_lens
+    assert frame_index.tolist() == [[1, 3, 5], [3, -1, -1], [0, 2, -1]], frame_index
+    for i in range(N):
+        for j in range(out_lens[i]):
+            assert torch.equal(out[i, j], encoder_out[i, frame_index[i, j]])
+
+    assert remap_timestamps([[0, 2], [0], [1]], frame_index, offset=10) == [
+        [11, 15],
+        [13],
+        [12],
+    ]
+
+    stats = BlankSkipStats()
+    stats.add_frames(encoder_out_lens, out_lens)
+    assert stats.kept_ratio == 6 / 13, stats.kept_ratio
+
+
+if __name__ == "__main__":
+    _test_skip_blank_frames()
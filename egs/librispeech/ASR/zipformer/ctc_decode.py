@@ -114,7 +114,7 @@ import math
 import os
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import sentencepiece as spm
@@ -130,11 +130,12 @@ from icefall.checkpoint import (
     find_checkpoints,
     load_checkpoint,
 )
-from icefall.context_graph import ContextGraph, ContextState
+from icefall.context_graph import ContextGraph, ContextState, FrozenContextGraph
 from icefall.decode import (
     ctc_greedy_search,
     ctc_prefix_beam_search,
     ctc_prefix_beam_search_attention_decoder_rescoring,
+    ctc_prefix_beam_search_batch,
     ctc_prefix_beam_search_shallow_fussion,
     get_lattice,
     nbest_decoding,
@@ -145,9 +146,10 @@ from icefall.decode import (
     rescore_with_n_best_list,
     rescore_with_whole_lattice,
 )
+from icefall.graph_cache import GraphCache, get_lm_file
 from icefall.lexicon import Lexicon
 from icefall.lm_wrapper import LmScorer
-from icefall.ngram_lm import NgramLm, NgramLmStateCost
+from icefall.ngram_lm import CsrNgramLm, NgramLm, NgramLmStateCost
 from icefall.utils import (
     AttributeDict,
     get_texts,
@@ -268,6 +270,8 @@ def get_parser():
           the given beam, rescore them with the attention decoder.
         - (12) ctc-prefix-beam-search-shallow-fussion. Use NNLM shallow fussion during
           beam search, LODR and hotwords are also supported in this decoding method.
+        - (13) ctc-prefix-beam-search-batch. Same as ctc-prefix-beam-search, but
+          decodes the whole batch with tensor operations instead of a process pool.
         """,
     )
 
@@ -293,6 +297,20 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--attention-rescoring-memory-budget",
+        type=int,
+        default=1024,
+        help="""Memory, in MB, used to rescore a batch of paths with the
+        attention decoder. The paths of an utterance share its encoder output
+        and their common prefixes, and are rescored in batches within this
+        budget. 0 copies the encoder output for each path and rescores all
+        paths at once, which needs a lot of memory for a large --num-paths.
+        Used only when "method" is one of the attention-decoder rescoring
+        methods.
+        """,
+    )
+
     parser.add_argument(
         "--nnlm-type",
         type=str,
@@ -327,6 +345,18 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--graph-cache-dir",
+        type=str,
+        default="",
+        help="""If not empty, the prepared G_4_gram is cached in this
+        directory, keyed by a hash of the word table and the n-gram LM, so
+        that later runs only need to memory-map it. See icefall/graph_cache.py.
+        HLG.pt is already compiled by local/compile_hlg.py, which has its own
+        --graph-cache-dir option.
+        """,
+    )
+
     parser.add_argument(
         "--backoff-id",
         type=int,
@@ -334,6 +364,15 @@ def get_parser():
         help="ID of the backoff symbol in the ngram LM",
     )
 
+    parser.add_argument(
+        "--use-csr-ngram-lm",
+        type=str2bool,
+        default=True,
+        help="""True to convert the LODR ngram LM to a CsrNgramLm, which
+        looks up the ngram states of all hypotheses with batched NumPy ops
+        instead of Python dicts. It gives the same results but is faster.""",
+    )
+
     parser.add_argument(
         "--lodr-ngram",
         type=str,
@@ -368,6 +407,18 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--context-graph-dir",
+        type=str,
+        default="",
+        help="""
+        The directory of a frozen context graph (see FrozenContextGraph in
+        icefall/context_graph.py). If it exists, the graph is loaded from it
+        instead of being built from --context-file. Otherwise, if it is given,
+        the graph built from --context-file is saved to it.
+        """,
+    )
+
     parser.add_argument(
         "--skip-scoring",
         type=str2bool,
@@ -391,6 +442,7 @@ def get_decoding_params() -> AttributeDict:
             "max_active_states": 10000,
             "use_double_scores": True,
             "beam": 4,  # for prefix-beam-search
+            "prune_beam": 4,  # for first pass pruning in prefix-beam-search-batch
         }
     )
     return params
@@ -406,8 +458,8 @@ def decode_one_batch(
     word_table: k2.SymbolTable,
     G: Optional[k2.Fsa] = None,
     NNLM: Optional[LmScorer] = None,
-    LODR_lm: Optional[NgramLm] = None,
-    context_graph: Optional[ContextGraph] = None,
+    LODR_lm: Optional[Union[NgramLm, CsrNgramLm]] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -495,12 +547,29 @@ def decode_one_batch(
         key = "prefix-beam-search"
         return {key: hyps}
 
+    if params.decoding_method == "ctc-prefix-beam-search-batch":
+        token_ids = ctc_prefix_beam_search_batch(
+            ctc_output=ctc_output,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam,
+            blank_id=params.blank_id,
+            prune_beam=params.prune_beam,
+        )
+        # hyps is a list of str, e.g., ['xxx yyy zzz', ...]
+        hyps = bpe_model.decode(token_ids)
+
+        # hyps is a list of list of str, e.g., [['xxx', 'yyy', 'zzz'], ... ]
+        hyps = [s.split() for s in hyps]
+        key = "prefix-beam-search-batch"
+        return {key: hyps}
+
     if params.decoding_method == "ctc-prefix-beam-search-attention-decoder-rescoring":
         best_path_dict = ctc_prefix_beam_search_attention_decoder_rescoring(
             ctc_output=ctc_output,
             attention_decoder=model.attention_decoder,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
+            memory_budget=params.attention_rescoring_memory_budget * 2**20 or None,
         )
         ans = dict()
         for a_scale_str, token_ids in best_path_dict.items():
@@ -590,6 +659,7 @@ def decode_one_batch(
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
             nbest_scale=params.nbest_scale,
+            memory_budget=params.attention_rescoring_memory_budget * 2**20 or None,
         )
         ans = dict()
         for a_scale_str, best_path in best_path_dict.items():
@@ -677,6 +747,7 @@ def decode_one_batch(
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
             nbest_scale=params.nbest_scale,
+            memory_budget=params.attention_rescoring_memory_budget * 2**20 or None,
         )
     else:
         assert False, f"Unsupported decoding method: {params.decoding_method}"
@@ -702,8 +773,8 @@ def decode_dataset(
     word_table: k2.SymbolTable,
     G: Optional[k2.Fsa] = None,
     NNLM: Optional[LmScorer] = None,
-    LODR_lm: Optional[NgramLm] = None,
-    context_graph: Optional[ContextGraph] = None,
+    LODR_lm: Optional[Union[NgramLm, CsrNgramLm]] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -862,6 +933,7 @@ def main():
         "ctc-greedy-search",
         "ctc-prefix-beam-search",
         "ctc-prefix-beam-search-attention-decoder-rescoring",
+        "ctc-prefix-beam-search-batch",
         "ctc-prefix-beam-search-shallow-fussion",
         "1best",
         "nbest",
@@ -890,6 +962,8 @@ def main():
 
     if "prefix-beam-search" in params.decoding_method:
         params.suffix += f"_beam-{params.beam}"
+        if params.decoding_method == "ctc-prefix-beam-search-batch":
+            params.suffix += f"_prune-beam-{params.prune_beam}"
         if params.decoding_method == "ctc-prefix-beam-search-shallow-fussion":
             if params.nnlm_scale != 0:
                 params.suffix += f"_nnlm-scale-{params.nnlm_scale}"
@@ -927,6 +1001,7 @@ def main():
         "ctc-greedy-search",
         "ctc-prefix-beam-search",
         "ctc-prefix-beam-search-attention-decoder-rescoring",
+        "ctc-prefix-beam-search-batch",
         "ctc-prefix-beam-search-shallow-fussion",
         "attention-decoder-rescoring-no-ngram",
     ]:
@@ -960,45 +1035,63 @@ def main():
         "whole-lattice-rescoring",
         "attention-decoder-rescoring-with-ngram",
     ):
-        if not (params.lm_dir / "G_4_gram.pt").is_file():
-            logging.info("Loading G_4_gram.fst.txt")
-            logging.warning("It may take 8 minutes.")
-            with open(params.lm_dir / "G_4_gram.fst.txt") as f:
-                first_word_disambig_id = lexicon.word_table["#0"]
-
-                G = k2.Fsa.from_openfst(f.read(), acceptor=False)
-                # G.aux_labels is not needed in later computations, so
-                # remove it here.
-                del G.aux_labels
-                # CAUTION: The following line is crucial.
-                # Arcs entering the back-off state have label equal to #0.
-                # We have to change it to 0 here.
-                G.labels[G.labels >= first_word_disambig_id] = 0
-                # See https://github.com/k2-fsa/k2/issues/874
-                # for why we need to set G.properties to None
-                G.__dict__["_properties"] = None
-                G = k2.Fsa.from_fsas([G]).to(device)
-                G = k2.arc_sort(G)
-                # Save a dummy value so that it can be loaded in C++.
-                # See https://github.com/pytorch/pytorch/issues/67902
-                # for why we need to do this.
-                G.dummy = 1
-
-                torch.save(G.as_dict(), params.lm_dir / "G_4_gram.pt")
-        else:
-            logging.info("Loading pre-compiled G_4_gram.pt")
-            d = torch.load(params.lm_dir / "G_4_gram.pt", map_location=device)
-            G = k2.Fsa.from_dict(d)
-
-        if params.decoding_method in [
+        add_epsilon_self_loops = params.decoding_method in [
             "whole-lattice-rescoring",
             "attention-decoder-rescoring-with-ngram",
-        ]:
-            # Add epsilon self-loops to G as we will compose
-            # it with the whole lattice later
-            G = k2.add_epsilon_self_loops(G)
-            G = k2.arc_sort(G)
-            G = G.to(device)
+        ]
+
+        def prepare_G() -> k2.Fsa:
+            if not (params.lm_dir / "G_4_gram.pt").is_file():
+                logging.info("Loading G_4_gram.fst.txt")
+                logging.warning("It may take 8 minutes.")
+                with open(params.lm_dir / "G_4_gram.fst.txt") as f:
+                    first_word_disambig_id = lexicon.word_table["#0"]
+
+                    G = k2.Fsa.from_openfst(f.read(), acceptor=False)
+                    # G.aux_labels is not needed in later computations, so
+                    # remove it here.
+                    del G.aux_labels
+                    # CAUTION: The following line is crucial.
+                    # Arcs entering the back-off state have label equal to #0.
+                    # We have to change it to 0 here.
+                    G.labels[G.labels >= first_word_disambig_id] = 0
+                    # See https://github.com/k2-fsa/k2/issues/874
+                    # for why we need to set G.properties to None
+                    G.__dict__["_properties"] = None
+                    G = k2.Fsa.from_fsas([G]).to(device)
+                    G = k2.arc_sort(G)
+                    # Save a dummy value so that it can be loaded in C++.
+                    # See https://github.com/pytorch/pytorch/issues/67902
+                    # for why we need to do this.
+                    G.dummy = 1
+
+                    torch.save(G.as_dict(), params.lm_dir / "G_4_gram.pt")
+            else:
+                logging.info("Loading pre-compiled G_4_gram.pt")
+                d = torch.load(params.lm_dir / "G_4_gram.pt", map_location=device)
+                G = k2.Fsa.from_dict(d)
+
+            if add_epsilon_self_loops:
+                # Add epsilon self-loops to G as we will compose
+                # it with the whole lattice later
+                G = k2.add_epsilon_self_loops(G)
+                G = k2.arc_sort(G)
+                G = G.to(device)
+            return G
+
+        if params.graph_cache_dir:
+            G = GraphCache(params.graph_cache_dir).get_or_compile(
+                name="G_4_gram",
+                filenames=[
+                    params.lang_dir / "words.txt",
+                    get_lm_file(params.lm_dir, "G_4_gram"),
+                ],
+                compile_fn=prepare_G,
+                device=device,
+                add_epsilon_self_loops=add_epsilon_self_loops,
+            )
+        else:
+            G = prepare_G()
 
         # G.lm_scores is used to replace HLG.lm_scores during
         # LM rescoring.
@@ -1036,20 +1129,30 @@ def main():
             is_binary=False,
         )
         logging.info(f"num states: {LODR_lm.lm.num_states}")
+        if params.use_csr_ngram_lm:
+            LODR_lm = CsrNgramLm.from_ngram_lm(LODR_lm)
 
     context_graph = None
     if (
         params.decoding_method == "ctc-prefix-beam-search-shallow-fussion"
         and params.context_score != 0
     ):
-        assert os.path.exists(
-            params.context_file
-        ), f"context_file does not exists, given path : {params.context_file}"
-        contexts = []
-        for line in open(params.context_file).readlines():
-            contexts.append(bpe_model.encode(line.strip()))
-        context_graph = ContextGraph(params.context_score)
-        context_graph.build(contexts)
+        if params.context_graph_dir and os.path.exists(params.context_graph_dir):
+            logging.info(f"Loading context graph from {params.context_graph_dir}")
+            context_graph = FrozenContextGraph.load(params.context_graph_dir)
+        else:
+            assert os.path.exists(
+                params.context_file
+            ), f"context_file does not exists, given path : {params.context_file}"
+            contexts = []
+            for line in open(params.context_file).readlines():
+                contexts.append(bpe_model.encode(line.strip()))
+            context_graph = ContextGraph(params.context_score)
+            context_graph.build(contexts)
+            context_graph = context_graph.freeze()
+            if params.context_graph_dir:
+                logging.info(f"Saving context graph to {params.context_graph_dir}")
+                context_graph.save(params.context_graph_dir)
 
     logging.info("About to create model")
     model = get_model(params)
@@ -98,9 +98,11 @@ import argparse
 import logging
 import math
 import os
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import sentencepiece as spm
@@ -108,6 +110,7 @@ import torch
 import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
 from beam_search import (
+    DecoderOutCache,
     beam_search,
     fast_beam_search_nbest,
     fast_beam_search_nbest_LG,
@@ -120,17 +123,20 @@ from beam_search import (
     modified_beam_search_lm_rescore_LODR,
     modified_beam_search_lm_shallow_fusion,
     modified_beam_search_LODR,
+    modified_beam_search_tensorized,
 )
+from blank_skip import BlankSkipStats, skip_blank_frames
 from lhotse import set_caching_enabled
 from train import add_model_arguments, get_model, get_params
 
-from icefall import ContextGraph, LmScorer, NgramLm
+from icefall import ContextGraph, CsrNgramLm, FrozenContextGraph, LmScorer, NgramLm
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
     find_checkpoints,
     load_checkpoint,
 )
+from icefall.error_stats import ErrorStatsScorer
 from icefall.lexicon import Lexicon
 from icefall.utils import (
     AttributeDict,
@@ -217,12 +223,16 @@ def get_parser():
           - beam_search
           - modified_beam_search
           - modified_beam_search_LODR
+          - modified_beam_search_tensorized
           - fast_beam_search
           - fast_beam_search_nbest
           - fast_beam_search_nbest_oracle
           - fast_beam_search_nbest_LG
         If you use fast_beam_search_nbest_LG, you have to specify
         `--lang-dir`, which should contain `LG.pt`.
+        modified_beam_search_tensorized gives the same results as
+        modified_beam_search but keeps the hypotheses in tensors; it does
+        not support context biasing.
         """,
     )
 
@@ -235,6 +245,16 @@ def get_parser():
         modified_beam_search.""",
     )
 
+    parser.add_argument(
+        "--decoder-out-cache-size",
+        type=int,
+        default=10000,
+        help="""Maximum number of contexts in the LRU cache of decoder outputs.
+        The decoder is only run on contexts that are not in the cache.
+        0 to disable the cache.
+        Used only when --decoding-method is modified_beam_search.""",
+    )
+
     parser.add_argument(
         "--beam",
         type=float,
@@ -349,6 +369,15 @@ def get_parser():
         help="ID of the backoff symbol in the ngram LM",
     )
 
+    parser.add_argument(
+        "--use-csr-ngram-lm",
+        type=str2bool,
+        default=True,
+        help="""True to convert the LODR ngram LM to a CsrNgramLm, which
+        looks up the ngram states of all hypotheses with batched NumPy ops
+        instead of Python dicts. It gives the same results but is faster.""",
+    )
+
     parser.add_argument(
         "--context-score",
         type=float,
@@ -371,6 +400,18 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--context-graph-dir",
+        type=str,
+        default="",
+        help="""
+        The directory of a frozen context graph (see FrozenContextGraph in
+        icefall/context_graph.py). If it exists, the graph is loaded from it
+        instead of being built from --context-file. Otherwise, if it is given,
+        the graph built from --context-file is saved to it.
+        """,
+    )
+
     parser.add_argument(
         "--skip-scoring",
         type=str2bool,
@@ -378,6 +419,26 @@ def get_parser():
         help="""Skip scoring, but still save the ASR output (for eval sets).""",
     )
 
+    parser.add_argument(
+        "--num-scoring-workers",
+        type=int,
+        default=0,
+        help="""If positive, the decoded batches are aligned against the
+        references in this number of worker processes while decoding is
+        still running, so the WER is available right after the last batch.
+        """,
+    )
+
+    parser.add_argument(
+        "--blank-skip-threshold",
+        type=float,
+        default=0.0,
+        help="""If positive, the encoder frames whose CTC blank probability is
+        larger than this value, e.g., 0.95, are removed before the search.
+        It requires a model trained with --use-ctc True.
+        """,
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -390,10 +451,12 @@ def decode_one_batch(
     batch: dict,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
     LM: Optional[LmScorer] = None,
     ngram_lm=None,
     ngram_lm_scale: float = 0.0,
+    decoder_out_cache: Optional[DecoderOutCache] = None,
+    blank_skip_stats: Optional[BlankSkipStats] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -428,6 +491,12 @@ def decode_one_batch(
         A ngram language model
       ngram_lm_scale:
         The scale for the ngram language model.
+      decoder_out_cache:
+        The cache of decoder outputs. Used only when --decoding-method
+        is modified_beam_search.
+      blank_skip_stats:
+        If not None, the number of frames kept by blank skipping is added
+        to it.
     Returns:
       Return the decoding result. See above description for the format of
       the returned dict.
@@ -454,6 +523,18 @@ def decode_one_batch(
 
     encoder_out, encoder_out_lens = model.forward_encoder(feature, feature_lens)
 
+    if params.blank_skip_threshold > 0:
+        num_frames = encoder_out_lens
+        encoder_out, encoder_out_lens, _ = skip_blank_frames(
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            ctc_output=model.ctc_output(encoder_out),
+            threshold=params.blank_skip_threshold,
+            blank_id=model.decoder.blank_id,
+        )
+        if blank_skip_stats is not None:
+            blank_skip_stats.add_frames(num_frames, encoder_out_lens)
+
     hyps = []
 
     if params.decoding_method == "fast_beam_search":
@@ -526,6 +607,16 @@ def decode_one_batch(
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
             context_graph=context_graph,
+            decoder_out_cache=decoder_out_cache,
+        )
+        for hyp in sp.decode(hyp_tokens):
+            hyps.append(hyp.split())
+    elif params.decoding_method == "modified_beam_search_tensorized":
+        hyp_tokens = modified_beam_search_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=params.beam_size,
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
@@ -642,10 +733,12 @@ def decode_dataset(
     sp: spm.SentencePieceProcessor,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
     LM: Optional[LmScorer] = None,
     ngram_lm=None,
     ngram_lm_scale: float = 0.0,
+    scorers: Optional[Dict[str, ErrorStatsScorer]] = None,
+    blank_skip_stats: Optional[BlankSkipStats] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -664,6 +757,12 @@ def decode_dataset(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding-method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      scorers:
+        If not None, the results of each batch are also added to
+        scorers[name], so that they are aligned while decoding continues.
+      blank_skip_stats:
+        If not None, the time spent in decoding, the duration of the cuts
+        and the number of frames kept by blank skipping are added to it.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -683,11 +782,22 @@ def decode_dataset(
     else:
         log_interval = 20
 
+    if (
+        params.decoding_method == "modified_beam_search"
+        and params.decoder_out_cache_size > 0
+    ):
+        decoder_out_cache = DecoderOutCache(
+            model=model, max_size=params.decoder_out_cache_size
+        )
+    else:
+        decoder_out_cache = None
+
     results = defaultdict(list)
     for batch_idx, batch in enumerate(dl):
         texts = batch["supervisions"]["text"]
         cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
 
+        start_time = time.perf_counter()
         hyps_dict = decode_one_batch(
             params=params,
             model=model,
@@ -699,7 +809,14 @@ def decode_dataset(
             LM=LM,
             ngram_lm=ngram_lm,
             ngram_lm_scale=ngram_lm_scale,
+            decoder_out_cache=decoder_out_cache,
+            blank_skip_stats=blank_skip_stats,
         )
+        if blank_skip_stats is not None:
+            blank_skip_stats.add_time(
+                audio_seconds=sum(c.duration for c in batch["supervisions"]["cut"]),
+                elapsed_seconds=time.perf_counter() - start_time,
+            )
 
         for name, hyps in hyps_dict.items():
             this_batch = []
@@ -709,6 +826,8 @@ def decode_dataset(
                 this_batch.append((cut_id, ref_words, hyp_words))
 
             results[name].extend(this_batch)
+            if scorers is not None:
+                scorers[name].add(this_batch)
 
         num_cuts += len(texts)
 
@@ -716,6 +835,13 @@ def decode_dataset(
             batch_str = f"{batch_idx}/{num_batches}"
 
             logging.info(f"batch {batch_str}, cuts processed until now is {num_cuts}")
+
+    if decoder_out_cache is not None:
+        logging.info(f"{decoder_out_cache}")
+
+    if blank_skip_stats is not None:
+        logging.info(f"{blank_skip_stats}")
+
     return results
 
 
@@ -741,9 +867,13 @@ def save_wer_results(
     params: AttributeDict,
     test_set_name: str,
     results_dict: Dict[str, List[Tuple[str, List[str], List[str], Tuple]]],
+    scorers: Optional[Dict[str, ErrorStatsScorer]] = None,
 ):
     """
     Save WER and per-utterance word alignments.
+
+    If scorers is not None, it contains the statistics of results_dict
+    accumulated by :func:`decode_dataset`.
     """
     test_set_wers = dict()
     for key, results in results_dict.items():
@@ -751,9 +881,12 @@ def save_wer_results(
         # ref/hyp pairs.
         errs_filename = params.res_dir / f"errs-{test_set_name}-{params.suffix}.txt"
         with open(errs_filename, "w", encoding="utf8") as fd:
-            wer = write_error_stats(
-                fd, f"{test_set_name}-{key}", results, enable_log=True
-            )
+            if scorers is not None:
+                wer = scorers[key].write(fd, f"{test_set_name}-{key}", enable_log=True)
+            else:
+                wer = write_error_stats(
+                    fd, f"{test_set_name}-{key}", results, enable_log=True
+                )
             test_set_wers[key] = wer
 
         logging.info(f"Wrote detailed error stats to {errs_filename}")
@@ -798,17 +931,25 @@ def main():
         "fast_beam_search_nbest_oracle",
         "modified_beam_search",
         "modified_beam_search_LODR",
+        "modified_beam_search_tensorized",
         "modified_beam_search_lm_shallow_fusion",
         "modified_beam_search_lm_rescore",
         "modified_beam_search_lm_rescore_LODR",
     )
     params.res_dir = params.exp_dir / params.decoding_method
 
-    if os.path.exists(params.context_file):
+    if os.path.exists(params.context_file) or (
+        params.context_graph_dir and os.path.exists(params.context_graph_dir)
+    ):
         params.has_contexts = True
     else:
         params.has_contexts = False
 
+    if params.decoding_method == "modified_beam_search_tensorized":
+        assert (
+            not params.has_contexts
+        ), "modified_beam_search_tensorized does not support context biasing"
+
     if params.iter > 0:
         params.suffix = f"iter-{params.iter}_avg-{params.avg}"
     else:
@@ -853,6 +994,10 @@ def main():
                 f"_LODR-{params.tokens_ngram}gram-scale-{params.ngram_lm_scale}"
             )
 
+    if params.blank_skip_threshold > 0:
+        assert params.use_ctc, "--blank-skip-threshold requires --use-ctc True"
+        params.suffix += f"_blank-skip-{params.blank_skip_threshold}"
+
     if params.use_averaged_model:
         params.suffix += "_use-averaged-model"
 
@@ -1001,6 +1146,8 @@ def main():
             is_binary=False,
         )
         logging.info(f"num states: {ngram_lm.lm.num_states}")
+        if params.use_csr_ngram_lm:
+            ngram_lm = CsrNgramLm.from_ngram_lm(ngram_lm)
         ngram_lm_scale = params.ngram_lm_scale
     else:
         ngram_lm = None
@@ -1024,12 +1171,19 @@ def main():
         word_table = None
 
     if "modified_beam_search" in params.decoding_method:
-        if os.path.exists(params.context_file):
+        if params.context_graph_dir and os.path.exists(params.context_graph_dir):
+            logging.info(f"Loading context graph from {params.context_graph_dir}")
+            context_graph = FrozenContextGraph.load(params.context_graph_dir)
+        elif os.path.exists(params.context_file):
             contexts = []
             for line in open(params.context_file).readlines():
-                contexts.append((sp.encode(line.strip()), 0.0))
+                contexts.append(sp.encode(line.strip()))
             context_graph = ContextGraph(params.context_score)
             context_graph.build(contexts)
+            context_graph = context_graph.freeze()
+            if params.context_graph_dir:
+                logging.info(f"Saving context graph to {params.context_graph_dir}")
+                context_graph.save(params.context_graph_dir)
         else:
             context_graph = None
     else:
@@ -1051,7 +1205,18 @@ def main():
     test_sets = ["test-clean", "test-other"]
     test_dl = [test_clean_dl, test_other_dl]
 
+    if params.num_scoring_workers > 0 and not params.skip_scoring:
+        scoring_executor = ProcessPoolExecutor(params.num_scoring_workers)
+    else:
+        scoring_executor = None
+
     for test_set, test_dl in zip(test_sets, test_dl):
+        if scoring_executor is not None:
+            scorers = defaultdict(lambda: ErrorStatsScorer(executor=scoring_executor))
+        else:
+            scorers = None
+
+        blank_skip_stats = BlankSkipStats()
         results_dict = decode_dataset(
             dl=test_dl,
             params=params,
@@ -1063,6 +1228,11 @@ def main():
             LM=LM,
             ngram_lm=ngram_lm,
             ngram_lm_scale=ngram_lm_scale,
+            scorers=scorers,
+            blank_skip_stats=blank_skip_stats,
+        )
+        blank_skip_stats.write(
+            params.res_dir / f"rtf-summary-{test_set}-{params.suffix}.txt"
         )
 
         save_asr_output(
@@ -1076,8 +1246,12 @@ def main():
                 params=params,
                 test_set_name=test_set,
                 results_dict=results_dict,
+                scorers=scorers,
             )
 
+    if scoring_executor is not None:
+        scoring_executor.shutdown()
+
     logging.info("Done!")
 
 
@@ -21,48 +21,86 @@ from typing import List, Optional, Tuple
 import k2
 import torch
 from beam_search import Hypothesis, HypothesisList
+from kaldifeat import FbankOptions, OnlineFbank
 
 from icefall.utils import AttributeDict
 
 
+def get_fbank_options(
+    device: torch.device = torch.device("cpu"),
+    sample_rate: int = 16000,
+    num_bins: int = 80,
+) -> FbankOptions:
+    """Return the fbank options used for streaming decoding."""
+    opts = FbankOptions()
+    opts.device = device
+    opts.frame_opts.dither = 0
+    opts.frame_opts.snip_edges = False
+    opts.frame_opts.samp_freq = sample_rate
+    opts.mel_opts.num_bins = num_bins
+    return opts
+
+
 class DecodeStream(object):
     def __init__(
         self,
         params: AttributeDict,
         cut_id: str,
-        initial_states: List[torch.Tensor],
+        initial_states: Optional[List[torch.Tensor]],
         decoding_graph: Optional[k2.Fsa] = None,
         device: torch.device = torch.device("cpu"),
+        slot: Optional[int] = None,
     ) -> None:
         """
         Args:
           initial_states:
             Initial decode states of the model, e.g. the return value of
-            `get_init_state` in conformer.py
+            `get_init_state` in conformer.py. None if the states are kept
+            in a `StatePool`.
           decoding_graph:
             Decoding graph used for decoding, may be a TrivialGraph or a HLG.
             Used only when decoding_method is fast_beam_search.
           device:
             The device to run this stream.
+          slot:
+            The slot of this stream in a `StatePool`, see ./state_pool.py.
+            Used only if `initial_states` is None.
         """
+        assert (initial_states is None) != (slot is None), (initial_states, slot)
         if params.decoding_method == "fast_beam_search":
             assert decoding_graph is not None
             assert device == decoding_graph.device
 
         self.params = params
         self.cut_id = cut_id
+        self.device = device
         self.LOG_EPS = math.log(1e-10)
 
         self.states = initial_states
+        self.slot = slot
 
         # It contains a 2-D tensors representing the feature frames.
         self.features: torch.Tensor = None
 
+        # The index of the first frame in `self.features`. It is non-zero
+        # only if features are fed with `func:accept_features`, in which
+        # case the processed frames are dropped from `self.features`.
+        self.features_offset: int = 0
+
         self.num_frames: int = 0
         # how many frames have been processed. (before subsampling).
         # we only modify this value in `func:get_feature_frames`.
         self.num_processed_frames: int = 0
 
+        # True if no more features will be fed to this stream.
+        self._input_finished: bool = False
+
+        # Used only if audio samples are fed with `func:accept_waveform`.
+        # It computes fbank frames incrementally on CPU.
+        self.online_fbank: Optional[OnlineFbank] = None
+        # Number of fbank frames taken from `self.online_fbank`
+        self.num_fbank_frames: int = 0
+
         self._done: bool = False
 
         # The transcript of current utterance.
@@ -105,6 +143,11 @@ class DecodeStream(object):
     def id(self) -> str:
         return self.cut_id
 
+    @property
+    def input_finished(self) -> bool:
+        """Return True if no more features will be fed to this stream."""
+        return self._input_finished
+
     def set_features(
         self,
         features: torch.Tensor,
@@ -119,6 +162,99 @@ class DecodeStream(object):
             value=self.LOG_EPS,
         )
         self.num_frames = self.features.size(0)
+        self._input_finished = True
+
+    def accept_features(self, features: torch.Tensor) -> None:
+        """Append feature frames to current utterance.
+
+        Unlike :func:`set_features`, it can be called many times, e.g., for
+        live audio. Call :func:`finish_input` after the last frames.
+
+        Args:
+          features:
+            A 2-D tensor of shape (num_frames, feature_dim).
+        """
+        assert features.dim() == 2, features.dim()
+        assert not self._input_finished, "The input has been finished"
+        features = features.to(self.device)
+
+        if self.features is None:
+            self.features = features
+        else:
+            self.features = torch.cat([self.features, features], dim=0)
+        self.num_frames += features.size(0)
+
+    def accept_waveform(self, sample_rate: int, samples: torch.Tensor) -> None:
+        """Append audio samples to current utterance.
+
+        The fbank features are computed chunk by chunk as the samples
+        arrive, with `snip_edges=False` as in ./streaming_decode.py.
+        After :func:`finish_input`, the frames are the same as the ones
+        computed from the whole utterance at once.
+
+        Args:
+          sample_rate:
+            The sample rate of `samples`.
+          samples:
+            A 1-D float32 tensor of samples normalized to [-1, 1].
+        """
+        assert samples.dim() == 1, samples.dim()
+        assert not self._input_finished, "The input has been finished"
+
+        if self.online_fbank is None:
+            assert self.features is None, "Cannot mix features and samples"
+            opts = get_fbank_options(
+                device=torch.device("cpu"),
+                sample_rate=sample_rate,
+                num_bins=self.params.feature_dim,
+            )
+            self.online_fbank = OnlineFbank(opts)
+
+        self.online_fbank.accept_waveform(
+            sampling_rate=sample_rate, waveform=samples.cpu()
+        )
+        self._fetch_fbank_frames()
+
+    def _fetch_fbank_frames(self) -> None:
+        """Move the ready frames of `self.online_fbank` to the features."""
+        num_frames_ready = self.online_fbank.num_frames_ready
+        if num_frames_ready == self.num_fbank_frames:
+            return
+        frames = [
+            self.online_fbank.get_frame(i)
+            for i in range(self.num_fbank_frames, num_frames_ready)
+        ]
+        self.num_fbank_frames = num_frames_ready
+        self.accept_features(torch.cat(frames, dim=0))
+
+    def finish_input(self, tail_pad_len: int = 0) -> None:
+        """Signal that no more features will be fed to this stream.
+
+        The remaining frames are padded as in :func:`set_features`.
+        """
+        assert not self._input_finished, "The input has been finished"
+        if self.online_fbank is not None:
+            # Compute the last frames, which need the end of the audio
+            self.online_fbank.input_finished()
+            self._fetch_fbank_frames()
+
+        pad = torch.full(
+            (self.pad_length + tail_pad_len, self.params.feature_dim),
+            self.LOG_EPS,
+            device=self.device,
+        )
+        self.accept_features(pad)
+        self._input_finished = True
+
+    def is_ready(self, chunk_size: int) -> bool:
+        """Return True if a chunk of chunk_size frames can be decoded, i.e.,
+        :func:`get_feature_frames` can be called."""
+        if self._done:
+            return False
+        if self._input_finished:
+            return True
+        num_available = self.num_frames - self.num_processed_frames
+        return num_available >= chunk_size + self.pad_length
 
     def get_feature_frames(self, chunk_size: int) -> Tuple[torch.Tensor, int]:
         """Consume chunk_size frames of features"""
@@ -126,14 +262,19 @@ class DecodeStream(object):
 
         ret_length = min(self.num_frames - self.num_processed_frames, chunk_length)
 
-        ret_features = self.features[
-            self.num_processed_frames : self.num_processed_frames + ret_length  # noqa
-        ]
+        start = self.num_processed_frames - self.features_offset
+        ret_features = self.features[start : start + ret_length]  # noqa
 
         self.num_processed_frames += chunk_size
-        if self.num_processed_frames >= self.num_frames:
+        if self.num_processed_frames >= self.num_frames and self._input_finished:
             self._done = True
 
+        if not self._input_finished:
+            # Drop the processed frames, which are not needed any more
+            num_dropped = self.num_processed_frames - self.features_offset
+            self.features = self.features[num_dropped:]
+            self.features_offset += num_dropped
+
         return ret_features, ret_length
 
     def decoding_result(self) -> List[int]:
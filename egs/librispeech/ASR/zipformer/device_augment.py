@@ -0,0 +1,357 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched SpecAugment and noise mixing on the training device.
+
+With --augment-on-device in ./train.py, `CutMix` with MUSAN and `SpecAugment`
+are removed from the dataloader and applied by :class:`DeviceAugment` to the
+whole padded batch after it is moved to the GPU. The MUSAN features are loaded
+once into a tensor on the device, so the dataloader workers only read the
+features of the training cuts.
+
+Unlike lhotse's `SpecAugment`, which processes each utterance in a Python loop,
+every augmentation here is a handful of batched tensor ops. Random parameters
+are still drawn independently for each utterance, and, as in lhotse, a single
+draw with probability `p` decides whether an utterance is augmented at all.
+"""
+
+import logging
+import math
+import random
+from pathlib import Path
+from typing import Optional, Tuple
+
+import torch
+from lhotse import load_manifest
+from torch import Tensor
+
+# log(1e-10), the value lhotse uses to pad features
+LOG_EPSILON = math.log(1e-10)
+
+
+def load_noise_bank(
+    filename: Path,
+    max_frames: int = 1000000,
+    seed: int = 42,
+    dtype: torch.dtype = torch.float16,
+) -> Tensor:
+    """Load the features of randomly selected noise cuts, e.g., MUSAN, and
+    concatenate them into a single tensor.
+
+    Args:
+      filename:
+        The cut manifest with precomputed features,
+        e.g., data/fbank/musan_cuts.jsonl.gz
+      max_frames:
+        Stop loading cuts when the bank has this number of frames.
+      seed:
+        The seed for selecting the cuts.
+      dtype:
+        The dtype of the returned tensor. float16 halves the memory used.
+    Returns:
+      Return a tensor of shape (num_frames, num_features).
+    """
+    cuts = load_manifest(filename).shuffle(rng=random.Random(seed))
+    feats = []
+    num_frames = 0
+    for cut in cuts:
+        f = torch.from_numpy(cut.load_features()).to(dtype)
+        feats.append(f[: max_frames - num_frames])
+        num_frames += feats[-1].size(0)
+        if num_frames >= max_frames:
+            break
+    logging.info(f"Loaded {num_frames} frames of noise from {filename}")
+    return torch.cat(feats)
+
+
+def _lens_to_mask(lens: Tensor, max_len: int) -> Tensor:
+    """Return a bool tensor of shape (len(lens), max_len), True for valid
+    positions."""
+    return torch.arange(max_len, device=lens.device) < lens.unsqueeze(1)
+
+
+def _randint(low: Tensor, high: Tensor) -> Tensor:
+    """Like torch.randint, but with a different range [low, high) for each
+    element. high must be greater than low."""
+    r = torch.rand(low.shape, device=low.device)
+    return (low + r * (high - low)).long().clamp(max=high - 1)
+
+
+class BatchedNoiseMixer(object):
+    def __init__(
+        self,
+        noise: Tensor,
+        p: float = 0.5,
+        snr: Tuple[float, float] = (10, 20),
+    ) -> None:
+        """
+        Args:
+          noise:
+            The log-mel features of the noise, of shape (N, num_features),
+            e.g., returned by :func:`load_noise_bank`.
+          p:
+            The probability of mixing noise into an utterance.
+          snr:
+            The SNR in dB is sampled uniformly from this range.
+        """
+        assert noise.ndim == 2, noise.shape
+        self.noise = noise
+        self.p = p
+        self.snr = snr
+
+    def __call__(self, features: Tensor, feature_lens: Tensor) -> Tensor:
+        """Mix noise into the features in the linear energy domain, like
+        lhotse does when mixing cuts with precomputed fbank features.
+
+        Args:
+          features:
+            A tensor of shape (N, T, C), on the same device as the noise.
+          feature_lens:
+            A tensor of shape (N,), the number of valid frames of each
+            utterance.
+        Returns:
+          Return a new tensor of the same shape as features.
+        """
+        N, T, C = features.shape
+        device = features.device
+        assert self.noise.size(1) == C, (self.noise.shape, features.shape)
+
+        # Pick a random segment of the noise bank for each utterance,
+        # wrapping around at the end of the bank.
+        num_noise_frames = self.noise.size(0)
+        start = torch.randint(0, num_noise_frames, (N, 1), device=device)
+        index = (start + torch.arange(T, device=device)) % num_noise_frames
+        noise = self.noise[index].to(features.dtype)  # (N, T, C)
+
+        mask = _lens_to_mask(feature_lens, T).unsqueeze(-1)  # (N, T, 1)
+        # log of the total energy of the speech and the noise
+        speech_energy = features.masked_fill(~mask, -math.inf).flatten(1).logsumexp(1)
+        noise_energy = noise.masked_fill(~mask, -math.inf).flatten(1).logsumexp(1)
+
+        snr = torch.empty(N, device=device).uniform_(*self.snr)
+        # log of the gain of the noise
+        gain = speech_energy - noise_energy - snr * (math.log(10) / 10)
+
+        mixed = torch.logaddexp(features, noise + gain.view(N, 1, 1))
+        mixed = mixed.clamp(min=LOG_EPSILON)
+
+        apply = torch.rand(N, 1, 1, device=device) < self.p
+        return torch.where(apply & mask, mixed, features)
+
+
+class BatchedSpecAugment(object):
+    """Time warping, frequency masking and time masking as in lhotse's
+    `SpecAugment`, applied to a whole batch at once. Time warping uses linear
+    instead of bicubic interpolation."""
+
+    def __init__(
+        self,
+        time_warp_factor: Optional[int] = 80,
+        num_feature_masks: int = 2,
+        features_mask_size: int = 27,
+        num_frame_masks: int = 10,
+        frames_mask_size: int = 100,
+        max_frames_mask_fraction: float = 0.15,
+        p: float = 0.9,
+    ) -> None:
+        """
+        See lhotse's `SpecAugment` for the meaning of the arguments.
+        """
+        assert 0 <= p <= 1, p
+        assert features_mask_size > 0, features_mask_size
+        assert frames_mask_size > 0, frames_mask_size
+        self.time_warp_factor = time_warp_factor
+        self.num_feature_masks = num_feature_masks
+        self.features_mask_size = features_mask_size
+        self.num_frame_masks = num_frame_masks
+        self.frames_mask_size = frames_mask_size
+        self.max_frames_mask_fraction = max_frames_mask_fraction
+        self.p = p
+
+    def _sample_apply(self, features: Tensor) -> Tensor:
+        """Return a bool tensor of shape (N,), True for the utterances to
+        augment, each with probability p."""
+        N = features.size(0)
+        return torch.rand(N, device=features.device) < self.p
+
+    def time_warp(
+        self,
+        features: Tensor,
+        feature_lens: Tensor,
+        apply: Optional[Tensor] = None,
+    ) -> Tensor:
+        """Warp the valid frames of each utterance in time around a random
+        center, which is moved by up to time_warp_factor frames.
+
+        `apply` is a bool tensor of shape (N,), True for the utterances to
+        augment. If None, it is sampled with probability p."""
+        factor = self.time_warp_factor
+        if factor is None or factor < 1:
+            return features
+        N, T, C = features.shape
+        device = features.device
+
+        if apply is None:
+            apply = self._sample_apply(features)
+        lens = feature_lens.to(device=device, dtype=torch.int64)
+        apply = apply & (lens - factor > factor + 1)
+        # Use a valid range for utterances that are not warped
+        safe_lens = torch.where(apply, lens, torch.full_like(lens, 2 * factor + 2))
+        center = _randint(torch.full_like(lens, factor + 1), safe_lens - factor)
+        warped = _randint(center - factor, center + factor + 1)
+
+        # For each output frame, compute the position in the input,
+        # as F.interpolate() with align_corners=False does.
+        t = torch.arange(T, device=device, dtype=torch.float32).expand(N, T)
+        center_f = center.unsqueeze(1).float()
+        warped_f = warped.unsqueeze(1).float()
+        lens_f = safe_lens.unsqueeze(1).float()
+        left = (
+            ((t + 0.5) * center_f / warped_f - 0.5).clamp(min=0).minimum(center_f - 1)
+        )
+        right = (
+            center_f + (t - warped_f + 0.5) * (lens_f - center_f) / (lens_f - warped_f)
+        ) - 0.5
+        right = right.maximum(center_f).minimum(lens_f - 1)
+        src = torch.where(t < warped_f, left, right)
+        keep = ~apply.unsqueeze(1) | (t >= lens.unsqueeze(1))
+        src = torch.where(keep, t, src)
+
+        src0 = src.floor().long().clamp(0, T - 1)
+        src1 = (src0 + 1).clamp(max=T - 1)
+        w = (src - src0).unsqueeze(-1).to(features.dtype)
+        x0 = features.gather(1, src0.unsqueeze(-1).expand(N, T, C))
+        x1 = features.gather(1, src1.unsqueeze(-1).expand(N, T, C))
+        return x0 * (1 - w) + x1 * w
+
+    def _make_masks(
+        self,
+        size: Tensor,
+        mask_size: Tensor,
+        num_masks: Tensor,
+        max_num_masks: int,
+        max_len: int,
+    ) -> Tensor:
+        """Return a bool tensor of shape (N, max_len), True for masked
+        positions. The i-th utterance has length size[i] and num_masks[i]
+        masks, each of which has a random width in [0, mask_size[i])."""
+        N = size.size(0)
+        device = size.device
+        M = max_num_masks
+        width = (torch.rand(N, M, device=device) * mask_size.unsqueeze(1)).long()
+        # Disable the masks with index >= num_masks[i] by making them empty
+        width *= torch.arange(M, device=device).unsqueeze(0) < num_masks.unsqueeze(1)
+        start = (torch.rand(N, M, device=device) * (size.unsqueeze(1) - width)).long()
+        pos = torch.arange(max_len, device=device).view(1, 1, max_len)
+        masks = (pos >= start.unsqueeze(-1)) & (pos < (start + width).unsqueeze(-1))
+        return masks.any(dim=1)
+
+    def mask(
+        self,
+        features: Tensor,
+        feature_lens: Tensor,
+        apply: Optional[Tensor] = None,
+    ) -> Tensor:
+        """Apply frequency masks and time masks to each utterance. Masked
+        values are set to the mean of the valid frames of the utterance.
+
+        `apply` is as in :func:`time_warp`."""
+        N, T, C = features.shape
+        device = features.device
+        if apply is None:
+            apply = self._sample_apply(features)
+        lens = feature_lens.to(device=device, dtype=torch.int64)
+        valid = _lens_to_mask(lens, T)
+
+        num_valid = (lens * C).clamp(min=1).unsqueeze(1)
+        mean = (features * valid.unsqueeze(-1)).flatten(1).sum(1, keepdim=True)
+        mean = (mean / num_valid).view(N, 1, 1)
+
+        masked = torch.zeros(N, T, C, dtype=torch.bool, device=device)
+        if self.num_feature_masks > 0:
+            feature_masks = self._make_masks(
+                size=torch.full((N,), C, device=device),
+                mask_size=torch.full((N,), self.features_mask_size, device=device),
+                num_masks=torch.full((N,), self.num_feature_masks, device=device),
+                max_num_masks=self.num_feature_masks,
+                max_len=C,
+            )
+            masked |= feature_masks.unsqueeze(1)
+
+        if self.num_frame_masks > 0:
+            # Limit the total number of masked frames as lhotse does
+            max_tot_mask_frames = self.max_frames_mask_fraction * lens
+            num_frame_masks = (max_tot_mask_frames / self.frames_mask_size).ceil()
+            num_frame_masks = num_frame_masks.clamp(min=1, max=self.num_frame_masks)
+            max_mask_frames = (max_tot_mask_frames / num_frame_masks).floor()
+            max_mask_frames = max_mask_frames.clamp(max=self.frames_mask_size)
+
+            frame_masks = self._make_masks(
+                size=lens,
+                mask_size=max_mask_frames,
+                num_masks=num_frame_masks,
+                max_num_masks=self.num_frame_masks,
+                max_len=T,
+            )
+            masked |= frame_masks.unsqueeze(-1)
+
+        apply = apply.view(N, 1, 1) & valid.unsqueeze(-1)
+        return torch.where(masked & apply, mean.to(features.dtype), features)
+
+    def __call__(self, features: Tensor, feature_lens: Tensor) -> Tensor:
+        # Like lhotse, decide once per utterance whether to augment it
+        apply = self._sample_apply(features)
+        features = self.time_warp(features, feature_lens, apply)
+        return self.mask(features, feature_lens, apply)
+
+
+class DeviceAugment(object):
+    def __init__(
+        self,
+        noise_mixer: Optional[BatchedNoiseMixer] = None,
+        spec_augment: Optional[BatchedSpecAugment] = None,
+    ) -> None:
+        """
+        Args:
+          noise_mixer:
+            If not None, mix noise into the features first.
+          spec_augment:
+            If not None, apply SpecAugment after mixing noise.
+        """
+        self.noise_mixer = noise_mixer
+        self.spec_augment = spec_augment
+
+    @torch.no_grad()
+    def __call__(self, batch: dict, device: torch.device) -> dict:
+        """Move the features of a batch returned by
+        `K2SpeechRecognitionDataset` to the device and augment them.
+
+        It assumes there is one supervision per cut, as `compute_loss()`
+        in ./train.py does.
+
+        Returns:
+          Return the batch with batch["inputs"] replaced by the augmented
+          features on the device.
+        """
+        features = batch["inputs"].to(device, non_blocking=True)
+        feature_lens = batch["supervisions"]["num_frames"].to(device)
+        if self.noise_mixer is not None:
+            features = self.noise_mixer(features, feature_lens)
+        if self.spec_augment is not None:
+            features = self.spec_augment(features, feature_lens)
+        batch["inputs"] = features
+        return batch
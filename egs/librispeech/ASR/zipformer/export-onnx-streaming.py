@@ -61,6 +61,13 @@ It will generate the following 3 files inside $repo/exp:
   - decoder-epoch-99-avg-1-chunk-16-left-128.onnx
   - joiner-epoch-99-avg-1-chunk-16-left-128.onnx
 
+If --calibration-cuts is given, e.g.,
+--calibration-cuts data/fbank/librispeech_cuts_dev-clean.jsonl.gz, it also
+generates an encoder with static int8 quantization, calibrated by decoding
+the cuts chunk by chunk:
+
+  - encoder-epoch-99-avg-1-chunk-16-left-128.int8-static.onnx
+
 See ./onnx_pretrained-streaming.py for how to use the exported ONNX models.
 """
 
@@ -74,6 +81,13 @@ import onnx
 import torch
 import torch.nn as nn
 from decoder import Decoder
+from onnx_greedy_search import export_greedy_search_onnx
+from onnx_quantize import (
+    StreamingEncoderCalibrationDataReader,
+    add_static_quant_arguments,
+    load_calibration_features,
+    quantize_encoder_static,
+)
 from onnxruntime.quantization import QuantType, quantize_dynamic
 from scaling_converter import convert_scaled_to_non_scaled
 from train import add_model_arguments, get_model, get_params
@@ -160,6 +174,25 @@ def get_parser():
         help="Whether to export models in fp16",
     )
 
+    parser.add_argument(
+        "--export-greedy-search",
+        type=str2bool,
+        default=False,
+        help="""If True, also export the greedy search, with the decoder and
+        joiner inside its frame loop, as a single model
+        greedy_search-xxx.onnx""",
+    )
+
+    parser.add_argument(
+        "--max-sym-per-frame",
+        type=int,
+        default=1,
+        help="""Maximum number of symbols per frame of the exported greedy
+        search. Used only when --export-greedy-search is True.""",
+    )
+
+    add_static_quant_arguments(parser)
+
     add_model_arguments(parser)
 
     return parser
@@ -730,6 +763,28 @@ def main():
     )
     logging.info(f"Exported joiner to {joiner_filename}")
 
+    if params.export_greedy_search:
+        logging.info("Exporting greedy search")
+        greedy_search_filename = params.exp_dir / f"greedy_search-{suffix}.onnx"
+        export_greedy_search_onnx(
+            decoder=decoder,
+            joiner=joiner,
+            filename=greedy_search_filename,
+            context_size=model.decoder.context_size,
+            joiner_dim=model.joiner.output_linear.weight.shape[1],
+            max_sym_per_frame=params.max_sym_per_frame,
+            opset_version=opset_version,
+        )
+        add_meta_data(
+            filename=greedy_search_filename,
+            meta_data={
+                "context_size": str(model.decoder.context_size),
+                "vocab_size": str(model.decoder.vocab_size),
+                "max_sym_per_frame": str(params.max_sym_per_frame),
+            },
+        )
+        logging.info(f"Exported greedy search to {greedy_search_filename}")
+
     if params.fp16:
         from onnxconverter_common import float16
 
@@ -779,6 +834,27 @@ def main():
         weight_type=QuantType.QInt8,
     )
 
+    if params.calibration_cuts:
+        # The decoder and joiner are small and run on a few frames per
+        # call, so only the encoder is quantized statically. Use it with
+        # the dynamically quantized decoder and joiner above.
+        logging.info("Generate static int8 quantization encoder")
+        features = load_calibration_features(
+            params.calibration_cuts, params.num_calibration_cuts
+        )
+        encoder_filename_int8_static = (
+            params.exp_dir / f"encoder-{suffix}.int8-static.onnx"
+        )
+        quantize_encoder_static(
+            model_input=encoder_filename,
+            model_output=encoder_filename_int8_static,
+            data_reader=StreamingEncoderCalibrationDataReader(
+                encoder_filename, features
+            ),
+            calibration_method=params.calibration_method,
+        )
+        logging.info(f"Exported encoder to {encoder_filename_int8_static}")
+
 
 if __name__ == "__main__":
     formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
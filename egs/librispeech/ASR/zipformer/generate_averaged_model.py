@@ -34,6 +34,9 @@ You can later load it by `torch.load("epoch-28-avg-15.pt")`.
 
 It will generate a file `iter-22000-avg-5.pt` in the given `exp_dir`.
 You can later load it by `torch.load("iter-22000-avg-5.pt")`.
+
+Only `model_avg` of the two checkpoints is read, from memory-mapped files,
+so the optimizer states in them do not need to fit into memory.
 """
 
 
@@ -44,7 +47,10 @@ import k2
 import torch
 from train import add_model_arguments, get_model, get_params
 
-from icefall.checkpoint import average_checkpoints_with_averaged_model, find_checkpoints
+from icefall.checkpoint import (
+    average_checkpoints_with_averaged_model_mmap,
+    find_checkpoints,
+)
 
 
 def get_parser():
@@ -154,7 +160,7 @@ def main():
         )
         model.to(device)
         model.load_state_dict(
-            average_checkpoints_with_averaged_model(
+            average_checkpoints_with_averaged_model_mmap(
                 filename_start=filename_start,
                 filename_end=filename_end,
                 device=device,
@@ -174,7 +180,7 @@ def main():
         )
         model.to(device)
         model.load_state_dict(
-            average_checkpoints_with_averaged_model(
+            average_checkpoints_with_averaged_model_mmap(
                 filename_start=filename_start,
                 filename_end=filename_end,
                 device=device,
@@ -65,6 +65,14 @@ It will generate the following 3 files inside $repo/exp:
   --decoder-model-filename $repo/exp/decoder-epoch-99-avg-1.onnx \
   --joiner-model-filename $repo/exp/joiner-epoch-99-avg-1.onnx \
   --tokens $repo/data/lang_bpe_500/tokens.txt \
+  --decoding-method greedy_search
+
+The results are saved with the name of the encoder model as suffix, so
+quantized encoders, e.g., encoder-epoch-99-avg-1.int8.onnx (dynamic) and
+encoder-epoch-99-avg-1.int8-static.onnx (static, see ./export-onnx.py), can be
+decoded into the same directory and compared by the files
+wer-summary-test-clean-encoder-epoch-99-avg-1*.txt and
+rtf-summary-test-clean-encoder-epoch-99-avg-1*.txt.
 """
 
 
@@ -75,10 +83,9 @@ from pathlib import Path
 from typing import List, Tuple
 
 import torch
-import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
 from k2 import SymbolTable
-from onnx_pretrained import OnnxModel, greedy_search
+from onnx_engine import OnnxTransducerEngine
 
 from icefall.utils import setup_logger, store_transcripts, write_error_stats
 
@@ -129,24 +136,76 @@ def get_parser():
         help="Valid values are greedy_search and modified_beam_search",
     )
 
+    parser.add_argument(
+        "--beam-size",
+        type=int,
+        default=4,
+        help="""Number of active paths used in modified_beam_search""",
+    )
+
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=4,
+        help="""Number of threads of the encoder session""",
+    )
+
+    parser.add_argument(
+        "--search-num-threads",
+        type=int,
+        default=1,
+        help="""Number of threads of the decoder and joiner sessions, which
+        run on a few rows per call""",
+    )
+
+    parser.add_argument(
+        "--max-batch-frames",
+        type=int,
+        default=0,
+        help="""If positive, the utterances of a dataloader batch are sorted
+        by length and split into encoder batches of at most this many
+        frames, including padding""",
+    )
+
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=0,
+        help="""If positive, the maximum number of utterances of an encoder
+        batch""",
+    )
+
     return parser
 
 
 def decode_one_batch(
-    model: OnnxModel, token_table: SymbolTable, batch: dict
+    model: OnnxTransducerEngine,
+    token_table: SymbolTable,
+    batch: dict,
+    decoding_method: str = "greedy_search",
+    beam_size: int = 4,
+    max_batch_frames: int = 0,
+    max_batch_size: int = 0,
 ) -> List[List[str]]:
     """Decode one batch and return the result.
-    Currently it only greedy_search is supported.
 
     Args:
       model:
-        The neural model.
+        The ONNX inference engine.
       token_table:
         The token table.
       batch:
         It is the return value from iterating
         `lhotse.dataset.K2SpeechRecognitionDataset`. See its documentation
         for the format of the `batch`.
+      decoding_method:
+        Either greedy_search or modified_beam_search.
+      beam_size:
+        Number of active paths used in modified_beam_search.
+      max_batch_frames:
+        If positive, the maximum number of frames of an encoder batch.
+      max_batch_size:
+        If positive, the maximum number of utterances of an encoder batch.
 
     Returns:
       Return the decoded results for each utterance.
@@ -156,12 +215,16 @@ def decode_one_batch(
     # at entry, feature is (N, T, C)
 
     supervisions = batch["supervisions"]
-    feature_lens = supervisions["num_frames"].to(dtype=torch.int64)
-
-    encoder_out, encoder_out_lens = model.run_encoder(x=feature, x_lens=feature_lens)
-
-    hyps = greedy_search(
-        model=model, encoder_out=encoder_out, encoder_out_lens=encoder_out_lens
+    feature_lens = supervisions["num_frames"].tolist()
+    feature = feature.numpy()
+    features = [feature[i, :n] for i, n in enumerate(feature_lens)]
+
+    hyps = model.decode(
+        features,
+        decoding_method=decoding_method,
+        beam=beam_size,
+        max_batch_frames=max_batch_frames,
+        max_batch_size=max_batch_size,
     )
 
     def token_ids_to_words(token_ids: List[int]) -> str:
@@ -176,8 +239,12 @@ def decode_one_batch(
 
 def decode_dataset(
     dl: torch.utils.data.DataLoader,
-    model: nn.Module,
+    model: OnnxTransducerEngine,
     token_table: SymbolTable,
+    decoding_method: str = "greedy_search",
+    beam_size: int = 4,
+    max_batch_frames: int = 0,
+    max_batch_size: int = 0,
 ) -> Tuple[List[Tuple[str, List[str], List[str]]], float]:
     """Decode dataset.
 
@@ -185,9 +252,17 @@ def decode_dataset(
       dl:
         PyTorch's dataloader containing the dataset to decode.
       model:
-        The neural model.
+        The ONNX inference engine.
       token_table:
         The token table.
+      decoding_method:
+        Either greedy_search or modified_beam_search.
+      beam_size:
+        Number of active paths used in modified_beam_search.
+      max_batch_frames:
+        If positive, the maximum number of frames of an encoder batch.
+      max_batch_size:
+        If positive, the maximum number of utterances of an encoder batch.
 
     Returns:
       - A list of tuples. Each tuple contains three elements:
@@ -212,7 +287,15 @@ def decode_dataset(
         cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
         total_duration += sum([cut.duration for cut in batch["supervisions"]["cut"]])
 
-        hyps = decode_one_batch(model=model, token_table=token_table, batch=batch)
+        hyps = decode_one_batch(
+            model=model,
+            token_table=token_table,
+            batch=batch,
+            decoding_method=decoding_method,
+            beam_size=beam_size,
+            max_batch_frames=max_batch_frames,
+            max_batch_size=max_batch_size,
+        )
 
         this_batch = []
         assert len(hyps) == len(texts)
@@ -236,25 +319,32 @@ def save_results(
     res_dir: Path,
     test_set_name: str,
     results: List[Tuple[str, List[str], List[str]]],
+    suffix: str,
+    rtf: float,
 ):
-    recog_path = res_dir / f"recogs-{test_set_name}.txt"
+    recog_path = res_dir / f"recogs-{test_set_name}-{suffix}.txt"
     results = sorted(results)
     store_transcripts(filename=recog_path, texts=results)
     logging.info(f"The transcripts are stored in {recog_path}")
 
     # The following prints out WERs, per-word error statistics and aligned
     # ref/hyp pairs.
-    errs_filename = res_dir / f"errs-{test_set_name}.txt"
+    errs_filename = res_dir / f"errs-{test_set_name}-{suffix}.txt"
     with open(errs_filename, "w") as f:
         wer = write_error_stats(f, f"{test_set_name}", results, enable_log=True)
 
     logging.info("Wrote detailed error stats to {}".format(errs_filename))
 
-    errs_info = res_dir / f"wer-summary-{test_set_name}.txt"
+    errs_info = res_dir / f"wer-summary-{test_set_name}-{suffix}.txt"
     with open(errs_info, "w") as f:
         print("WER", file=f)
         print(wer, file=f)
 
+    rtf_info = res_dir / f"rtf-summary-{test_set_name}-{suffix}.txt"
+    with open(rtf_info, "w") as f:
+        print("RTF", file=f)
+        print(f"{rtf:.4f}", file=f)
+
     s = "\nFor {}, WER is {}:\n".format(test_set_name, wer)
     logging.info(s)
 
@@ -265,12 +355,15 @@ def main():
     LibriSpeechAsrDataModule.add_arguments(parser)
     args = parser.parse_args()
 
-    assert (
-        args.decoding_method == "greedy_search"
-    ), "Only supports greedy_search currently."
+    assert args.decoding_method in (
+        "greedy_search",
+        "modified_beam_search",
+    ), args.decoding_method
     res_dir = Path(args.exp_dir) / f"onnx-{args.decoding_method}"
+    # e.g., encoder-epoch-99-avg-1.int8
+    suffix = Path(args.encoder_model_filename).stem
 
-    setup_logger(f"{res_dir}/log-decode")
+    setup_logger(f"{res_dir}/log-decode-{suffix}")
     logging.info("Decoding started")
 
     device = torch.device("cpu")
@@ -281,10 +374,12 @@ def main():
     logging.info(vars(args))
 
     logging.info("About to create model")
-    model = OnnxModel(
+    model = OnnxTransducerEngine(
         encoder_model_filename=args.encoder_model_filename,
         decoder_model_filename=args.decoder_model_filename,
         joiner_model_filename=args.joiner_model_filename,
+        encoder_num_threads=args.num_threads,
+        search_num_threads=args.search_num_threads,
     )
 
     # we need cut ids to display recognition results.
@@ -303,7 +398,13 @@ def main():
     for test_set, test_dl in zip(test_sets, test_dl):
         start_time = time.time()
         results, total_duration = decode_dataset(
-            dl=test_dl, model=model, token_table=token_table
+            dl=test_dl,
+            model=model,
+            token_table=token_table,
+            decoding_method=args.decoding_method,
+            beam_size=args.beam_size,
+            max_batch_frames=args.max_batch_frames,
+            max_batch_size=args.max_batch_size,
         )
         end_time = time.time()
         elapsed_seconds = end_time - start_time
@@ -315,7 +416,13 @@ def main():
             f"Real time factor (RTF): {elapsed_seconds:.3f}/{total_duration:.3f} = {rtf:.3f}"
         )
 
-        save_results(res_dir=res_dir, test_set_name=test_set, results=results)
+        save_results(
+            res_dir=res_dir,
+            test_set_name=test_set,
+            results=results,
+            suffix=suffix,
+            rtf=rtf,
+        )
 
     logging.info("Done!")
 
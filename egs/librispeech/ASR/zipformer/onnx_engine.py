@@ -0,0 +1,470 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An inference engine for the encoder, decoder and joiner exported by
+./export-onnx.py, which runs them with onnxruntime.
+
+Compared with `OnnxModel` in ./onnx_pretrained.py:
+
+  - The sessions of the encoder and of the decoder and joiner have their own
+    thread settings. The decoder and joiner run on a few rows per call, for
+    which one thread is usually the fastest.
+  - The decoder and joiner are run through IOBinding on preallocated NumPy
+    buffers, so no input or output is allocated per frame.
+  - Utterances are sorted by length and decoded in batches of similar
+    length, so little computation is spent on padding.
+  - It supports greedy search and modified beam search.
+
+Usage::
+
+    engine = OnnxTransducerEngine(
+        encoder_model_filename="exp/encoder-epoch-99-avg-1.onnx",
+        decoder_model_filename="exp/decoder-epoch-99-avg-1.onnx",
+        joiner_model_filename="exp/joiner-epoch-99-avg-1.onnx",
+    )
+    # features is a list of arrays of shape (T, 80)
+    hyps = engine.decode(features, decoding_method="modified_beam_search")
+"""
+
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import onnxruntime as ort
+
+LOG_EPS = math.log(1e-10)
+
+_ONNX_TO_NUMPY_DTYPE = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(int64)": np.int64,
+}
+
+
+def get_session_options(
+    num_threads: int,
+    inter_op_num_threads: int = 1,
+    allow_spinning: bool = True,
+) -> ort.SessionOptions:
+    """
+    Args:
+      num_threads:
+        The number of threads used within an operator.
+      inter_op_num_threads:
+        The number of threads used to run operators in parallel.
+      allow_spinning:
+        If False, idle threads of the session sleep instead of spinning.
+        Disable it when several sessions or processes share the CPU.
+    """
+    session_opts = ort.SessionOptions()
+    session_opts.intra_op_num_threads = num_threads
+    session_opts.inter_op_num_threads = inter_op_num_threads
+    if not allow_spinning:
+        session_opts.add_session_config_entry("session.intra_op.allow_spinning", "0")
+        session_opts.add_session_config_entry("session.inter_op.allow_spinning", "0")
+    return session_opts
+
+
+class _BoundSession(object):
+    """Run a session through IOBinding on NumPy buffers whose first
+    dimension is the batch size. The buffers are allocated for `capacity`
+    rows, and a binding is created for each batch size that is used, on
+    views of the first rows of the buffers."""
+
+    def __init__(self, session: ort.InferenceSession, shapes: Dict[str, Tuple[int]]):
+        """
+        Args:
+          session:
+            The session to run.
+          shapes:
+            The shape, without the batch dimension, of each input and
+            output of the session.
+        """
+        self.session = session
+        self.shapes = shapes
+        self.dtypes = {
+            x.name: _ONNX_TO_NUMPY_DTYPE[x.type]
+            for x in session.get_inputs() + session.get_outputs()
+        }
+        self.input_names = [x.name for x in session.get_inputs()]
+        self.output_names = [x.name for x in session.get_outputs()]
+        self.capacity = 0
+        self.buffers: Dict[str, np.ndarray] = {}
+        self.bindings: Dict[int, ort.IOBinding] = {}
+
+    def _reserve(self, batch_size: int) -> None:
+        if batch_size <= self.capacity:
+            return
+        self.capacity = max(batch_size, 2 * self.capacity)
+        self.buffers = {
+            name: np.zeros((self.capacity,) + shape, dtype=self.dtypes[name])
+            for name, shape in self.shapes.items()
+        }
+        self.bindings = {}
+
+    def _get_binding(self, batch_size: int) -> ort.IOBinding:
+        binding = self.bindings.get(batch_size)
+        if binding is None:
+            binding = self.session.io_binding()
+            for name in self.input_names + self.output_names:
+                value = ort.OrtValue.ortvalue_from_numpy(
+                    self.buffers[name][:batch_size]
+                )
+                if name in self.input_names:
+                    binding.bind_ortvalue_input(name, value)
+                else:
+                    binding.bind_ortvalue_output(name, value)
+            self.bindings[batch_size] = binding
+        return binding
+
+    def run(self, *inputs: np.ndarray) -> np.ndarray:
+        """Copy the inputs to the buffers, run the session and return a view
+        of the buffer of the first output. The view is overwritten by the
+        next call."""
+        batch_size = inputs[0].shape[0]
+        self._reserve(batch_size)
+        for name, x in zip(self.input_names, inputs):
+            np.copyto(self.buffers[name][:batch_size], x, casting="same_kind")
+        self.session.run_with_iobinding(self._get_binding(batch_size))
+        return self.buffers[self.output_names[0]][:batch_size]
+
+
+class OnnxTransducerEngine(object):
+    def __init__(
+        self,
+        encoder_model_filename: str,
+        decoder_model_filename: str,
+        joiner_model_filename: str,
+        encoder_num_threads: int = 4,
+        search_num_threads: int = 1,
+        allow_spinning: bool = True,
+        providers: Optional[List[str]] = None,
+    ):
+        """
+        Args:
+          encoder_model_filename:
+            Path to the encoder exported by ./export-onnx.py.
+          decoder_model_filename:
+            Path to the decoder exported by ./export-onnx.py.
+          joiner_model_filename:
+            Path to the joiner exported by ./export-onnx.py.
+          encoder_num_threads:
+            The number of threads of the encoder session.
+          search_num_threads:
+            The number of threads of the decoder and joiner sessions.
+          allow_spinning:
+            See :func:`get_session_options`.
+          providers:
+            The execution providers. Defaults to ["CPUExecutionProvider"].
+            The buffers of the decoder and joiner are in CPU memory.
+        """
+        if providers is None:
+            providers = ["CPUExecutionProvider"]
+
+        self.encoder = ort.InferenceSession(
+            encoder_model_filename,
+            sess_options=get_session_options(
+                encoder_num_threads, allow_spinning=allow_spinning
+            ),
+            providers=providers,
+        )
+        search_opts = get_session_options(
+            search_num_threads, allow_spinning=allow_spinning
+        )
+        decoder = ort.InferenceSession(
+            decoder_model_filename, sess_options=search_opts, providers=providers
+        )
+        joiner = ort.InferenceSession(
+            joiner_model_filename, sess_options=search_opts, providers=providers
+        )
+
+        decoder_meta = decoder.get_modelmeta().custom_metadata_map
+        self.context_size = int(decoder_meta["context_size"])
+        self.vocab_size = int(decoder_meta["vocab_size"])
+        joiner_meta = joiner.get_modelmeta().custom_metadata_map
+        self.joiner_dim = int(joiner_meta["joiner_dim"])
+        self.blank_id = 0  # hard-code to 0
+
+        self.encoder_input_dtype = _ONNX_TO_NUMPY_DTYPE[
+            self.encoder.get_inputs()[0].type
+        ]
+
+        self.decoder = _BoundSession(
+            decoder,
+            shapes={
+                "y": (self.context_size,),
+                "decoder_out": (self.joiner_dim,),
+            },
+        )
+        self.joiner = _BoundSession(
+            joiner,
+            shapes={
+                "encoder_out": (self.joiner_dim,),
+                "decoder_out": (self.joiner_dim,),
+                "logit": (self.vocab_size,),
+            },
+        )
+
+    def run_encoder(
+        self, x: np.ndarray, x_lens: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+          x:
+            A 3-D array of shape (N, T, C).
+          x_lens:
+            A 1-D array of shape (N,). Its dtype is np.int64.
+        Returns:
+          Return a tuple containing:
+            - encoder_out, its shape is (N, T', joiner_dim)
+            - encoder_out_lens, its shape is (N,)
+        """
+        encoder_out, encoder_out_lens = self.encoder.run(
+            ["encoder_out", "encoder_out_lens"],
+            {"x": x.astype(self.encoder_input_dtype, copy=False), "x_lens": x_lens},
+        )
+        return encoder_out, encoder_out_lens
+
+    def run_decoder(self, y: np.ndarray) -> np.ndarray:
+        """
+        Args:
+          y:
+            A 2-D array of shape (N, context_size). Its dtype is np.int64.
+        Returns:
+          Return a 2-D array of shape (N, joiner_dim). It is overwritten by
+          the next call.
+        """
+        return self.decoder.run(y)
+
+    def run_joiner(
+        self, encoder_out: np.ndarray, decoder_out: np.ndarray
+    ) -> np.ndarray:
+        """
+        Args:
+          encoder_out:
+            A 2-D array of shape (N, joiner_dim).
+          decoder_out:
+            A 2-D array of shape (N, joiner_dim).
+        Returns:
+          Return a 2-D array of shape (N, vocab_size). It is overwritten by
+          the next call.
+        """
+        return self.joiner.run(encoder_out, decoder_out)
+
+    def greedy_search(
+        self, encoder_out: np.ndarray, encoder_out_lens: np.ndarray
+    ) -> List[List[int]]:
+        """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
+
+        Args:
+          encoder_out:
+            A 3-D array of shape (N, T, joiner_dim).
+          encoder_out_lens:
+            A 1-D array of shape (N,).
+        Returns:
+          Return the decoded results for each utterance.
+        """
+        N = encoder_out.shape[0]
+        blank_id = self.blank_id
+        context_size = self.context_size
+
+        # Sort by length in descending order, so that the utterances still
+        # active at frame t are the first num_active[t] ones.
+        indexes = np.argsort(-encoder_out_lens, kind="stable")
+        encoder_out_lens = encoder_out_lens[indexes]
+        # (T, N, joiner_dim)
+        encoder_out = np.ascontiguousarray(encoder_out[indexes].transpose(1, 0, 2))
+        T = int(encoder_out_lens[0]) if N > 0 else 0
+        num_active = (encoder_out_lens[None, :] > np.arange(T)[:, None]).sum(axis=1)
+
+        hyps = [[] for _ in range(N)]
+        contexts = np.full((N, context_size), blank_id, dtype=np.int64)
+        decoder_out = self.run_decoder(contexts).copy()
+
+        for t in range(T):
+            n = int(num_active[t])
+            logit = self.run_joiner(encoder_out[t, :n], decoder_out[:n])
+            y = logit.argmax(axis=1)
+            emitted = np.nonzero(y != blank_id)[0]
+            if emitted.size == 0:
+                continue
+            for i in emitted.tolist():
+                hyps[i].append(int(y[i]))
+            # Shift the contexts of the utterances that emitted a token and
+            # update only their decoder outputs.
+            contexts[emitted, :-1] = contexts[emitted, 1:]
+            contexts[emitted, -1] = y[emitted]
+            decoder_out[emitted] = self.run_decoder(contexts[emitted])
+
+        ans = [None] * N
+        for i, h in zip(indexes.tolist(), hyps):
+            ans[i] = h
+        return ans
+
+    def modified_beam_search(
+        self,
+        encoder_out: np.ndarray,
+        encoder_out_lens: np.ndarray,
+        beam: int = 4,
+    ) -> List[List[int]]:
+        """Beam search in batch mode with --max-sym-per-frame=1 being
+        hardcoded. It is the same algorithm as `modified_beam_search` in
+        ./beam_search.py.
+
+        Args:
+          encoder_out:
+            A 3-D array of shape (N, T, joiner_dim).
+          encoder_out_lens:
+            A 1-D array of shape (N,).
+          beam:
+            Number of active paths of each utterance.
+        Returns:
+          Return the decoded results for each utterance.
+        """
+        N = encoder_out.shape[0]
+        blank_id = self.blank_id
+        context_size = self.context_size
+        V = self.vocab_size
+
+        indexes = np.argsort(-encoder_out_lens, kind="stable")
+        encoder_out_lens = encoder_out_lens[indexes]
+        encoder_out = np.ascontiguousarray(encoder_out[indexes].transpose(1, 0, 2))
+        T = int(encoder_out_lens[0]) if N > 0 else 0
+        num_active = (encoder_out_lens[None, :] > np.arange(T)[:, None]).sum(axis=1)
+
+        # B[i] maps the tokens of a hypothesis of utterance i, including
+        # context_size leading blanks, to its log prob.
+        initial = tuple([blank_id] * context_size)
+        B: List[Dict[Tuple[int, ...], float]] = [{initial: 0.0} for _ in range(N)]
+
+        for t in range(T):
+            n = int(num_active[t])
+            ys_list = []
+            log_probs_list = []
+            row_splits = [0]
+            for i in range(n):
+                for ys, log_prob in B[i].items():
+                    ys_list.append(ys)
+                    log_probs_list.append(log_prob)
+                row_splits.append(len(ys_list))
+
+            contexts = np.array([ys[-context_size:] for ys in ys_list], dtype=np.int64)
+            decoder_out = self.run_decoder(contexts)
+            hyp_to_utt = np.repeat(np.arange(n), np.diff(row_splits))
+            logit = self.run_joiner(encoder_out[t, hyp_to_utt], decoder_out)
+
+            logit = logit.astype(np.float32)
+            max_logit = logit.max(axis=1, keepdims=True)
+            log_probs = logit - max_logit
+            log_probs -= np.log(np.exp(log_probs).sum(axis=1, keepdims=True))
+            log_probs += np.array(log_probs_list, dtype=np.float32)[:, None]
+
+            for i in range(n):
+                start, end = row_splits[i], row_splits[i + 1]
+                scores = log_probs[start:end].reshape(-1)
+                k = min(beam, scores.size)
+                topk = np.argpartition(-scores, k - 1)[:k]
+
+                new_hyps: Dict[Tuple[int, ...], float] = {}
+                for j in topk.tolist():
+                    ys = ys_list[start + j // V]
+                    token = j % V
+                    if token != blank_id:
+                        ys = ys + (token,)
+                    score = float(scores[j])
+                    if ys in new_hyps:
+                        score = np.logaddexp(new_hyps[ys], score)
+                    new_hyps[ys] = score
+                B[i] = new_hyps
+
+        ans = [None] * N
+        for i, hyps in zip(indexes.tolist(), B):
+            # The same length normalization as `modified_beam_search`
+            # in ./beam_search.py
+            ys = max(hyps, key=lambda ys: hyps[ys] / len(ys))
+            ans[i] = list(ys[context_size:])
+        return ans
+
+    def decode(
+        self,
+        features: List[np.ndarray],
+        decoding_method: str = "greedy_search",
+        beam: int = 4,
+        max_batch_frames: int = 0,
+        max_batch_size: int = 0,
+    ) -> List[List[int]]:
+        """Decode a list of utterances.
+
+        The utterances are sorted by the number of frames and split into
+        batches of consecutive utterances, so that the utterances of a batch
+        have similar lengths.
+
+        Args:
+          features:
+            features[i] is the fbank features, of shape (T_i, C), of
+            utterance i.
+          decoding_method:
+            Either greedy_search or modified_beam_search.
+          beam:
+            Number of active paths of modified_beam_search.
+          max_batch_frames:
+            If positive, the maximum number of frames, including padding,
+            of a batch.
+          max_batch_size:
+            If positive, the maximum number of utterances of a batch.
+        Returns:
+          Return the decoded token IDs of each utterance.
+        """
+        if decoding_method not in ("greedy_search", "modified_beam_search"):
+            raise ValueError(f"Unsupported decoding method: {decoding_method}")
+
+        lengths = [f.shape[0] for f in features]
+        order = sorted(range(len(features)), key=lambda i: lengths[i], reverse=True)
+
+        ans = [None] * len(features)
+        start = 0
+        while start < len(order):
+            # order is sorted, so the first utterance of a batch is its
+            # longest one
+            longest = lengths[order[start]]
+            end = len(order)
+            if max_batch_frames > 0:
+                end = min(end, start + max(1, max_batch_frames // max(longest, 1)))
+            if max_batch_size > 0:
+                end = min(end, start + max_batch_size)
+            batch = order[start:end]
+            start = end
+
+            x = np.full(
+                (len(batch), longest, features[batch[0]].shape[1]),
+                LOG_EPS,
+                dtype=np.float32,
+            )
+            for j, i in enumerate(batch):
+                x[j, : lengths[i]] = features[i]
+            x_lens = np.array([lengths[i] for i in batch], dtype=np.int64)
+
+            encoder_out, encoder_out_lens = self.run_encoder(x, x_lens)
+            if decoding_method == "greedy_search":
+                hyps = self.greedy_search(encoder_out, encoder_out_lens)
+            else:
+                hyps = self.modified_beam_search(
+                    encoder_out, encoder_out_lens, beam=beam
+                )
+            for i, hyp in zip(batch, hyps):
+                ans[i] = hyp
+        return ans
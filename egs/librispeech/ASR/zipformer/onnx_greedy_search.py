@@ -0,0 +1,300 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Greedy search of a transducer as a single ONNX model.
+
+With the separate decoder and joiner models of ./export-onnx.py, the frame
+loop runs in Python, and the joiner on every frame and the decoder on every
+emitted token is a separate `session.run()`. For short utterances, the time
+of those calls is dominated by the overhead of the round trips.
+
+:class:`OnnxGreedySearch` contains the whole search: the frame loop, the
+joiner, the argmax, the decoder update of the utterances that emitted a
+token, and up to `max_sym_per_frame` symbols per frame. It is scripted, with
+the decoder and joiner traced, and exported as one model whose loops are ONNX
+Loop operators.
+
+The model takes the decoder contexts of the utterances as input and returns
+the contexts after the search, so it can also be used chunk by chunk in
+streaming decoding.
+"""
+
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+
+class OnnxGreedySearch(nn.Module):
+    def __init__(
+        self,
+        decoder: nn.Module,
+        joiner: nn.Module,
+        blank_id: int = 0,
+        max_sym_per_frame: int = 1,
+    ):
+        """
+        Args:
+          decoder:
+            It maps contexts of shape (N, context_size) to the projected
+            decoder output of shape (N, joiner_dim), e.g., `OnnxDecoder` in
+            ./export-onnx.py.
+          joiner:
+            It maps the projected encoder and decoder outputs, each of shape
+            (N, joiner_dim), to logits of shape (N, vocab_size), e.g.,
+            `OnnxJoiner` in ./export-onnx.py.
+          blank_id:
+            The ID of the blank symbol.
+          max_sym_per_frame:
+            The maximum number of symbols emitted per frame.
+        """
+        super().__init__()
+        assert max_sym_per_frame >= 1, max_sym_per_frame
+        self.decoder = decoder
+        self.joiner = joiner
+        self.blank_id = blank_id
+        self.max_sym_per_frame = max_sym_per_frame
+
+    def forward(
+        self,
+        encoder_out: torch.Tensor,
+        encoder_out_lens: torch.Tensor,
+        contexts: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+          encoder_out:
+            A 3-D tensor of shape (N, T, joiner_dim), the projected encoder
+            output.
+          encoder_out_lens:
+            A 1-D tensor of shape (N,).
+          contexts:
+            A 2-D tensor of shape (N, context_size) with the last tokens of
+            each utterance. It is all blank_id at the start of an utterance.
+        Returns:
+          Return a tuple containing:
+            - tokens, a 2-D tensor of shape (N, S). tokens[i, :num_tokens[i]]
+              are the tokens of utterance i, the rest is padding.
+            - timestamps, a 2-D tensor of shape (N, S) with the frame of each
+              token.
+            - num_tokens, a 1-D tensor of shape (N,).
+            - new_contexts, a 2-D tensor of shape (N, context_size) to pass to
+              the next call in streaming decoding.
+        """
+        N = encoder_out.size(0)
+        T = encoder_out.size(1)
+        blank_id = self.blank_id
+
+        # One more slot than the maximum number of tokens, to which the
+        # utterances that emit nothing write.
+        max_len = T * self.max_sym_per_frame + 1
+        tokens = torch.full(
+            [N, max_len], blank_id, dtype=torch.int64, device=encoder_out.device
+        )
+        timestamps = torch.zeros_like(tokens)
+        num_tokens = torch.zeros(N, dtype=torch.int64, device=encoder_out.device)
+
+        contexts = contexts.to(torch.int64)
+        decoder_out = self.decoder(contexts)
+
+        for t in range(T):
+            encoder_out_t = encoder_out[:, t]
+            active = encoder_out_lens > t
+            for _ in range(self.max_sym_per_frame):
+                logits = self.joiner(encoder_out_t, decoder_out)
+                y = logits.argmax(dim=1)
+                emitted = active & (y != blank_id)
+
+                index = num_tokens.unsqueeze(1)
+                tokens = tokens.scatter(
+                    1, index, y.masked_fill(~emitted, blank_id).unsqueeze(1)
+                )
+                timestamps = timestamps.scatter(1, index, torch.full_like(index, t))
+                num_tokens = num_tokens + emitted.to(torch.int64)
+
+                if not bool(emitted.any()):
+                    break
+
+                # Update the contexts and decoder outputs of the utterances
+                # that emitted a token
+                mask = emitted.unsqueeze(1)
+                new_contexts = torch.cat([contexts[:, 1:], y.unsqueeze(1)], dim=1)
+                contexts = torch.where(mask, new_contexts, contexts)
+                decoder_out = torch.where(mask, self.decoder(contexts), decoder_out)
+                active = emitted
+
+        S = int(num_tokens.max())
+        return tokens[:, :S], timestamps[:, :S], num_tokens, contexts
+
+
+def export_greedy_search_onnx(
+    decoder: nn.Module,
+    joiner: nn.Module,
+    filename: str,
+    context_size: int,
+    joiner_dim: int,
+    max_sym_per_frame: int = 1,
+    opset_version: int = 13,
+) -> None:
+    """Export the greedy search to ONNX format.
+    The exported model has three inputs:
+
+        - encoder_out: a tensor of shape (N, T, joiner_dim)
+        - encoder_out_lens: a tensor of shape (N,)
+        - contexts: a tensor of shape (N, context_size)
+
+    and produces four outputs:
+
+        - tokens: a tensor of shape (N, S)
+        - timestamps: a tensor of shape (N, S)
+        - num_tokens: a tensor of shape (N,)
+        - new_contexts: a tensor of shape (N, context_size)
+
+    Args:
+      decoder:
+        The decoder wrapper, `OnnxDecoder` of ./export-onnx.py.
+      joiner:
+        The joiner wrapper, `OnnxJoiner` of ./export-onnx.py.
+      filename:
+        The filename to save the exported model.
+      context_size:
+        The context size of the decoder.
+      joiner_dim:
+        The input dimension of the joiner.
+      max_sym_per_frame:
+        The maximum number of symbols emitted per frame.
+      opset_version:
+        The opset version to use.
+    """
+    y = torch.zeros(2, context_size, dtype=torch.int64)
+    decoder = torch.jit.trace(decoder, (y,))
+    x = torch.rand(2, joiner_dim)
+    joiner = torch.jit.trace(joiner, (x, x))
+
+    model = torch.jit.script(
+        OnnxGreedySearch(
+            decoder=decoder,
+            joiner=joiner,
+            max_sym_per_frame=max_sym_per_frame,
+        )
+    )
+
+    encoder_out = torch.rand(2, 10, joiner_dim, dtype=torch.float32)
+    encoder_out_lens = torch.tensor([10, 7], dtype=torch.int64)
+    contexts = torch.zeros(2, context_size, dtype=torch.int64)
+
+    torch.onnx.export(
+        model,
+        (encoder_out, encoder_out_lens, contexts),
+        filename,
+        verbose=False,
+        opset_version=opset_version,
+        input_names=["encoder_out", "encoder_out_lens", "contexts"],
+        output_names=["tokens", "timestamps", "num_tokens", "new_contexts"],
+        dynamic_axes={
+            "encoder_out": {0: "N", 1: "T"},
+            "encoder_out_lens": {0: "N"},
+            "contexts": {0: "N"},
+            "tokens": {0: "N", 1: "S"},
+            "timestamps": {0: "N", 1: "S"},
+            "num_tokens": {0: "N"},
+            "new_contexts": {0: "N"},
+        },
+    )
+
+
+def _test_onnx_greedy_search():
+    from decoder import Decoder
+
+    torch.manual_seed(20240101)
+    vocab_size, joiner_dim, context_size = 10, 16, 2
+
+    class _Decoder(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.decoder = Decoder(
+                vocab_size=vocab_size,
+                decoder_dim=joiner_dim,
+                blank_id=0,
+                context_size=context_size,
+            )
+
+        def forward(self, y: torch.Tensor) -> torch.Tensor:
+            return self.decoder(y, need_pad=False).squeeze(1)
+
+    class _Joiner(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.output_linear = nn.Linear(joiner_dim, vocab_size)
+
+        def forward(self, encoder_out, decoder_out):
+            return self.output_linear(torch.tanh(encoder_out + decoder_out))
+
+    decoder = _Decoder().eval()
+    joiner = _Joiner().eval()
+    # Make blank less likely, so that several symbols per frame are emitted
+    joiner.output_linear.bias.data[0] -= 1.0
+
+    def reference(encoder_out, T, contexts, max_sym_per_frame):
+        hyp = contexts
+        timestamps = []
+        for t in range(T):
+            for _ in range(max_sym_per_frame):
+                y = torch.tensor([hyp[-context_size:]])
+                logits = joiner(encoder_out[None, t], decoder(y))
+                v = int(logits.argmax(dim=1))
+                if v == 0:
+                    break
+                hyp = hyp + [v]
+                timestamps.append(t)
+        return hyp[context_size:], timestamps
+
+    encoder_out = torch.randn(3, 12, joiner_dim)
+    encoder_out_lens = torch.tensor([12, 5, 9])
+    contexts = torch.tensor([[0, 0], [0, 0], [3, 4]])
+
+    y = torch.zeros(2, context_size, dtype=torch.int64)
+    traced_decoder = torch.jit.trace(decoder, (y,))
+    x = torch.rand(2, joiner_dim)
+    traced_joiner = torch.jit.trace(joiner, (x, x))
+
+    for max_sym_per_frame in [1, 3]:
+        model = torch.jit.script(
+            OnnxGreedySearch(
+                traced_decoder, traced_joiner, max_sym_per_frame=max_sym_per_frame
+            )
+        )
+        with torch.no_grad():
+            tokens, timestamps, num_tokens, new_contexts = model(
+                encoder_out, encoder_out_lens, contexts
+            )
+        for i in range(3):
+            ref_hyp, ref_timestamps = reference(
+                encoder_out[i],
+                int(encoder_out_lens[i]),
+                contexts[i].tolist(),
+                max_sym_per_frame,
+            )
+            n = int(num_tokens[i])
+            assert tokens[i, :n].tolist() == ref_hyp, (tokens[i], ref_hyp)
+            assert timestamps[i, :n].tolist() == ref_timestamps
+            expected_contexts = (contexts[i].tolist() + ref_hyp)[-context_size:]
+            assert new_contexts[i].tolist() == expected_contexts
+
+
+if __name__ == "__main__":
+    _test_onnx_greedy_search()
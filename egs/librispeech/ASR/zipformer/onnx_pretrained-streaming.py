@@ -107,6 +107,16 @@ def get_parser():
         help="Path to the joiner onnx model. ",
     )
 
+    parser.add_argument(
+        "--greedy-search-model-filename",
+        type=str,
+        default="",
+        help="""Path to the greedy search onnx model exported by
+        ./export-onnx-streaming.py with --export-greedy-search True. If given,
+        it decodes each chunk in one call instead of running the decoder and
+        joiner frame by frame.""",
+    )
+
     parser.add_argument(
         "--tokens",
         type=str,
@@ -131,6 +141,7 @@ class OnnxModel:
         encoder_model_filename: str,
         decoder_model_filename: str,
         joiner_model_filename: str,
+        greedy_search_model_filename: str = "",
     ):
         session_opts = ort.SessionOptions()
         session_opts.inter_op_num_threads = 1
@@ -142,6 +153,10 @@ class OnnxModel:
         self.init_decoder(decoder_model_filename)
         self.init_joiner(joiner_model_filename)
 
+        self.greedy_search = None
+        if greedy_search_model_filename:
+            self.init_greedy_search(greedy_search_model_filename)
+
     def init_encoder(self, encoder_model_filename: str):
         self.encoder = ort.InferenceSession(
             encoder_model_filename,
@@ -259,6 +274,16 @@ class OnnxModel:
 
         logging.info(f"joiner_dim: {self.joiner_dim}")
 
+    def init_greedy_search(self, greedy_search_model_filename: str):
+        self.greedy_search = ort.InferenceSession(
+            greedy_search_model_filename,
+            sess_options=self.session_opts,
+            providers=["CPUExecutionProvider"],
+        )
+
+        meta = self.greedy_search.get_modelmeta().custom_metadata_map
+        logging.info(f"max_sym_per_frame: {meta['max_sym_per_frame']}")
+
     def _build_encoder_input_output(
         self,
         x: torch.Tensor,
@@ -373,6 +398,30 @@ class OnnxModel:
 
         return torch.from_numpy(out)
 
+    def run_greedy_search(
+        self, encoder_out: torch.Tensor, contexts: List[int]
+    ) -> List[int]:
+        """
+        Args:
+          encoder_out:
+            A 3-D tensor of shape (1, T, joiner_dim)
+          contexts:
+            The last context_size tokens decoded so far.
+        Returns:
+          Return the tokens decoded from this chunk.
+        """
+        encoder_out_lens = torch.tensor([encoder_out.size(1)], dtype=torch.int64)
+        contexts = torch.tensor([contexts], dtype=torch.int64)
+        tokens, num_tokens = self.greedy_search.run(
+            ["tokens", "num_tokens"],
+            {
+                "encoder_out": encoder_out.numpy(),
+                "encoder_out_lens": encoder_out_lens.numpy(),
+                "contexts": contexts.numpy(),
+            },
+        )
+        return tokens[0, : num_tokens[0]].tolist()
+
 
 def read_sound_files(
     filenames: List[str], expected_sample_rate: float
@@ -475,6 +524,7 @@ def main():
         encoder_model_filename=args.encoder_model_filename,
         decoder_model_filename=args.decoder_model_filename,
         joiner_model_filename=args.joiner_model_filename,
+        greedy_search_model_filename=args.greedy_search_model_filename,
     )
 
     sample_rate = 16000
@@ -519,13 +569,18 @@ def main():
             frames = torch.cat(frames, dim=0)
             frames = frames.unsqueeze(0)
             encoder_out = model.run_encoder(frames)
-            hyp, decoder_out = greedy_search(
-                model,
-                encoder_out,
-                context_size,
-                decoder_out,
-                hyp,
-            )
+            if model.greedy_search is not None:
+                if hyp is None:
+                    hyp = [0] * context_size  # blank_id is 0
+                hyp += model.run_greedy_search(encoder_out, hyp[-context_size:])
+            else:
+                hyp, decoder_out = greedy_search(
+                    model,
+                    encoder_out,
+                    context_size,
+                    decoder_out,
+                    hyp,
+                )
 
     token_table = k2.SymbolTable.from_file(args.tokens)
 
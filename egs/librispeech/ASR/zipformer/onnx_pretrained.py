@@ -63,6 +63,10 @@ It will generate the following 3 files inside $repo/exp:
   $repo/test_wavs/1089-134686-0001.wav \
   $repo/test_wavs/1221-135766-0001.wav \
   $repo/test_wavs/1221-135766-0002.wav
+
+If ./export-onnx.py is run with --export-greedy-search True, you can pass
+--greedy-search-model-filename $repo/exp/greedy_search-epoch-99-avg-1.onnx
+to run the whole greedy search in one onnxruntime call per batch.
 """
 
 import argparse
@@ -104,6 +108,14 @@ def get_parser():
         help="Path to the joiner onnx model. ",
     )
 
+    parser.add_argument(
+        "--greedy-search-model-filename",
+        type=str,
+        default="",
+        help="""Path to the greedy search onnx model. If given, it is used
+        instead of running the decoder and joiner frame by frame.""",
+    )
+
     parser.add_argument(
         "--tokens",
         type=str,
@@ -136,6 +148,7 @@ class OnnxModel:
         encoder_model_filename: str,
         decoder_model_filename: str,
         joiner_model_filename: str,
+        greedy_search_model_filename: str = "",
     ):
         session_opts = ort.SessionOptions()
         session_opts.inter_op_num_threads = 1
@@ -147,6 +160,10 @@ class OnnxModel:
         self.init_decoder(decoder_model_filename)
         self.init_joiner(joiner_model_filename)
 
+        self.greedy_search = None
+        if greedy_search_model_filename:
+            self.init_greedy_search(greedy_search_model_filename)
+
     def init_encoder(self, encoder_model_filename: str):
         self.encoder = ort.InferenceSession(
             encoder_model_filename,
@@ -180,6 +197,16 @@ class OnnxModel:
 
         logging.info(f"joiner_dim: {self.joiner_dim}")
 
+    def init_greedy_search(self, greedy_search_model_filename: str):
+        self.greedy_search = ort.InferenceSession(
+            greedy_search_model_filename,
+            sess_options=self.session_opts,
+            providers=["CPUExecutionProvider"],
+        )
+
+        meta = self.greedy_search.get_modelmeta().custom_metadata_map
+        logging.info(f"max_sym_per_frame: {meta['max_sym_per_frame']}")
+
     def run_encoder(
         self,
         x: torch.Tensor,
@@ -245,6 +272,30 @@ class OnnxModel:
 
         return torch.from_numpy(out)
 
+    def run_greedy_search(
+        self, encoder_out: torch.Tensor, encoder_out_lens: torch.Tensor
+    ) -> List[List[int]]:
+        """
+        Args:
+          encoder_out:
+            A 3-D tensor of shape (N, T, joiner_dim)
+          encoder_out_lens:
+            A 1-D tensor of shape (N,)
+        Returns:
+          Return the decoded results for each utterance.
+        """
+        N = encoder_out.size(0)
+        contexts = torch.zeros(N, self.context_size, dtype=torch.int64)
+        tokens, num_tokens = self.greedy_search.run(
+            ["tokens", "num_tokens"],
+            {
+                "encoder_out": encoder_out.numpy(),
+                "encoder_out_lens": encoder_out_lens.numpy(),
+                "contexts": contexts.numpy(),
+            },
+        )
+        return [tokens[i, : num_tokens[i]].tolist() for i in range(N)]
+
 
 def read_sound_files(
     filenames: List[str], expected_sample_rate: float
@@ -360,6 +411,7 @@ def main():
         encoder_model_filename=args.encoder_model_filename,
         decoder_model_filename=args.decoder_model_filename,
         joiner_model_filename=args.joiner_model_filename,
+        greedy_search_model_filename=args.greedy_search_model_filename,
     )
 
     logging.info("Constructing Fbank computer")
@@ -392,11 +444,14 @@ def main():
     feature_lengths = torch.tensor(feature_lengths, dtype=torch.int64)
     encoder_out, encoder_out_lens = model.run_encoder(features, feature_lengths)
 
-    hyps = greedy_search(
-        model=model,
-        encoder_out=encoder_out,
-        encoder_out_lens=encoder_out_lens,
-    )
+    if model.greedy_search is not None:
+        hyps = model.run_greedy_search(encoder_out, encoder_out_lens)
+    else:
+        hyps = greedy_search(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+        )
     s = "\n"
 
     token_table = k2.SymbolTable.from_file(args.tokens)
@@ -0,0 +1,249 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Static int8 quantization of the encoder exported by ./export-onnx.py and
+./export-onnx-streaming.py.
+
+With dynamic quantization, the scale of the activations of each quantized
+MatMul is computed at runtime on every call. With static quantization, it is
+computed once from the activations of a calibration set, and the model is
+saved in the QDQ format, i.e., with QuantizeLinear/DequantizeLinear pairs
+around the quantized operators, which onnxruntime fuses into int8 kernels.
+
+The calibration set is a CutSet with precomputed features, e.g.,
+data/fbank/librispeech_cuts_dev-clean.jsonl.gz. For the streaming encoder,
+the calibration utterances are fed chunk by chunk to the float32 model, so
+that the cached states in the calibration inputs are those of real
+streaming decoding.
+"""
+
+import argparse
+import logging
+import math
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import onnxruntime as ort
+from lhotse import CutSet
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+
+LOG_EPS = math.log(1e-10)
+
+_CALIBRATION_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "entropy": CalibrationMethod.Entropy,
+    "percentile": CalibrationMethod.Percentile,
+}
+
+
+def add_static_quant_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--calibration-cuts",
+        type=str,
+        default="",
+        help="""If not empty, a CutSet with precomputed features, e.g.,
+        data/fbank/librispeech_cuts_dev-clean.jsonl.gz, used to calibrate
+        the encoder with static int8 quantization. The encoder is then also
+        saved to encoder-xxx.int8-static.onnx.
+        """,
+    )
+
+    parser.add_argument(
+        "--num-calibration-cuts",
+        type=int,
+        default=100,
+        help="Number of cuts of --calibration-cuts used for calibration.",
+    )
+
+    parser.add_argument(
+        "--calibration-method",
+        type=str,
+        default="minmax",
+        choices=list(_CALIBRATION_METHODS.keys()),
+        help="How to compute the range of the activations from calibration.",
+    )
+
+
+def load_calibration_features(filename: str, num_cuts: int) -> List[np.ndarray]:
+    """Return the features, each of shape (T, C), of the first `num_cuts`
+    cuts of the CutSet in `filename`."""
+    cuts = CutSet.from_file(filename).subset(first=num_cuts)
+    features = [cut.load_features() for cut in cuts]
+    logging.info(
+        f"Loaded {len(features)} calibration cuts, "
+        f"{sum(f.shape[0] for f in features)} frames"
+    )
+    return features
+
+
+def _pad(features: List[np.ndarray], length: int) -> np.ndarray:
+    ans = np.full(
+        (len(features), length, features[0].shape[1]), LOG_EPS, dtype=np.float32
+    )
+    for i, f in enumerate(features):
+        n = min(f.shape[0], length)
+        ans[i, :n] = f[:n]
+    return ans
+
+
+class EncoderCalibrationDataReader(CalibrationDataReader):
+    def __init__(self, features: List[np.ndarray], batch_size: int = 1):
+        """Provide the inputs of the non-streaming encoder.
+
+        Args:
+          features:
+            The features, each of shape (T, C), of the calibration utterances.
+          batch_size:
+            Number of utterances in each input. Utterances are sorted by
+            length so that there is little padding.
+        """
+        features = sorted(features, key=lambda f: f.shape[0])
+        self.batches = [
+            features[i : i + batch_size] for i in range(0, len(features), batch_size)
+        ]
+        self.index = 0
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        if self.index >= len(self.batches):
+            return None
+        batch = self.batches[self.index]
+        self.index += 1
+        lengths = [f.shape[0] for f in batch]
+        return {
+            "x": _pad(batch, max(lengths)),
+            "x_lens": np.array(lengths, dtype=np.int64),
+        }
+
+
+class StreamingEncoderCalibrationDataReader(CalibrationDataReader):
+    def __init__(
+        self,
+        encoder_filename: str,
+        features: List[np.ndarray],
+        batch_size: int = 1,
+    ):
+        """Provide the inputs, including the cached states, of each chunk of
+        the streaming encoder.
+
+        Args:
+          encoder_filename:
+            The float32 streaming encoder. It is run on each chunk to get the
+            states of the next one.
+          features:
+            The features, each of shape (T, C), of the calibration utterances.
+          batch_size:
+            Number of utterances decoded in parallel.
+        """
+        session_opts = ort.SessionOptions()
+        session_opts.inter_op_num_threads = 1
+        session_opts.intra_op_num_threads = 4
+        self.encoder = ort.InferenceSession(
+            str(encoder_filename),
+            sess_options=session_opts,
+            providers=["CPUExecutionProvider"],
+        )
+        meta = self.encoder.get_modelmeta().custom_metadata_map
+        self.T = int(meta["T"])
+        self.decode_chunk_len = int(meta["decode_chunk_len"])
+
+        features = sorted(features, key=lambda f: f.shape[0])
+        batches = [
+            features[i : i + batch_size] for i in range(0, len(features), batch_size)
+        ]
+        self.chunks = self._chunks(batches)
+
+    def _init_states(self, batch_size: int) -> Dict[str, np.ndarray]:
+        states = {}
+        for x in self.encoder.get_inputs():
+            if x.name == "x":
+                continue
+            # The batch dimension is the symbolic dimension "N"
+            shape = [batch_size if isinstance(d, str) else d for d in x.shape]
+            dtype = np.int64 if x.type == "tensor(int64)" else np.float32
+            states[x.name] = np.zeros(shape, dtype=dtype)
+        return states
+
+    def _chunks(self, batches: List[List[np.ndarray]]):
+        output_names = [x.name for x in self.encoder.get_outputs()]
+        for batch in batches:
+            num_frames = max(f.shape[0] for f in batch)
+            num_chunks = max(1, math.ceil(num_frames / self.decode_chunk_len))
+            x = _pad(batch, (num_chunks - 1) * self.decode_chunk_len + self.T)
+            states = self._init_states(len(batch))
+            for i in range(num_chunks):
+                start = i * self.decode_chunk_len
+                chunk = np.ascontiguousarray(x[:, start : start + self.T])
+                inputs = {"x": chunk, **states}
+                yield inputs
+
+                out = self.encoder.run(output_names, inputs)
+                # Outputs other than encoder_out are new_{name} of the
+                # state {name}
+                states = {
+                    name[len("new_") :]: value
+                    for name, value in zip(output_names[1:], out[1:])
+                }
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        return next(self.chunks, None)
+
+
+def quantize_encoder_static(
+    model_input: Path,
+    model_output: Path,
+    data_reader: CalibrationDataReader,
+    calibration_method: str = "minmax",
+    op_types_to_quantize: Optional[List[str]] = None,
+) -> None:
+    """Quantize the weights and activations of the encoder to int8 and save
+    it in the QDQ format.
+
+    Args:
+      model_input:
+        The float32 encoder.
+      model_output:
+        The quantized encoder.
+      data_reader:
+        An :class:`EncoderCalibrationDataReader` or a
+        :class:`StreamingEncoderCalibrationDataReader`.
+      calibration_method:
+        One of minmax, entropy and percentile.
+      op_types_to_quantize:
+        Defaults to ["MatMul"], the same as the dynamic quantization in
+        ./export-onnx.py.
+    """
+    if op_types_to_quantize is None:
+        op_types_to_quantize = ["MatMul"]
+
+    quantize_static(
+        model_input=model_input,
+        model_output=model_output,
+        calibration_data_reader=data_reader,
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=op_types_to_quantize,
+        per_channel=True,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=_CALIBRATION_METHODS[calibration_method],
+    )
@@ -165,6 +165,11 @@ class ScaledAdam(BatchedOptimizer):
                    of the parameter tensor.  This is provided to save a little time
                    in the update.
      clipping_update_period: if clipping_scale is specified, this is the period
+          foreach: If True, the parameters of each group are updated together with
+                   torch._foreach_* ops, and the gradient clipping is done without
+                   copying the gradient norm to the CPU on every step.  The result is
+                   the same as with foreach=False, and so is the layout of the state,
+                   so checkpoints can be loaded with either setting.
     """
 
     def __init__(
@@ -180,6 +185,7 @@ class ScaledAdam(BatchedOptimizer):
         scalar_max=10.0,
         size_update_period=4,
         clipping_update_period=100,
+        foreach=False,
     ):
 
         defaults = dict(
@@ -203,6 +209,7 @@ class ScaledAdam(BatchedOptimizer):
         super(ScaledAdam, self).__init__(param_groups, defaults)
         assert len(self.param_groups) == len(parameters_names)
         self.parameters_names = parameters_names
+        self.foreach = foreach
 
     def _get_names_of_parameters(
         self, params_or_named_params
@@ -341,9 +348,16 @@ class ScaledAdam(BatchedOptimizer):
                     len(batches[0][1]) == 0
                 ):  # if len(first state) == 0: not yet initialized
                     clipping_scale = 1
+                elif self.foreach:
+                    clipping_scale = self._get_clipping_scale_foreach(group, batches)
                 else:
                     clipping_scale = self._get_clipping_scale(group, batches)
 
+                if self.foreach and len(batches[0][1]) != 0:
+                    # The state of all batches was initialized on the 1st step.
+                    self._step_foreach(group, batches, clipping_scale)
+                    continue
+
                 for p, state, _ in batches:
                     # Perform optimization step.
                     # grad is not going to be None, we handled that when creating the batches.
@@ -452,6 +466,48 @@ class ScaledAdam(BatchedOptimizer):
             )
         first_state["model_norms"][step % clipping_update_period] = tot_norm
 
+        self._update_clipping_threshold(group, first_state)
+
+        try:
+            model_norm_threshold = first_state["model_norm_threshold"]
+        except KeyError:
+            return 1.0  # threshold has not yet been set.
+
+        ans = min(1.0, (model_norm_threshold / (tot_norm + 1.0e-20)).item())
+        if ans != ans:  # e.g. ans is nan
+            ans = 0.0
+        if ans < 1.0:
+            first_state["num_clipped"] += 1
+        if ans < 0.1:
+            logging.warn(
+                f"Scaling gradients by {ans}, model_norm_threshold={model_norm_threshold}"
+            )
+            if self.show_dominant_parameters:
+                assert p.shape[0] == len(param_names)
+                self._show_gradient_dominating_parameter(
+                    tuples, tot_sumsq, group["scalar_lr_scale"]
+                )
+
+        if ans == 0.0:
+            for (p, state, param_names) in tuples:
+                p.grad.zero_()  # get rid of infinity()
+
+        return ans
+
+    def _update_clipping_threshold(self, group: dict, first_state: dict) -> None:
+        """
+        Every `clipping_update_period` steps, and on a few steps at the start,
+        set first_state["model_norm_threshold"] from the recent gradient norms
+        in first_state["model_norms"] and print some stats.
+
+        Args:
+           group: the parameter group, an item in self.param_groups
+           first_state: the state of the first batch of parameters of the group
+        """
+        clipping_scale = group["clipping_scale"]
+        clipping_update_period = group["clipping_update_period"]
+        step = first_state["step"]
+
         irregular_estimate_steps = [
             i for i in [10, 20, 40] if i < clipping_update_period
         ]
@@ -489,32 +545,6 @@ class ScaledAdam(BatchedOptimizer):
                 f"threshold={threshold:.3e}, percent-clipped={percent_clipped:.1f}"
             )
 
-        try:
-            model_norm_threshold = first_state["model_norm_threshold"]
-        except KeyError:
-            return 1.0  # threshold has not yet been set.
-
-        ans = min(1.0, (model_norm_threshold / (tot_norm + 1.0e-20)).item())
-        if ans != ans:  # e.g. ans is nan
-            ans = 0.0
-        if ans < 1.0:
-            first_state["num_clipped"] += 1
-        if ans < 0.1:
-            logging.warn(
-                f"Scaling gradients by {ans}, model_norm_threshold={model_norm_threshold}"
-            )
-            if self.show_dominant_parameters:
-                assert p.shape[0] == len(param_names)
-                self._show_gradient_dominating_parameter(
-                    tuples, tot_sumsq, group["scalar_lr_scale"]
-                )
-
-        if ans == 0.0:
-            for (p, state, param_names) in tuples:
-                p.grad.zero_()  # get rid of infinity()
-
-        return ans
-
     def _show_gradient_dominating_parameter(
         self,
         tuples: List[Tuple[Tensor, dict, List[str]]],
@@ -758,6 +788,228 @@ class ScaledAdam(BatchedOptimizer):
         p.clamp_(min=-scalar_max, max=scalar_max)
         p.add_(delta)
 
+    def _get_clipping_scale_foreach(
+        self, group: dict, tuples: List[Tuple[Tensor, dict, List[str]]]
+    ) -> Union[float, Tensor]:
+        """
+        Like :meth:`_get_clipping_scale`, but the returned scale is a tensor on the
+        device of the parameters, so the gradient norm is not copied to the CPU
+        except on the steps where the clipping threshold is updated.  Because of
+        that, it does not warn about gradients that are scaled by less than 0.1.
+        The scale is 0 if the gradients are not finite.
+
+        Args:
+           group: the parameter group, an item in self.param_groups
+           tuples: a list of tuples of (param, state, param_names), see
+                :meth:`_get_clipping_scale`.
+        """
+        assert len(tuples) >= 1
+        clipping_scale = group["clipping_scale"]
+        (first_p, first_state, _) = tuples[0]
+        step = first_state["step"]
+        if clipping_scale is None or step == 0:
+            return 1.0
+        clipping_update_period = group["clipping_update_period"]
+        scalar_lr_scale = group["scalar_lr_scale"]
+
+        grads = [p.grad for (p, _, _) in tuples]
+        if any(g.is_sparse for g in grads):
+            raise RuntimeError("ScaledAdam optimizer does not support sparse gradients")
+        scales = [
+            torch.full_like(p.grad, scalar_lr_scale)
+            if p.numel() == p.shape[0]  # a batch of scalars
+            else state["param_rms"]
+            for (p, state, _) in tuples
+        ]
+        norms = torch._foreach_norm(torch._foreach_mul(grads, scales))
+        tot_sumsq = torch.stack(norms).square().sum()
+
+        tot_norm = tot_sumsq.sqrt()
+        if "model_norms" not in first_state:
+            first_state["model_norms"] = torch.zeros(
+                clipping_update_period, device=first_p.device
+            )
+        first_state["model_norms"][step % clipping_update_period] = tot_norm
+
+        self._update_clipping_threshold(group, first_state)
+
+        try:
+            model_norm_threshold = first_state["model_norm_threshold"]
+        except KeyError:
+            return 1.0  # threshold has not yet been set.
+
+        ans = (model_norm_threshold / (tot_norm + 1.0e-20)).clamp(max=1.0)
+        ans = torch.nan_to_num(ans, nan=0.0)
+        # It becomes a tensor, which can also be loaded with foreach=False.
+        first_state["num_clipped"] = first_state["num_clipped"] + (ans < 1.0)
+        return ans
+
+    def _step_foreach(
+        self,
+        group: dict,
+        tuples: List[Tuple[Tensor, dict, List[str]]],
+        clipping_scale: Union[float, Tensor],
+    ):
+        """
+        Do the step of :meth:`_step_one_batch` for all batches of parameters of
+        a group at once, using torch._foreach_* ops where possible.
+
+        Args:
+           group: dict to look up configuration values
+           tuples: a list of tuples of (param, state, param_names), see
+                :meth:`_get_clipping_scale`.  The state of all batches must
+                have been initialized.
+           clipping_scale: the result of :meth:`_get_clipping_scale_foreach`
+        """
+        size_update_period = group["size_update_period"]
+        beta1 = group["betas"][0]
+
+        params = [p for (p, _, _) in tuples]
+        states = [state for (_, state, _) in tuples]
+        grads = [p.grad for p in params]
+
+        step = states[0]["step"]
+        assert all(state["step"] == step for state in states), "steps differ"
+
+        if isinstance(clipping_scale, Tensor):
+            torch._foreach_mul_(grads, [clipping_scale] * len(grads))
+            # The scale is 0 if the grads are not finite; get rid of infinity.
+            for grad in grads:
+                grad.nan_to_num_(nan=0.0, posinf=0.0, neginf=0.0)
+        elif clipping_scale != 1.0:
+            torch._foreach_mul_(grads, clipping_scale)
+
+        torch._foreach_mul_([state["delta"] for state in states], beta1)
+
+        scalar_tuples = []
+        tensor_tuples = []
+        for p, state, grad in zip(params, states, grads):
+            if p.numel() == p.shape[0]:
+                scalar_tuples.append((p, state))
+            else:
+                tensor_tuples.append((p, state, grad))
+
+        # There are only a few batches of scalars.
+        for p, state in scalar_tuples:
+            self._step_scalar(group, p, state)
+
+        if tensor_tuples:
+            for p, state, grad in tensor_tuples:
+                dims = list(range(1, p.ndim))
+                state["scale_grads"][step % size_update_period] = (p * grad).sum(
+                    dim=dims, keepdim=True
+                )
+                if step % size_update_period == size_update_period - 1:
+                    state["param_rms"].copy_(
+                        (p**2).mean(dim=dims, keepdim=True).sqrt()
+                    )
+
+            if step % size_update_period == size_update_period - 1 and step > 0:
+                self._size_update_foreach(group, tensor_tuples)
+
+            self._step_tensors_foreach(group, tensor_tuples)
+
+        for state in states:
+            state["step"] = step + 1
+
+    def _size_update_foreach(
+        self, group: dict, tuples: List[Tuple[Tensor, dict, Tensor]]
+    ) -> None:
+        """
+        Like :meth:`_size_update`, for all batches of non-scalar parameters of a
+        group at once.
+
+        Args:
+           group: dict to look up configuration values
+           tuples: a list of tuples of (param, state, grad)
+        """
+        beta1, beta2 = group["betas"]
+        size_lr = group["lr"] * group["scalar_lr_scale"]
+        param_min_rms = group["param_min_rms"]
+        param_max_rms = group["param_max_rms"]
+        eps = group["eps"]
+        step = tuples[0][1]["step"]
+        size_update_period = group["size_update_period"]
+
+        params = [p for (p, _, _) in tuples]
+        states = [state for (_, state, _) in tuples]
+        scale_grads = [state["scale_grads"] for state in states]
+        param_rms = [state["param_rms"] for state in states]
+
+        beta2_corr = beta2**size_update_period
+
+        scale_exp_avg_sq = [state["scale_exp_avg_sq"] for state in states]
+        torch._foreach_mul_(scale_exp_avg_sq, beta2_corr)
+        torch._foreach_add_(
+            scale_exp_avg_sq,
+            [(g**2).mean(dim=0) for g in scale_grads],
+            alpha=1 - beta2_corr,
+        )
+
+        size_step = (step + 1) // size_update_period
+        bias_correction2 = 1 - beta2_corr**size_step
+
+        denom = torch._foreach_sqrt(scale_exp_avg_sq)
+        torch._foreach_add_(denom, eps)
+
+        scale_steps = torch._foreach_div([g.sum(dim=0) for g in scale_grads], denom)
+        torch._foreach_mul_(scale_steps, -size_lr * (bias_correction2**0.5))
+
+        for scale_step, rms in zip(scale_steps, param_rms):
+            scale_step.masked_fill_(rms < param_min_rms, 0.0)
+            torch.minimum(scale_step, (param_max_rms - rms) / rms, out=scale_step)
+
+        torch._foreach_add_(
+            [state["delta"] for state in states],
+            torch._foreach_mul(params, scale_steps),
+            alpha=(1 - beta1),
+        )
+
+    def _step_tensors_foreach(
+        self, group: dict, tuples: List[Tuple[Tensor, dict, Tensor]]
+    ) -> None:
+        """
+        Like :meth:`_step`, for all batches of non-scalar parameters of a group
+        at once.  It modifies the parameters.
+
+        Args:
+           group: dict to look up configuration values
+           tuples: a list of tuples of (param, state, grad)
+        """
+        lr = group["lr"]
+        beta1, beta2 = group["betas"]
+        eps = group["eps"]
+        param_min_rms = group["param_min_rms"]
+
+        params = [p for (p, _, _) in tuples]
+        states = [state for (_, state, _) in tuples]
+        grads = [grad for (_, _, grad) in tuples]
+
+        exp_avg_sq = [state["exp_avg_sq"] for state in states]
+        torch._foreach_mul_(exp_avg_sq, beta2)
+        torch._foreach_addcmul_(exp_avg_sq, grads, grads, value=(1 - beta2))
+
+        state = states[0]
+        this_step = state["step"] - (state["zero_step"] if "zero_step" in state else 0)
+        bias_correction2 = 1 - beta2 ** (this_step + 1)
+        if bias_correction2 < 0.99:
+            denom = torch._foreach_mul(exp_avg_sq, 1.0 / bias_correction2)
+            torch._foreach_sqrt_(denom)
+        else:
+            denom = torch._foreach_sqrt(exp_avg_sq)
+        torch._foreach_add_(denom, eps)
+        updates = torch._foreach_div(grads, denom)
+
+        alpha = [
+            state["param_rms"].clamp(min=param_min_rms) * (-lr * (1 - beta1))
+            for state in states
+        ]
+        torch._foreach_mul_(updates, alpha)
+
+        deltas = [state["delta"] for state in states]
+        torch._foreach_add_(deltas, updates)
+        torch._foreach_add_(params, deltas)
+
 
 class LRScheduler(object):
     """
@@ -1237,6 +1489,65 @@ def _test_scaled_adam(hidden_dim: int):
         logging.info(f"output_magnitudes = {output_magnitudes}")
 
 
+def _test_scaled_adam_foreach():
+    # foreach=True should give the same result as foreach=False, and the
+    # state dicts should be interchangeable.
+    E = 20
+
+    def make_model():
+        fix_random_seed(42)
+        return torch.nn.Sequential(
+            torch.nn.Linear(E, 30),
+            torch.nn.PReLU(),
+            torch.nn.Linear(30, 30),
+            torch.nn.PReLU(),
+            torch.nn.Linear(30, E),
+        )
+
+    fix_random_seed(0)
+    train_pairs = [(torch.randn(4, E), torch.randn(4, E)) for _ in range(5)]
+
+    def train(m, optim, num_epochs):
+        for epoch in range(num_epochs):
+            for x, y in train_pairs:
+                loss = ((m(x) - y) ** 2).mean()
+                loss.backward()
+                optim.step()
+                optim.zero_grad()
+
+    models = []
+    for foreach in [False, True]:
+        m = make_model()
+        optim = ScaledAdam(
+            m.named_parameters(),
+            lr=0.03,
+            clipping_scale=2.0,
+            clipping_update_period=20,
+            foreach=foreach,
+        )
+        train(m, optim, num_epochs=30)
+        models.append(m)
+
+        # Resume with the other setting
+        m2 = make_model()
+        m2.load_state_dict(m.state_dict())
+        optim2 = ScaledAdam(
+            m2.named_parameters(),
+            lr=0.03,
+            clipping_scale=2.0,
+            clipping_update_period=20,
+            foreach=not foreach,
+        )
+        optim2.load_state_dict(optim.state_dict())
+        train(m, optim, num_epochs=2)
+        train(m2, optim2, num_epochs=2)
+        for p, p2 in zip(m.parameters(), m2.parameters()):
+            assert torch.allclose(p, p2, atol=1e-5), (p - p2).abs().max()
+
+    for p, p2 in zip(models[0].parameters(), models[1].parameters()):
+        assert torch.allclose(p, p2, atol=1e-5), (p - p2).abs().max()
+
+
 if __name__ == "__main__":
     torch.set_num_threads(1)
     torch.set_num_interop_threads(1)
@@ -1255,4 +1566,5 @@ if __name__ == "__main__":
         hidden_dim = 200
 
     _test_scaled_adam(hidden_dim)
+    _test_scaled_adam_foreach()
     _test_eden()
@@ -18,13 +18,14 @@
 import logging
 import math
 import random
-from typing import Optional, Tuple, Union
+from typing import Callable, List, Optional, Tuple, Union
 
 import k2
 import torch
 import torch.nn as nn
 from torch import Tensor
 from torch.cuda.amp import custom_bwd, custom_fwd
+from torch.utils.checkpoint import checkpoint as torch_checkpoint
 
 
 def logaddexp_onnx(x: Tensor, y: Tensor) -> Tensor:
@@ -272,7 +273,16 @@ class CutoffEstimator:
         """
         Returns true if x is above the cutoff.
         """
+        state = _checkpoint_state
+        if state is not None and state.recomputing:
+            # Make the same decision as in the forward pass, see checkpoint().
+            ans = state.cutoffs[state.num_cutoffs_replayed]
+            state.num_cutoffs_replayed += 1
+            return ans
+
         ans = x > self.cutoff
+        if state is not None:
+            state.cutoffs.append(ans)
         self.count += 1
         if ans:
             self.count_above += 1
@@ -284,6 +294,63 @@ class CutoffEstimator:
         return ans
 
 
+class _CheckpointState:
+    """
+    What is needed to recompute a checkpointed function in the same way as in
+    the forward pass, apart from the torch RNG state, which is restored by
+    torch.utils.checkpoint.
+    """
+
+    def __init__(self):
+        # Many modules here, e.g. Balancer and Whiten, use the `random` module.
+        self.py_rng_state = random.getstate()
+        # Results of CutoffEstimator in the forward pass, which depend on
+        # the memory usage.
+        self.cutoffs: List[bool] = []
+        self.num_cutoffs_replayed = 0
+        self.recomputing = False
+
+
+_checkpoint_state: Optional[_CheckpointState] = None
+
+
+def checkpoint(function: Callable, *args, **kwargs):
+    """
+    Activation checkpointing: returns function(*args, **kwargs), but the
+    intermediate activations of `function` are not kept for the backward pass;
+    they are recomputed in the backward pass instead.
+
+    Unlike torch.utils.checkpoint.checkpoint(), the recomputation also uses the
+    same random numbers from the `random` module and the same decisions of
+    CutoffEstimator as the forward pass, so modules like Balancer, Whiten and
+    the const-attention in Zipformer2EncoderLayer do the same thing both times,
+    and the custom autograd functions save the same tensors.  The torch RNG
+    state, e.g. for dropout and ActivationDropoutAndLinear, is restored by
+    torch.utils.checkpoint.
+    """
+    state = _CheckpointState()
+
+    def run(*args):
+        global _checkpoint_state
+        prev_state = _checkpoint_state
+        prev_py_rng_state = None
+        if state.recomputing:
+            # Called for the 2nd time, in the backward pass.
+            prev_py_rng_state = random.getstate()
+            random.setstate(state.py_rng_state)
+            state.num_cutoffs_replayed = 0
+        _checkpoint_state = state
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _checkpoint_state = prev_state
+            state.recomputing = True
+            if prev_py_rng_state is not None:
+                random.setstate(prev_py_rng_state)
+
+    return torch_checkpoint(run, *args, use_reentrant=False)
+
+
 class SoftmaxFunction(torch.autograd.Function):
     """
     Tries to handle half-precision derivatives in a randomized way that should
@@ -0,0 +1,123 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+
+import torch
+from torch import Tensor
+
+
+class StatePool(object):
+    """Keep the zipformer states of many streams in fixed slots of
+    preallocated batched tensors.
+
+    The states have the same layout as the return value of
+    `get_init_states()` in ./streaming_decode.py. For layer-i,
+    states[i*6:(i+1)*6] is (cached_key, cached_nonlin_attn, cached_val1,
+    cached_val2, cached_conv1, cached_conv2), states[-2] is the cached left
+    padding for ConvNeXt module and states[-1] is processed_lens.
+
+    Instead of :func:`stack_states` and :func:`unstack_states`, which
+    concatenate and split every cached tensor of every stream for each chunk,
+    the states of a batch are gathered from the pool by slot index before
+    a chunk and the new states are scattered back after it.
+    """
+
+    def __init__(self, init_states: List[Tensor], capacity: int = 64) -> None:
+        """
+        Args:
+          init_states:
+            The initial states of a single stream, i.e., the return value
+            of `get_init_states(model, batch_size=1)`.
+          capacity:
+            The initial number of slots. It is doubled whenever all slots
+            are in use.
+        """
+        assert (len(init_states) - 2) % 6 == 0, len(init_states)
+        assert capacity > 0, capacity
+        tot_num_layers = (len(init_states) - 2) // 6
+
+        # The batch dim of each state tensor
+        self.batch_dims = [1, 1, 1, 1, 0, 0] * tot_num_layers + [0, 0]
+        for s, dim in zip(init_states, self.batch_dims):
+            assert s.size(dim) == 1, (s.shape, dim)
+
+        self.init_states = init_states
+        self.capacity = 0
+        self.states: List[Tensor] = [
+            s.narrow(dim, 0, 0) for s, dim in zip(init_states, self.batch_dims)
+        ]
+        self.free_slots: List[int] = []
+        self._grow(capacity)
+
+    @property
+    def device(self) -> torch.device:
+        return self.init_states[-1].device
+
+    @property
+    def num_used(self) -> int:
+        return self.capacity - len(self.free_slots)
+
+    def _grow(self, capacity: int) -> None:
+        """Reallocate the pool with the given number of slots."""
+        assert capacity > self.capacity, (capacity, self.capacity)
+        num_new = capacity - self.capacity
+        new_states = []
+        for s, init, dim in zip(self.states, self.init_states, self.batch_dims):
+            repeats = [1] * init.dim()
+            repeats[dim] = num_new
+            new_states.append(torch.cat([s, init.repeat(*repeats)], dim=dim))
+        self.states = new_states
+
+        # free_slots is used as a stack, so lower slots are allocated first
+        self.free_slots = (
+            list(range(capacity - 1, self.capacity - 1, -1)) + self.free_slots
+        )
+        self.capacity = capacity
+
+    def allocate(self) -> int:
+        """Allocate a slot holding the initial states and return its index."""
+        if not self.free_slots:
+            self._grow(2 * self.capacity)
+        slot = self.free_slots.pop()
+        for s, init, dim in zip(self.states, self.init_states, self.batch_dims):
+            s.narrow(dim, slot, 1).copy_(init)
+        return slot
+
+    def free(self, slot: int) -> None:
+        """Release a slot, e.g., when the stream is finished."""
+        assert 0 <= slot < self.capacity, (slot, self.capacity)
+        assert slot not in self.free_slots, f"slot {slot} is not in use"
+        self.free_slots.append(slot)
+
+    def gather(self, slots: List[int]) -> List[Tensor]:
+        """Return the batched states of the given slots, in the same format
+        as the return value of :func:`stack_states`."""
+        index = torch.tensor(slots, dtype=torch.int64, device=self.device)
+        return [
+            s.index_select(dim, index) for s, dim in zip(self.states, self.batch_dims)
+        ]
+
+    def scatter(self, slots: List[int], batch_states: List[Tensor]) -> None:
+        """Write the batched states, e.g., the new states returned by the
+        model, back into the given slots. It is the inverse of :func:`gather`."""
+        assert len(batch_states) == len(self.states), (
+            len(batch_states),
+            len(self.states),
+        )
+        index = torch.tensor(slots, dtype=torch.int64, device=self.device)
+        for s, new_s, dim in zip(self.states, batch_states, self.batch_dims):
+            s.index_copy_(dim, index, new_s.to(s.dtype))
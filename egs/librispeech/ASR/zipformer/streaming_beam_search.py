@@ -15,7 +15,7 @@
 # limitations under the License.
 
 import warnings
-from typing import List
+from typing import Callable, List, Optional
 
 import k2
 import torch
@@ -32,6 +32,7 @@ def greedy_search(
     encoder_out: torch.Tensor,
     streams: List[DecodeStream],
     blank_penalty: float = 0.0,
+    encoder_out_lens: Optional[torch.Tensor] = None,
 ) -> None:
     """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
 
@@ -42,6 +43,10 @@ def greedy_search(
         Output from the encoder. Its shape is (N, T, C), where N >= 1.
       streams:
         A list of Stream objects.
+      encoder_out_lens:
+        If not None, a tensor of shape (N,) with the number of frames of each
+        stream in `encoder_out`, e.g., after blank skipping. Frames after it
+        are ignored.
     """
     assert len(streams) == encoder_out.size(0)
     assert encoder_out.ndim == 3
@@ -50,6 +55,8 @@ def greedy_search(
     context_size = model.decoder.context_size
     device = model.device
     T = encoder_out.size(1)
+    if encoder_out_lens is not None:
+        encoder_out_lens = encoder_out_lens.tolist()
 
     decoder_input = torch.tensor(
         [stream.hyp[-context_size:] for stream in streams],
@@ -79,6 +86,8 @@ def greedy_search(
         y = logits.argmax(dim=1).tolist()
         emitted = False
         for i, v in enumerate(y):
+            if encoder_out_lens is not None and t >= encoder_out_lens[i]:
+                continue
             if v != blank_id:
                 streams[i].hyp.append(v)
                 emitted = True
@@ -102,6 +111,8 @@ def modified_beam_search(
     streams: List[DecodeStream],
     num_active_paths: int = 4,
     blank_penalty: float = 0.0,
+    decoder_out_cache: Optional[Callable[[List[List[int]]], torch.Tensor]] = None,
+    encoder_out_lens: Optional[torch.Tensor] = None,
 ) -> None:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -115,6 +126,15 @@ def modified_beam_search(
         A list of stream objects.
       num_active_paths:
         Number of active paths during the beam search.
+      decoder_out_cache:
+        If not None, the decoder output is looked up in this cache and the
+        decoder is only run on contexts that are not in it, e.g., a
+        `DecoderOutCache` of ./beam_search.py. It maps a list of contexts
+        to a tensor of shape (num_contexts, 1, joiner_dim).
+      encoder_out_lens:
+        If not None, a tensor of shape (N,) with the number of frames of each
+        stream in `encoder_out`, e.g., after blank skipping. Frames after it
+        are ignored.
     """
     assert encoder_out.ndim == 3, encoder_out.shape
     assert len(streams) == encoder_out.size(0)
@@ -124,6 +144,8 @@ def modified_beam_search(
     device = next(model.parameters()).device
     batch_size = len(streams)
     T = encoder_out.size(1)
+    if encoder_out_lens is not None:
+        encoder_out_lens = encoder_out_lens.tolist()
 
     B = [stream.hyps for stream in streams]
 
@@ -140,14 +162,19 @@ def modified_beam_search(
             [hyp.log_prob.reshape(1) for hyps in A for hyp in hyps], dim=0
         )  # (num_hyps, 1)
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
+        if decoder_out_cache is not None:
+            decoder_out = decoder_out_cache(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps]
+            ).unsqueeze(1)
+        else:
+            decoder_input = torch.tensor(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+            decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
         # decoder_out is of shape (num_hyps, 1, 1, decoder_output_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
@@ -181,6 +208,12 @@ def modified_beam_search(
         ragged_log_probs = k2.RaggedTensor(shape=log_probs_shape, value=log_probs)
 
         for i in range(batch_size):
+            if encoder_out_lens is not None and t >= encoder_out_lens[i]:
+                # Past the end of this stream, keep its hypotheses
+                for hyp in A[i]:
+                    B[i].add(hyp)
+                continue
+
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(num_active_paths)
 
             with warnings.catch_warnings():
@@ -33,6 +33,7 @@ Usage:
 import argparse
 import logging
 import math
+import time
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
@@ -41,9 +42,12 @@ import numpy as np
 import sentencepiece as spm
 import torch
 from asr_datamodule import LibriSpeechAsrDataModule
-from decode_stream import DecodeStream
-from kaldifeat import Fbank, FbankOptions
+from beam_search import DecoderOutCache
+from blank_skip import BlankSkipStats, skip_blank_frames
+from decode_stream import DecodeStream, get_fbank_options
+from kaldifeat import Fbank
 from lhotse import CutSet, set_caching_enabled
+from state_pool import StatePool
 from streaming_beam_search import (
     fast_beam_search_one_best,
     greedy_search,
@@ -155,6 +159,16 @@ def get_parser():
         frame. Used only when --decoding-method is modified_beam_search.""",
     )
 
+    parser.add_argument(
+        "--decoder-out-cache-size",
+        type=int,
+        default=10000,
+        help="""Maximum number of contexts in the LRU cache of decoder outputs.
+        The decoder is only run on contexts that are not in the cache.
+        0 to disable the cache.
+        Used only when --decoding-method is modified_beam_search.""",
+    )
+
     parser.add_argument(
         "--beam",
         type=float,
@@ -195,6 +209,15 @@ def get_parser():
         help="The number of streams that can be decoded parallel.",
     )
 
+    parser.add_argument(
+        "--use-state-pool",
+        type=str2bool,
+        default=False,
+        help="""If True, keep the states of all streams in preallocated batched
+        tensors and gather/scatter them by slot index for each chunk, instead of
+        stacking and unstacking the states of every stream.""",
+    )
+
     parser.add_argument(
         "--skip-scoring",
         type=str2bool,
@@ -202,6 +225,16 @@ def get_parser():
         help="""Skip scoring, but still save the ASR output (for eval sets)."""
     )
 
+    parser.add_argument(
+        "--blank-skip-threshold",
+        type=float,
+        default=0.0,
+        help="""If positive, the encoder frames of each chunk whose CTC blank
+        probability is larger than this value, e.g., 0.95, are not passed to
+        the search. It requires a model trained with --use-ctc True and
+        greedy_search or modified_beam_search.""",
+    )
+
 
     add_model_arguments(parser)
 
@@ -436,6 +469,9 @@ def decode_one_chunk(
     params: AttributeDict,
     model: nn.Module,
     decode_streams: List[DecodeStream],
+    decoder_out_cache: Optional[DecoderOutCache] = None,
+    state_pool: Optional[StatePool] = None,
+    blank_skip_stats: Optional[BlankSkipStats] = None,
 ) -> List[int]:
     """Decode one chunk frames of features for each decode_streams and
     return the indexes of finished streams in a List.
@@ -447,6 +483,15 @@ def decode_one_chunk(
         The neural model.
       decode_streams:
         A List of DecodeStream, each belonging to a utterance.
+      decoder_out_cache:
+        The cache of decoder outputs. Used only when --decoding-method
+        is modified_beam_search.
+      state_pool:
+        If not None, the states of the streams are kept in it at
+        `stream.slot` instead of in `stream.states`.
+      blank_skip_stats:
+        If not None, the number of frames kept by blank skipping is added
+        to it.
     Returns:
       Return a List containing which DecodeStreams are finished.
     """
@@ -463,7 +508,8 @@ def decode_one_chunk(
         feat, feat_len = stream.get_feature_frames(chunk_size * 2)
         features.append(feat)
         feature_lens.append(feat_len)
-        states.append(stream.states)
+        if state_pool is None:
+            states.append(stream.states)
         processed_lens.append(stream.done_frames)
 
     feature_lens = torch.tensor(feature_lens, device=device)
@@ -483,7 +529,11 @@ def decode_one_chunk(
             value=LOG_EPS,
         )
 
-    states = stack_states(states)
+    if state_pool is not None:
+        slots = [stream.slot for stream in decode_streams]
+        states = state_pool.gather(slots)
+    else:
+        states = stack_states(states)
 
     encoder_out, encoder_out_lens, new_states = streaming_forward(
         features=features,
@@ -494,10 +544,28 @@ def decode_one_chunk(
         left_context_len=left_context_len,
     )
 
+    # The number of frames of each stream in encoder_out passed to the search
+    search_lens = encoder_out_lens
+    if params.blank_skip_threshold > 0:
+        encoder_out, search_lens, _ = skip_blank_frames(
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            ctc_output=model.ctc_output(encoder_out),
+            threshold=params.blank_skip_threshold,
+            blank_id=model.decoder.blank_id,
+        )
+        if blank_skip_stats is not None:
+            blank_skip_stats.add_frames(encoder_out_lens, search_lens)
+
     encoder_out = model.joiner.encoder_proj(encoder_out)
 
     if params.decoding_method == "greedy_search":
-        greedy_search(model=model, encoder_out=encoder_out, streams=decode_streams)
+        greedy_search(
+            model=model,
+            encoder_out=encoder_out,
+            streams=decode_streams,
+            encoder_out_lens=search_lens,
+        )
     elif params.decoding_method == "fast_beam_search":
         processed_lens = torch.tensor(processed_lens, device=device)
         processed_lens = processed_lens + encoder_out_lens
@@ -516,15 +584,21 @@ def decode_one_chunk(
             streams=decode_streams,
             encoder_out=encoder_out,
             num_active_paths=params.num_active_paths,
+            decoder_out_cache=decoder_out_cache,
+            encoder_out_lens=search_lens,
         )
     else:
         raise ValueError(f"Unsupported decoding method: {params.decoding_method}")
 
-    states = unstack_states(new_states)
+    if state_pool is not None:
+        state_pool.scatter(slots, new_states)
+    else:
+        states = unstack_states(new_states)
 
     finished_streams = []
     for i in range(len(decode_streams)):
-        decode_streams[i].states = states[i]
+        if state_pool is None:
+            decode_streams[i].states = states[i]
         decode_streams[i].done_frames += encoder_out_lens[i]
         if decode_streams[i].done:
             finished_streams.append(i)
@@ -538,6 +612,7 @@ def decode_dataset(
     model: nn.Module,
     sp: spm.SentencePieceProcessor,
     decoding_graph: Optional[k2.Fsa] = None,
+    blank_skip_stats: Optional[BlankSkipStats] = None,
 ) -> Dict[str, List[Tuple[List[str], List[str]]]]:
     """Decode dataset.
 
@@ -553,6 +628,9 @@ def decode_dataset(
       decoding_graph:
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search.
+      blank_skip_stats:
+        If not None, the time spent in decoding chunks, the duration of the
+        cuts and the number of frames kept by blank skipping are added to it.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -562,28 +640,56 @@ def decode_dataset(
     """
     device = model.device
 
-    opts = FbankOptions()
-    opts.device = device
-    opts.frame_opts.dither = 0
-    opts.frame_opts.snip_edges = False
-    opts.frame_opts.samp_freq = 16000
-    opts.mel_opts.num_bins = 80
+    opts = get_fbank_options(device=device)
 
     log_interval = 100
 
+    if (
+        params.decoding_method == "modified_beam_search"
+        and params.decoder_out_cache_size > 0
+    ):
+        decoder_out_cache = DecoderOutCache(
+            model=model, max_size=params.decoder_out_cache_size
+        )
+    else:
+        decoder_out_cache = None
+
+    if params.use_state_pool:
+        state_pool = StatePool(
+            init_states=get_init_states(model=model, batch_size=1, device=device),
+            capacity=params.num_decode_streams,
+        )
+    else:
+        state_pool = None
+
+    # Time spent in decode_one_chunk() and the duration of the cuts, for
+    # the real time factor
+    elapsed_seconds = 0.0
+    audio_seconds = 0.0
+
     decode_results = []
     # Contain decode streams currently running.
     decode_streams = []
     for num, cut in enumerate(cuts):
         # each utterance has a DecodeStream.
-        initial_states = get_init_states(model=model, batch_size=1, device=device)
-        decode_stream = DecodeStream(
-            params=params,
-            cut_id=cut.id,
-            initial_states=initial_states,
-            decoding_graph=decoding_graph,
-            device=device,
-        )
+        if state_pool is not None:
+            decode_stream = DecodeStream(
+                params=params,
+                cut_id=cut.id,
+                initial_states=None,
+                decoding_graph=decoding_graph,
+                device=device,
+                slot=state_pool.allocate(),
+            )
+        else:
+            initial_states = get_init_states(model=model, batch_size=1, device=device)
+            decode_stream = DecodeStream(
+                params=params,
+                cut_id=cut.id,
+                initial_states=initial_states,
+                decoding_graph=decoding_graph,
+                device=device,
+            )
 
         audio: np.ndarray = cut.load_audio()
         # audio.shape: (1, num_samples)
@@ -600,6 +706,7 @@ def decode_dataset(
         ), "Should be normalized to [-1, 1], 10 for tolerance..."
 
         samples = torch.from_numpy(audio).squeeze(0)
+        audio_seconds += cut.duration
 
         fbank = Fbank(opts)
         feature = fbank(samples.to(device))
@@ -609,9 +716,16 @@ def decode_dataset(
         decode_streams.append(decode_stream)
 
         while len(decode_streams) >= params.num_decode_streams:
+            start_time = time.perf_counter()
             finished_streams = decode_one_chunk(
-                params=params, model=model, decode_streams=decode_streams
+                params=params,
+                model=model,
+                decode_streams=decode_streams,
+                decoder_out_cache=decoder_out_cache,
+                state_pool=state_pool,
+                blank_skip_stats=blank_skip_stats,
             )
+            elapsed_seconds += time.perf_counter() - start_time
             for i in sorted(finished_streams, reverse=True):
                 decode_results.append(
                     (
@@ -620,6 +734,8 @@ def decode_dataset(
                         sp.decode(decode_streams[i].decoding_result()).split(),
                     )
                 )
+                if state_pool is not None:
+                    state_pool.free(decode_streams[i].slot)
                 del decode_streams[i]
 
         if num % log_interval == 0:
@@ -627,9 +743,16 @@ def decode_dataset(
 
     # decode final chunks of last sequences
     while len(decode_streams):
+        start_time = time.perf_counter()
         finished_streams = decode_one_chunk(
-            params=params, model=model, decode_streams=decode_streams
+            params=params,
+            model=model,
+            decode_streams=decode_streams,
+            decoder_out_cache=decoder_out_cache,
+            state_pool=state_pool,
+            blank_skip_stats=blank_skip_stats,
         )
+        elapsed_seconds += time.perf_counter() - start_time
         for i in sorted(finished_streams, reverse=True):
             decode_results.append(
                 (
@@ -638,8 +761,17 @@ def decode_dataset(
                     sp.decode(decode_streams[i].decoding_result()).split(),
                 )
             )
+            if state_pool is not None:
+                state_pool.free(decode_streams[i].slot)
             del decode_streams[i]
 
+    if decoder_out_cache is not None:
+        logging.info(f"{decoder_out_cache}")
+
+    if blank_skip_stats is not None:
+        blank_skip_stats.add_time(audio_seconds, elapsed_seconds)
+        logging.info(f"{blank_skip_stats}")
+
     if params.decoding_method == "greedy_search":
         key = "greedy_search"
     elif params.decoding_method == "fast_beam_search":
@@ -747,6 +879,13 @@ def main():
         params.suffix += f"_max-contexts-{params.max_contexts}"
         params.suffix += f"_max-states-{params.max_states}"
 
+    if params.blank_skip_threshold > 0:
+        assert params.use_ctc, "--blank-skip-threshold requires --use-ctc True"
+        assert (
+            params.decoding_method != "fast_beam_search"
+        ), "--blank-skip-threshold does not support fast_beam_search"
+        params.suffix += f"_blank-skip-{params.blank_skip_threshold}"
+
     if params.use_averaged_model:
         params.suffix += "-use-averaged-model"
 
@@ -872,12 +1011,17 @@ def main():
     test_cuts = [test_clean_cuts, test_other_cuts]
 
     for test_set, test_cut in zip(test_sets, test_cuts):
+        blank_skip_stats = BlankSkipStats()
         results_dict = decode_dataset(
             cuts=test_cut,
             params=params,
             model=model,
             sp=sp,
             decoding_graph=decoding_graph,
+            blank_skip_stats=blank_skip_stats,
+        )
+        blank_skip_stats.write(
+            params.res_dir / f"rtf-summary-{test_set}-{params.suffix}.txt"
         )
 
 
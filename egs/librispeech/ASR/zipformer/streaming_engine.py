@@ -0,0 +1,499 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in-process streaming decoding engine with continuous batching.
+
+Unlike `decode_dataset()` in ./streaming_decode.py, which decodes a `CutSet`,
+streams can join and leave at any time between two chunks. Each call to
+`StreamingEngine.step()` picks at most `max_batch_size` streams that have
+enough features for one chunk, decodes them in a batch with
+`decode_one_chunk()` and returns the partial results.
+
+`AsyncStreamingEngine` is an asyncio front end on top of it. It runs the
+decoding in a worker thread and waits at most `max_wait_ms` after a stream
+becomes ready before decoding a chunk, so that more streams can be batched
+together. Usage:
+
+    engine = AsyncStreamingEngine(
+        StreamingEngine(params, model, sp=sp, max_batch_size=64),
+        max_wait_ms=20,
+    )
+    engine.start()
+
+    stream = engine.create_stream()
+    stream.accept_waveform(16000, samples)  # can be called many times
+    stream.finish_input()
+
+    async for result in stream:
+        print(result.text, result.is_final)
+
+    await engine.stop()
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import k2
+import sentencepiece as spm
+import torch
+from beam_search import DecoderOutCache
+from decode_stream import DecodeStream
+from state_pool import StatePool
+from streaming_decode import decode_one_chunk, get_init_states
+from torch import nn
+
+from icefall.utils import AttributeDict
+
+
+@dataclass
+class StreamingResult:
+    # The id of the stream
+    stream_id: str
+
+    # The decoded token ids so far
+    tokens: List[int]
+
+    # The decoded text so far. Empty if no BPE model is given.
+    text: str
+
+    # True if it is the result of the last chunk of the stream
+    is_final: bool
+
+
+class StreamingEngine(object):
+    def __init__(
+        self,
+        params: AttributeDict,
+        model: nn.Module,
+        sp: Optional[spm.SentencePieceProcessor] = None,
+        decoding_graph: Optional[k2.Fsa] = None,
+        max_batch_size: int = 64,
+        decoder_out_cache: Optional[DecoderOutCache] = None,
+        use_state_pool: bool = True,
+    ) -> None:
+        """
+        Args:
+          params:
+            It's the return value of :func:`get_params` updated with the
+            arguments of ./streaming_decode.py.
+          model:
+            The neural model. It should be in eval mode and `model.device`
+            should be set.
+          sp:
+            The BPE model. If given, the partial results contain also text.
+          decoding_graph:
+            The decoding graph. Used only when --decoding-method is
+            fast_beam_search.
+          max_batch_size:
+            Maximum number of streams decoded in one chunk.
+          decoder_out_cache:
+            The cache of decoder outputs. Used only when --decoding-method
+            is modified_beam_search.
+          use_state_pool:
+            If True, keep the states of all streams in a `StatePool`.
+        """
+        assert max_batch_size > 0, max_batch_size
+        self.params = params
+        self.model = model
+        self.sp = sp
+        self.decoding_graph = decoding_graph
+        self.max_batch_size = max_batch_size
+        self.decoder_out_cache = decoder_out_cache
+
+        if use_state_pool:
+            self.state_pool = StatePool(
+                init_states=get_init_states(
+                    model=model, batch_size=1, device=model.device
+                ),
+                capacity=max_batch_size,
+            )
+        else:
+            self.state_pool = None
+
+        # Number of feature frames consumed by one chunk
+        self.chunk_length = int(params.chunk_size) * 2
+
+        self.streams: Dict[str, DecodeStream] = {}
+
+        # The time (from time.monotonic()) a stream was last decoded or
+        # added. Streams that waited longest are decoded first.
+        self._last_served: Dict[str, float] = {}
+
+        self._id_counter = itertools.count()
+
+    def add_stream(self, stream_id: Optional[str] = None) -> DecodeStream:
+        """Create a stream and return it.
+
+        Args:
+          stream_id:
+            The id of the stream. If None, a unique one is generated.
+        """
+        if stream_id is None:
+            stream_id = self.new_stream_id()
+        assert stream_id not in self.streams, f"{stream_id} exists"
+
+        device = self.model.device
+        if self.state_pool is not None:
+            initial_states = None
+            slot = self.state_pool.allocate()
+        else:
+            initial_states = get_init_states(
+                model=self.model, batch_size=1, device=device
+            )
+            slot = None
+        stream = DecodeStream(
+            params=self.params,
+            cut_id=stream_id,
+            initial_states=initial_states,
+            decoding_graph=self.decoding_graph,
+            device=device,
+            slot=slot,
+        )
+        self.streams[stream_id] = stream
+        self._last_served[stream_id] = time.monotonic()
+        return stream
+
+    def new_stream_id(self) -> str:
+        return f"stream-{next(self._id_counter)}"
+
+    def remove_stream(self, stream_id: str) -> None:
+        """Remove a stream, e.g., when the client disconnects."""
+        stream = self.streams.pop(stream_id, None)
+        self._last_served.pop(stream_id, None)
+        if stream is not None and self.state_pool is not None:
+            self.state_pool.free(stream.slot)
+
+    def ready_streams(self) -> List[DecodeStream]:
+        """Return the streams that have enough features for one chunk,
+        ordered by the time they were last decoded."""
+        ready = [s for s in self.streams.values() if s.is_ready(self.chunk_length)]
+        ready.sort(key=lambda s: self._last_served[s.id])
+        return ready
+
+    def result(self, stream: DecodeStream) -> StreamingResult:
+        tokens = stream.decoding_result()
+        text = self.sp.decode(tokens) if self.sp is not None else ""
+        return StreamingResult(
+            stream_id=stream.id,
+            tokens=tokens,
+            text=text,
+            is_final=stream.done,
+        )
+
+    def step(
+        self, streams: Optional[List[DecodeStream]] = None
+    ) -> List[StreamingResult]:
+        """Decode one chunk for a batch of streams.
+
+        Finished streams are removed from the engine.
+
+        Args:
+          streams:
+            The streams to decode. If None, at most `max_batch_size` streams
+            are selected from :func:`ready_streams`.
+        Returns:
+          Return the partial (or final) results of the decoded streams.
+        """
+        if streams is None:
+            streams = self.ready_streams()[: self.max_batch_size]
+        if len(streams) == 0:
+            return []
+        assert len(streams) <= self.max_batch_size, len(streams)
+
+        with torch.no_grad():
+            decode_one_chunk(
+                params=self.params,
+                model=self.model,
+                decode_streams=streams,
+                decoder_out_cache=self.decoder_out_cache,
+                state_pool=self.state_pool,
+            )
+
+        now = time.monotonic()
+        results = []
+        for stream in streams:
+            results.append(self.result(stream))
+            if stream.done:
+                self.remove_stream(stream.id)
+            else:
+                self._last_served[stream.id] = now
+        return results
+
+
+class StreamHandle(object):
+    """The client side of a stream in :class:`AsyncStreamingEngine`.
+
+    Features are buffered and handed over to the engine between two chunks.
+    Results can be received by iterating over it with `async for`, or
+    through the callback given to :func:`AsyncStreamingEngine.create_stream`.
+    """
+
+    def __init__(
+        self,
+        engine: "AsyncStreamingEngine",
+        stream_id: str,
+        callback: Optional[Callable[[StreamingResult], None]] = None,
+    ) -> None:
+        self.engine = engine
+        self.stream_id = stream_id
+        self.callback = callback
+
+        self._pending_features: List[torch.Tensor] = []
+        self._pending_samples: List[torch.Tensor] = []
+        self._sample_rate: Optional[int] = None
+        self._input_finished = False
+        # The time (from time.monotonic()) of the last call to
+        # accept_features(), accept_waveform() or finish_input()
+        self._last_input_time = time.monotonic()
+        # True once the stream is added to the engine
+        self._added = False
+        # None marks the end of the results
+        self._results: "asyncio.Queue[Optional[StreamingResult]]" = asyncio.Queue()
+        self._closed = False
+
+    def accept_features(self, features: torch.Tensor) -> None:
+        """Append feature frames of shape (num_frames, feature_dim)."""
+        assert not self._input_finished, "The input has been finished"
+        self._pending_features.append(features)
+        self._last_input_time = time.monotonic()
+        self.engine._wake_up()
+
+    def accept_waveform(self, sample_rate: int, samples: torch.Tensor) -> None:
+        """Append 1-D audio samples normalized to [-1, 1]. The fbank
+        features are computed incrementally by the engine."""
+        assert not self._input_finished, "The input has been finished"
+        assert self._sample_rate in (None, sample_rate), (
+            self._sample_rate,
+            sample_rate,
+        )
+        self._sample_rate = sample_rate
+        self._pending_samples.append(samples)
+        self._last_input_time = time.monotonic()
+        self.engine._wake_up()
+
+    def finish_input(self) -> None:
+        """Signal that no more features will be fed to this stream."""
+        self._input_finished = True
+        self._last_input_time = time.monotonic()
+        self.engine._wake_up()
+
+    def close(self) -> None:
+        """Leave the engine without waiting for the final result."""
+        self._closed = True
+        self._results.put_nowait(None)
+        self.engine._wake_up()
+
+    def _put(self, result: StreamingResult) -> None:
+        if self.callback is not None:
+            self.callback(result)
+        self._results.put_nowait(result)
+        if result.is_final:
+            self._results.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> StreamingResult:
+        result = await self._results.get()
+        if result is None:
+            # So that iterating again also stops
+            self._results.put_nowait(None)
+            raise StopAsyncIteration
+        return result
+
+
+class AsyncStreamingEngine(object):
+    def __init__(
+        self,
+        engine: StreamingEngine,
+        max_wait_ms: float = 20,
+    ) -> None:
+        """
+        Args:
+          engine:
+            The engine that does the decoding.
+          max_wait_ms:
+            The latency deadline. After the first stream becomes ready,
+            wait at most this many milliseconds for more streams before
+            decoding a chunk. A chunk is decoded immediately if
+            `engine.max_batch_size` streams are ready.
+        """
+        self.engine = engine
+        self.max_wait_ms = max_wait_ms
+
+        self.handles: Dict[str, StreamHandle] = {}
+
+        # The time (from time.monotonic()) each ready stream became ready.
+        # The deadline of a chunk is measured from the oldest one.
+        self._ready_since: Dict[str, float] = {}
+
+        self._event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    def create_stream(
+        self,
+        stream_id: Optional[str] = None,
+        callback: Optional[Callable[[StreamingResult], None]] = None,
+    ) -> StreamHandle:
+        """Create a stream. It joins the batch at the next chunk.
+
+        Args:
+          stream_id:
+            The id of the stream. If None, a unique one is generated.
+          callback:
+            If not None, it is called with each partial result of the stream
+            from the event loop.
+        """
+        if stream_id is None:
+            stream_id = self.engine.new_stream_id()
+        assert stream_id not in self.handles, f"{stream_id} exists"
+
+        handle = StreamHandle(self, stream_id, callback)
+        self.handles[stream_id] = handle
+        self._wake_up()
+        return handle
+
+    def start(self) -> None:
+        """Start the scheduling loop in the running event loop."""
+        assert self._task is None, "Already started"
+        self._event = asyncio.Event()
+        self._running = True
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        """Stop the scheduling loop after the current chunk.
+
+        The remaining streams are removed from the engine and their
+        iterators stop without a final result.
+        """
+        self._running = False
+        self._wake_up()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+        for stream_id in list(self.handles):
+            self._remove_stream(stream_id)
+
+    def _remove_stream(self, stream_id: str) -> None:
+        """Remove a stream from the engine and close its handle."""
+        self.engine.remove_stream(stream_id)
+        self._ready_since.pop(stream_id, None)
+        handle = self.handles.pop(stream_id, None)
+        if handle is not None and not handle._closed:
+            handle.close()
+
+    def _wake_up(self) -> None:
+        if self._event is not None:
+            self._event.set()
+
+    def _sync_streams(self) -> None:
+        """Add new streams to the engine, hand over the buffered features
+        and remove closed streams. The engine is only modified here, when
+        no chunk is being decoded."""
+        chunk_length = self.engine.chunk_length
+        for stream_id, handle in list(self.handles.items()):
+            if handle._closed:
+                self._remove_stream(stream_id)
+                continue
+
+            if not handle._added:
+                self.engine.add_stream(stream_id)
+                handle._added = True
+
+            stream = self.engine.streams[stream_id]
+            was_ready = stream.is_ready(chunk_length)
+            if handle._pending_features:
+                stream.accept_features(torch.cat(handle._pending_features, dim=0))
+                handle._pending_features = []
+            if handle._pending_samples:
+                stream.accept_waveform(
+                    sample_rate=handle._sample_rate,
+                    samples=torch.cat(handle._pending_samples, dim=0),
+                )
+                handle._pending_samples = []
+            if handle._input_finished and not stream.input_finished:
+                stream.finish_input()
+
+            if stream_id not in self._ready_since and stream.is_ready(chunk_length):
+                # A stream that is still ready after a chunk became ready
+                # when that chunk was decoded. Otherwise, the last input
+                # made it ready.
+                if was_ready:
+                    ready_time = self.engine._last_served[stream_id]
+                else:
+                    ready_time = handle._last_input_time
+                self._ready_since[stream_id] = ready_time
+
+    async def _loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._running:
+            self._sync_streams()
+            ready = self.engine.ready_streams()
+
+            if not ready:
+                self._event.clear()
+                await self._event.wait()
+                continue
+
+            if len(ready) < self.engine.max_batch_size:
+                # Wait for more streams until the deadline of the stream
+                # that has been ready for the longest time
+                while len(ready) < self.engine.max_batch_size and self._running:
+                    oldest = min(self._ready_since[s.id] for s in ready)
+                    timeout = oldest + self.max_wait_ms / 1000 - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._event.clear()
+                    try:
+                        await asyncio.wait_for(self._event.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    self._sync_streams()
+                    ready = self.engine.ready_streams()
+
+            batch = ready[: self.engine.max_batch_size]
+            if not batch:
+                continue
+            for stream in batch:
+                del self._ready_since[stream.id]
+
+            # Decode in a worker thread so that the event loop can keep
+            # receiving features. Only the streams in `batch` are touched
+            # there, and the new features are buffered in the handles.
+            try:
+                results = await loop.run_in_executor(None, self.engine.step, batch)
+            except Exception:
+                logging.exception("Failed to decode a chunk")
+                # Drop the streams of this chunk; their iterators stop
+                # without a final result.
+                for stream in batch:
+                    self._remove_stream(stream.id)
+                continue
+
+            for result in results:
+                handle = self.handles.get(result.stream_id)
+                if handle is None:
+                    continue
+                handle._put(result)
+                if result.is_final:
+                    del self.handles[result.stream_id]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import torch
+from beam_search import modified_beam_search, modified_beam_search_tensorized
+from torch import nn
+
+VOCAB_SIZE = 5
+JOINER_DIM = 16
+CONTEXT_SIZE = 2
+
+
+class Decoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.blank_id = 0
+        self.context_size = CONTEXT_SIZE
+        self.embedding = nn.Embedding(VOCAB_SIZE, JOINER_DIM)
+        self.output_linear = nn.Linear(CONTEXT_SIZE * JOINER_DIM, JOINER_DIM)
+
+    def forward(self, y: torch.Tensor, need_pad: bool = True) -> torch.Tensor:
+        # -1 in y means no token
+        embedding_out = self.embedding(y.clamp(min=0)) * (y >= 0).unsqueeze(-1)
+        embedding_out = embedding_out.reshape(y.size(0), 1, -1)
+        return self.output_linear(embedding_out)
+
+
+class Joiner(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.encoder_proj = nn.Linear(JOINER_DIM, JOINER_DIM)
+        self.decoder_proj = nn.Linear(JOINER_DIM, JOINER_DIM)
+        self.output_linear = nn.Linear(JOINER_DIM, VOCAB_SIZE)
+
+    def forward(
+        self,
+        encoder_out: torch.Tensor,
+        decoder_out: torch.Tensor,
+        project_input: bool = True,
+    ) -> torch.Tensor:
+        if project_input:
+            encoder_out = self.encoder_proj(encoder_out)
+            decoder_out = self.decoder_proj(decoder_out)
+        return self.output_linear(torch.tanh(encoder_out + decoder_out))
+
+
+def get_model() -> nn.Module:
+    model = nn.Module()
+    model.decoder = Decoder()
+    model.joiner = Joiner()
+    model.eval()
+    return model
+
+
+def test_modified_beam_search_tensorized():
+    torch.manual_seed(20240101)
+    model = get_model()
+
+    encoder_out = torch.randn(3, 12, JOINER_DIM)
+    encoder_out_lens = torch.tensor([7, 12, 3])
+
+    # beam 8 is larger than VOCAB_SIZE
+    for beam in [1, 4, 8]:
+        with torch.no_grad():
+            expected = modified_beam_search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=beam,
+                return_timestamps=True,
+            )
+            results = modified_beam_search_tensorized(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=beam,
+                return_timestamps=True,
+            )
+        assert results.hyps == expected.hyps, (beam, results.hyps, expected.hyps)
+        assert results.timestamps == expected.timestamps, beam
+
+
+def test_modified_beam_search_large_beam():
+    # A beam larger than the number of candidates, i.e., vocab_size at the
+    # first frame, keeps all of the candidates.
+    torch.manual_seed(20240102)
+    model = get_model()
+
+    encoder_out = torch.randn(2, 1, JOINER_DIM)
+    encoder_out_lens = torch.tensor([1, 1])
+    with torch.no_grad():
+        expected = modified_beam_search(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=VOCAB_SIZE,
+        )
+        hyps = modified_beam_search(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            beam=VOCAB_SIZE + 3,
+        )
+    assert hyps == expected, (hyps, expected)
+
+
+def main():
+    test_modified_beam_search_tensorized()
+    test_modified_beam_search_large_beam()
+
+
+if __name__ == "__main__":
+    main()
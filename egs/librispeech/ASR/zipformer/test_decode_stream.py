@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import torch
+from decode_stream import DecodeStream, get_fbank_options
+from kaldifeat import Fbank
+
+from icefall.utils import AttributeDict
+
+
+def test_accept_waveform():
+    params = AttributeDict(
+        {
+            "decoding_method": "greedy_search",
+            "context_size": 2,
+            "blank_id": 0,
+            "feature_dim": 80,
+        }
+    )
+    samples = torch.rand(16000 * 2 + 123) * 2 - 1
+
+    fbank = Fbank(get_fbank_options())
+    expected = fbank(samples)
+
+    stream = DecodeStream(params=params, cut_id="test", initial_states=[torch.zeros(1)])
+    start = 0
+    for chunk in [100, 3200, 1, 4000, 400, 17]:
+        stream.accept_waveform(16000, samples[start : start + chunk])
+        start += chunk
+    stream.accept_waveform(16000, samples[start:])
+    stream.finish_input()
+
+    num_frames = expected.size(0)
+    assert stream.num_frames == num_frames + stream.pad_length, (
+        stream.num_frames,
+        num_frames,
+    )
+    assert torch.allclose(stream.features[:num_frames], expected, atol=1e-4)
+
+
+def main():
+    test_accept_waveform()
+
+
+if __name__ == "__main__":
+    main()
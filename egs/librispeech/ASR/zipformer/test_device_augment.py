@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import math
+import random
+
+import numpy as np
+import torch
+from device_augment import BatchedNoiseMixer, BatchedSpecAugment
+from lhotse.dataset import SpecAugment
+from lhotse.features import Fbank
+from lhotse.features.mixer import FeatureMixer
+
+
+def get_masked(features: torch.Tensor, augmented: torch.Tensor, num_frames: int):
+    """Return the masked columns and the masked frames of an utterance,
+    i.e., the ones that are changed in all of the valid frames."""
+    changed = augmented[:num_frames] != features[:num_frames]
+    return changed.all(dim=0), changed.all(dim=1)
+
+
+def test_mask():
+    torch.manual_seed(20240101)
+    N, T, C = 4, 400, 80
+    features = torch.randn(N, T, C)
+    feature_lens = torch.tensor([400, 300, 120, 50])
+    spec_augment = BatchedSpecAugment(
+        time_warp_factor=None,
+        num_feature_masks=2,
+        features_mask_size=27,
+        num_frame_masks=10,
+        frames_mask_size=100,
+        max_frames_mask_fraction=0.15,
+        p=1.0,
+    )
+
+    for _ in range(20):
+        augmented = spec_augment(features, feature_lens)
+        assert augmented.shape == features.shape
+        for i in range(N):
+            num_frames = int(feature_lens[i])
+            # The padding is not changed
+            assert torch.equal(augmented[i, num_frames:], features[i, num_frames:])
+
+            masked_columns, masked_frames = get_masked(
+                features[i], augmented[i], num_frames
+            )
+            # Each changed value is in a masked column or a masked frame
+            changed = augmented[i, :num_frames] != features[i, :num_frames]
+            assert torch.equal(
+                changed, masked_columns.unsqueeze(0) | masked_frames.unsqueeze(1)
+            )
+
+            # and is set to the mean of the valid frames
+            mean = features[i, :num_frames].mean()
+            assert torch.allclose(augmented[i, :num_frames][changed], mean)
+
+            # 2 masks narrower than 27
+            assert masked_columns.sum() <= 2 * 26
+            # at most 15% of the frames
+            assert masked_frames.sum() <= 0.15 * num_frames
+
+
+def test_mask_like_lhotse():
+    # The average number of masked columns and frames should be close
+    # to those of lhotse's SpecAugment.
+    torch.manual_seed(20240102)
+    random.seed(20240102)
+    T, C = 500, 80
+    num_trials = 300
+    kwargs = dict(
+        time_warp_factor=None,
+        num_feature_masks=2,
+        features_mask_size=27,
+        num_frame_masks=10,
+        frames_mask_size=100,
+        max_frames_mask_fraction=0.15,
+        p=1.0,
+    )
+
+    features = torch.randn(num_trials, T, C)
+    feature_lens = torch.full((num_trials,), T)
+    augmented = BatchedSpecAugment(**kwargs)(features, feature_lens)
+    expected = SpecAugment(**kwargs)(features)
+
+    def get_stats(augmented):
+        num_columns = num_frames = 0
+        for i in range(num_trials):
+            masked_columns, masked_frames = get_masked(features[i], augmented[i], T)
+            num_columns += masked_columns.sum().item()
+            num_frames += masked_frames.sum().item()
+        return num_columns / num_trials, num_frames / num_trials
+
+    num_columns, num_frames = get_stats(augmented)
+    expected_num_columns, expected_num_frames = get_stats(expected)
+    assert abs(num_columns - expected_num_columns) < 0.15 * expected_num_columns, (
+        num_columns,
+        expected_num_columns,
+    )
+    assert abs(num_frames - expected_num_frames) < 0.15 * expected_num_frames, (
+        num_frames,
+        expected_num_frames,
+    )
+
+
+def test_time_warp():
+    torch.manual_seed(20240103)
+    N, T, C = 4, 400, 3
+    factor = 80
+    feature_lens = torch.tensor([400, 321, 2 * factor + 1, 50])
+    # The value of each frame is its index, so the output is the position in
+    # the input each frame is taken from.
+    features = torch.arange(T, dtype=torch.float32).view(1, T, 1).repeat(N, 1, C)
+    spec_augment = BatchedSpecAugment(time_warp_factor=factor, p=1.0)
+
+    num_warped = 0
+    for _ in range(20):
+        warped = spec_augment.time_warp(features, feature_lens)
+        assert warped.shape == features.shape
+        for i in range(N):
+            num_frames = int(feature_lens[i])
+            # The padding is not changed
+            assert torch.equal(warped[i, num_frames:], features[i, num_frames:])
+
+            # The valid frames are a monotonic resampling of the valid input
+            # frames, from the first one to the last one.
+            src = warped[i, :num_frames, 0]
+            assert torch.all(src[1:] >= src[:-1] - 1e-4)
+            assert src[0] < factor and src[-1] > num_frames - 1 - factor
+            assert src.max() <= num_frames - 1
+
+            if num_frames - factor <= factor + 1:
+                # Too short to be warped, as in lhotse
+                assert torch.equal(warped[i], features[i])
+            else:
+                num_warped += not torch.equal(warped[i], features[i])
+    assert num_warped > 0
+
+
+def test_spec_augment_p():
+    # Time warping and masking are applied to the same utterances
+    torch.manual_seed(20240104)
+    N, T, C = 400, 300, 80
+    features = torch.randn(N, T, C)
+    feature_lens = torch.full((N,), T)
+    spec_augment = BatchedSpecAugment(p=0.5)
+
+    augmented = spec_augment(features, feature_lens)
+    changed = (augmented != features).flatten(1).any(dim=1)
+    # With independent draws, only about 25% of the utterances would be
+    # left unchanged.
+    num_unchanged = (~changed).sum().item()
+    assert 0.4 * N < num_unchanged < 0.6 * N, num_unchanged
+
+    assert torch.equal(BatchedSpecAugment(p=0.0)(features, feature_lens), features)
+
+
+def test_noise_mixer():
+    torch.manual_seed(20240105)
+    N, T, C = 3, 200, 80
+    features = torch.randn(N, T, C) * 2 - 5
+    feature_lens = torch.tensor([200, 150, 30])
+    # The same noise in each frame, so that the mixed noise does not depend
+    # on the random offset in the noise bank.
+    noise = (torch.randn(1, C) * 2 - 8).expand(1000, C)
+
+    for snr in [0, 10, 20]:
+        mixer = BatchedNoiseMixer(noise, p=1.0, snr=(snr, snr))
+        mixed = mixer(features, feature_lens)
+        assert mixed.shape == features.shape
+        for i in range(N):
+            num_frames = int(feature_lens[i])
+            assert torch.equal(mixed[i, num_frames:], features[i, num_frames:])
+
+            # What lhotse does when mixing a MUSAN cut into a training cut
+            feats = features[i, :num_frames].double().numpy()
+            feature_mixer = FeatureMixer(
+                feature_extractor=Fbank(),
+                base_feats=feats,
+                frame_shift=0.01,
+            )
+            noise_feats = noise[:num_frames].double().numpy()
+            feature_mixer.add_to_mix(noise_feats, sampling_rate=16000, snr=snr)
+            expected = torch.from_numpy(feature_mixer.mixed_feats).float()
+            assert torch.allclose(mixed[i, :num_frames], expected, atol=1e-3), (
+                (mixed[i, :num_frames] - expected).abs().max()
+            )
+
+            # The SNR in the linear energy domain
+            speech_energy = np.exp(feats).sum()
+            mixed_energy = np.exp(mixed[i, :num_frames].double().numpy()).sum()
+            noise_energy = mixed_energy - speech_energy
+            actual_snr = 10 * math.log10(speech_energy / noise_energy)
+            assert abs(actual_snr - snr) < 0.1, (actual_snr, snr)
+
+    mixer = BatchedNoiseMixer(noise, p=0.0)
+    assert torch.equal(mixer(features, feature_lens), features)
+
+
+def main():
+    test_mask()
+    test_mask_like_lhotse()
+    test_time_warp()
+    test_spec_augment_p()
+    test_noise_mixer()
+
+
+if __name__ == "__main__":
+    main()
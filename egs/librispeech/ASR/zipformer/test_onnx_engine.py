@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This file tests ./onnx_engine.py with a tiny encoder, decoder and joiner
+exported to ONNX, which have the same inputs, outputs and meta data as the
+ones exported by ./export-onnx.py.
+"""
+
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from icefall import is_module_available
+
+if not is_module_available("onnxruntime"):
+    raise ValueError("Please 'pip install onnxruntime' first.")
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+import torch
+from onnx_engine import OnnxTransducerEngine, _BoundSession
+from torch import nn
+
+ort.set_default_logger_severity(3)
+
+NUM_FEATURES = 5
+JOINER_DIM = 8
+VOCAB_SIZE = 7
+CONTEXT_SIZE = 2
+
+
+class TinyEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(NUM_FEATURES, JOINER_DIM)
+
+    def forward(self, x: torch.Tensor, x_lens: torch.Tensor):
+        # Subsample by 2
+        encoder_out = torch.tanh(self.linear(x[:, ::2]))
+        encoder_out_lens = torch.div(x_lens + 1, 2, rounding_mode="floor")
+        return encoder_out, encoder_out_lens
+
+
+class TinyDecoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(VOCAB_SIZE, JOINER_DIM)
+
+    def forward(self, y: torch.Tensor) -> torch.Tensor:
+        return torch.tanh(self.embedding(y).sum(dim=1))
+
+
+class TinyJoiner(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.output_linear = nn.Linear(JOINER_DIM, VOCAB_SIZE)
+
+    def forward(
+        self, encoder_out: torch.Tensor, decoder_out: torch.Tensor
+    ) -> torch.Tensor:
+        return self.output_linear(torch.tanh(encoder_out + decoder_out)) * 3
+
+
+def add_meta_data(filename: str, meta_data: Dict[str, str]):
+    model = onnx.load(filename)
+    for key, value in meta_data.items():
+        meta = model.metadata_props.add()
+        meta.key = key
+        meta.value = value
+    onnx.save(model, filename)
+
+
+def export_models(out_dir: Path):
+    torch.manual_seed(20240101)
+    encoder = TinyEncoder().eval()
+    decoder = TinyDecoder().eval()
+    joiner = TinyJoiner().eval()
+
+    torch.onnx.export(
+        encoder,
+        (torch.rand(2, 10, NUM_FEATURES), torch.tensor([10, 7])),
+        str(out_dir / "encoder.onnx"),
+        opset_version=13,
+        input_names=["x", "x_lens"],
+        output_names=["encoder_out", "encoder_out_lens"],
+        dynamic_axes={
+            "x": {0: "N", 1: "T"},
+            "x_lens": {0: "N"},
+            "encoder_out": {0: "N", 1: "T"},
+            "encoder_out_lens": {0: "N"},
+        },
+    )
+
+    torch.onnx.export(
+        decoder,
+        torch.zeros(3, CONTEXT_SIZE, dtype=torch.int64),
+        str(out_dir / "decoder.onnx"),
+        opset_version=13,
+        input_names=["y"],
+        output_names=["decoder_out"],
+        dynamic_axes={"y": {0: "N"}, "decoder_out": {0: "N"}},
+    )
+    add_meta_data(
+        str(out_dir / "decoder.onnx"),
+        {"context_size": str(CONTEXT_SIZE), "vocab_size": str(VOCAB_SIZE)},
+    )
+
+    torch.onnx.export(
+        joiner,
+        (torch.rand(3, JOINER_DIM), torch.rand(3, JOINER_DIM)),
+        str(out_dir / "joiner.onnx"),
+        opset_version=13,
+        input_names=["encoder_out", "decoder_out"],
+        output_names=["logit"],
+        dynamic_axes={
+            "encoder_out": {0: "N"},
+            "decoder_out": {0: "N"},
+            "logit": {0: "N"},
+        },
+    )
+    add_meta_data(str(out_dir / "joiner.onnx"), {"joiner_dim": str(JOINER_DIM)})
+
+    return encoder, decoder, joiner
+
+
+def get_features(num_utts: int = 9) -> List[np.ndarray]:
+    rng = np.random.default_rng(20240101)
+    lengths = rng.integers(3, 40, size=num_utts)
+    return [
+        rng.standard_normal((int(n), NUM_FEATURES)).astype(np.float32) for n in lengths
+    ]
+
+
+@torch.no_grad()
+def reference_search(
+    encoder: nn.Module,
+    decoder: nn.Module,
+    joiner: nn.Module,
+    features: np.ndarray,
+    beam: int,
+) -> List[int]:
+    """Decode a single utterance with the PyTorch models. It is a plain
+    implementation of modified beam search, which is greedy search when
+    beam is 1."""
+    x = torch.from_numpy(features).unsqueeze(0)
+    encoder_out, _ = encoder(x, torch.tensor([x.size(1)]))
+
+    # Map the tokens of a hypothesis, including leading blanks, to its
+    # log prob
+    hyps = {tuple([0] * CONTEXT_SIZE): 0.0}
+    for t in range(encoder_out.size(1)):
+        candidates = []
+        for ys, score in hyps.items():
+            y = torch.tensor([ys[-CONTEXT_SIZE:]])
+            logit = joiner(encoder_out[:, t], decoder(y))
+            log_probs = logit.log_softmax(dim=-1).squeeze(0)
+            for token in range(VOCAB_SIZE):
+                candidates.append((score + log_probs[token].item(), ys, token))
+        candidates.sort(key=lambda c: c[0], reverse=True)
+
+        hyps = {}
+        for score, ys, token in candidates[:beam]:
+            if token != 0:
+                ys = ys + (token,)
+            if ys in hyps:
+                score = np.logaddexp(hyps[ys], score)
+            hyps[ys] = score
+
+    ys = max(hyps, key=lambda ys: hyps[ys] / len(ys))
+    return list(ys[CONTEXT_SIZE:])
+
+
+def test_bound_session():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        export_models(tmp_dir)
+        session = ort.InferenceSession(
+            str(tmp_dir / "joiner.onnx"), providers=["CPUExecutionProvider"]
+        )
+        bound = _BoundSession(
+            session,
+            shapes={
+                "encoder_out": (JOINER_DIM,),
+                "decoder_out": (JOINER_DIM,),
+                "logit": (VOCAB_SIZE,),
+            },
+        )
+
+        rng = np.random.default_rng(20240102)
+        for batch_size in [3, 5, 2, 5, 1]:
+            encoder_out = rng.standard_normal((batch_size, JOINER_DIM))
+            decoder_out = rng.standard_normal((batch_size, JOINER_DIM))
+            logit = bound.run(
+                encoder_out.astype(np.float32), decoder_out.astype(np.float32)
+            )
+            (expected,) = session.run(
+                ["logit"],
+                {
+                    "encoder_out": encoder_out.astype(np.float32),
+                    "decoder_out": decoder_out.astype(np.float32),
+                },
+            )
+            assert logit.shape == (batch_size, VOCAB_SIZE), logit.shape
+            np.testing.assert_allclose(logit, expected, rtol=1e-5, atol=1e-5)
+            # The output is a view of the preallocated buffer
+            assert np.shares_memory(logit, bound.buffers["logit"])
+
+        # The buffers grow by doubling, and a binding is kept for each
+        # batch size used since the last growth.
+        assert bound.capacity == 6, bound.capacity
+        assert sorted(bound.bindings) == [1, 2, 5], sorted(bound.bindings)
+
+
+def test_onnx_transducer_engine():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        encoder, decoder, joiner = export_models(tmp_dir)
+        engine = OnnxTransducerEngine(
+            encoder_model_filename=str(tmp_dir / "encoder.onnx"),
+            decoder_model_filename=str(tmp_dir / "decoder.onnx"),
+            joiner_model_filename=str(tmp_dir / "joiner.onnx"),
+            encoder_num_threads=1,
+            allow_spinning=False,
+        )
+        assert engine.context_size == CONTEXT_SIZE
+        assert engine.vocab_size == VOCAB_SIZE
+        assert engine.joiner_dim == JOINER_DIM
+
+        features = get_features()
+
+        # Utterances of different lengths in a batch, so fewer rows are
+        # active in the last frames.
+        greedy = engine.decode(features, max_batch_frames=60)
+        for f, hyp in zip(features, greedy):
+            expected = reference_search(encoder, decoder, joiner, f, beam=1)
+            assert hyp == expected, (hyp, expected)
+        assert sum(len(hyp) for hyp in greedy) > 0
+        assert engine.decode(features) == greedy
+
+        hyps = engine.decode(features, decoding_method="modified_beam_search", beam=1)
+        assert hyps == greedy
+
+        # beam 8 is larger than vocab_size
+        for beam in [4, 8]:
+            hyps = engine.decode(
+                features,
+                decoding_method="modified_beam_search",
+                beam=beam,
+                max_batch_size=4,
+            )
+            for f, hyp in zip(features, hyps):
+                expected = reference_search(encoder, decoder, joiner, f, beam=beam)
+                assert hyp == expected, (beam, hyp, expected)
+
+        assert engine.decode([]) == []
+
+
+def main():
+    test_bound_session()
+    test_onnx_transducer_engine()
+
+
+if __name__ == "__main__":
+    main()
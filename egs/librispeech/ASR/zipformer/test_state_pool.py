@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import torch
+from state_pool import StatePool
+
+
+def get_states(batch_size: int, num_layers: int = 2):
+    states = []
+    for _ in range(num_layers):
+        states += [
+            torch.rand(4, batch_size, 8),  # cached_key
+            torch.rand(1, batch_size, 4, 6),  # cached_nonlin_attn
+            torch.rand(4, batch_size, 5),  # cached_val1
+            torch.rand(4, batch_size, 5),  # cached_val2
+            torch.rand(batch_size, 8, 3),  # cached_conv1
+            torch.rand(batch_size, 8, 3),  # cached_conv2
+        ]
+    states.append(torch.rand(batch_size, 2, 3, 4))  # cached_embed_left_pad
+    states.append(torch.randint(0, 100, (batch_size,), dtype=torch.int32))
+    return states
+
+
+def test_state_pool():
+    init_states = get_states(batch_size=1)
+    pool = StatePool(init_states, capacity=2)
+
+    slots = [pool.allocate() for _ in range(5)]
+    assert slots == [0, 1, 2, 3, 4], slots
+    assert pool.capacity == 8, pool.capacity
+    assert pool.num_used == 5, pool.num_used
+
+    # A newly allocated slot holds the initial states
+    for s, init in zip(pool.gather([3]), init_states):
+        assert torch.equal(s, init)
+
+    new_states = get_states(batch_size=3)
+    pool.scatter([4, 0, 2], new_states)
+    for s, new_s in zip(pool.gather([4, 0, 2]), new_states):
+        assert torch.equal(s, new_s)
+
+    pool.free(0)
+    assert pool.allocate() == 0
+    for s, init in zip(pool.gather([0]), init_states):
+        assert torch.equal(s, init)
+
+
+def main():
+    test_state_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextlib
+import time
+from types import SimpleNamespace
+
+import streaming_engine
+import torch
+from streaming_engine import AsyncStreamingEngine, StreamingEngine
+
+from icefall.utils import AttributeDict
+
+# Each chunk consumes 2 * chunk_size feature frames
+CHUNK_SIZE = 8
+PAD_LENGTH = 7 + 2 * 3
+
+# Number of frames needed before the first chunk can be decoded
+READY_FRAMES = 2 * CHUNK_SIZE + PAD_LENGTH
+
+
+def get_params() -> AttributeDict:
+    return AttributeDict(
+        {
+            "decoding_method": "greedy_search",
+            "context_size": 2,
+            "blank_id": 0,
+            "feature_dim": 4,
+            "chunk_size": CHUNK_SIZE,
+        }
+    )
+
+
+def get_model():
+    # Only the initial states are needed, as decode_one_chunk() is faked.
+    return SimpleNamespace(
+        device=torch.device("cpu"),
+        encoder=SimpleNamespace(get_init_states=lambda batch_size, device: []),
+        encoder_embed=SimpleNamespace(
+            get_init_states=lambda batch_size, device: torch.zeros(batch_size)
+        ),
+    )
+
+
+def get_engine(max_batch_size: int) -> StreamingEngine:
+    return StreamingEngine(
+        get_params(),
+        get_model(),
+        max_batch_size=max_batch_size,
+        use_state_pool=False,
+    )
+
+
+class FakeDecoder(object):
+    """Replaces decode_one_chunk(). Each chunk consumes the features of one
+    chunk and emits one token, which is the size of the batch."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def __call__(self, params, model, decode_streams, **kwargs):
+        time.sleep(self.delay)
+        self.batch_sizes.append(len(decode_streams))
+        for stream in decode_streams:
+            stream.get_feature_frames(int(params.chunk_size) * 2)
+            stream.hyp.append(len(decode_streams))
+
+
+@contextlib.contextmanager
+def fake_decode_one_chunk(delay: float = 0.0):
+    decoder = FakeDecoder(delay)
+    orig = streaming_engine.decode_one_chunk
+    streaming_engine.decode_one_chunk = decoder
+    try:
+        yield decoder
+    finally:
+        streaming_engine.decode_one_chunk = orig
+
+
+def get_features(num_frames: int) -> torch.Tensor:
+    return torch.rand(num_frames, get_params().feature_dim)
+
+
+async def collect(handle):
+    return [result async for result in handle]
+
+
+def test_streaming_engine():
+    with fake_decode_one_chunk() as decoder:
+        engine = get_engine(max_batch_size=2)
+        streams = [engine.add_stream() for _ in range(3)]
+        assert engine.ready_streams() == []
+
+        for stream in streams:
+            stream.accept_features(get_features(READY_FRAMES))
+        assert len(engine.ready_streams()) == 3
+
+        # At most max_batch_size streams in a chunk
+        results = engine.step()
+        assert [r.stream_id for r in results] == [streams[0].id, streams[1].id]
+        assert all(not r.is_final for r in results)
+
+        # The stream that was not decoded goes first
+        results = engine.step()
+        assert [r.stream_id for r in results] == [streams[2].id]
+        assert engine.step() == []
+        assert decoder.batch_sizes == [2, 1]
+
+        # A finished stream is decoded until its last chunk and removed
+        streams[0].finish_input()
+        results = engine.step() + engine.step()
+        assert [r.stream_id for r in results] == [streams[0].id] * 2
+        assert [r.is_final for r in results] == [False, True]
+        assert results[-1].tokens == [2, 1, 1]
+        assert streams[0].id not in engine.streams
+        assert len(engine.streams) == 2
+
+
+def test_async_streaming_engine_batching():
+    async def run():
+        with fake_decode_one_chunk() as decoder:
+            engine = AsyncStreamingEngine(
+                get_engine(max_batch_size=4), max_wait_ms=10000
+            )
+            handles = [engine.create_stream() for _ in range(4)]
+            for handle in handles:
+                handle.accept_features(get_features(READY_FRAMES))
+                handle.finish_input()
+
+            start = time.monotonic()
+            engine.start()
+            all_results = await asyncio.gather(*[collect(h) for h in handles])
+            # A full batch does not wait for the deadline
+            assert time.monotonic() - start < 5
+
+            await engine.stop()
+
+        assert decoder.batch_sizes == [4, 4, 4], decoder.batch_sizes
+        for handle, results in zip(handles, all_results):
+            assert [r.is_final for r in results] == [False, False, True]
+            assert all(r.stream_id == handle.stream_id for r in results)
+            assert results[-1].tokens == [4, 4, 4]
+        assert engine.handles == {}
+        assert engine.engine.streams == {}
+
+    asyncio.run(run())
+
+
+def test_async_streaming_engine_deadline():
+    async def run():
+        max_wait = 0.2
+        with fake_decode_one_chunk() as decoder:
+            engine = AsyncStreamingEngine(
+                get_engine(max_batch_size=4), max_wait_ms=max_wait * 1000
+            )
+            engine.start()
+
+            a = engine.create_stream()
+            start = time.monotonic()
+            a.accept_features(get_features(READY_FRAMES))
+
+            # b becomes ready before the deadline of a, so they are
+            # decoded together, at the deadline of a.
+            await asyncio.sleep(max_wait / 2)
+            b = engine.create_stream()
+            b.accept_features(get_features(READY_FRAMES))
+
+            result = await a.__anext__()
+            elapsed = time.monotonic() - start
+            assert max_wait * 0.9 < elapsed < max_wait * 1.4, elapsed
+            assert result.tokens == [2]
+            assert decoder.batch_sizes == [2]
+
+            await engine.stop()
+
+    asyncio.run(run())
+
+
+def test_async_streaming_engine_deadline_while_decoding():
+    async def run():
+        max_wait = 0.2
+        delay = 0.3
+        with fake_decode_one_chunk(delay=delay) as decoder:
+            engine = AsyncStreamingEngine(
+                get_engine(max_batch_size=4), max_wait_ms=max_wait * 1000
+            )
+            engine.start()
+
+            a = engine.create_stream()
+            a.accept_features(get_features(READY_FRAMES))
+            # The chunk of a is being decoded after its deadline
+            await asyncio.sleep(max_wait + 0.05)
+            assert decoder.batch_sizes == []
+
+            # b becomes ready while a is being decoded. Its deadline has
+            # passed when the chunk of a is done, so it is decoded at once,
+            # i.e., after (delay - 0.05) + delay seconds, instead of
+            # waiting for another max_wait seconds.
+            b = engine.create_stream()
+            start = time.monotonic()
+            b.accept_features(get_features(READY_FRAMES))
+            await b.__anext__()
+            elapsed = time.monotonic() - start
+            assert elapsed < 2 * delay + max_wait / 2, elapsed
+            assert decoder.batch_sizes == [1, 1], decoder.batch_sizes
+
+            await engine.stop()
+
+    asyncio.run(run())
+
+
+def test_async_streaming_engine_stop():
+    async def run():
+        with fake_decode_one_chunk() as decoder:
+            engine = AsyncStreamingEngine(get_engine(max_batch_size=4))
+            engine.start()
+
+            # Not enough features for a chunk
+            handle = engine.create_stream()
+            handle.accept_features(get_features(READY_FRAMES - 1))
+            task = asyncio.ensure_future(collect(handle))
+            await asyncio.sleep(0.05)
+            assert not task.done()
+
+            # The iterator stops without a final result
+            await engine.stop()
+            results = await asyncio.wait_for(task, timeout=5)
+            assert results == []
+            assert decoder.batch_sizes == []
+            assert engine.handles == {}
+            assert engine.engine.streams == {}
+
+    asyncio.run(run())
+
+
+def main():
+    test_streaming_engine()
+    test_async_streaming_engine_batching()
+    test_async_streaming_engine_deadline()
+    test_async_streaming_engine_deadline_while_decoding()
+    test_async_streaming_engine_stop()
+
+
+if __name__ == "__main__":
+    main()
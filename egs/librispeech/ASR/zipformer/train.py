@@ -53,12 +53,14 @@ It supports training with:
 
 
 import argparse
+import contextlib
 import copy
 import logging
+import time
 import warnings
 from pathlib import Path
 from shutil import copyfile
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import k2
 import optim
@@ -69,7 +71,14 @@ import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
 from attention_decoder import AttentionDecoderModel
 from decoder import Decoder
+from device_augment import (
+    BatchedNoiseMixer,
+    BatchedSpecAugment,
+    DeviceAugment,
+    load_noise_bank,
+)
 from joiner import Joiner
+from lhotse import CutSet
 from lhotse.cut import Cut
 from lhotse.dataset import SpecAugment
 from lhotse.dataset.sampling.base import CutSampler
@@ -85,7 +94,18 @@ from torch.utils.tensorboard import SummaryWriter
 from zipformer import Zipformer2
 
 from icefall import diagnostics
-from icefall.checkpoint import load_checkpoint, remove_checkpoints
+from icefall.batch_tuner import (
+    BucketedTimeConstraint,
+    is_oom_error,
+    measure_peak_memory,
+    split_batch,
+    tune_max_durations,
+)
+from icefall.checkpoint import (
+    AsyncCheckpointWriter,
+    load_checkpoint,
+    remove_checkpoints,
+)
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
 from icefall.checkpoint import (
     save_checkpoint_with_global_batch_idx,
@@ -95,6 +115,7 @@ from icefall.dist import cleanup_dist, setup_dist
 from icefall.env import get_env_info
 from icefall.err import raise_grad_scale_is_too_small_error
 from icefall.hooks import register_inf_check_hooks
+from icefall.step_timer import StepTimer, TorchProfilerWindow
 from icefall.utils import (
     AttributeDict,
     MetricsTracker,
@@ -111,6 +132,7 @@ def get_adjusted_batch_count(params: AttributeDict) -> float:
     # duration.  This is for purposes of set_batch_count().
     return (
         params.batch_idx_train
+        * params.accum_grad
         * (params.max_duration * params.world_size)
         / params.ref_duration
     )
@@ -522,6 +544,153 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--async-checkpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, checkpoints are copied to (pinned) CPU memory and
+        written to disk in a background thread, so that training is not
+        blocked by saving them. Old checkpoints are removed according to
+        --keep-last-k after the new one is written.
+        """,
+    )
+
+    parser.add_argument(
+        "--augment-on-device",
+        type=str2bool,
+        default=False,
+        help="""If True, MUSAN noise mixing (--enable-musan) and SpecAugment
+        (--enable-spec-aug) are applied to each batch on the training device
+        by ./device_augment.py instead of in the dataloader workers.
+        """,
+    )
+
+    parser.add_argument(
+        "--noise-bank-frames",
+        type=int,
+        default=1000000,
+        help="""Used only when --augment-on-device is True and --enable-musan
+        is True. Number of frames of MUSAN features kept on the device.
+        """,
+    )
+
+    parser.add_argument(
+        "--activation-checkpoint-stacks",
+        type=str,
+        default="",
+        help="""Comma-separated 0/1 per encoder stack, e.g. 1,1,1,1,1,1, or a
+        single value for all stacks. The activations of the selected stacks are
+        recomputed in the backward pass instead of being kept, which allows a
+        larger --max-duration at the cost of about one more forward pass of
+        the encoder. Empty to disable.
+        """,
+    )
+
+    parser.add_argument(
+        "--activation-checkpoint-modules",
+        type=str,
+        default="layer",
+        help="""Comma-separated types of modules to recompute in the stacks
+        selected by --activation-checkpoint-stacks: layer, or some of
+        attn_weights, nonlin_attn, self_attn, conv, ff.
+        """,
+    )
+
+    parser.add_argument(
+        "--activation-checkpoint-memory-budget",
+        type=float,
+        default=0.0,
+        help="""If positive, a module selected for activation checkpointing is
+        recomputed only if the allocated CUDA memory exceeds this many GB when
+        it is called, so that batches that fit are not slowed down.
+        """,
+    )
+
+    parser.add_argument(
+        "--accum-grad",
+        type=int,
+        default=1,
+        help="""Accumulate the gradients of this many batches before each
+        optimizer step, so that the effective batch is accum_grad times
+        --max-duration per GPU. The gradients are synchronized across DDP
+        ranks only at the optimizer steps. The batch count of the model, the
+        learning rate schedule and the averaged model count optimizer steps.
+        """,
+    )
+
+    parser.add_argument(
+        "--auto-batch-size",
+        type=str2bool,
+        default=False,
+        help="""If True, the peak memory of training steps on batches of a few
+        duration buckets is measured before training, instead of only
+        checking the most pessimistic batches, and the maximum duration of
+        the batches of each bucket is chosen so that the peak memory is
+        --auto-batch-target-utilization of the GPU memory. --max-duration
+        is used as the size of the measured batches. Also, a batch that runs
+        out of memory is retried as up to --oom-max-splits micro-batches and
+        the maximum duration of its bucket is lowered. Requires a CUDA device
+        and --bucketing-sampler True.
+        """,
+    )
+
+    parser.add_argument(
+        "--auto-batch-target-utilization",
+        type=float,
+        default=0.85,
+        help="""Used only when --auto-batch-size is True. The target fraction
+        of the GPU memory used at the peak of a training step.
+        """,
+    )
+
+    parser.add_argument(
+        "--oom-max-splits",
+        type=int,
+        default=8,
+        help="""Used only when --auto-batch-size is True. A batch that runs
+        out of memory is split into 2, 4, ... micro-batches, up to this
+        number, before training is aborted. With DDP, it only helps if the
+        out of memory error happens before the backward pass.
+        """,
+    )
+
+    parser.add_argument(
+        "--optim-foreach",
+        type=str2bool,
+        default=False,
+        help="""If True, ScaledAdam updates all parameters of a group together
+        with torch._foreach_* ops and clips gradients without a host sync on
+        every step. The result and the checkpoints are the same as with False.
+        """,
+    )
+
+    parser.add_argument(
+        "--step-timing",
+        type=str2bool,
+        default=True,
+        help="""If True, the average time per batch of each phase of training,
+        e.g., data loading, encoder, losses, backward and optimizer step, is
+        logged every --log-interval batches and written to tensorboard.
+        """,
+    )
+
+    parser.add_argument(
+        "--profile-start-batch",
+        type=int,
+        default=0,
+        help="""If positive, run torch.profiler from this global batch index
+        for --profile-num-batches batches and save the trace to
+        exp-dir/profile. The trace can be viewed with tensorboard.
+        """,
+    )
+
+    parser.add_argument(
+        "--profile-num-batches",
+        type=int,
+        default=5,
+        help="Number of batches to profile. See --profile-start-batch.",
+    )
+
     parser.add_argument(
         "--average-period",
         type=int,
@@ -756,6 +925,64 @@ def get_spec_augment(params: AttributeDict) -> SpecAugment:
     return spec_augment
 
 
+def get_device_augment(params: AttributeDict, device: torch.device) -> DeviceAugment:
+    """Create the augmentation applied to training batches on the device,
+    replacing CutMix with MUSAN and SpecAugment in the dataloader.
+    See --augment-on-device.
+    """
+    noise_mixer = None
+    if params.enable_musan:
+        logging.info("Enable MUSAN on device")
+        noise = load_noise_bank(
+            params.manifest_dir / "musan_cuts.jsonl.gz",
+            max_frames=params.noise_bank_frames,
+            seed=params.seed,
+        )
+        noise_mixer = BatchedNoiseMixer(noise.to(device), p=0.5, snr=(10, 20))
+
+    spec_augment = None
+    # With cr-ctc, SpecAugment is done in model.py
+    if params.enable_spec_aug and not params.use_cr_ctc:
+        logging.info("Enable SpecAugment on device")
+        spec_augment = BatchedSpecAugment(
+            time_warp_factor=params.spec_aug_time_warp_factor,
+            num_frame_masks=10,
+            features_mask_size=27,
+            num_feature_masks=2,
+            frames_mask_size=100,
+        )
+
+    return DeviceAugment(noise_mixer=noise_mixer, spec_augment=spec_augment)
+
+
+def get_step_timer(
+    params: AttributeDict, model: Union[nn.Module, DDP], device: torch.device
+) -> StepTimer:
+    """Create the timer of the phases of a training step, which also times
+    the encoder and each loss of the model. See --step-timing.
+
+    With DDP, the gradient all-reduce overlaps with the backward pass, so
+    its time is part of the "backward" phase.
+    """
+    step_timer = StepTimer(device, enabled=params.step_timing)
+    if isinstance(model, DDP):
+        model = model.module
+
+    step_timer.time_method(model, "forward_encoder", "encoder")
+    if params.use_transducer:
+        step_timer.time_method(model, "forward_transducer", "transducer_loss")
+    if params.use_ctc:
+        if params.use_cr_ctc:
+            step_timer.time_method(model, "forward_cr_ctc", "cr_ctc_loss")
+        else:
+            step_timer.time_method(model, "forward_ctc", "ctc_loss")
+    if params.use_attention_decoder:
+        step_timer.time_method(
+            model.attention_decoder, "calc_att_loss", "attention_decoder_loss"
+        )
+    return step_timer
+
+
 def load_checkpoint_if_available(
     params: AttributeDict,
     model: nn.Module,
@@ -831,6 +1058,7 @@ def save_checkpoint(
     sampler: Optional[CutSampler] = None,
     scaler: Optional[GradScaler] = None,
     rank: int = 0,
+    async_writer: Optional[AsyncCheckpointWriter] = None,
 ) -> None:
     """Save model, optimizer, scheduler and training stats to file.
 
@@ -847,6 +1075,8 @@ def save_checkpoint(
        The sampler for the training dataset.
       scaler:
         The scaler used for mix precision training.
+      async_writer:
+        If not None, write the checkpoint in the background.
     """
     if rank != 0:
         return
@@ -861,15 +1091,22 @@ def save_checkpoint(
         sampler=sampler,
         scaler=scaler,
         rank=rank,
+        async_writer=async_writer,
     )
 
+    # With async_writer, the copies are made after the checkpoint is written
+    copy_to = []
     if params.best_train_epoch == params.cur_epoch:
-        best_train_filename = params.exp_dir / "best-train-loss.pt"
-        copyfile(src=filename, dst=best_train_filename)
+        copy_to.append(params.exp_dir / "best-train-loss.pt")
 
     if params.best_valid_epoch == params.cur_epoch:
-        best_valid_filename = params.exp_dir / "best-valid-loss.pt"
-        copyfile(src=filename, dst=best_valid_filename)
+        copy_to.append(params.exp_dir / "best-valid-loss.pt")
+
+    for dst in copy_to:
+        if async_writer is not None:
+            async_writer.submit(copyfile, src=filename, dst=dst)
+        else:
+            copyfile(src=filename, dst=dst)
 
 
 def compute_loss(
@@ -1026,6 +1263,82 @@ def compute_validation_loss(
     return tot_loss
 
 
+def compute_loss_and_backward(
+    params: AttributeDict,
+    model: Union[nn.Module, DDP],
+    sp: spm.SentencePieceProcessor,
+    batch: dict,
+    scaler: GradScaler,
+    spec_augment: Optional[SpecAugment] = None,
+    step_timer: Optional[StepTimer] = None,
+    num_splits: int = 1,
+    sync_grad: bool = True,
+) -> MetricsTracker:
+    """Compute the loss of a training batch and its gradients.
+
+    Args:
+      num_splits:
+        If larger than 1, the batch is split into this many micro-batches,
+        and their gradients are accumulated. Since the loss is summed over
+        the utterances, the gradients are the same as those of the whole
+        batch.
+      sync_grad:
+        If False, the gradients are not synchronized across DDP ranks, e.g.,
+        for all but the last batch of an optimizer step with --accum-grad.
+    Returns:
+      Return the loss info of the batch.
+    """
+    if step_timer is None:
+        step_timer = StepTimer(enabled=False)
+
+    if num_splits > 1:
+        micro_batches = split_batch(batch, num_splits)
+    else:
+        micro_batches = [batch]
+
+    tot_info = MetricsTracker()
+    for i, micro_batch in enumerate(micro_batches):
+        if isinstance(model, DDP) and (not sync_grad or i + 1 < len(micro_batches)):
+            # Synchronize the gradients only once, after the last one
+            sync_context = model.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
+        with sync_context:
+            with step_timer.phase("forward"), torch.cuda.amp.autocast(
+                enabled=params.use_autocast, dtype=params.dtype
+            ):
+                loss, loss_info = compute_loss(
+                    params=params,
+                    model=model,
+                    sp=sp,
+                    batch=micro_batch,
+                    is_training=True,
+                    spec_augment=spec_augment,
+                )
+            # NOTE: We use reduction==sum and loss is computed over utterances
+            # in the batch and there is no normalization to it so far.
+            with step_timer.phase("backward"):
+                scaler.scale(loss).backward()
+        tot_info = tot_info + loss_info
+
+    return tot_info
+
+
+def back_off_batch_size(sampler: CutSampler, batch: dict) -> None:
+    """Lower the maximum duration of the bucket of a batch that ran out of
+    memory. It has an effect only with --auto-batch-size True."""
+    constraint = getattr(sampler, "constraint", None)
+    cuts = batch["supervisions"].get("cut")
+    if not isinstance(constraint, BucketedTimeConstraint) or not cuts:
+        return
+    durations = [c.duration for c in cuts]
+    max_duration = constraint.back_off(longest=max(durations), total=sum(durations))
+    logging.info(
+        f"Maximum duration of batches with cuts of {max(durations):.1f} "
+        f"seconds is lowered to {max_duration:.1f} seconds"
+    )
+
+
 def train_one_epoch(
     params: AttributeDict,
     model: Union[nn.Module, DDP],
@@ -1040,6 +1353,10 @@ def train_one_epoch(
     tb_writer: Optional[SummaryWriter] = None,
     world_size: int = 1,
     rank: int = 0,
+    async_writer: Optional[AsyncCheckpointWriter] = None,
+    device_augment: Optional[DeviceAugment] = None,
+    step_timer: Optional[StepTimer] = None,
+    profiler_window: Optional[TorchProfilerWindow] = None,
 ) -> None:
     """Train the model for one epoch.
 
@@ -1073,14 +1390,29 @@ def train_one_epoch(
       rank:
         The rank of the node in DDP training. If no DDP is used, it should
         be set to 0.
+      async_writer:
+        If not None, checkpoints are written in the background by it.
+      device_augment:
+        If not None, it augments each training batch on the device before
+        the loss is computed.
+      step_timer:
+        If not None, it times the phases of each training step.
+      profiler_window:
+        If not None, it runs torch.profiler for some of the steps.
     """
     model.train()
+    device = model.device if isinstance(model, DDP) else next(model.parameters()).device
+    if step_timer is None:
+        step_timer = StepTimer(device, enabled=False)
 
     tot_loss = MetricsTracker()
 
     saved_bad_model = False
 
     def save_bad_model(suffix: str = ""):
+        if async_writer is not None:
+            # Finish the pending checkpoint before the process exits
+            async_writer.wait()
         save_checkpoint_impl(
             filename=params.exp_dir / f"bad-model{suffix}-{rank}.pt",
             model=model,
@@ -1093,36 +1425,88 @@ def train_one_epoch(
             rank=0,
         )
 
-    for batch_idx, batch in enumerate(train_dl):
-        if batch_idx % 10 == 0:
-            set_batch_count(model, get_adjusted_batch_count(params))
-
-        params.batch_idx_train += 1
+    step_timer.start()
+    data_start = time.perf_counter()
+    # It stays -1 if train_dl is empty, e.g., when resuming at the end of
+    # an epoch, so that there is no incomplete optimizer step below
+    sub_batch_idx = -1
+    for sub_batch_idx, batch in enumerate(train_dl):
+        step_timer.add_host_time("data", time.perf_counter() - data_start)
+
+        # batch_idx and params.batch_idx_train count optimizer steps, each
+        # of which accumulates the gradients of params.accum_grad batches.
+        batch_idx = sub_batch_idx // params.accum_grad
+        is_first_sub_batch = sub_batch_idx % params.accum_grad == 0
+        is_last_sub_batch = sub_batch_idx % params.accum_grad == params.accum_grad - 1
+
+        if is_first_sub_batch:
+            if batch_idx % 10 == 0:
+                set_batch_count(model, get_adjusted_batch_count(params))
+
+            params.batch_idx_train += 1
+            step_info = MetricsTracker()
         batch_size = len(batch["supervisions"]["text"])
 
+        if device_augment is not None:
+            with step_timer.phase("augment"):
+                batch = device_augment(batch, device)
+
         try:
-            with torch.cuda.amp.autocast(
-                enabled=params.use_autocast, dtype=params.dtype
-            ):
-                loss, loss_info = compute_loss(
-                    params=params,
-                    model=model,
-                    sp=sp,
-                    batch=batch,
-                    is_training=True,
-                    spec_augment=spec_augment,
-                )
+            loss_info = None
+            num_splits = 1
+            while loss_info is None:
+                oom = False
+                try:
+                    loss_info = compute_loss_and_backward(
+                        params=params,
+                        model=model,
+                        sp=sp,
+                        batch=batch,
+                        scaler=scaler,
+                        spec_augment=spec_augment,
+                        step_timer=step_timer,
+                        num_splits=num_splits,
+                        sync_grad=is_last_sub_batch,
+                    )
+                except Exception as e:
+                    if (
+                        not params.auto_batch_size
+                        or not is_oom_error(e)
+                        or num_splits >= min(params.oom_max_splits, batch_size)
+                    ):
+                        raise
+                    oom = True
+                if oom:
+                    # Outside of the except block, so that the tensors
+                    # referenced by the traceback are freed.
+                    optimizer.zero_grad(set_to_none=True)
+                    torch.cuda.empty_cache()
+                    if not is_first_sub_batch:
+                        logging.warning(
+                            "The gradients of the previous batches of this "
+                            "optimizer step are discarded"
+                        )
+                    num_splits *= 2
+                    logging.warning(
+                        f"Out of memory with a batch of {batch_size} utterances, "
+                        f"retrying it as {num_splits} micro-batches"
+                    )
+                    back_off_batch_size(train_dl.sampler, batch)
             # summary stats
             tot_loss = (tot_loss * (1 - 1 / params.reset_interval)) + loss_info
+            step_info = step_info + loss_info
+
+            if not is_last_sub_batch:
+                data_start = time.perf_counter()
+                continue
+            loss_info = step_info
 
-            # NOTE: We use reduction==sum and loss is computed over utterances
-            # in the batch and there is no normalization to it so far.
-            scaler.scale(loss).backward()
             scheduler.step_batch(params.batch_idx_train)
 
-            scaler.step(optimizer)
-            scaler.update()
-            optimizer.zero_grad()
+            with step_timer.phase("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
         except Exception as e:
             logging.info(f"Caught exception: {e}.")
             save_bad_model()
@@ -1137,33 +1521,44 @@ def train_one_epoch(
             and params.batch_idx_train > 0
             and params.batch_idx_train % params.average_period == 0
         ):
-            update_averaged_model(
-                params=params,
-                model_cur=model,
-                model_avg=model_avg,
-            )
+            with step_timer.phase("average"):
+                update_averaged_model(
+                    params=params,
+                    model_cur=model,
+                    model_avg=model_avg,
+                )
 
         if (
             params.batch_idx_train > 0
             and params.batch_idx_train % params.save_every_n == 0
         ):
-            save_checkpoint_with_global_batch_idx(
-                out_dir=params.exp_dir,
-                global_batch_idx=params.batch_idx_train,
-                model=model,
-                model_avg=model_avg,
-                params=params,
-                optimizer=optimizer,
-                scheduler=scheduler,
-                sampler=train_dl.sampler,
-                scaler=scaler,
-                rank=rank,
-            )
-            remove_checkpoints(
-                out_dir=params.exp_dir,
-                topk=params.keep_last_k,
-                rank=rank,
-            )
+            with step_timer.phase("checkpoint"):
+                save_checkpoint_with_global_batch_idx(
+                    out_dir=params.exp_dir,
+                    global_batch_idx=params.batch_idx_train,
+                    model=model,
+                    model_avg=model_avg,
+                    params=params,
+                    optimizer=optimizer,
+                    scheduler=scheduler,
+                    sampler=train_dl.sampler,
+                    scaler=scaler,
+                    rank=rank,
+                    async_writer=async_writer,
+                )
+                if async_writer is not None:
+                    async_writer.submit(
+                        remove_checkpoints,
+                        out_dir=params.exp_dir,
+                        topk=params.keep_last_k,
+                        rank=rank,
+                    )
+                else:
+                    remove_checkpoints(
+                        out_dir=params.exp_dir,
+                        topk=params.keep_last_k,
+                        rank=rank,
+                    )
 
         if batch_idx % 100 == 0 and params.use_autocast:
             # If the grad scale was less than 1, try increasing it.    The _growth_interval
@@ -1210,13 +1605,14 @@ def train_one_epoch(
 
         if batch_idx % params.valid_interval == 0 and not params.print_diagnostics:
             logging.info("Computing validation loss")
-            valid_info = compute_validation_loss(
-                params=params,
-                model=model,
-                sp=sp,
-                valid_dl=valid_dl,
-                world_size=world_size,
-            )
+            with step_timer.pause():
+                valid_info = compute_validation_loss(
+                    params=params,
+                    model=model,
+                    sp=sp,
+                    valid_dl=valid_dl,
+                    world_size=world_size,
+                )
             model.train()
             logging.info(f"Epoch {params.cur_epoch}, validation: {valid_info}")
             logging.info(
@@ -1227,6 +1623,23 @@ def train_one_epoch(
                     tb_writer, "train/valid_", params.batch_idx_train
                 )
 
+        step_timer.step()
+        if batch_idx % params.log_interval == 0 and batch_idx > 0:
+            step_timer.log(tb_writer, params.batch_idx_train)
+
+        if profiler_window is not None:
+            profiler_window.step(params.batch_idx_train)
+
+        data_start = time.perf_counter()
+
+    if profiler_window is not None:
+        # Do not profile across epochs
+        profiler_window.stop()
+
+    if sub_batch_idx % params.accum_grad != params.accum_grad - 1:
+        # Discard the gradients of an incomplete optimizer step
+        optimizer.zero_grad()
+
     loss_value = tot_loss["loss"] / tot_loss["frames"]
     params.train_loss = loss_value
     if params.train_loss < params.best_train_loss:
@@ -1324,6 +1737,20 @@ def run(rank, world_size, args):
         params=params, model=model, model_avg=model_avg
     )
 
+    if params.activation_checkpoint_stacks:
+        stacks = tuple(
+            bool(i) for i in _to_int_tuple(params.activation_checkpoint_stacks)
+        )
+        if len(stacks) == 1:
+            stacks = stacks[0]
+        module_types = tuple(params.activation_checkpoint_modules.split(","))
+        logging.info(f"Activation checkpointing of {module_types} in stacks {stacks}")
+        model.encoder.set_activation_checkpointing(
+            stacks=stacks,
+            module_types=module_types,
+            memory_budget=params.activation_checkpoint_memory_budget,
+        )
+
     model.to(device)
     if world_size > 1:
         logging.info("Using DDP")
@@ -1333,6 +1760,7 @@ def run(rank, world_size, args):
         get_parameter_groups_with_lrs(model, lr=params.base_lr, include_names=True),
         lr=params.base_lr,  # should have no effect
         clipping_scale=2.0,
+        foreach=params.optim_foreach,
     )
 
     scheduler = Eden(optimizer, params.lr_batches, params.lr_epochs)
@@ -1358,6 +1786,13 @@ def run(rank, world_size, args):
     if params.inf_check:
         register_inf_check_hooks(model)
 
+    device_augment = None
+    if params.augment_on_device:
+        device_augment = get_device_augment(params, device)
+        # Don't apply them again in the dataloader
+        args.enable_musan = False
+        args.enable_spec_aug = False
+
     librispeech = LibriSpeechAsrDataModule(args)
 
     if params.full_libri:
@@ -1420,15 +1855,43 @@ def run(rank, world_size, args):
     else:
         sampler_state_dict = None
 
+    duration_bins = None
+    max_durations = None
+    if params.auto_batch_size:
+        assert params.bucketing_sampler, "--auto-batch-size requires bucketing"
+        if sampler_state_dict is not None and "max_durations" in sampler_state_dict:
+            # Keep the batch sizes of the checkpoint, so that the rest of the
+            # epoch has the same batches
+            duration_bins = sampler_state_dict["duration_bins"]
+            max_durations = sampler_state_dict["max_durations"]
+        else:
+            probe_dl = librispeech.train_dataloaders(train_cuts)
+            duration_bins = probe_dl.sampler.duration_bins
+            max_durations = tune_batch_size(
+                model=model,
+                train_dl=probe_dl,
+                train_cuts=train_cuts,
+                optimizer=optimizer,
+                sp=sp,
+                params=params,
+                device=device,
+                world_size=world_size,
+                spec_augment=spec_augment,
+                device_augment=device_augment,
+            )
+
     train_dl = librispeech.train_dataloaders(
-        train_cuts, sampler_state_dict=sampler_state_dict
+        train_cuts,
+        sampler_state_dict=sampler_state_dict,
+        duration_bins=duration_bins,
+        max_durations=max_durations,
     )
 
     valid_cuts = librispeech.dev_clean_cuts()
     valid_cuts += librispeech.dev_other_cuts()
     valid_dl = librispeech.valid_dataloaders(valid_cuts)
 
-    if not params.print_diagnostics:
+    if not params.print_diagnostics and not params.auto_batch_size:
         scan_pessimistic_batches_for_oom(
             model=model,
             train_dl=train_dl,
@@ -1443,6 +1906,19 @@ def run(rank, world_size, args):
         logging.info("Loading grad scaler state dict")
         scaler.load_state_dict(checkpoints["grad_scaler"])
 
+    async_writer = None
+    if params.async_checkpoint and rank == 0:
+        async_writer = AsyncCheckpointWriter()
+
+    step_timer = get_step_timer(params, model, device)
+    profiler_window = None
+    if params.profile_start_batch > 0:
+        profiler_window = TorchProfilerWindow(
+            start=params.profile_start_batch,
+            num_steps=params.profile_num_batches,
+            out_dir=params.exp_dir / "profile" / f"rank-{rank}",
+        )
+
     for epoch in range(params.start_epoch, params.num_epochs + 1):
         scheduler.step_epoch(epoch - 1)
         fix_random_seed(params.seed + epoch - 1)
@@ -1467,6 +1943,10 @@ def run(rank, world_size, args):
             tb_writer=tb_writer,
             world_size=world_size,
             rank=rank,
+            async_writer=async_writer,
+            device_augment=device_augment,
+            step_timer=step_timer,
+            profiler_window=profiler_window,
         )
 
         if params.print_diagnostics:
@@ -1482,8 +1962,12 @@ def run(rank, world_size, args):
             sampler=train_dl.sampler,
             scaler=scaler,
             rank=rank,
+            async_writer=async_writer,
         )
 
+    if async_writer is not None:
+        async_writer.close()
+
     logging.info("Done!")
 
     if world_size > 1:
@@ -1569,6 +2053,84 @@ def scan_pessimistic_batches_for_oom(
         )
 
 
+def tune_batch_size(
+    model: Union[nn.Module, DDP],
+    train_dl: torch.utils.data.DataLoader,
+    train_cuts: CutSet,
+    optimizer: torch.optim.Optimizer,
+    sp: spm.SentencePieceProcessor,
+    params: AttributeDict,
+    device: torch.device,
+    world_size: int = 1,
+    spec_augment: Optional[SpecAugment] = None,
+    device_augment: Optional[DeviceAugment] = None,
+) -> List[float]:
+    """Measure the peak memory of training steps on batches of a few duration
+    buckets of `train_dl.sampler` and return the maximum duration of the
+    batches of each bucket. See icefall/batch_tuner.py."""
+    assert device.type == "cuda", "--auto-batch-size requires a CUDA device"
+    if isinstance(model, DDP):
+        # Without DDP, the gradients are not synchronized, so the ranks
+        # need not measure the same batches.
+        model = model.module
+
+    def peak_memory(cuts: CutSet) -> int:
+        def train_step():
+            batch = train_dl.dataset[cuts]
+            if device_augment is not None:
+                batch = device_augment(batch, device)
+            with torch.cuda.amp.autocast(
+                enabled=params.use_autocast, dtype=params.dtype
+            ):
+                loss, _ = compute_loss(
+                    params=params,
+                    model=model,
+                    sp=sp,
+                    batch=batch,
+                    is_training=True,
+                    spec_augment=spec_augment,
+                )
+            loss.backward()
+
+        try:
+            return measure_peak_memory(train_step, device)
+        finally:
+            optimizer.zero_grad(set_to_none=True)
+
+    budget = (
+        params.auto_batch_target_utilization
+        * torch.cuda.get_device_properties(device).total_memory
+    )
+    if not optimizer.state:
+        # The state of ScaledAdam, about two tensors per parameter, is
+        # allocated at the first step.
+        budget -= 2 * sum(p.numel() * p.element_size() for p in model.parameters())
+
+    logging.info("Measuring the peak memory of training steps to choose the batch size")
+    max_durations, _ = tune_max_durations(
+        train_cuts,
+        duration_bins=train_dl.sampler.duration_bins,
+        peak_memory_fn=peak_memory,
+        num_tokens_fn=lambda c: len(sp.encode(c.supervisions[0].text)),
+        budget=budget,
+        probe_durations=[params.max_duration / 2, params.max_duration],
+    )
+
+    if world_size > 1:
+        # Use the same batch sizes on all ranks
+        max_durations = torch.tensor(max_durations, device=device)
+        torch.distributed.all_reduce(max_durations, op=torch.distributed.ReduceOp.MIN)
+        max_durations = max_durations.tolist()
+
+    bins = [0.0] + list(train_dl.sampler.duration_bins)
+    for b, max_duration in enumerate(max_durations):
+        logging.info(
+            f"Bucket {b}, cuts longer than {bins[b]:.1f} seconds: "
+            f"max duration {max_duration:.1f} seconds"
+        )
+    return max_durations
+
+
 def main():
     parser = get_parser()
     LibriSpeechAsrDataModule.add_arguments(parser)
@@ -40,6 +40,7 @@ from scaling import (
     FloatLike,
     ScheduledFloat,
     Whiten,
+    checkpoint,
     convert_num_channels,
     limit_param_value,
     penalize_abs_values_gt,
@@ -47,6 +48,18 @@ from scaling import (
 )
 from torch import Tensor, nn
 
+# Types of submodules of Zipformer2EncoderLayer that activation checkpointing
+# can be applied to, see Zipformer2.set_activation_checkpointing().
+# "layer" means the whole layer.
+CHECKPOINT_MODULE_TYPES = (
+    "layer",
+    "attn_weights",
+    "nonlin_attn",
+    "self_attn",
+    "conv",
+    "ff",
+)
+
 
 class Zipformer2(EncoderInterface):
     """
@@ -286,6 +299,43 @@ class Zipformer2(EncoderInterface):
 
         return chunk_size, left_context_chunks
 
+    def set_activation_checkpointing(
+        self,
+        stacks: Union[bool, Tuple[bool]] = True,
+        module_types: Tuple[str] = ("layer",),
+        memory_budget: float = 0.0,
+    ) -> None:
+        """
+        Do not keep the intermediate activations of some modules for the backward pass,
+        but recompute them in the backward pass, which saves memory at the cost of
+        about one more forward pass of these modules.
+
+        Args:
+          stacks: for each encoder stack, whether to apply activation checkpointing to its
+             layers; a single bool applies to all stacks.
+          module_types: the types of modules in each layer that are checkpointed, a subset
+             of CHECKPOINT_MODULE_TYPES.  "layer" checkpoints each layer as a whole, which
+             saves the most memory; e.g. ("attn_weights", "ff") only recomputes the
+             attention weights and the feedforward modules.
+          memory_budget: if > 0, a module is checkpointed only if the CUDA memory allocated
+             when it is called exceeds this many GB, so short batches are not slowed down.
+        """
+        if isinstance(stacks, bool):
+            stacks = (stacks,) * len(self.encoders)
+        assert len(stacks) == len(self.encoders), (stacks, len(self.encoders))
+        for t in module_types:
+            assert t in CHECKPOINT_MODULE_TYPES, (t, CHECKPOINT_MODULE_TYPES)
+        if "layer" in module_types:
+            # The other modules are part of the layer.
+            module_types = ("layer",)
+
+        for enabled, encoder in zip(stacks, self.encoders):
+            if isinstance(encoder, DownsampledZipformer2Encoder):
+                encoder = encoder.encoder
+            for layer in encoder.layers:
+                layer.checkpoint_module_types = tuple(module_types) if enabled else ()
+                layer.checkpoint_memory_budget = memory_budget
+
     def forward(
         self,
         x: Tensor,
@@ -663,6 +713,10 @@ class Zipformer2EncoderLayer(nn.Module):
             max_abs=4.0,
         )
 
+        # See Zipformer2.set_activation_checkpointing()
+        self.checkpoint_module_types = ()
+        self.checkpoint_memory_budget = 0.0
+
     def get_sequence_dropout_mask(self, x: Tensor, dropout_rate: float) -> Optional[Tensor]:
         if dropout_rate == 0.0 or not self.training or torch.jit.is_scripting() or torch.jit.is_tracing():
             return None
@@ -681,6 +735,33 @@ class Zipformer2EncoderLayer(nn.Module):
         else:
             return x * dropout_mask
 
+    def use_checkpoint(self, module_type: str, x: Tensor) -> bool:
+        """
+        Returns true if activation checkpointing is to be applied to a module of type
+        `module_type` with input x, see Zipformer2.set_activation_checkpointing().
+        """
+        if module_type not in self.checkpoint_module_types:
+            return False
+        if not (self.training and x.requires_grad and torch.is_grad_enabled()):
+            return False
+        if self.checkpoint_memory_budget > 0 and x.is_cuda:
+            return (
+                torch.cuda.memory_allocated(x.device)
+                > self.checkpoint_memory_budget * 1.0e09
+            )
+        return True
+
+    def call_module(
+        self, module_type: str, module: nn.Module, x: Tensor, *args, **kwargs
+    ):
+        """
+        Returns module(x, *args, **kwargs), with activation checkpointing if configured.
+        Not for use with torch.jit.script().
+        """
+        if self.use_checkpoint(module_type, x):
+            return checkpoint(module, x, *args, **kwargs)
+        return module(x, *args, **kwargs)
+
     def forward(
         self,
         src: Tensor,
@@ -715,14 +796,27 @@ class Zipformer2EncoderLayer(nn.Module):
             attention_skip_rate = float(self.attention_skip_rate) if self.training else 0.0
 
         # attn_weights: (num_heads, batch_size, seq_len, seq_len)
-        attn_weights = self.self_attn_weights(
-            src,
-            pos_emb=pos_emb,
-            attn_mask=attn_mask,
-            key_padding_mask=src_key_padding_mask,
-        )
+        if torch.jit.is_scripting():
+            attn_weights = self.self_attn_weights(
+                src,
+                pos_emb=pos_emb,
+                attn_mask=attn_mask,
+                key_padding_mask=src_key_padding_mask,
+            )
+        else:
+            attn_weights = self.call_module(
+                "attn_weights",
+                self.self_attn_weights,
+                src,
+                pos_emb=pos_emb,
+                attn_mask=attn_mask,
+                key_padding_mask=src_key_padding_mask,
+            )
 
-        src = src + self.feed_forward1(src)
+        if torch.jit.is_scripting():
+            src = src + self.feed_forward1(src)
+        else:
+            src = src + self.call_module("ff", self.feed_forward1, src)
 
         self_attn_dropout_mask = self.get_sequence_dropout_mask(src, attention_skip_rate)
 
@@ -738,11 +832,22 @@ class Zipformer2EncoderLayer(nn.Module):
             selected_attn_weights = (selected_attn_weights > 0.0).to(selected_attn_weights.dtype)
             selected_attn_weights = selected_attn_weights * (1.0 / selected_attn_weights.sum(dim=-1, keepdim=True))
 
-        na = self.balancer_na(self.nonlin_attention(src, selected_attn_weights))
+        if torch.jit.is_scripting():
+            na = self.nonlin_attention(src, selected_attn_weights)
+        else:
+            na = self.call_module(
+                "nonlin_attn", self.nonlin_attention, src, selected_attn_weights
+            )
+        na = self.balancer_na(na)
 
         src = src + (na if self_attn_dropout_mask is None else na * self_attn_dropout_mask)
 
-        self_attn = self.self_attn1(src, attn_weights)
+        if torch.jit.is_scripting():
+            self_attn = self.self_attn1(src, attn_weights)
+        else:
+            self_attn = self.call_module(
+                "self_attn", self.self_attn1, src, attn_weights
+            )
 
         src = src + (self_attn if self_attn_dropout_mask is None else self_attn * self_attn_dropout_mask)
 
@@ -750,21 +855,39 @@ class Zipformer2EncoderLayer(nn.Module):
             conv_skip_rate = 0.0
         else:
             conv_skip_rate = float(self.conv_skip_rate) if self.training else 0.0
-        src = src + self.sequence_dropout(
-            self.conv_module1(src, chunk_size=chunk_size, src_key_padding_mask=src_key_padding_mask),
-            conv_skip_rate,
-        )
+        if torch.jit.is_scripting():
+            src_conv = self.conv_module1(
+                src, chunk_size=chunk_size, src_key_padding_mask=src_key_padding_mask
+            )
+        else:
+            src_conv = self.call_module(
+                "conv",
+                self.conv_module1,
+                src,
+                chunk_size=chunk_size,
+                src_key_padding_mask=src_key_padding_mask,
+            )
+        src = src + self.sequence_dropout(src_conv, conv_skip_rate)
 
         if torch.jit.is_scripting() or torch.jit.is_tracing():
             ff2_skip_rate = 0.0
         else:
             ff2_skip_rate = float(self.ff2_skip_rate) if self.training else 0.0
-        src = src + self.sequence_dropout(self.balancer_ff2(self.feed_forward2(src)), ff2_skip_rate)
+        if torch.jit.is_scripting():
+            ff2 = self.feed_forward2(src)
+        else:
+            ff2 = self.call_module("ff", self.feed_forward2, src)
+        src = src + self.sequence_dropout(self.balancer_ff2(ff2), ff2_skip_rate)
 
         # bypass in the middle of the layer.
         src = self.bypass_mid(src_orig, src)
 
-        self_attn = self.self_attn2(src, attn_weights)
+        if torch.jit.is_scripting():
+            self_attn = self.self_attn2(src, attn_weights)
+        else:
+            self_attn = self.call_module(
+                "self_attn", self.self_attn2, src, attn_weights
+            )
 
         src = src + (self_attn if self_attn_dropout_mask is None else self_attn * self_attn_dropout_mask)
 
@@ -772,16 +895,29 @@ class Zipformer2EncoderLayer(nn.Module):
             conv_skip_rate = 0.0
         else:
             conv_skip_rate = float(self.conv_skip_rate) if self.training else 0.0
-        src = src + self.sequence_dropout(
-            self.conv_module2(src, chunk_size=chunk_size, src_key_padding_mask=src_key_padding_mask),
-            conv_skip_rate,
-        )
+        if torch.jit.is_scripting():
+            src_conv = self.conv_module2(
+                src, chunk_size=chunk_size, src_key_padding_mask=src_key_padding_mask
+            )
+        else:
+            src_conv = self.call_module(
+                "conv",
+                self.conv_module2,
+                src,
+                chunk_size=chunk_size,
+                src_key_padding_mask=src_key_padding_mask,
+            )
+        src = src + self.sequence_dropout(src_conv, conv_skip_rate)
 
         if torch.jit.is_scripting() or torch.jit.is_tracing():
             ff3_skip_rate = 0.0
         else:
             ff3_skip_rate = float(self.ff3_skip_rate) if self.training else 0.0
-        src = src + self.sequence_dropout(self.balancer_ff3(self.feed_forward3(src)), ff3_skip_rate)
+        if torch.jit.is_scripting():
+            ff3 = self.feed_forward3(src)
+        else:
+            ff3 = self.call_module("ff", self.feed_forward3, src)
+        src = src + self.sequence_dropout(self.balancer_ff3(ff3), ff3_skip_rate)
 
         src = self.balancer1(src)
         src = self.norm(src)
@@ -986,13 +1122,24 @@ class Zipformer2Encoder(nn.Module):
             output = output * feature_mask
 
         for i, mod in enumerate(self.layers):
-            output = mod(
-                output,
-                pos_emb,
-                chunk_size=chunk_size,
-                attn_mask=attn_mask,
-                src_key_padding_mask=src_key_padding_mask,
-            )
+            if torch.jit.is_scripting():
+                output = mod(
+                    output,
+                    pos_emb,
+                    chunk_size=chunk_size,
+                    attn_mask=attn_mask,
+                    src_key_padding_mask=src_key_padding_mask,
+                )
+            else:
+                output = mod.call_module(
+                    "layer",
+                    mod,
+                    output,
+                    pos_emb,
+                    chunk_size=chunk_size,
+                    attn_mask=attn_mask,
+                    src_key_padding_mask=src_key_padding_mask,
+                )
 
             if not torch.jit.is_scripting() and not torch.jit.is_tracing():
                 output = output * feature_mask
@@ -2315,9 +2462,47 @@ def _test_zipformer_main(causal: bool = False):
     f  # to remove flake8 warnings
 
 
+def _test_zipformer_checkpointing():
+    # Gradients with activation checkpointing should be the same as without it,
+    # including the randomness of dropout, Balancer and Whiten.
+    batch_size = 3
+    seq_len = 30
+    x = torch.randn(seq_len, batch_size, 64)
+    x_lens = torch.full((batch_size,), seq_len, dtype=torch.int64)
+
+    torch.manual_seed(0)
+    c = Zipformer2(
+        encoder_dim=(64, 96),
+        encoder_unmasked_dim=(48, 64),
+        num_heads=(4, 4),
+        num_encoder_layers=2,
+    )
+
+    def get_grads():
+        random.seed(10)
+        torch.manual_seed(10)
+        c.zero_grad()
+        f = c(x, x_lens)
+        (f[0] ** 2).sum().backward()
+        return [p.grad.clone() for p in c.parameters() if p.grad is not None]
+
+    ref = get_grads()
+    for module_types in [
+        ("layer",),
+        ("attn_weights", "nonlin_attn", "self_attn", "conv", "ff"),
+    ]:
+        c.set_activation_checkpointing(stacks=(True, True), module_types=module_types)
+        grads = get_grads()
+        assert len(grads) == len(ref)
+        for g, r in zip(grads, ref):
+            assert torch.allclose(g, r, atol=1e-5), (module_types, (g - r).abs().max())
+    c.set_activation_checkpointing(stacks=False)
+
+
 if __name__ == "__main__":
     logging.getLogger().setLevel(logging.INFO)
     torch.set_num_threads(1)
     torch.set_num_interop_threads(1)
     _test_zipformer_main(False)
     _test_zipformer_main(True)
+    _test_zipformer_checkpointing()
@@ -0,0 +1 @@
+../../../librispeech/ASR/zipformer/blank_skip.py
\ No newline at end of file
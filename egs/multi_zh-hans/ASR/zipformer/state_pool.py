@@ -0,0 +1 @@
+../../../librispeech/ASR/zipformer/state_pool.py
\ No newline at end of file
@@ -32,6 +32,8 @@ import k2
 import numpy as np
 import torch
 
+from icefall.rnn_lm.dataset import save_lm_data_as_mmap
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -53,6 +55,15 @@ def get_args():
         help="Statistics about LM training data., data/bpe_500/statistics.txt",
     )
 
+    parser.add_argument(
+        "--out-mmap-dir",
+        type=str,
+        default="",
+        help="""If not empty, also save the sorted LM data to this directory
+        in the memory-mapped format of MmapLmDataset in
+        icefall/rnn_lm/dataset.py, e.g., data/bpe_500/sorted_lm_data_mmap""",
+    )
+
     return parser.parse_args()
 
 
@@ -103,6 +114,10 @@ def main():
     torch.save(data, args.out_lm_data)
     logging.info(f"Saved to {args.out_lm_data}")
 
+    if args.out_mmap_dir:
+        save_lm_data_as_mmap(args.out_lm_data, args.out_mmap_dir)
+        logging.info(f"Saved to {args.out_mmap_dir}")
+
     statistics = Path(args.out_statistics)
 
     # Write statistics
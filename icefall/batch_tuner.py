@@ -0,0 +1,491 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Choosing the batch size from the memory the model actually uses.
+
+Instead of a single ``--max-duration`` tuned by hand for each GPU and model
+size, the peak memory of a few training steps is measured on batches from
+different duration buckets, and a :class:`MemoryModel` is fitted to it::
+
+    peak = base + seconds * (per_second + per_second_length * length)
+                + tokens * per_token
+
+where `seconds` is the total duration of the batch, `length` the duration of
+its longest cut and `tokens` the total number of tokens. The term with
+`length` accounts for self-attention, whose memory grows with the square of
+the sequence length. From the fitted model, the largest total duration that
+keeps the peak memory below a budget is computed for each bucket and used by
+:class:`BucketedTimeConstraint` in the sampler.
+
+If a batch still runs out of memory during training, :func:`split_batch`
+splits it into micro-batches whose gradients are accumulated, and
+:meth:`BucketedTimeConstraint.back_off` lowers the maximum duration of its
+bucket for the following batches.
+"""
+
+import logging
+from bisect import bisect_left
+from dataclasses import asdict, dataclass
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import torch
+from lhotse import CutSet
+from lhotse.cut import Cut
+from lhotse.dataset import DynamicBucketingSampler
+from lhotse.dataset.sampling.base import SamplingConstraint
+
+
+def is_oom_error(e: BaseException) -> bool:
+    """Return True if `e` is raised because the GPU ran out of memory."""
+    oom_error = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_error is not None and isinstance(e, oom_error):
+        return True
+    return isinstance(e, RuntimeError) and "CUDA out of memory" in str(e)
+
+
+@dataclass
+class BucketedTimeConstraint(SamplingConstraint):
+    """
+    A sampling constraint on the total duration of a batch, with a different
+    maximum for each duration bucket of a ``DynamicBucketingSampler``.
+
+    The bucket of a batch is that of its longest cut. Unlike lhotse's
+    ``FixedBucketBatchSizeConstraint``, cuts longer than the last bin are
+    accepted and go to the last bucket.
+    """
+
+    duration_bins: List[float]
+    # len(max_durations) == len(duration_bins) + 1
+    max_durations: List[float]
+    current: float = 0.0
+    longest_seen: float = 0.0
+    num_cuts: int = 0
+
+    def __post_init__(self):
+        assert sorted(self.duration_bins) == list(self.duration_bins)
+        assert len(self.max_durations) == len(self.duration_bins) + 1, (
+            len(self.max_durations),
+            len(self.duration_bins),
+        )
+
+    def is_active(self) -> bool:
+        return True
+
+    def bucket_of(self, duration: float) -> int:
+        return bisect_left(self.duration_bins, duration)
+
+    def add(self, example: Cut) -> None:
+        duration = self.measure_length(example)
+        self.current += duration
+        self.longest_seen = max(self.longest_seen, duration)
+        self.num_cuts += 1
+
+    def exceeded(self) -> bool:
+        return self.current > self.max_durations[self.bucket_of(self.longest_seen)]
+
+    def close_to_exceeding(self) -> bool:
+        """True if adding another cut of the same bucket could exceed the
+        constraint. Unlike lhotse's ``TimeConstraint``, which assumes that
+        the next cut is not longer than the longest one seen so far, the
+        upper bound of the bucket is used, so that a batch never exceeds its
+        maximum duration."""
+        bucket = self.bucket_of(self.longest_seen)
+        if bucket < len(self.duration_bins):
+            longest = self.duration_bins[bucket]
+        else:
+            longest = self.longest_seen
+        return self.current + longest > self.max_durations[bucket]
+
+    def reset(self) -> None:
+        self.current = 0.0
+        self.longest_seen = 0.0
+        self.num_cuts = 0
+
+    def measure_length(self, example: Cut) -> float:
+        return example.duration
+
+    def back_off(self, longest: float, total: float, factor: float = 0.9) -> float:
+        """
+        Lower the maximum duration of the bucket of a batch that ran out of
+        memory to `factor` times its total duration. The list of maximum
+        durations is modified in place, so the change is seen by all copies
+        of this constraint, e.g., those made by the sampler.
+
+        Args:
+          longest:
+            The duration of the longest cut in the batch.
+          total:
+            The total duration of the batch.
+          factor:
+            The new maximum duration relative to `total`.
+        Returns:
+          Return the new maximum duration of the bucket.
+        """
+        bucket = self.bucket_of(longest)
+        # Keep room for at least one cut
+        new_max = max(factor * total, longest)
+        self.max_durations[bucket] = min(self.max_durations[bucket], new_max)
+        return self.max_durations[bucket]
+
+    def state_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.duration_bins = state_dict.pop("duration_bins")
+        # In place, see back_off()
+        self.max_durations[:] = state_dict.pop("max_durations")
+        self.current = state_dict.pop("current")
+        self.longest_seen = state_dict.pop("longest_seen")
+        self.num_cuts = state_dict.pop("num_cuts")
+        assert len(state_dict) == 0, (
+            "Error in BucketedTimeConstraint.load_state_dict(): Unexpected keys:\n- "
+            + "\n- ".join(state_dict.keys())
+        )
+
+    def __add__(self, other: "BucketedTimeConstraint") -> "BucketedTimeConstraint":
+        assert self.duration_bins == other.duration_bins
+        assert self.max_durations == other.max_durations
+        return BucketedTimeConstraint(
+            duration_bins=self.duration_bins,
+            max_durations=self.max_durations,
+            current=self.current + other.current,
+            longest_seen=max(self.longest_seen, other.longest_seen),
+            num_cuts=self.num_cuts + other.num_cuts,
+        )
+
+    def __eq__(self, other: "BucketedTimeConstraint") -> bool:
+        return (
+            isinstance(other, BucketedTimeConstraint)
+            and self.duration_bins == other.duration_bins
+            and self.max_durations == other.max_durations
+        )
+
+
+class BucketedDynamicBucketingSampler(DynamicBucketingSampler):
+    """A ``DynamicBucketingSampler`` whose batches are limited by a
+    :class:`BucketedTimeConstraint`. Unlike the samplers with other custom
+    constraints, it supports ``state_dict()``; the maximum durations are
+    saved with it, so that a resumed training sees the same batches."""
+
+    def __init__(
+        self,
+        *cuts: CutSet,
+        duration_bins: List[float],
+        max_durations: List[float],
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            *cuts,
+            constraint=BucketedTimeConstraint(
+                duration_bins=list(duration_bins),
+                max_durations=list(max_durations),
+            ),
+            duration_bins=list(duration_bins),
+            **kwargs,
+        )
+
+    def state_dict(self) -> Dict[str, Any]:
+        # The base class refuses to save samplers with a custom constraint
+        # since it cannot restore them.
+        constraint, self.constraint = self.constraint, None
+        try:
+            sd = super().state_dict()
+        finally:
+            self.constraint = constraint
+        sd["duration_bins"] = list(constraint.duration_bins)
+        sd["max_durations"] = list(constraint.max_durations)
+        return sd
+
+    def load_state_dict(self, sd: Dict[str, Any]) -> None:
+        duration_bins = sd.pop("duration_bins", None)
+        max_durations = sd.pop("max_durations", None)
+        if max_durations is not None:
+            assert list(duration_bins) == list(self.duration_bins), (
+                duration_bins,
+                self.duration_bins,
+            )
+            self.constraint.max_durations[:] = max_durations
+        super().load_state_dict(sd)
+
+
+class MemoryModel(object):
+    """
+    A linear model of the peak memory in bytes of a training step::
+
+        peak = base + seconds * (per_second + per_second_length * length)
+                    + tokens * per_token
+
+    See the docstring of this module.
+    """
+
+    names = ("base", "per_second", "per_second_length", "per_token")
+
+    def __init__(self, coefs: Sequence[float] = (0.0, 0.0, 0.0, 0.0)) -> None:
+        self.coefs = [float(c) for c in coefs]
+
+    @staticmethod
+    def features(seconds: float, length: float, tokens: float) -> List[float]:
+        return [1.0, seconds, seconds * length, tokens]
+
+    @classmethod
+    def fit(cls, probes: Sequence[Tuple[float, float, float, float]]) -> "MemoryModel":
+        """
+        Fit the model by least squares with non-negative coefficients.
+
+        Args:
+          probes:
+            Each entry is (seconds, length, tokens, peak_bytes) of a
+            measured training step.
+        """
+        x = np.array([cls.features(s, l, t) for s, l, t, _ in probes])
+        y = np.array([p for _, _, _, p in probes], dtype=np.float64)
+        # Scale the columns, so that the least squares problem is well
+        # conditioned.
+        scale = np.abs(x).max(axis=0)
+        scale[scale == 0] = 1.0
+        x = x / scale
+
+        # A simple active set method: coefficients that come out negative
+        # are fixed to zero and the rest are fitted again.
+        active = list(range(x.shape[1]))
+        coefs = np.zeros(x.shape[1])
+        while active:
+            sol, *_ = np.linalg.lstsq(x[:, active], y, rcond=None)
+            if (sol >= 0).all():
+                coefs[active] = sol
+                break
+            active = [a for a, c in zip(active, sol) if c >= 0]
+        return cls(coefs / scale)
+
+    def __call__(self, seconds: float, length: float, tokens: float) -> float:
+        """Return the predicted peak memory in bytes."""
+        return float(np.dot(self.coefs, self.features(seconds, length, tokens)))
+
+    def max_duration(
+        self, length: float, tokens_per_second: float, budget: float
+    ) -> float:
+        """Return the largest total duration of a batch whose longest cut
+        has the given duration, such that the peak memory is within
+        `budget` bytes."""
+        base, per_second, per_second_length, per_token = self.coefs
+        cost = per_second + per_second_length * length + per_token * tokens_per_second
+        if cost <= 0:
+            return float("inf")
+        return max(budget - base, 0.0) / cost
+
+    def __str__(self) -> str:
+        return ", ".join(f"{n}: {c:.4g}" for n, c in zip(self.names, self.coefs))
+
+
+def measure_peak_memory(fn: Callable[[], Any], device: torch.device) -> int:
+    """Run `fn` and return the peak memory in bytes allocated on `device`
+    while it runs."""
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    fn()
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device)
+
+
+def tune_max_durations(
+    cuts: Iterable[Cut],
+    duration_bins: List[float],
+    peak_memory_fn: Callable[[CutSet], int],
+    num_tokens_fn: Callable[[Cut], int],
+    budget: float,
+    probe_durations: Sequence[float],
+    num_probe_buckets: int = 4,
+    num_cuts_for_estimate: int = 10000,
+) -> Tuple[List[float], MemoryModel]:
+    """
+    Measure the peak memory of training steps on batches from a few buckets
+    and compute the maximum duration of the batches of each bucket.
+
+    Args:
+      cuts:
+        The training cuts. Only the first `num_cuts_for_estimate` of them
+        are read.
+      duration_bins:
+        The duration bins of the sampler.
+      peak_memory_fn:
+        It runs a training step, i.e., forward and backward, on a batch of
+        cuts and returns its peak memory in bytes. See
+        :func:`measure_peak_memory`.
+      num_tokens_fn:
+        It returns the number of tokens of a cut.
+      budget:
+        The maximum peak memory in bytes.
+      probe_durations:
+        The total durations of the batches measured in each probed bucket.
+        There should be at least two different values, so that the memory
+        per second can be told apart from the base memory.
+      num_probe_buckets:
+        The number of buckets, evenly spaced and including the last one, to
+        measure.
+      num_cuts_for_estimate:
+        The number of cuts read from `cuts`.
+    Returns:
+      Return a tuple (max_durations, memory_model), where max_durations
+      contains the maximum total duration of each of the
+      ``len(duration_bins) + 1`` buckets.
+    """
+    num_buckets = len(duration_bins) + 1
+    max_probe_duration = max(probe_durations)
+
+    # Read some cuts of each bucket, and the tokens per second of them
+    bucket_cuts: List[List[Cut]] = [[] for _ in range(num_buckets)]
+    bucket_seconds = [0.0] * num_buckets
+    bucket_tokens = [0] * num_buckets
+    bucket_longest = [0.0] * num_buckets
+    bucket_kept = [0.0] * num_buckets
+    for cut in islice(cuts, num_cuts_for_estimate):
+        b = bisect_left(duration_bins, cut.duration)
+        bucket_seconds[b] += cut.duration
+        bucket_tokens[b] += num_tokens_fn(cut)
+        bucket_longest[b] = max(bucket_longest[b], cut.duration)
+        if bucket_kept[b] < max_probe_duration:
+            bucket_cuts[b].append(cut)
+            bucket_kept[b] += cut.duration
+
+    non_empty = [b for b in range(num_buckets) if bucket_cuts[b]]
+    assert non_empty, "No cuts to measure"
+    num_probe_buckets = min(num_probe_buckets, len(non_empty))
+    probe_buckets = sorted(
+        set(
+            non_empty[round(i * (len(non_empty) - 1) / max(num_probe_buckets - 1, 1))]
+            for i in range(num_probe_buckets)
+        )
+    )
+
+    probes = []
+    for b in probe_buckets:
+        for probe_duration in sorted(set(probe_durations)):
+            selected = []
+            seconds = 0.0
+            for cut in bucket_cuts[b]:
+                if selected and seconds + cut.duration > probe_duration:
+                    break
+                selected.append(cut)
+                seconds += cut.duration
+            length = max(c.duration for c in selected)
+            tokens = sum(num_tokens_fn(c) for c in selected)
+
+            oom = False
+            try:
+                peak = peak_memory_fn(CutSet.from_cuts(selected))
+            except Exception as e:
+                if not is_oom_error(e):
+                    raise
+                oom = True
+            if oom:
+                # Larger batches of this bucket would run out of memory too
+                logging.warning(
+                    f"Out of memory with a batch of {seconds:.1f} seconds "
+                    f"from bucket {b}, skipping larger ones"
+                )
+                torch.cuda.empty_cache()
+                break
+            logging.info(
+                f"Bucket {b}: {len(selected)} cuts, {seconds:.1f} seconds, "
+                f"longest {length:.1f} seconds, {tokens} tokens, "
+                f"peak memory {peak // 1000000}MB"
+            )
+            probes.append((seconds, length, tokens, peak))
+
+    if len(probes) < 2:
+        raise RuntimeError(
+            "Too few batches could be measured to tune the batch size. "
+            "Please use smaller probe durations, e.g., decrease --max-duration."
+        )
+
+    memory_model = MemoryModel.fit(probes)
+    logging.info(f"Memory model in bytes: {memory_model}")
+
+    total_seconds = sum(bucket_seconds)
+    default_rate = sum(bucket_tokens) / total_seconds if total_seconds > 0 else 0.0
+    max_durations = []
+    for b in range(num_buckets):
+        if b < len(duration_bins):
+            length = duration_bins[b]
+        else:
+            length = max(bucket_longest[b], duration_bins[-1] if duration_bins else 0)
+        if bucket_seconds[b] > 0:
+            rate = bucket_tokens[b] / bucket_seconds[b]
+        else:
+            rate = default_rate
+        max_duration = memory_model.max_duration(
+            length=length, tokens_per_second=rate, budget=budget
+        )
+        # Each batch has at least one cut
+        max_durations.append(max(max_duration, length))
+
+    return max_durations, memory_model
+
+
+def split_batch(batch: Dict[str, Any], num_splits: int) -> List[Dict[str, Any]]:
+    """
+    Split a batch from ``K2SpeechRecognitionDataset`` into at most
+    `num_splits` batches with about the same number of sequences. The
+    padding of the features is trimmed to the longest sequence of each
+    split.
+
+    Args:
+      batch:
+        A batch with the keys "inputs" and "supervisions". Entries of
+        batch["supervisions"] that are tensors or lists are indexed by
+        supervision; batch["supervisions"]["sequence_idx"] maps each
+        supervision to its row in batch["inputs"].
+      num_splits:
+        The number of batches to split into.
+    Returns:
+      Return a list of batches.
+    """
+    inputs = batch["inputs"]
+    supervisions = batch["supervisions"]
+    sequence_idx = supervisions["sequence_idx"].tolist()
+    num_seqs = inputs.size(0)
+    num_splits = max(1, min(num_splits, num_seqs))
+
+    ans = []
+    boundaries = np.linspace(0, num_seqs, num_splits + 1).round().astype(int)
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        sups = [i for i, s in enumerate(sequence_idx) if start <= s < end]
+        if not sups:
+            continue
+        num_frames = int(
+            max(
+                supervisions["start_frame"][i] + supervisions["num_frames"][i]
+                for i in sups
+            )
+        )
+        split_sups = {}
+        for key, value in supervisions.items():
+            if key == "sequence_idx":
+                split_sups[key] = value[sups] - int(start)
+            elif isinstance(value, torch.Tensor) and value.size(0) == len(sequence_idx):
+                split_sups[key] = value[sups]
+            elif isinstance(value, (list, tuple)) and len(value) == len(sequence_idx):
+                split_sups[key] = [value[i] for i in sups]
+            else:
+                split_sups[key] = value
+        split = dict(batch)
+        split["inputs"] = inputs[start:end, :num_frames]
+        split["supervisions"] = split_sups
+        ans.append(split)
+    return ans
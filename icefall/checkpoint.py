@@ -16,12 +16,15 @@
 # limitations under the License.
 
 
+import copy
 import glob
 import logging
 import os
+import queue
 import re
+import threading
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -36,6 +39,143 @@ from torch.optim import Optimizer
 LRSchedulerType = object
 
 
+class AsyncCheckpointWriter(object):
+    """Write checkpoints in a background thread so that training is
+    not blocked by `torch.save`.
+
+    :meth:`save` copies all tensors of a checkpoint to CPU memory, which is
+    pinned if CUDA is available, and returns as soon as the copy is done.
+    The copy is then written to a temporary file in a background thread and
+    renamed to the final filename, so an interrupted write never leaves a
+    truncated checkpoint behind.
+
+    Functions passed to :meth:`submit`, e.g., :func:`remove_checkpoints`,
+    run in the same thread after all previously saved checkpoints have been
+    written.
+
+    At most one checkpoint is pending at any time, so the host memory used
+    is bounded by the size of a single checkpoint. The pinned buffers are
+    reused by the next checkpoint.
+
+    Usage::
+
+        writer = AsyncCheckpointWriter()
+        save_checkpoint(filename, model, ..., async_writer=writer)
+        writer.submit(remove_checkpoints, out_dir=exp_dir, topk=keep_last_k)
+        ...
+        writer.close()
+    """
+
+    def __init__(self, pin_memory: bool = True) -> None:
+        """
+        Args:
+          pin_memory:
+            True to snapshot the tensors to pinned memory. It is ignored if
+            CUDA is not available.
+        """
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        # Map the path of a tensor in the checkpoint, e.g., ("model", "x.weight"),
+        # to its CPU buffer.
+        self._buffers: Dict[Tuple[Any, ...], Tensor] = dict()
+        self._queue: queue.Queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _snapshot(self, obj: Any, path: Tuple[Any, ...] = ()) -> Any:
+        """Return a copy of obj with every tensor copied to CPU memory.
+        Copies from GPU are asynchronous; the caller has to synchronize."""
+        if isinstance(obj, Tensor):
+            buf = self._buffers.get(path)
+            if (
+                buf is None
+                or buf.shape != obj.shape
+                or buf.dtype != obj.dtype
+                or buf.layout != obj.layout
+            ):
+                if obj.layout != torch.strided:
+                    return obj.detach().to("cpu", copy=True)
+                buf = torch.empty(
+                    obj.shape,
+                    dtype=obj.dtype,
+                    pin_memory=self.pin_memory and obj.is_cuda,
+                )
+                self._buffers[path] = buf
+            buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return buf
+        elif isinstance(obj, dict):
+            # copy.copy() keeps the type and attributes, e.g., the _metadata
+            # of a state_dict
+            ans = copy.copy(obj)
+            for k, v in obj.items():
+                ans[k] = self._snapshot(v, path + (k,))
+            return ans
+        elif isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+            return type(obj)(self._snapshot(v, path + (i,)) for i, v in enumerate(obj))
+        else:
+            return obj
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args, kwargs = item
+                if self._error is None:
+                    fn(*args, **kwargs)
+            except BaseException as e:
+                logging.error(f"Async checkpoint writer failed: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self) -> None:
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise RuntimeError("Failed to write checkpoint in background") from e
+
+    @staticmethod
+    def _write(checkpoint: Dict[str, Any], filename: Path) -> None:
+        filename = Path(filename)
+        tmp_filename = filename.with_name(f"{filename.name}.tmp")
+        torch.save(checkpoint, tmp_filename)
+        os.replace(tmp_filename, filename)
+        logging.info(f"Saved checkpoint to {filename}")
+
+    def save(self, checkpoint: Dict[str, Any], filename: Path) -> None:
+        """Snapshot the checkpoint and write it to `filename` in the
+        background. It waits for the previous checkpoint to be written
+        first."""
+        self.wait()
+        checkpoint = self._snapshot(checkpoint)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self._queue.put((self._write, (checkpoint, filename), {}))
+
+    def submit(self, fn: Callable, *args, **kwargs) -> None:
+        """Run `fn(*args, **kwargs)` in the background thread after all
+        pending checkpoints have been written. It is skipped if a previous
+        write failed."""
+        self._check_error()
+        self._queue.put((fn, args, kwargs))
+
+    def wait(self) -> None:
+        """Block until all pending checkpoints are written and all
+        submitted functions have finished."""
+        self._queue.join()
+        self._check_error()
+
+    def close(self) -> None:
+        """Wait for pending work and stop the background thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+
 def save_checkpoint(
     filename: Path,
     model: Union[nn.Module, DDP],
@@ -46,6 +186,7 @@ def save_checkpoint(
     scaler: Optional[GradScaler] = None,
     sampler: Optional[CutSampler] = None,
     rank: int = 0,
+    async_writer: Optional[AsyncCheckpointWriter] = None,
 ) -> None:
     """Save training information to a file.
 
@@ -66,6 +207,10 @@ def save_checkpoint(
         The GradScaler to be saved. We only save its `state_dict()`.
       rank:
         Used in DDP. We save checkpoint only for the node whose rank is 0.
+      async_writer:
+        If not None, the checkpoint is copied to CPU memory and written
+        by it in the background, so this function returns before the file
+        exists. Use its `wait()` method to wait for the file.
     Returns:
       Return None.
     """
@@ -93,7 +238,10 @@ def save_checkpoint(
             assert k not in checkpoint, k
             checkpoint[k] = v
 
-    torch.save(checkpoint, filename)
+    if async_writer is not None:
+        async_writer.save(checkpoint, filename)
+    else:
+        torch.save(checkpoint, filename)
 
 
 def load_checkpoint(
@@ -202,6 +350,7 @@ def save_checkpoint_with_global_batch_idx(
     scaler: Optional[GradScaler] = None,
     sampler: Optional[CutSampler] = None,
     rank: int = 0,
+    async_writer: Optional[AsyncCheckpointWriter] = None,
 ):
     """Save training info after processing given number of batches.
 
@@ -233,6 +382,9 @@ def save_checkpoint_with_global_batch_idx(
       rank:
         The rank ID used in DDP training of the current node. Set it to 0
         if DDP is not used.
+      async_writer:
+        If not None, write the checkpoint in the background.
+        See :func:`save_checkpoint`.
     """
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -247,6 +399,7 @@ def save_checkpoint_with_global_batch_idx(
         scaler=scaler,
         sampler=sampler,
         rank=rank,
+        async_writer=async_writer,
     )
 
 
@@ -451,6 +604,193 @@ def average_checkpoints_with_averaged_model(
     return avg
 
 
+def _load_mmap(filename: Union[str, Path]) -> Dict[str, Any]:
+    """Load a checkpoint with its tensors memory-mapped, so that tensor data
+    is read from disk only when accessed."""
+    try:
+        return torch.load(filename, map_location="cpu", mmap=True)
+    except TypeError:
+        # torch < 2.1 does not support mmap
+        logging.warning("torch.load() does not support mmap, loading the whole file")
+        return torch.load(filename, map_location="cpu")
+
+
+def _get_uniqued_names(state_dict: Dict[str, Tensor]) -> Dict[str, str]:
+    """Map each name in state_dict to the first name sharing the same data.
+    Two parameters are said to be shared if they have the same data_ptr."""
+    uniqued: Dict[int, str] = dict()
+    ans: Dict[str, str] = dict()
+    for k, v in state_dict.items():
+        ans[k] = uniqued.setdefault(v.data_ptr(), k)
+    return ans
+
+
+def average_checkpoints_mmap(
+    filenames: List[Path],
+    device: torch.device = torch.device("cpu"),
+    key: str = "model",
+) -> Dict[str, Tensor]:
+    """Average a list of checkpoints, like :func:`average_checkpoints`, while
+    keeping the memory usage bounded.
+
+    The checkpoints are memory-mapped and only `checkpoint[key]` is accessed,
+    one tensor at a time, so the optimizer state is never read. Floating point
+    tensors are accumulated in float64 and the result is converted back to
+    the original dtype before the next tensor is processed. The peak memory
+    is thus the size of the returned state_dict plus one tensor in float64.
+    If torch.load() does not support mmap, the checkpoints are loaded one
+    at a time instead, see :func:`_average_checkpoints_one_by_one`.
+
+    Args:
+      filenames:
+        Filenames of the checkpoints to be averaged. We assume all
+        checkpoints are saved by :func:`save_checkpoint`.
+      device:
+        The device to accumulate the tensors on. The returned tensors are
+        also on this device.
+      key:
+        The state_dict to average, e.g., "model" or "model_avg".
+    Returns:
+      Return a dict (i.e., state_dict) which is the average of
+      `checkpoint[key]` of all the checkpoints.
+    """
+    n = len(filenames)
+    assert n > 0, n
+    try:
+        state_dicts = [
+            torch.load(f, map_location="cpu", mmap=True)[key] for f in filenames
+        ]
+    except TypeError:
+        # torch < 2.1 does not support mmap
+        logging.warning(
+            "torch.load() does not support mmap, loading one file at a time"
+        )
+        return _average_checkpoints_one_by_one(filenames, device=device, key=key)
+
+    avg: Dict[str, Tensor] = dict()
+    for k, first in _get_uniqued_names(state_dicts[0]).items():
+        if k != first:
+            avg[k] = avg[first]
+            continue
+
+        v = state_dicts[0][k]
+        if v.is_floating_point():
+            acc = torch.zeros(v.shape, dtype=torch.float64, device=device)
+            for state_dict in state_dicts:
+                acc += state_dict[k].to(device)
+            acc /= n
+        else:
+            acc = torch.zeros(v.shape, dtype=torch.int64, device=device)
+            for state_dict in state_dicts:
+                acc += state_dict[k].to(device)
+            acc //= n
+        avg[k] = acc.to(v.dtype)
+
+    return avg
+
+
+def _average_checkpoints_one_by_one(
+    filenames: List[Path],
+    device: torch.device = torch.device("cpu"),
+    key: str = "model",
+) -> Dict[str, Tensor]:
+    """The same as :func:`average_checkpoints_mmap`, for torch versions
+    without mmap support in torch.load().
+
+    Each checkpoint is read as a whole and added to the float64 (or int64)
+    accumulators before the next one is loaded, so at most one checkpoint
+    is in memory at a time.
+    """
+    n = len(filenames)
+    uniqued_names: Dict[str, str] = dict()
+    dtypes: Dict[str, torch.dtype] = dict()
+    acc: Dict[str, Tensor] = dict()
+    for i, f in enumerate(filenames):
+        state_dict = torch.load(f, map_location="cpu")[key]
+        if i == 0:
+            uniqued_names = _get_uniqued_names(state_dict)
+            for k, first in uniqued_names.items():
+                if k != first:
+                    continue
+                v = state_dict[k]
+                dtypes[k] = v.dtype
+                acc_dtype = torch.float64 if v.is_floating_point() else torch.int64
+                acc[k] = torch.zeros(v.shape, dtype=acc_dtype, device=device)
+
+        for k, v in acc.items():
+            v += state_dict[k].to(device)
+        del state_dict
+
+    avg: Dict[str, Tensor] = dict()
+    for k, first in uniqued_names.items():
+        if k != first:
+            avg[k] = avg[first]
+            continue
+
+        v = acc[k]
+        if v.is_floating_point():
+            v /= n
+        else:
+            v //= n
+        avg[k] = v.to(dtypes[k])
+
+    return avg
+
+
+def average_checkpoints_with_averaged_model_mmap(
+    filename_start: str,
+    filename_end: str,
+    device: torch.device = torch.device("cpu"),
+) -> Dict[str, Tensor]:
+    """Like :func:`average_checkpoints_with_averaged_model`, but only
+    `model_avg` of the two checkpoints is read, one memory-mapped tensor at
+    a time, and the computation is done in float64.
+
+    Args:
+      filename_start:
+        Checkpoint filename of the start model (excluded).
+      filename_end:
+        Checkpoint filename of the end model.
+      device:
+        The device to do the computation on. The returned tensors are
+        also on this device.
+    """
+    checkpoint_start = _load_mmap(filename_start)
+    checkpoint_end = _load_mmap(filename_end)
+
+    average_period = checkpoint_start["average_period"]
+
+    batch_idx_train_start = checkpoint_start["batch_idx_train"]
+    batch_idx_train_start = (batch_idx_train_start // average_period) * average_period
+    batch_idx_train_end = checkpoint_end["batch_idx_train"]
+    batch_idx_train_end = (batch_idx_train_end // average_period) * average_period
+    interval = batch_idx_train_end - batch_idx_train_start
+    assert interval > 0, interval
+    weight_end = batch_idx_train_end / interval
+    weight_start = 1 - weight_end
+
+    model_start = checkpoint_start["model_avg"]
+    model_end = checkpoint_end["model_avg"]
+
+    avg: Dict[str, Tensor] = dict()
+    for k, first in _get_uniqued_names(model_end).items():
+        if k != first:
+            avg[k] = avg[first]
+            continue
+
+        v = model_end[k]
+        if not v.is_floating_point():
+            avg[k] = v.to(device, copy=True)
+            continue
+
+        acc = v.to(device=device, dtype=torch.float64, copy=True)
+        acc *= weight_end
+        acc += model_start[k].to(device=device, dtype=torch.float64) * weight_start
+        avg[k] = acc.to(v.dtype)
+
+    return avg
+
+
 def average_state_dict(
     state_dict_1: Dict[str, Tensor],
     state_dict_2: Dict[str, Tensor],
@@ -14,11 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import shutil
 from collections import deque
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
+
 
 class ContextState:
     """The state in ContextGraph"""
@@ -145,13 +149,10 @@ class ContextGraph:
                     if token in fail.next:
                         fail = fail.next[token]
                 node.fail = fail
-                # fill the output arc
-                output = node.fail
-                while not output.is_end:
-                    output = output.fail
-                    if output.token == -1:  # root
-                        output = None
-                        break
+                # fill the output arc, i.e., the first end node along the fail
+                # arcs. `fail` is closer to root than `node`, so its output
+                # arc has already been filled in this breadth-first search.
+                output = fail if fail.is_end else fail.output
                 node.output = output
                 node.output_score += 0 if output is None else output.output_score
                 queue.append(node)
@@ -242,6 +243,11 @@ class ContextGraph:
                 node = node.next[token]
         self._fill_fail_output()
 
+    def freeze(self) -> "FrozenContextGraph":
+        """Convert the graph into flat arrays for batched search.
+        See :class:`FrozenContextGraph`."""
+        return FrozenContextGraph.from_context_graph(self)
+
     def forward_one_step(
         self, state: ContextState, token: int, strict_mode: bool = True
     ) -> Tuple[float, ContextState, ContextState]:
@@ -480,6 +486,250 @@ class ContextGraph:
         return dot
 
 
+class FrozenContextGraph:
+    """A read-only ContextGraph stored in flat arrays.
+
+    The states are represented by integer node ids, the root is always 0.
+    The goto table is stored in CSR format, i.e., the arcs leaving node n
+    are arcs[row_splits[n]:row_splits[n+1]] sorted by token, and the fail
+    arcs, output arcs and scores are arrays indexed by node id.
+
+    :meth:`forward` advances a whole batch of (state, token) pairs with a few
+    NumPy calls, and the graph can be saved with :meth:`save` and memory-mapped
+    with :meth:`load`, so a large graph does not need to be rebuilt every time.
+
+    It also has the same ``root``, ``forward_one_step``, ``is_matched`` and
+    ``finalize`` interface as :class:`ContextGraph`, except that states are
+    node ids instead of :class:`ContextState` objects (the matched state is
+    None or a node id), so it can be used as a drop-in replacement for
+    contextual biasing.
+    """
+
+    _array_names = (
+        "row_splits",
+        "tokens",
+        "next_nodes",
+        "arc_keys",
+        "fail",
+        "output",
+        "token_score",
+        "node_score",
+        "output_score",
+        "is_end",
+        "level",
+        "ac_threshold",
+    )
+
+    def __init__(self, phrases: List[str], **arrays):
+        """
+        Args:
+          phrases:
+            phrases[n] is the phrase of node n, it is "" if node n is not an
+            end node.
+          arrays:
+            The arrays listed in ``FrozenContextGraph._array_names``. The
+            missing output arc is represented by -1.
+        """
+        for name in self._array_names:
+            setattr(self, name, arrays[name])
+        assert len(phrases) == self.num_nodes, (len(phrases), self.num_nodes)
+        self.phrases = phrases
+        self.num_tokens = int(self.tokens.max()) + 1 if self.tokens.size > 0 else 1
+
+    @property
+    def root(self) -> int:
+        return 0
+
+    @property
+    def num_nodes(self) -> int:
+        return self.row_splits.size - 1
+
+    @staticmethod
+    def from_context_graph(graph: ContextGraph) -> "FrozenContextGraph":
+        nodes = [None] * (graph.num_nodes + 1)
+        queue = deque([graph.root])
+        while queue:
+            node = queue.popleft()
+            nodes[node.id] = node
+            queue.extend(node.next.values())
+        assert all(n is not None for n in nodes)
+
+        row_splits = np.zeros(len(nodes) + 1, dtype=np.int64)
+        tokens = []
+        next_nodes = []
+        for node in nodes:
+            for token in sorted(node.next.keys()):
+                tokens.append(token)
+                next_nodes.append(node.next[token].id)
+            row_splits[node.id + 1] = len(tokens)
+
+        tokens = np.array(tokens, dtype=np.int64)
+        num_tokens = int(tokens.max()) + 1 if tokens.size > 0 else 1
+        arc_nodes = np.repeat(
+            np.arange(len(nodes), dtype=np.int64), np.diff(row_splits)
+        )
+
+        return FrozenContextGraph(
+            phrases=[n.phrase for n in nodes],
+            row_splits=row_splits,
+            tokens=tokens,
+            next_nodes=np.array(next_nodes, dtype=np.int32),
+            arc_keys=arc_nodes * num_tokens + tokens,
+            fail=np.array([n.fail.id for n in nodes], dtype=np.int32),
+            output=np.array(
+                [-1 if n.output is None else n.output.id for n in nodes],
+                dtype=np.int32,
+            ),
+            token_score=np.array([n.token_score for n in nodes], dtype=np.float64),
+            node_score=np.array([n.node_score for n in nodes], dtype=np.float64),
+            output_score=np.array([n.output_score for n in nodes], dtype=np.float64),
+            is_end=np.array([n.is_end for n in nodes], dtype=bool),
+            level=np.array([n.level for n in nodes], dtype=np.int32),
+            ac_threshold=np.array([n.ac_threshold for n in nodes], dtype=np.float64),
+        )
+
+    def save(self, dirname: Union[str, Path]) -> None:
+        """Save the graph as ``.npy`` files in the given directory."""
+        dirname = Path(dirname)
+        dirname.mkdir(parents=True, exist_ok=True)
+        for name in self._array_names:
+            np.save(dirname / f"{name}.npy", getattr(self, name))
+        with open(dirname / "phrases.json", "w", encoding="utf-8") as f:
+            json.dump(self.phrases, f, ensure_ascii=False)
+
+    @staticmethod
+    def load(dirname: Union[str, Path], mmap: bool = True) -> "FrozenContextGraph":
+        """Load a graph saved by :meth:`save`.
+
+        Args:
+          dirname:
+            The directory passed to :meth:`save`.
+          mmap:
+            True to memory-map the arrays instead of reading them into memory.
+        """
+        dirname = Path(dirname)
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(dirname / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in FrozenContextGraph._array_names
+        }
+        with open(dirname / "phrases.json", encoding="utf-8") as f:
+            phrases = json.load(f)
+        return FrozenContextGraph(phrases=phrases, **arrays)
+
+    def _goto(
+        self, nodes: np.ndarray, tokens: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Look up the goto table.
+
+        Returns:
+          Return a tuple (found, next_nodes). next_nodes is valid only where
+          found is True.
+        """
+        found = (tokens >= 0) & (tokens < self.num_tokens)
+        if self.arc_keys.size == 0:
+            return found & False, nodes.copy()
+        keys = nodes * self.num_tokens + tokens
+        idx = np.searchsorted(self.arc_keys, keys)
+        idx = np.minimum(idx, self.arc_keys.size - 1)
+        found &= self.arc_keys[idx] == keys
+        return found, self.next_nodes[idx].astype(np.int64)
+
+    def forward(
+        self,
+        states: Union[List[int], np.ndarray],
+        tokens: Union[List[int], np.ndarray],
+        strict_mode: bool = True,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Advance state[i] with token[i] for all i at once. It gives the same
+        results as :meth:`ContextGraph.forward_one_step`.
+
+        Args:
+          states:
+            A list or a 1-D array of node ids.
+          tokens:
+            A list or a 1-D array of tokens with the same size as `states`.
+          strict_mode:
+            See :meth:`ContextGraph.forward_one_step`.
+        Returns:
+          Return a tuple of three 1-D arrays (scores, next_states,
+          matched_states). matched_states[i] is -1 if no phrase is matched.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        tokens = np.asarray(tokens, dtype=np.int64)
+        assert states.shape == tokens.shape, (states.shape, tokens.shape)
+
+        found, nodes = self._goto(states, tokens)
+        scores = np.where(found, self.token_score[nodes], 0.0)
+
+        # For tokens not matched, trace along the fail arcs until the token
+        # matches or we reach the root. Each iteration moves all the pending
+        # states one fail arc closer to the root.
+        pending = np.nonzero(~found)[0]
+        current = self.fail[states[pending]].astype(np.int64)
+        while pending.size > 0:
+            matched, next_nodes = self._goto(current, tokens[pending])
+            done = matched | (current == self.root)
+            nodes[pending[done]] = np.where(matched, next_nodes, current)[done]
+            pending = pending[~done]
+            current = self.fail[current[~done]].astype(np.int64)
+
+        # The score of the fail path
+        scores[~found] = (
+            self.node_score[nodes[~found]] - self.node_score[states[~found]]
+        )
+
+        output = self.output[nodes].astype(np.int64)
+        is_end = self.is_end[nodes]
+        matched_states = np.where(is_end, nodes, output)
+        output_score = self.output_score[nodes]
+
+        if strict_mode:
+            return scores + output_score, nodes, matched_states
+
+        # output_score != 0 means at least one phrase matched, for such states
+        # the longest matched phrase is output and we go back to the root.
+        hit = output_score != 0
+        node_score = self.node_score[nodes]
+        matched_node_score = np.where(
+            is_end | (output < 0), node_score, self.node_score[np.maximum(output, 0)]
+        )
+        scores = np.where(
+            hit, scores + matched_node_score - node_score, scores + output_score
+        )
+        nodes = np.where(hit, self.root, nodes)
+        return scores, nodes, matched_states
+
+    def forward_one_step(
+        self, state: int, token: int, strict_mode: bool = True
+    ) -> Tuple[float, int, Optional[int]]:
+        """Same as :meth:`ContextGraph.forward_one_step`, but the states are
+        node ids."""
+        scores, next_states, matched_states = self.forward(
+            [state], [token], strict_mode
+        )
+        matched_state = int(matched_states[0])
+        return (
+            float(scores[0]),
+            int(next_states[0]),
+            None if matched_state < 0 else matched_state,
+        )
+
+    def is_matched(self, state: int) -> Tuple[bool, Optional[int]]:
+        """Same as :meth:`ContextGraph.is_matched`, but the states are
+        node ids."""
+        if self.is_end[state]:
+            return True, state
+        if self.output[state] >= 0:
+            return True, int(self.output[state])
+        return False, None
+
+    def finalize(self, state: int) -> Tuple[float, int]:
+        """Same as :meth:`ContextGraph.finalize`, but the states are
+        node ids."""
+        return (-float(self.node_score[state]), self.root)
+
+
 def _test(queries, score, strict_mode):
     contexts_str = [
         "S",
@@ -533,6 +783,32 @@ def _test(queries, score, strict_mode):
             query,
         )
 
+    # the frozen graph should give the same results, both step by step and
+    # in one batch
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        context_graph.freeze().save(tmp_dir)
+        frozen_graph = FrozenContextGraph.load(tmp_dir)
+
+    queries = list(queries.items())
+    states = np.zeros(len(queries), dtype=np.int64)
+    total_scores = np.zeros(len(queries))
+    max_len = max(len(query) for query, _ in queries)
+    for i in range(max_len):
+        # queries that are already finished are padded with a token that
+        # does not exist in the graph
+        tokens = [ord(q[i]) if i < len(q) else 0 for q, _ in queries]
+        scores, states, matched = frozen_graph.forward(states, tokens, strict_mode)
+        total_scores += scores
+    for k, (query, expected_score) in enumerate(queries):
+        total_scores[k] += frozen_graph.finalize(states[k])[0]
+        assert round(total_scores[k], 2) == expected_score, (
+            total_scores[k],
+            expected_score,
+            query,
+        )
+
 
 if __name__ == "__main__":
     # test default score
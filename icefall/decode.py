@@ -23,9 +23,9 @@ from typing import Dict, List, Optional, Tuple, Union
 import k2
 import torch
 
-from icefall.context_graph import ContextGraph, ContextState
+from icefall.context_graph import ContextGraph, ContextState, FrozenContextGraph
 from icefall.lm_wrapper import LmScorer
-from icefall.ngram_lm import NgramLm, NgramLmStateCost
+from icefall.ngram_lm import CsrNgramLm, CsrNgramLmStateCost, NgramLm, NgramLmStateCost
 from icefall.utils import add_eos, add_sos, get_texts
 
 DEFAULT_LM_SCALE = [
@@ -1089,6 +1089,65 @@ def rescore_with_attention_decoder(
     return ans
 
 
+def attention_decoder_scores(
+    attention_decoder: torch.nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    token_ids: List[List[int]],
+    path_to_utt_map: torch.Tensor,
+    memory_budget: Optional[int] = None,
+) -> torch.Tensor:
+    """Compute the attention decoder scores, i.e., the log likelihood, of
+    n-best paths.
+
+    Args:
+      attention_decoder:
+        The attention decoder. See the class "AttentionDecoderModel" in
+        zipformer/attention_decoder.py for its interface.
+      encoder_out:
+        The encoder output of shape `(N, T, C)`.
+      encoder_out_lens:
+        Length of encoder outputs, with shape of `(N,)`.
+      token_ids:
+        A list of token id list, one per path.
+      path_to_utt_map:
+        A 1-D tensor with the utterance of each path.
+      memory_budget:
+        If None, the encoder output is expanded to one row per path and
+        the paths are decoded in a single batch. Otherwise, and if the
+        attention decoder supports it, the cross-attention keys and values
+        are computed once per utterance, paths with a common prefix share
+        its computation, and paths are decoded in batches that use about
+        `memory_budget` bytes.
+    Returns:
+      A 1-D tensor of shape `(len(token_ids),)`.
+    """
+    if memory_budget is not None and hasattr(attention_decoder, "nll_shared"):
+        nll = attention_decoder.nll_shared(
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            token_ids=token_ids,
+            path_to_utt_map=path_to_utt_map,
+            memory_budget=memory_budget,
+        )
+        assert nll.shape == (len(token_ids),), nll.shape
+        return -nll
+
+    # the shape of encoder_out is (N, T, C), so we use axis=0 here
+    expanded_encoder_out = encoder_out.index_select(0, path_to_utt_map)
+    expanded_encoder_out_lens = encoder_out_lens.index_select(0, path_to_utt_map)
+
+    nll = attention_decoder.nll(
+        encoder_out=expanded_encoder_out,
+        encoder_out_lens=expanded_encoder_out_lens,
+        token_ids=token_ids,
+    )
+    assert nll.ndim == 2
+    assert nll.shape[0] == len(token_ids)
+
+    return -nll.sum(dim=1)
+
+
 def rescore_with_attention_decoder_with_ngram(
     lattice: k2.Fsa,
     num_paths: int,
@@ -1099,6 +1158,7 @@ def rescore_with_attention_decoder_with_ngram(
     ngram_lm_scale: Optional[float] = None,
     attention_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    memory_budget: Optional[int] = None,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -1125,6 +1185,10 @@ def rescore_with_attention_decoder_with_ngram(
         Optional. It specifies the scale for n-gram LM scores.
       attention_scale:
         Optional. It specifies the scale for attention decoder scores.
+      memory_budget:
+        Optional. If not None, the paths share the encoder output instead
+        of copying it, and are rescored in batches that use about
+        `memory_budget` bytes. See :func:`attention_decoder_scores`.
     Returns:
       A dict of FsaVec, whose key contains a string
       ngram_lm_scale_attention_scale and the value is the
@@ -1171,9 +1235,6 @@ def rescore_with_attention_decoder_with_ngram(
     assert isinstance(nbest.fsa.tokens, torch.Tensor)
 
     path_to_utt_map = nbest.shape.row_ids(1).to(torch.long)
-    # the shape of memory is (T, N, C), so we use axis=1 here
-    expanded_encoder_out = encoder_out.index_select(0, path_to_utt_map)
-    expanded_encoder_out_lens = encoder_out_lens.index_select(0, path_to_utt_map)
 
     # remove axis corresponding to states.
     tokens_shape = nbest.fsa.arcs.shape().remove_axis(1)
@@ -1181,15 +1242,14 @@ def rescore_with_attention_decoder_with_ngram(
     tokens = tokens.remove_values_leq(0)
     token_ids = tokens.tolist()
 
-    nll = attention_decoder.nll(
-        encoder_out=expanded_encoder_out,
-        encoder_out_lens=expanded_encoder_out_lens,
+    attention_scores = attention_decoder_scores(
+        attention_decoder=attention_decoder,
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
         token_ids=token_ids,
+        path_to_utt_map=path_to_utt_map,
+        memory_budget=memory_budget,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     if ngram_lm_scale is None:
         ngram_lm_scale_list = [0.01, 0.05, 0.08]
@@ -1233,6 +1293,7 @@ def rescore_with_attention_decoder_no_ngram(
     nbest_scale: float = 1.0,
     attention_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    memory_budget: Optional[int] = None,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -1257,6 +1318,10 @@ def rescore_with_attention_decoder_no_ngram(
         leads to more unique paths at the risk of missing the correct path.
       attention_scale:
         Optional. It specifies the scale for attention decoder scores.
+      memory_budget:
+        Optional. If not None, the paths share the encoder output instead
+        of copying it, and are rescored in batches that use about
+        `memory_budget` bytes. See :func:`attention_decoder_scores`.
 
     Returns:
       A dict of FsaVec, whose key contains a string
@@ -1283,21 +1348,17 @@ def rescore_with_attention_decoder_no_ngram(
     scores = k2.RaggedTensor(utt_to_path_shape, scores.sum())
 
     path_to_utt_map = utt_to_path_shape.row_ids(1).to(torch.long)
-    # the shape of memory is (N, T, C), so we use axis=0 here
-    expanded_encoder_out = encoder_out.index_select(0, path_to_utt_map)
-    expanded_encoder_out_lens = encoder_out_lens.index_select(0, path_to_utt_map)
 
     token_ids = aux_labels.remove_values_leq(0).tolist()
 
-    nll = attention_decoder.nll(
-        encoder_out=expanded_encoder_out,
-        encoder_out_lens=expanded_encoder_out_lens,
+    attention_scores = attention_decoder_scores(
+        attention_decoder=attention_decoder,
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
         token_ids=token_ids,
+        path_to_utt_map=path_to_utt_map,
+        memory_budget=memory_budget,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     if attention_scale is None:
         attention_scale_list = [0.01, 0.05, 0.08]
@@ -1538,13 +1599,13 @@ class Hypothesis:
     state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
 
     # LODR (N-gram LM) state
-    LODR_state: Optional[NgramLmStateCost] = None
+    LODR_state: Optional[Union[NgramLmStateCost, CsrNgramLmStateCost]] = None
 
     # N-gram LM state
     Ngram_state: Optional[NgramLmStateCost] = None
 
     # Context graph state
-    context_state: Optional[ContextState] = None
+    context_state: Optional[Union[ContextState, int]] = None
 
     # This is the total score of current path, acoustic plus external LM score.
     @property
@@ -1727,7 +1788,7 @@ def _step_worker(
     blank_id: int = 0,
     nnlm_scale: float = 0,
     LODR_lm_scale: float = 0,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
 ) -> HypothesisList:
     """The worker to decode one step.
     Args:
@@ -1747,17 +1808,51 @@ def _step_worker(
       LODR_lm_scale:
         The scale of the LODR_lm
       context_graph:
-        A ContextGraph instance containing contextual phrases.
+        A ContextGraph or FrozenContextGraph instance containing contextual
+        phrases. The states of a FrozenContextGraph are advanced in batches.
     Return:
       Returns the updated HypothesisList.
     """
     A = list(B)
     B = HypothesisList()
+
+    tokens = indexes.tolist()
+    # The (hyp, non-blank token) pairs, i.e., the ones that change the prefix.
+    # If the LODR states or the context graph are array-backed, they are
+    # advanced for all these pairs with a single batched call.
+    pairs = [
+        (h, k)
+        for h in range(len(A))
+        for k in range(len(tokens))
+        if tokens[k] != blank_id
+    ]
+
+    next_LODR_states = None
+    if len(pairs) != 0 and isinstance(A[0].LODR_state, CsrNgramLmStateCost):
+        next_LODR_states = CsrNgramLmStateCost.cat(
+            [A[h].LODR_state for h, _ in pairs]
+        ).forward([tokens[k] for _, k in pairs])
+        next_LODR_states = {pair: next_LODR_states[i] for i, pair in enumerate(pairs)}
+
+    next_context_states = None
+    if (
+        len(pairs) != 0
+        and isinstance(context_graph, FrozenContextGraph)
+        and A[0].context_state is not None
+    ):
+        context_scores, context_states, _ = context_graph.forward(
+            [A[h].context_state for h, _ in pairs], [tokens[k] for _, k in pairs]
+        )
+        next_context_states = {
+            pair: (float(context_scores[i]), int(context_states[i]))
+            for i, pair in enumerate(pairs)
+        }
+
     for h in range(len(A)):
         hyp = A[h]
         for k in range(log_probs.size(0)):
-            log_prob, index = log_probs[k], indexes[k]
-            new_token = index.item()
+            log_prob = log_probs[k]
+            new_token = tokens[k]
             update_prefix = False
             new_hyp = hyp.clone()
             if new_token == blank_id:
@@ -1805,7 +1900,11 @@ def _step_worker(
                     lm_score = lm_score + hyp.lm_log_probs[new_token] * nnlm_scale
                     new_hyp.lm_log_probs = None
 
-                if context_graph is not None and hyp.context_state is not None:
+                if next_context_states is not None:
+                    context_score, new_context_state = next_context_states[(h, k)]
+                    lm_score = lm_score + context_score
+                    new_hyp.context_state = new_context_state
+                elif context_graph is not None and hyp.context_state is not None:
                     (
                         context_score,
                         new_context_state,
@@ -1815,7 +1914,10 @@ def _step_worker(
                     new_hyp.context_state = new_context_state
 
                 if hyp.LODR_state is not None:
-                    state_cost = hyp.LODR_state.forward_one_step(new_token)
+                    if next_LODR_states is not None:
+                        state_cost = next_LODR_states[(h, k)]
+                    else:
+                        state_cost = hyp.LODR_state.forward_one_step(new_token)
                     # calculate the score of the latest token
                     current_ngram_score = state_cost.lm_score - hyp.LODR_state.lm_score
                     assert current_ngram_score <= 0.0, (
@@ -1923,15 +2025,251 @@ def ctc_prefix_beam_search(
         return [hyp.ys for hyp in best_hyps]
 
 
+def ctc_prefix_beam_search_batch(
+    ctc_output: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    beam: int = 4,
+    blank_id: int = 0,
+    prune_beam: Optional[int] = None,
+    return_timestamps: bool = False,
+) -> Union[List[List[int]], Tuple[List[List[int]], List[List[int]]]]:
+    """A batched version of :func:`ctc_prefix_beam_search`.
+
+    Instead of running a `HypothesisList` per utterance in a process pool,
+    the hypotheses of the whole batch are kept in tensors of shape
+    (B, beam), and all utterances are advanced together frame by frame
+    on the device of `ctc_output`. Prefixes are identified by rolling hashes
+    of their tokens, and the best paths are recovered at the end by
+    following back-pointers.
+
+    Args:
+      ctc_output:
+        The output of ctc head (log probability), the shape is (B, T, V)
+      encoder_out_lens:
+        The lengths (frames) of sequences after subsampling, the shape is (B,)
+      beam:
+        The number of hypothesis to be kept at each step.
+      blank_id:
+        The id of blank in the vocabulary.
+      prune_beam:
+        The number of tokens kept at each frame in the first pass pruning.
+        If None, it is set to `beam`, which gives the same results as
+        :func:`ctc_prefix_beam_search`.
+      return_timestamps:
+        If true, also return the frame index on which each token is decoded.
+    Return:
+      Returns a list of list of decoded token ids. If return_timestamps is
+      true, returns also a list of list of timestamps.
+    """
+    assert ctc_output.ndim == 3, ctc_output.shape
+    batch_size, num_frames, vocab_size = ctc_output.shape
+    device = ctc_output.device
+    neg_inf = float("-inf")
+
+    if prune_beam is None:
+        prune_beam = beam
+    prune_beam = min(prune_beam, vocab_size)
+
+    topk_values, topk_indexes = ctc_output.topk(prune_beam)  # (B, T, prune_beam)
+    encoder_out_lens = encoder_out_lens.to(device)
+
+    # Only the first hypothesis, i.e., the empty prefix, is active at the
+    # beginning. Inactive hypotheses have both log probs set to -inf.
+    log_prob_blank = torch.full(
+        (batch_size, beam), neg_inf, dtype=torch.float32, device=device
+    )
+    log_prob_blank[:, 0] = 0
+    log_prob_non_blank = torch.full_like(log_prob_blank, neg_inf)
+
+    # The last token of each prefix, -1 for the empty prefix
+    last_tokens = torch.full((batch_size, beam), -1, dtype=torch.int64, device=device)
+    hyp_lens = torch.zeros(batch_size, beam, dtype=torch.int64, device=device)
+
+    # Two independent rolling hashes of the tokens of each prefix. Two
+    # prefixes are considered to be the same if they have the same length
+    # and hashes.
+    hyp_hashes = torch.zeros(batch_size, beam, 2, dtype=torch.int64, device=device)
+    hash_bases = torch.tensor([1000003, 999983], dtype=torch.int64, device=device)
+    hash_modulus = 2147483647
+
+    # back_pointers[t][b][k] is the index of the hypothesis at frame t-1
+    # that the most probable path of the k-th hypothesis of the b-th
+    # utterance at frame t comes from, and emitted_tokens[t][b][k] is the
+    # token it appends at frame t, or -1 if the prefix does not change.
+    back_pointers = torch.zeros(
+        num_frames, batch_size, beam, dtype=torch.int64, device=device
+    )
+    emitted_tokens = torch.full(
+        (num_frames, batch_size, beam), -1, dtype=torch.int64, device=device
+    )
+
+    hyp_indexes = torch.arange(beam, device=device).expand(batch_size, beam)
+
+    for t in range(num_frames):
+        log_probs = topk_values[:, t]  # (B, prune_beam)
+        tokens = topk_indexes[:, t]  # (B, prune_beam)
+        is_blank = tokens == blank_id
+
+        log_prob = torch.logaddexp(log_prob_blank, log_prob_non_blank)
+        is_active = log_prob > neg_inf  # (B, beam)
+
+        # Case 0: *a + ε => *a
+        #         *aε + ε => *a
+        # Prefix does not change, update log_prob of blank
+        blank_log_prob = log_probs.masked_fill(~is_blank, neg_inf).max(dim=1)[0]
+        stay_log_prob_blank = log_prob + blank_log_prob.unsqueeze(1)
+
+        # Case 1: *a + a => *a
+        # Prefix does not change, update log_prob of non_blank
+        is_last = tokens.unsqueeze(1) == last_tokens.unsqueeze(2)
+        # is_last is of shape (B, beam, prune_beam)
+        last_log_prob = (
+            log_probs.unsqueeze(1)
+            .expand(-1, beam, -1)
+            .masked_fill(~is_last, neg_inf)
+            .max(dim=2)[0]
+        )
+        stay_log_prob_non_blank = log_prob_non_blank + last_log_prob
+
+        # Case 2: *aε + a => *aa
+        # Case 3: *a + b => *ab, *aε + b => *ab
+        # Prefix changes, update log_prob of non_blank
+        ext_log_prob_non_blank = torch.where(
+            is_last, log_prob_blank.unsqueeze(2), log_prob.unsqueeze(2)
+        ) + log_probs.unsqueeze(1)
+        ext_log_prob_non_blank.masked_fill_(is_blank.unsqueeze(1), neg_inf)
+        # (B, beam, prune_beam) -> (B, beam * prune_beam)
+        ext_log_prob_non_blank = ext_log_prob_non_blank.reshape(batch_size, -1)
+
+        ext_tokens = tokens.unsqueeze(1).expand(-1, beam, -1).reshape(batch_size, -1)
+        ext_parents = (
+            hyp_indexes.unsqueeze(2).expand(-1, -1, prune_beam).reshape(batch_size, -1)
+        )
+        ext_lens = hyp_lens.gather(1, ext_parents) + 1
+        ext_hashes = (
+            hyp_hashes.gather(1, ext_parents.unsqueeze(-1).expand(-1, -1, 2))
+            * hash_bases
+            + ext_tokens.unsqueeze(-1)
+            + 1
+        ) % hash_modulus
+
+        # An extended prefix may be the same as an existing one,
+        # e.g., (a) + b and (ab). Merge it into the existing one.
+        # same[b][e][k] is True if the e-th extended prefix is the same
+        # as the k-th existing prefix.
+        same = (ext_hashes.unsqueeze(2) == hyp_hashes.unsqueeze(1)).all(dim=-1)
+        same &= ext_lens.unsqueeze(2) == hyp_lens.unsqueeze(1)
+        same &= is_active.unsqueeze(1)
+        same &= (ext_log_prob_non_blank > neg_inf).unsqueeze(2)
+
+        merged = (
+            ext_log_prob_non_blank.unsqueeze(2)
+            .expand(-1, -1, beam)
+            .masked_fill(~same, neg_inf)
+        )
+        merged_log_prob_non_blank = merged.logsumexp(dim=1)
+
+        # If the most probable extension merged into a prefix is more
+        # probable than the paths that keep it, the prefix now comes from
+        # that extension, so that the back-pointers follow the most probable
+        # path and give the frames on which its tokens are emitted.
+        best_merged_log_prob, best_merged = merged.max(dim=1)  # (B, beam)
+        is_merged = best_merged_log_prob > torch.logaddexp(
+            stay_log_prob_blank, stay_log_prob_non_blank
+        )
+        stay_parents = torch.where(
+            is_merged, ext_parents.gather(1, best_merged), hyp_indexes
+        )
+        stay_tokens = torch.where(
+            is_merged,
+            ext_tokens.gather(1, best_merged),
+            torch.full_like(hyp_indexes, -1),
+        )
+
+        stay_log_prob_non_blank = torch.logaddexp(
+            stay_log_prob_non_blank, merged_log_prob_non_blank
+        )
+        ext_log_prob_non_blank = ext_log_prob_non_blank.masked_fill(
+            same.any(dim=2), neg_inf
+        )
+
+        # Candidates are the existing prefixes followed by the extended ones
+        cand_log_prob_blank = torch.cat(
+            [stay_log_prob_blank, torch.full_like(ext_log_prob_non_blank, neg_inf)],
+            dim=1,
+        )
+        cand_log_prob_non_blank = torch.cat(
+            [stay_log_prob_non_blank, ext_log_prob_non_blank], dim=1
+        )
+        cand_parents = torch.cat([stay_parents, ext_parents], dim=1)
+        cand_tokens = torch.cat([stay_tokens, ext_tokens], dim=1)
+        cand_last_tokens = torch.cat([last_tokens, ext_tokens], dim=1)
+        cand_lens = torch.cat([hyp_lens, ext_lens], dim=1)
+        cand_hashes = torch.cat([hyp_hashes, ext_hashes], dim=1)
+
+        _, best_indexes = torch.logaddexp(
+            cand_log_prob_blank, cand_log_prob_non_blank
+        ).topk(beam, dim=1)
+
+        # Utterances that have reached their end keep their hypotheses
+        is_running = (t < encoder_out_lens).unsqueeze(1)  # (B, 1)
+
+        log_prob_blank = torch.where(
+            is_running, cand_log_prob_blank.gather(1, best_indexes), log_prob_blank
+        )
+        log_prob_non_blank = torch.where(
+            is_running,
+            cand_log_prob_non_blank.gather(1, best_indexes),
+            log_prob_non_blank,
+        )
+        last_tokens = torch.where(
+            is_running, cand_last_tokens.gather(1, best_indexes), last_tokens
+        )
+        hyp_lens = torch.where(is_running, cand_lens.gather(1, best_indexes), hyp_lens)
+        hyp_hashes = torch.where(
+            is_running.unsqueeze(-1),
+            cand_hashes.gather(1, best_indexes.unsqueeze(-1).expand(-1, -1, 2)),
+            hyp_hashes,
+        )
+        back_pointers[t] = torch.where(
+            is_running, cand_parents.gather(1, best_indexes), hyp_indexes
+        )
+        emitted_tokens[t] = cand_tokens.gather(1, best_indexes).masked_fill(
+            ~is_running, -1
+        )
+
+    # See HypothesisList.get_most_probable()
+    k = torch.logaddexp(log_prob_blank, log_prob_non_blank).argmax(dim=1)
+
+    utt_indexes = torch.arange(batch_size, device=device)
+    best_tokens = torch.full(
+        (num_frames, batch_size), -1, dtype=torch.int64, device=device
+    )
+    for t in range(num_frames - 1, -1, -1):
+        best_tokens[t] = emitted_tokens[t, utt_indexes, k]
+        k = back_pointers[t, utt_indexes, k]
+
+    ans = []
+    timestamps = []
+    for tokens in best_tokens.t().tolist():
+        ans.append([token for token in tokens if token >= 0])
+        timestamps.append([t for t, token in enumerate(tokens) if token >= 0])
+
+    if return_timestamps:
+        return ans, timestamps
+    else:
+        return ans
+
+
 def ctc_prefix_beam_search_shallow_fussion(
     ctc_output: torch.Tensor,
     encoder_out_lens: torch.Tensor,
     beam: int = 4,
     blank_id: int = 0,
-    LODR_lm: Optional[NgramLm] = None,
+    LODR_lm: Optional[Union[NgramLm, CsrNgramLm]] = None,
     LODR_lm_scale: Optional[float] = 0,
     NNLM: Optional[LmScorer] = None,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, FrozenContextGraph]] = None,
 ) -> List[List[int]]:
     """Implement prefix search decoding in "Connectionist Temporal Classification:
     Labelling Unsegmented Sequence Data with Recurrent Neural Networks" and add
@@ -1947,13 +2285,15 @@ def ctc_prefix_beam_search_shallow_fussion(
       blank_id:
         The id of blank in the vocabulary.
       LODR_lm:
-        A low order n-gram LM, whose score will be subtracted during shallow fusion
+        A low order n-gram LM, whose score will be subtracted during shallow fusion.
+        If it is a CsrNgramLm, the LODR states are advanced in batches.
       LODR_lm_scale:
         The scale of the LODR_lm
       LM:
         A neural net LM, e.g an RNNLM or transformer LM
       context_graph:
-        A ContextGraph instance containing contextual phrases.
+        A ContextGraph or FrozenContextGraph instance containing contextual
+        phrases.
     Return:
       Returns a list of list of decoded token ids.
     """
@@ -1990,7 +2330,15 @@ def ctc_prefix_beam_search_shallow_fussion(
                 lm_score=torch.zeros(1, dtype=torch.float32),
                 state=init_states,
                 lm_log_probs=None if init_scores is None else init_scores.reshape(-1),
-                LODR_state=None if LODR_lm is None else NgramLmStateCost(LODR_lm),
+                LODR_state=(
+                    None
+                    if LODR_lm is None
+                    else (
+                        CsrNgramLmStateCost(LODR_lm)
+                        if isinstance(LODR_lm, CsrNgramLm)
+                        else NgramLmStateCost(LODR_lm)
+                    )
+                ),
                 context_state=None if context_graph is None else context_graph.root,
             )
         )
@@ -2085,6 +2433,7 @@ def ctc_prefix_beam_search_attention_decoder_rescoring(
     blank_id: int = 0,
     attention_scale: Optional[float] = None,
     process_pool: Optional[Pool] = None,
+    memory_budget: Optional[int] = None,
 ):
     """Implement prefix search decoding in "Connectionist Temporal Classification:
     Labelling Unsegmented Sequence Data with Recurrent Neural Networks" and add
@@ -2108,6 +2457,10 @@ def ctc_prefix_beam_search_attention_decoder_rescoring(
       process_pool:
         The process pool for parallel decoding, if not provided, it will use all
         you cpu cores by default.
+      memory_budget:
+        Optional. If not None, the hypotheses share the encoder output instead
+        of copying it, and are rescored in batches that use about
+        `memory_budget` bytes. See :func:`attention_decoder_scores`.
     """
     # List[HypothesisList]
     nbest = ctc_prefix_beam_search(
@@ -2122,9 +2475,6 @@ def ctc_prefix_beam_search_attention_decoder_rescoring(
 
     hyp_shape = get_hyps_shape(nbest).to(device)
     hyp_to_utt_map = hyp_shape.row_ids(1).to(torch.long)
-    # the shape of encoder_out is (N, T, C), so we use axis=0 here
-    expanded_encoder_out = encoder_out.index_select(0, hyp_to_utt_map)
-    expanded_encoder_out_lens = encoder_out_lens.index_select(0, hyp_to_utt_map)
 
     nbest = [list(x) for x in nbest]
     token_ids = []
@@ -2135,15 +2485,14 @@ def ctc_prefix_beam_search_attention_decoder_rescoring(
             scores.append(hyp.log_prob.reshape(1))
     scores = torch.cat(scores).to(device)
 
-    nll = attention_decoder.nll(
-        encoder_out=expanded_encoder_out,
-        encoder_out_lens=expanded_encoder_out_lens,
+    attention_scores = attention_decoder_scores(
+        attention_decoder=attention_decoder,
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
         token_ids=token_ids,
+        path_to_utt_map=hyp_to_utt_map,
+        memory_budget=memory_budget,
     )
-    assert nll.ndim == 2
-    assert nll.shape[0] == len(token_ids)
-
-    attention_scores = -nll.sum(dim=1)
 
     if attention_scale is None:
         attention_scale_list = [0.01, 0.05, 0.08]
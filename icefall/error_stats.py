@@ -0,0 +1,364 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compute WER statistics, i.e., the content of the `errs-*.txt` files written
+by :func:`icefall.utils.write_error_stats`.
+
+Each utterance is aligned only once; the alignment is used both for the
+error counts and for the PER-UTT DETAILS section. :class:`ErrorStatsScorer`
+can further shard the alignment over a process pool and accept results
+batch by batch while decoding is still running, e.g.::
+
+    scorer = ErrorStatsScorer(executor=ProcessPoolExecutor(4))
+    for batch in dl:
+        ...
+        scorer.add(this_batch)
+    with open(errs_filename, "w") as f:
+        wer = scorer.write(f, test_set_name)
+"""
+
+import logging
+from collections import defaultdict
+from concurrent.futures import Executor, Future
+from typing import Dict, List, Optional, TextIO, Tuple, Union
+
+import kaldialign
+
+ERR = "*"
+
+
+def _zero_word_counts() -> List[int]:
+    # corr, ref_sub, hyp_sub, ins, dels
+    return [0, 0, 0, 0, 0]
+
+
+def combine_successive_errors(ali: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Merge successive errors in an alignment into one, e.g.,
+    [(A, B), (C, *)] becomes [("A C", B)], for the PER-UTT DETAILS section."""
+    ali = [[[x], [y]] for x, y in ali]
+    for i in range(len(ali) - 1):
+        if ali[i][0] != ali[i][1] and ali[i + 1][0] != ali[i + 1][1]:
+            ali[i + 1][0] = ali[i][0] + ali[i + 1][0]
+            ali[i + 1][1] = ali[i][1] + ali[i + 1][1]
+            ali[i] = [[], []]
+    ali = [
+        [
+            list(filter(lambda a: a != ERR, x)),
+            list(filter(lambda a: a != ERR, y)),
+        ]
+        for x, y in ali
+    ]
+    ali = list(filter(lambda x: x != [[], []], ali))
+    return [
+        (
+            ERR if x == [] else " ".join(x),
+            ERR if y == [] else " ".join(y),
+        )
+        for x, y in ali
+    ]
+
+
+def format_utt_details(cut_id: str, ali: List[Tuple[str, str]]) -> str:
+    """Return the line of an utterance in the PER-UTT DETAILS section."""
+    ali = combine_successive_errors(ali)
+    return f"{cut_id}:\t" + " ".join(
+        (
+            ref_word if ref_word == hyp_word else f"({ref_word}->{hyp_word})"
+            for ref_word, hyp_word in ali
+        )
+    )
+
+
+class ErrorCounts(object):
+    """Error counts and per-utterance details of a set of utterances.
+
+    Counts of different sets of utterances can be merged with :meth:`merge`,
+    so they can be computed in parallel.
+    """
+
+    def __init__(self) -> None:
+        self.subs: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.ins: Dict[str, int] = defaultdict(int)
+        self.dels: Dict[str, int] = defaultdict(int)
+        # `words` stores counts per word, as follows:
+        #   corr, ref_sub, hyp_sub, ins, dels
+        self.words: Dict[str, List[int]] = defaultdict(_zero_word_counts)
+        self.num_corr = 0
+        self.ref_len = 0
+        # Lines of the PER-UTT DETAILS section as (cut_id, line)
+        self.utt_details: List[Tuple[str, str]] = []
+
+    def add(
+        self,
+        cut_id: str,
+        ref: List[str],
+        hyp: List[str],
+        sclite_mode: bool = False,
+    ) -> List[Tuple[str, str]]:
+        """Align ref and hyp, update the counts and return the alignment."""
+        ali = kaldialign.align(ref, hyp, ERR, sclite_mode=sclite_mode)
+        self.add_alignment(cut_id, ali, ref_len=len(ref))
+        if sclite_mode:
+            # The PER-UTT DETAILS section always uses the default alignment
+            details_ali = kaldialign.align(ref, hyp, ERR)
+        else:
+            details_ali = ali
+        self.utt_details.append((cut_id, format_utt_details(cut_id, details_ali)))
+        return ali
+
+    def add_alignment(
+        self, cut_id: str, ali: List[Tuple[str, str]], ref_len: int
+    ) -> None:
+        """Update the counts with an existing alignment. It does not add
+        anything to the PER-UTT DETAILS section."""
+        self.ref_len += ref_len
+        for ref_word, hyp_word in ali:
+            if ref_word == ERR:
+                self.ins[hyp_word] += 1
+                self.words[hyp_word][3] += 1
+            elif hyp_word == ERR:
+                self.dels[ref_word] += 1
+                self.words[ref_word][4] += 1
+            elif hyp_word != ref_word:
+                self.subs[(ref_word, hyp_word)] += 1
+                self.words[ref_word][1] += 1
+                self.words[hyp_word][2] += 1
+            else:
+                self.words[ref_word][0] += 1
+                self.num_corr += 1
+
+    def merge(self, other: "ErrorCounts") -> None:
+        """Add the counts of other to self. The PER-UTT DETAILS of other
+        are appended after those of self."""
+        for k, v in other.subs.items():
+            self.subs[k] += v
+        for k, v in other.ins.items():
+            self.ins[k] += v
+        for k, v in other.dels.items():
+            self.dels[k] += v
+        for k, v in other.words.items():
+            counts = self.words[k]
+            for i in range(len(counts)):
+                counts[i] += v[i]
+        self.num_corr += other.num_corr
+        self.ref_len += other.ref_len
+        self.utt_details.extend(other.utt_details)
+
+    @property
+    def num_errors(self) -> Tuple[int, int, int]:
+        """Return (ins_errs, del_errs, sub_errs)."""
+        return (
+            sum(self.ins.values()),
+            sum(self.dels.values()),
+            sum(self.subs.values()),
+        )
+
+    @property
+    def tot_err_rate(self) -> str:
+        """The WER in percent, with two decimals, e.g., "2.35"."""
+        return "%.2f" % (100.0 * sum(self.num_errors) / self.ref_len)
+
+    def log(self, test_set_name: str) -> None:
+        ins_errs, del_errs, sub_errs = self.num_errors
+        tot_errs = ins_errs + del_errs + sub_errs
+        logging.info(
+            f"[{test_set_name}] %WER {tot_errs / self.ref_len:.2%} "
+            f"[{tot_errs} / {self.ref_len}, {ins_errs} ins, "
+            f"{del_errs} del, {sub_errs} sub ]"
+        )
+
+    def write_summary(
+        self, f: TextIO, tot_err_rate: Optional[Union[str, float]] = None
+    ) -> None:
+        """Write the %WER and Errors lines. `tot_err_rate` is the WER to
+        print; it defaults to :attr:`tot_err_rate`."""
+        ins_errs, del_errs, sub_errs = self.num_errors
+        if tot_err_rate is None:
+            tot_err_rate = self.tot_err_rate
+        print(f"%WER = {tot_err_rate}", file=f)
+        print(
+            f"Errors: {ins_errs} insertions, {del_errs} deletions, "
+            f"{sub_errs} substitutions, over {self.ref_len} reference "
+            f"words ({self.num_corr} correct)",
+            file=f,
+        )
+
+    def write_utt_details(self, f: TextIO, sort: bool = False) -> None:
+        """Write the PER-UTT DETAILS lines. If sort is True, they are sorted
+        by cut_id; otherwise, they are in the order the utterances were
+        added."""
+        utt_details = self.utt_details
+        if sort:
+            utt_details = sorted(utt_details, key=lambda x: x[0])
+        for _, line in utt_details:
+            print(line, file=f)
+
+    def write_word_stats(self, f: TextIO) -> None:
+        """Write the SUBSTITUTIONS, DELETIONS, INSERTIONS and PER-WORD STATS
+        sections."""
+        print("", file=f)
+        print("SUBSTITUTIONS: count ref -> hyp", file=f)
+
+        for count, (ref, hyp) in sorted(
+            [(v, k) for k, v in self.subs.items()], reverse=True
+        ):
+            print(f"{count}   {ref} -> {hyp}", file=f)
+
+        print("", file=f)
+        print("DELETIONS: count ref", file=f)
+        for count, ref in sorted([(v, k) for k, v in self.dels.items()], reverse=True):
+            print(f"{count}   {ref}", file=f)
+
+        print("", file=f)
+        print("INSERTIONS: count hyp", file=f)
+        for count, hyp in sorted([(v, k) for k, v in self.ins.items()], reverse=True):
+            print(f"{count}   {hyp}", file=f)
+
+        print("", file=f)
+        print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
+        for _, word, counts in sorted(
+            [(sum(v[1:]), k, v) for k, v in self.words.items()], reverse=True
+        ):
+            (corr, ref_sub, hyp_sub, ins, dels) = counts
+            tot_errs = ref_sub + hyp_sub + ins + dels
+            ref_count = corr + ref_sub + dels
+            hyp_count = corr + hyp_sub + ins
+
+            print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
+
+    def write(
+        self,
+        f: TextIO,
+        test_set_name: str,
+        enable_log: bool = True,
+        sort: bool = False,
+    ) -> float:
+        """Write the statistics in the format of :func:`write_error_stats`
+        and return the WER in percent."""
+        if enable_log:
+            self.log(test_set_name)
+
+        self.write_summary(f)
+        print(
+            "Search below for sections starting with PER-UTT DETAILS:, "
+            "SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
+            file=f,
+        )
+
+        print("", file=f)
+        print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
+        self.write_utt_details(f, sort=sort)
+        self.write_word_stats(f)
+        return float(self.tot_err_rate)
+
+
+def compute_error_counts(
+    results: List[Tuple[str, List[str], List[str]]],
+    sclite_mode: bool = False,
+) -> ErrorCounts:
+    """Return the ErrorCounts of a list of (cut_id, ref, hyp). It is the
+    function run by the workers of :class:`ErrorStatsScorer`."""
+    counts = ErrorCounts()
+    for cut_id, ref, hyp in results:
+        counts.add(cut_id, ref, hyp, sclite_mode=sclite_mode)
+    return counts
+
+
+class ErrorStatsScorer(object):
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        chunk_size: int = 1000,
+        compute_CER: bool = False,
+        sclite_mode: bool = False,
+    ) -> None:
+        """
+        Args:
+          executor:
+            If not None, e.g., a `concurrent.futures.ProcessPoolExecutor`,
+            utterances are aligned by it in chunks of `chunk_size`. It can be
+            shared by several scorers and is not shut down by this class.
+            If None, utterances are aligned in :meth:`add`.
+          chunk_size:
+            Number of utterances per task submitted to the executor.
+          compute_CER:
+            True to compute the character error rate. Words are joined and
+            split into characters before alignment.
+          sclite_mode:
+            True to align in the sclite mode for the error counts.
+        """
+        assert chunk_size > 0, chunk_size
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.compute_CER = compute_CER
+        self.sclite_mode = sclite_mode
+
+        self.counts = ErrorCounts()
+        self._buffer: List[Tuple[str, List[str], List[str]]] = []
+        self._pending: List[Future] = []
+
+    def add(self, results: List[Tuple[str, List[str], List[str]]]) -> None:
+        """Add the results of some utterances, e.g., of a decoded batch.
+
+        Args:
+          results:
+            A list of tuples (cut_id, ref_words, hyp_words).
+        """
+        if self.compute_CER:
+            results = [
+                (cut_id, list("".join(ref)), list("".join(hyp)))
+                for cut_id, ref, hyp in results
+            ]
+
+        if self.executor is None:
+            for cut_id, ref, hyp in results:
+                self.counts.add(cut_id, ref, hyp, sclite_mode=self.sclite_mode)
+            return
+
+        self._buffer.extend(results)
+        while len(self._buffer) >= self.chunk_size:
+            self._submit(self._buffer[: self.chunk_size])
+            self._buffer = self._buffer[self.chunk_size :]
+
+    def _submit(self, results: List[Tuple[str, List[str], List[str]]]) -> None:
+        self._pending.append(
+            self.executor.submit(compute_error_counts, results, self.sclite_mode)
+        )
+
+    def finalize(self) -> ErrorCounts:
+        """Wait for all pending alignments and return the merged counts.
+        The counts are merged in the order the utterances were added."""
+        if self._buffer:
+            self._submit(self._buffer)
+            self._buffer = []
+        for future in self._pending:
+            self.counts.merge(future.result())
+        self._pending = []
+        return self.counts
+
+    def write(
+        self,
+        f: TextIO,
+        test_set_name: str,
+        enable_log: bool = True,
+        sort: bool = False,
+    ) -> float:
+        """Write the statistics to f and return the WER in percent.
+        See :meth:`ErrorCounts.write`."""
+        return self.finalize().write(
+            f, test_set_name=test_set_name, enable_log=enable_log, sort=sort
+        )
@@ -0,0 +1,279 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A store of precomputed features packed into a few large shard files.
+
+Features stored by lhotse, e.g., with ``LilcomChunkyWriter``, are read and
+decompressed cut by cut. Here the feature matrices are written uncompressed
+into shard files of about 1 GB, each matrix starting at an aligned offset,
+together with an index that maps a cut ID to (shard, offset, num_frames).
+The shards are memory-mapped, so reading the features of a cut is a slice of
+the mapping that is copied directly into the batch tensor.
+
+The layout of a store directory is::
+
+    meta.json       # num_features, dtype, alignment and number of shards
+    shard-00000.bin # raw feature matrices
+    shard-00001.bin
+    ...
+    cut_ids.npy     # sorted cut IDs, as bytes
+    shard_ids.npy   # int32, shard of each cut
+    offsets.npy     # int64, byte offset of each cut in its shard
+    num_frames.npy  # int32, number of frames of each cut
+
+Use ``./local/build_feature_store.py`` to build a store and
+:class:`FeatureStoreInput` as the `input_strategy` of
+``K2SpeechRecognitionDataset`` to read it.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from lhotse import CutSet, MonoCut
+from lhotse.cut import Cut
+from lhotse.dataset import PrecomputedFeatures
+from lhotse.utils import LOG_EPSILON
+
+
+def _shard_filename(store_dir: Path, shard: int) -> Path:
+    return store_dir / f"shard-{shard:05d}.bin"
+
+
+def write_feature_store(
+    cuts: Iterable[Cut],
+    out_dir: Union[str, Path],
+    shard_size: int = 1 << 30,
+    alignment: int = 4096,
+    dtype: str = "float32",
+) -> int:
+    """Write the features of the given cuts into a feature store.
+
+    Args:
+      cuts:
+        The cuts with precomputed features. Their IDs must be unique.
+      out_dir:
+        The directory of the store.
+      shard_size:
+        A new shard is started when the current one would exceed this many
+        bytes.
+      alignment:
+        Each feature matrix starts at a multiple of this many bytes in its
+        shard.
+      dtype:
+        The dtype of the stored features, e.g., float32 or float16.
+    Returns:
+      Return the number of cuts written.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    dtype = np.dtype(dtype)
+    assert alignment % dtype.itemsize == 0, (alignment, dtype)
+
+    cut_ids: List[str] = []
+    shard_ids: List[int] = []
+    offsets: List[int] = []
+    num_frames: List[int] = []
+
+    num_features = None
+    f = None
+    shard = -1
+    pos = 0
+    for i, cut in enumerate(cuts):
+        feats = np.ascontiguousarray(cut.load_features(), dtype=dtype)
+        if num_features is None:
+            num_features = feats.shape[1]
+        assert feats.shape[1] == num_features, (cut.id, feats.shape, num_features)
+
+        if f is None or (pos > 0 and pos + feats.nbytes > shard_size):
+            if f is not None:
+                f.close()
+            shard += 1
+            f = open(_shard_filename(out_dir, shard), "wb")
+            pos = 0
+
+        padding = -pos % alignment
+        f.write(b"\0" * padding)
+        pos += padding
+
+        cut_ids.append(cut.id)
+        shard_ids.append(shard)
+        offsets.append(pos)
+        num_frames.append(feats.shape[0])
+
+        f.write(feats.tobytes())
+        pos += feats.nbytes
+
+        if i % 10000 == 0:
+            logging.info(f"Processed {i} cuts")
+
+    if f is not None:
+        f.close()
+
+    assert len(set(cut_ids)) == len(cut_ids), "Cut IDs are not unique"
+
+    cut_ids = np.array([c.encode() for c in cut_ids], dtype=np.bytes_)
+    order = np.argsort(cut_ids, kind="stable")
+    np.save(out_dir / "cut_ids.npy", cut_ids[order])
+    np.save(out_dir / "shard_ids.npy", np.array(shard_ids, dtype=np.int32)[order])
+    np.save(out_dir / "offsets.npy", np.array(offsets, dtype=np.int64)[order])
+    np.save(out_dir / "num_frames.npy", np.array(num_frames, dtype=np.int32)[order])
+
+    # meta.json is written last, so an incomplete store cannot be opened.
+    meta = {
+        "num_features": num_features,
+        "dtype": dtype.name,
+        "alignment": alignment,
+        "num_shards": shard + 1,
+    }
+    with open(out_dir / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+    return len(cut_ids)
+
+
+class FeatureStore(object):
+    def __init__(self, store_dir: Union[str, Path]) -> None:
+        """
+        Args:
+          store_dir:
+            A directory written by :func:`write_feature_store`.
+        """
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / "meta.json") as f:
+            meta = json.load(f)
+        self.num_features = meta["num_features"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.num_shards = meta["num_shards"]
+
+        self.cut_ids = np.load(self.store_dir / "cut_ids.npy", mmap_mode="r")
+        self.shard_ids = np.load(self.store_dir / "shard_ids.npy", mmap_mode="r")
+        self.offsets = np.load(self.store_dir / "offsets.npy", mmap_mode="r")
+        self.num_frames = np.load(self.store_dir / "num_frames.npy", mmap_mode="r")
+
+        # The shards are mapped lazily, so that each dataloader worker
+        # has its own mapping.
+        self._shards: Optional[List[np.memmap]] = None
+
+    def __getstate__(self):
+        # Re-open the memory-mapped files instead of pickling their content
+        return {"store_dir": self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["store_dir"])
+
+    def __len__(self) -> int:
+        return len(self.cut_ids)
+
+    def __contains__(self, cut_id: str) -> bool:
+        return self.index(cut_id) is not None
+
+    def index(self, cut_id: str) -> Optional[int]:
+        """Return the position of cut_id in the index, or None if the cut
+        is not in the store."""
+        key = cut_id.encode()
+        i = int(np.searchsorted(self.cut_ids, key))
+        if i < len(self.cut_ids) and self.cut_ids[i] == key:
+            return i
+        return None
+
+    def _get_shards(self) -> List[np.memmap]:
+        if self._shards is None:
+            self._shards = [
+                np.memmap(
+                    _shard_filename(self.store_dir, s), dtype=self.dtype, mode="r"
+                )
+                for s in range(self.num_shards)
+            ]
+        return self._shards
+
+    def get_by_index(self, i: int) -> np.ndarray:
+        """Return the features at position i of the index as a read-only
+        view of shape (num_frames, num_features) into the mapped shard."""
+        shard = self._get_shards()[self.shard_ids[i]]
+        start = int(self.offsets[i]) // self.dtype.itemsize
+        num_frames = int(self.num_frames[i])
+        end = start + num_frames * self.num_features
+        return shard[start:end].reshape(num_frames, self.num_features)
+
+    def get(self, cut_id: str) -> np.ndarray:
+        """Return the features of the given cut. See :meth:`get_by_index`."""
+        i = self.index(cut_id)
+        if i is None:
+            raise KeyError(cut_id)
+        return self.get_by_index(i)
+
+
+class FeatureStoreInput(PrecomputedFeatures):
+    """An input strategy for ``K2SpeechRecognitionDataset`` that reads the
+    features from a :class:`FeatureStore`.
+
+    Features of a cut are copied from the mapped shard directly into the
+    padded batch tensor. Cuts that are not in the store as is, e.g., cuts
+    mixed with noise by ``CutMix`` or concatenated by ``CutConcatenate``,
+    are read with ``cut.load_features()`` as in ``PrecomputedFeatures``.
+    """
+
+    def __init__(self, store: Union[str, Path, FeatureStore]) -> None:
+        super().__init__()
+        if not isinstance(store, FeatureStore):
+            store = FeatureStore(store)
+        self.store = store
+
+    def _load(self, cut: Cut) -> np.ndarray:
+        if isinstance(cut, MonoCut):
+            i = self.store.index(cut.id)
+            if i is not None and self.store.num_frames[i] == cut.num_frames:
+                return self.store.get_by_index(i)
+        return cut.load_features()
+
+    def __call__(
+        self,
+        cuts: CutSet,
+        pad_direction: Optional[str] = "right",
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the features of shape (batch_size, num_frames, num_features),
+        padded with a low log-energy, and the number of frames of each cut."""
+        cuts = list(cuts)
+        features_lens = torch.tensor([cut.num_frames for cut in cuts], dtype=torch.int)
+        max_num_frames = features_lens.max().item()
+        num_features = cuts[0].num_features
+
+        features = torch.full(
+            (len(cuts), max_num_frames, num_features),
+            LOG_EPSILON,
+            dtype=torch.float32,
+        )
+        # A numpy view of the batch, so that the features are copied into it
+        # without creating an intermediate tensor.
+        np_features = features.numpy()
+        for i, cut in enumerate(cuts):
+            feats = self._load(cut)
+            num_frames = min(feats.shape[0], max_num_frames)
+            padding = max_num_frames - num_frames
+            if pad_direction == "right":
+                start = 0
+            elif pad_direction == "left":
+                start = padding
+            else:
+                start = padding // 2
+            np_features[i, start : start + num_frames] = feats[:num_frames]
+
+        return features, features_lens
@@ -0,0 +1,228 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An on-disk cache for compiled decoding graphs, e.g., HLG, LG and G.
+
+Compiling HLG or LG, or even loading a pre-compiled ``HLG.pt`` and
+preparing it with ``k2.arc_sort``, ``k2.add_epsilon_self_loops`` and so on,
+can take minutes for a large vocabulary. This module stores the fully
+prepared graph together with its properties, so the next run loads it with
+``torch.load(..., mmap=True)``, which only maps the file into memory.
+
+The cache key is the SHA-256 hash of the content of the input files
+(e.g., the lexicon, the BPE model and G) and of the options used to
+prepare the graph, so a stale graph is never returned when one of the
+inputs changes.
+
+Usage::
+
+    cache = GraphCache("data/graph_cache")
+    HLG = cache.get_or_compile(
+        name="HLG",
+        filenames=get_lang_files(lang_dir) + [get_lm_file(lm_dir, "G_3_gram")],
+        compile_fn=lambda: compile_HLG(lang_dir),
+        device=device,
+    )
+"""
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+
+import k2
+import torch
+
+# Increase it when the format of the cached files changes
+_CACHE_VERSION = 1
+
+
+def hash_files(
+    filenames: List[Union[str, Path]],
+    chunk_size: int = 1 << 20,
+    **kwargs,
+) -> str:
+    """Return the SHA-256 hex digest of the content of the given files and
+    of the given keyword arguments.
+
+    Args:
+      filenames:
+        The files to hash. The order matters. Files that do not exist are
+        hashed by their names only.
+      chunk_size:
+        Files are read in chunks of this many bytes.
+      kwargs:
+        Extra options that affect the result, e.g., the graph name. Their
+        values are converted to str.
+    """
+    h = hashlib.sha256()
+    h.update(f"version={_CACHE_VERSION}".encode())
+    for key in sorted(kwargs):
+        h.update(f"{key}={kwargs[key]}".encode())
+
+    for filename in filenames:
+        filename = Path(filename)
+        h.update(filename.name.encode())
+        if not filename.is_file():
+            h.update(b"<missing>")
+            continue
+        with open(filename, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def get_lang_files(lang_dir: Union[str, Path]) -> List[Path]:
+    """Return the files in lang_dir that affect a compiled HLG or LG,
+    i.e., the lexicon, the symbol tables and the BPE model if any."""
+    lang_dir = Path(lang_dir)
+    names = ["L_disambig.pt", "tokens.txt", "words.txt", "bpe.model"]
+    return [lang_dir / name for name in names if (lang_dir / name).is_file()]
+
+
+def get_lm_file(lm_dir: Union[str, Path], lm: str) -> Path:
+    """Return the file of the n-gram LM G with the given stem name,
+    e.g., G_3_gram. The text format is preferred as the pre-compiled
+    ``.pt`` file is derived from it."""
+    lm_dir = Path(lm_dir)
+    if (lm_dir / f"{lm}.fst.txt").is_file():
+        return lm_dir / f"{lm}.fst.txt"
+    return lm_dir / f"{lm}.pt"
+
+
+def save_graph(fsa: k2.Fsa, filename: Union[str, Path]) -> None:
+    """Save a graph so that it can be memory-mapped by :func:`load_graph`.
+
+    The file is written to a temporary file first and then renamed, so
+    concurrent readers never see a partially written graph.
+    """
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+
+    d = fsa.to("cpu").as_dict()
+    # Save the properties so that they are not recomputed after loading.
+    d["properties"] = fsa.properties
+
+    tmp_filename = filename.with_name(f"{filename.name}.tmp.{os.getpid()}")
+    torch.save(d, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def load_graph(
+    filename: Union[str, Path],
+    device: Union[str, torch.device] = "cpu",
+    mmap: bool = True,
+) -> k2.Fsa:
+    """Load a graph saved by :func:`save_graph`.
+
+    Args:
+      filename:
+        The file to load.
+      device:
+        The returned graph is on this device.
+      mmap:
+        True to memory-map the file instead of reading it. The mapping is
+        private, so modifying the graph, e.g., scaling its scores, does not
+        change the file.
+    """
+    if mmap:
+        try:
+            d = torch.load(filename, map_location="cpu", mmap=True)
+        except TypeError:
+            # torch < 2.1 does not support mmap
+            logging.warning(
+                "torch.load() does not support mmap, loading the whole file"
+            )
+            d = torch.load(filename, map_location="cpu")
+    else:
+        d = torch.load(filename, map_location="cpu")
+    properties = d.pop("properties", None)
+    fsa = k2.Fsa.from_dict(d)
+    if properties is not None:
+        fsa.__dict__["_properties"] = properties
+    return fsa.to(device)
+
+
+class GraphCache(object):
+    def __init__(self, cache_dir: Union[str, Path]) -> None:
+        """
+        Args:
+          cache_dir:
+            The directory to keep the graphs. It is created if it does not
+            exist.
+        """
+        self.cache_dir = Path(cache_dir)
+
+    def filename(self, name: str, key: str) -> Path:
+        return self.cache_dir / f"{name}-{key}.pt"
+
+    def get(
+        self,
+        name: str,
+        key: str,
+        device: Union[str, torch.device] = "cpu",
+    ) -> Optional[k2.Fsa]:
+        """Return the cached graph, or None if it is not in the cache."""
+        filename = self.filename(name, key)
+        if not filename.is_file():
+            return None
+        logging.info(f"Loading {name} from {filename}")
+        return load_graph(filename, device=device)
+
+    def put(self, name: str, key: str, fsa: k2.Fsa) -> None:
+        filename = self.filename(name, key)
+        logging.info(f"Saving {name} to {filename}")
+        save_graph(fsa, filename)
+
+    def get_or_compile(
+        self,
+        name: str,
+        filenames: List[Union[str, Path]],
+        compile_fn: Callable[[], k2.Fsa],
+        device: Union[str, torch.device] = "cpu",
+        **kwargs,
+    ) -> k2.Fsa:
+        """Return the cached graph if the inputs are unchanged. Otherwise,
+        compile it with `compile_fn`, save it to the cache and return it.
+
+        Args:
+          name:
+            The name of the graph, e.g., HLG. It is part of the key.
+          filenames:
+            The input files of `compile_fn`, e.g., the lexicon and G.
+          compile_fn:
+            A function without arguments returning the prepared graph. Its
+            result should already be arc-sorted and contain all the
+            attributes needed for decoding.
+          device:
+            The returned graph is on this device.
+          kwargs:
+            Extra options of `compile_fn` that are part of the key.
+        """
+        key = hash_files(filenames, name=name, **kwargs)
+        fsa = self.get(name, key, device=device)
+        if fsa is not None:
+            return fsa
+
+        logging.info(f"{name} is not in the cache {self.cache_dir}, compiling it")
+        fsa = compile_fn()
+        self.put(name, key, fsa)
+        return fsa.to(device)
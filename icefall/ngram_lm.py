@@ -14,8 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 from collections import defaultdict
-from typing import List, Optional, Tuple
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 from icefall.utils import is_module_available
 
@@ -169,3 +173,414 @@ class NgramLmStateCost:
             return float("-inf")
 
         return -1 * min(self.state_cost.values())
+
+
+class CsrNgramLm:
+    """An array-backed copy of an n-gram FSA.
+
+    The arcs are stored in CSR format, i.e., the arcs leaving state s are
+    arcs[row_splits[s]:row_splits[s+1]] and they are sorted by ilabel.
+    Each state has at most one backoff arc, which is also kept in the two
+    per-state arrays ``backoff_states`` and ``backoff_costs`` so that
+    following the backoff chain does not need any search.
+
+    The arrays can be saved to a directory with :meth:`save` and loaded
+    back with :meth:`load`, which memory-maps them by default, so that
+    several decoding processes can share one copy of a large LM.
+
+    Unlike :class:`NgramLm`, it does not depend on kaldifst once it is built
+    and it is used together with :class:`CsrNgramLmStateCost`, which advances
+    the states of many hypotheses with a single call.
+    """
+
+    _array_names = (
+        "row_splits",
+        "ilabels",
+        "next_states",
+        "costs",
+        "arc_keys",
+        "backoff_states",
+        "backoff_costs",
+    )
+
+    def __init__(
+        self,
+        row_splits: np.ndarray,
+        ilabels: np.ndarray,
+        next_states: np.ndarray,
+        costs: np.ndarray,
+        backoff_states: np.ndarray,
+        backoff_costs: np.ndarray,
+        backoff_id: int,
+        arc_keys: Optional[np.ndarray] = None,
+    ):
+        """
+        Args:
+          row_splits:
+            A 1-D int64 array of shape (num_states + 1,).
+          ilabels:
+            A 1-D int32 array of shape (num_arcs,). The input label of arcs.
+          next_states:
+            A 1-D int32 array of shape (num_arcs,).
+          costs:
+            A 1-D float32 array of shape (num_arcs,). The cost (i.e., negative
+            log-prob) of arcs.
+          backoff_states:
+            A 1-D int32 array of shape (num_states,). backoff_states[s] is
+            the destination state of the backoff arc leaving state s, or -1
+            if there is no such arc.
+          backoff_costs:
+            A 1-D float32 array of shape (num_states,). The cost of the
+            backoff arcs.
+          backoff_id:
+            ID of the backoff symbol.
+          arc_keys:
+            Optional. A 1-D int64 array of shape (num_arcs,) containing
+            ``state * num_labels + ilabel`` of each arc. It is computed from
+            the other arrays if not given.
+        """
+        assert row_splits.ndim == 1 and row_splits.size >= 2, row_splits.shape
+        assert ilabels.shape == next_states.shape == costs.shape, (
+            ilabels.shape,
+            next_states.shape,
+            costs.shape,
+        )
+        assert row_splits[-1] == ilabels.size, (row_splits[-1], ilabels.size)
+        assert backoff_states.size == backoff_costs.size == row_splits.size - 1
+
+        self.row_splits = row_splits
+        self.ilabels = ilabels
+        self.next_states = next_states
+        self.costs = costs
+        self.backoff_states = backoff_states
+        self.backoff_costs = backoff_costs
+        self.backoff_id = backoff_id
+        self.num_labels = int(ilabels.max()) + 1 if ilabels.size > 0 else 1
+
+        if arc_keys is None:
+            arc_states = np.repeat(
+                np.arange(self.num_states, dtype=np.int64), np.diff(row_splits)
+            )
+            arc_keys = arc_states * self.num_labels + ilabels.astype(np.int64)
+        assert arc_keys.shape == ilabels.shape, (arc_keys.shape, ilabels.shape)
+        self.arc_keys = arc_keys
+
+    @property
+    def num_states(self) -> int:
+        return self.row_splits.size - 1
+
+    @property
+    def num_arcs(self) -> int:
+        return self.ilabels.size
+
+    @staticmethod
+    def from_ngram_lm(ngram_lm: NgramLm) -> "CsrNgramLm":
+        """Build it from an instance of :class:`NgramLm`."""
+        import kaldifst
+
+        lm = ngram_lm.lm
+        assert lm.start == 0, lm.start
+
+        num_states = lm.num_states
+        row_splits = np.zeros(num_states + 1, dtype=np.int64)
+        ilabels = []
+        next_states = []
+        costs = []
+        for state in range(num_states):
+            for arc in kaldifst.ArcIterator(lm, state):
+                ilabels.append(arc.ilabel)
+                next_states.append(arc.nextstate)
+                costs.append(arc.weight.value)
+            row_splits[state + 1] = len(ilabels)
+
+        ilabels = np.array(ilabels, dtype=np.int32)
+        next_states = np.array(next_states, dtype=np.int32)
+        costs = np.array(costs, dtype=np.float32)
+
+        backoff_states = np.full(num_states, -1, dtype=np.int32)
+        backoff_costs = np.zeros(num_states, dtype=np.float32)
+        arc_states = np.repeat(np.arange(num_states), np.diff(row_splits))
+        is_backoff = ilabels == ngram_lm.backoff_id
+        # Arcs are sorted by ilabel within a state, so if a state has several
+        # backoff arcs, the last assignment wins. An n-gram LM has at most one.
+        backoff_states[arc_states[is_backoff]] = next_states[is_backoff]
+        backoff_costs[arc_states[is_backoff]] = costs[is_backoff]
+
+        return CsrNgramLm(
+            row_splits=row_splits,
+            ilabels=ilabels,
+            next_states=next_states,
+            costs=costs,
+            backoff_states=backoff_states,
+            backoff_costs=backoff_costs,
+            backoff_id=ngram_lm.backoff_id,
+        )
+
+    @staticmethod
+    def from_fst(
+        fst_filename: str,
+        backoff_id: int,
+        is_binary: bool = False,
+    ) -> "CsrNgramLm":
+        """Build it from an FST file. See :class:`NgramLm` for the meaning of
+        the arguments."""
+        return CsrNgramLm.from_ngram_lm(
+            NgramLm(fst_filename, backoff_id=backoff_id, is_binary=is_binary)
+        )
+
+    def save(self, dirname: Union[str, Path]) -> None:
+        """Save the arrays as ``.npy`` files in the given directory."""
+        dirname = Path(dirname)
+        dirname.mkdir(parents=True, exist_ok=True)
+        for name in self._array_names:
+            np.save(dirname / f"{name}.npy", getattr(self, name))
+        with open(dirname / "meta.json", "w") as f:
+            json.dump({"backoff_id": self.backoff_id}, f)
+
+    @staticmethod
+    def load(dirname: Union[str, Path], mmap: bool = True) -> "CsrNgramLm":
+        """Load a CsrNgramLm saved by :meth:`save`.
+
+        Args:
+          dirname:
+            The directory passed to :meth:`save`.
+          mmap:
+            True to memory-map the arrays instead of reading them into memory.
+        """
+        dirname = Path(dirname)
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(dirname / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in CsrNgramLm._array_names
+        }
+        with open(dirname / "meta.json") as f:
+            meta = json.load(f)
+        return CsrNgramLm(backoff_id=meta["backoff_id"], **arrays)
+
+    def lookup(
+        self, states: np.ndarray, labels: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find the arcs with the given labels leaving the given states,
+        without following backoff arcs.
+
+        Args:
+          states:
+            A 1-D int64 array.
+          labels:
+            A 1-D int64 array of the same shape as `states`.
+        Returns:
+          Return a tuple with three arrays of the same shape as `states`:
+            - found, a bool array, True if the arc exists
+            - next_states, valid only where `found` is True
+            - costs, valid only where `found` is True
+        """
+        keys = states * self.num_labels + labels
+        idx = np.searchsorted(self.arc_keys, keys)
+        idx = np.minimum(idx, max(self.num_arcs - 1, 0))
+        found = (labels >= 0) & (labels < self.num_labels)
+        if self.num_arcs == 0:
+            found[:] = False
+            return found, np.zeros_like(states), np.zeros(states.shape)
+        found &= self.arc_keys[idx] == keys
+        return found, self.next_states[idx], self.costs[idx]
+
+
+class CsrNgramLmStateCost:
+    """The n-gram LM states of a batch of hypotheses.
+
+    It is a ragged array: the i-th hypothesis is in states
+    states[row_splits[i]:row_splits[i+1]] with costs
+    costs[row_splits[i]:row_splits[i+1]], which is the array version of
+    ``NgramLmStateCost.state_cost``.
+
+    When it contains a single hypothesis, it can be used as a drop-in
+    replacement of :class:`NgramLmStateCost`, i.e., it has the methods
+    :meth:`forward_one_step` and the property :attr:`lm_score`.
+    """
+
+    def __init__(
+        self,
+        ngram_lm: CsrNgramLm,
+        row_splits: Optional[np.ndarray] = None,
+        states: Optional[np.ndarray] = None,
+        costs: Optional[np.ndarray] = None,
+    ):
+        """
+        Args:
+          ngram_lm:
+            The n-gram LM.
+          row_splits:
+            A 1-D int64 array of shape (num_hyps + 1,). If it is None,
+            it contains a single hypothesis at the start state with cost 0.
+          states:
+            A 1-D int64 array of shape (row_splits[-1],).
+          costs:
+            A 1-D float64 array of shape (row_splits[-1],).
+        """
+        self.ngram_lm = ngram_lm
+        if row_splits is None:
+            assert states is None and costs is None
+            row_splits = np.array([0, 1], dtype=np.int64)
+            states = np.zeros(1, dtype=np.int64)
+            costs = np.zeros(1, dtype=np.float64)
+        assert states.shape == costs.shape, (states.shape, costs.shape)
+        assert row_splits[-1] == states.size, (row_splits[-1], states.size)
+        self.row_splits = row_splits
+        self.states = states
+        self.costs = costs
+
+    @staticmethod
+    def init(ngram_lm: CsrNgramLm, num_hyps: int = 1) -> "CsrNgramLmStateCost":
+        """Return `num_hyps` hypotheses at the start state with cost 0."""
+        return CsrNgramLmStateCost(
+            ngram_lm,
+            row_splits=np.arange(num_hyps + 1, dtype=np.int64),
+            states=np.zeros(num_hyps, dtype=np.int64),
+            costs=np.zeros(num_hyps, dtype=np.float64),
+        )
+
+    @staticmethod
+    def cat(
+        state_costs: Sequence["CsrNgramLmStateCost"],
+    ) -> "CsrNgramLmStateCost":
+        """Concatenate the hypotheses of a list of CsrNgramLmStateCost."""
+        assert len(state_costs) > 0
+        if len(state_costs) == 1:
+            return state_costs[0]
+
+        sizes = [np.zeros(1, dtype=np.int64)]
+        sizes += [np.diff(sc.row_splits) for sc in state_costs]
+        return CsrNgramLmStateCost(
+            state_costs[0].ngram_lm,
+            row_splits=np.cumsum(np.concatenate(sizes)),
+            states=np.concatenate([sc.states for sc in state_costs]),
+            costs=np.concatenate([sc.costs for sc in state_costs]),
+        )
+
+    @property
+    def num_hyps(self) -> int:
+        return self.row_splits.size - 1
+
+    def __len__(self) -> int:
+        return self.num_hyps
+
+    def __getitem__(self, i: int) -> "CsrNgramLmStateCost":
+        """Return the i-th hypothesis. The arrays are views, not copies."""
+        begin, end = self.row_splits[i], self.row_splits[i + 1]
+        return CsrNgramLmStateCost(
+            self.ngram_lm,
+            row_splits=np.array([0, end - begin], dtype=np.int64),
+            states=self.states[begin:end],
+            costs=self.costs[begin:end],
+        )
+
+    def index_select(self, indexes: Sequence[int]) -> "CsrNgramLmStateCost":
+        """Return the hypotheses with the given indexes. An index may occur
+        several times, e.g., when several hypotheses are extended from the
+        same one."""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        begins = self.row_splits[indexes]
+        sizes = self.row_splits[indexes + 1] - begins
+        row_splits = np.zeros(indexes.size + 1, dtype=np.int64)
+        np.cumsum(sizes, out=row_splits[1:])
+        # pos[j] is the index in self.states of the j-th output element
+        pos = np.arange(row_splits[-1], dtype=np.int64) + np.repeat(
+            begins - row_splits[:-1], sizes
+        )
+        return CsrNgramLmStateCost(
+            self.ngram_lm,
+            row_splits=row_splits,
+            states=self.states[pos],
+            costs=self.costs[pos],
+        )
+
+    def forward(self, labels: Sequence[int]) -> "CsrNgramLmStateCost":
+        """Advance the i-th hypothesis with labels[i] for all i at once.
+
+        It gives the same result as calling
+        :meth:`NgramLmStateCost.forward_one_step` for each hypothesis.
+
+        Args:
+          labels:
+            A list or a 1-D array of shape (num_hyps,).
+        Returns:
+          Return the new states of the hypotheses.
+        """
+        lm = self.ngram_lm
+        labels = np.asarray(labels, dtype=np.int64)
+        assert labels.shape == (self.num_hyps,), (labels.shape, self.num_hyps)
+
+        hyp_ids = np.repeat(
+            np.arange(self.num_hyps, dtype=np.int64), np.diff(self.row_splits)
+        )
+        states = self.states.astype(np.int64, copy=False)
+        costs = self.costs.astype(np.float64, copy=False)
+
+        all_hyp_ids = [np.zeros(0, dtype=np.int64)]
+        all_next_states = [np.zeros(0, dtype=np.int64)]
+        all_costs = [np.zeros(0, dtype=np.float64)]
+        # Each iteration handles one more level of the backoff chains, so
+        # the number of iterations is bounded by the order of the LM.
+        while states.size > 0:
+            found, next_states, arc_costs = lm.lookup(states, labels[hyp_ids])
+            # Like NgramLm.get_next_state_and_cost(), arcs entering
+            # state 0 are ignored
+            found &= next_states != 0
+            all_hyp_ids.append(hyp_ids[found])
+            all_next_states.append(next_states[found].astype(np.int64))
+            all_costs.append(costs[found] + arc_costs[found])
+
+            backoff_states = lm.backoff_states[states]
+            has_backoff = backoff_states >= 0
+            hyp_ids = hyp_ids[has_backoff]
+            costs = costs[has_backoff] + lm.backoff_costs[states[has_backoff]]
+            states = backoff_states[has_backoff].astype(np.int64)
+
+        hyp_ids = np.concatenate(all_hyp_ids)
+        next_states = np.concatenate(all_next_states)
+        costs = np.concatenate(all_costs)
+
+        # Keep the minimum cost for each (hyp, next_state) pair. Sorting by
+        # (key, cost) puts the minimum cost first in each group.
+        keys = hyp_ids * lm.num_states + next_states
+        order = np.lexsort((costs, keys))
+        keys = keys[order]
+        first = np.ones(keys.size, dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        order = order[first]
+
+        hyp_ids = hyp_ids[order]
+        row_splits = np.zeros(self.num_hyps + 1, dtype=np.int64)
+        np.cumsum(np.bincount(hyp_ids, minlength=self.num_hyps), out=row_splits[1:])
+
+        return CsrNgramLmStateCost(
+            lm,
+            row_splits=row_splits,
+            states=next_states[order],
+            costs=costs[order],
+        )
+
+    def forward_one_step(self, label: int) -> "CsrNgramLmStateCost":
+        """Same as :meth:`NgramLmStateCost.forward_one_step`. It requires
+        that there is only one hypothesis."""
+        assert self.num_hyps == 1, self.num_hyps
+        return self.forward([label])
+
+    @property
+    def lm_scores(self) -> np.ndarray:
+        """Return a 1-D float64 array of shape (num_hyps,) with the LM score
+        of each hypothesis. It is -inf for hypotheses without any state."""
+        scores = np.full(self.num_hyps, float("inf"))
+        non_empty = self.row_splits[1:] > self.row_splits[:-1]
+        if non_empty.any():
+            scores[non_empty] = np.minimum.reduceat(
+                self.costs, self.row_splits[:-1][non_empty]
+            )
+        return -scores
+
+    @property
+    def lm_score(self) -> float:
+        """Same as :attr:`NgramLmStateCost.lm_score`. It requires that there
+        is only one hypothesis."""
+        assert self.num_hyps == 1, self.num_hyps
+        return float(self.lm_scores[0])
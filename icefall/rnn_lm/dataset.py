@@ -14,9 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Tuple
+import bisect
+from pathlib import Path
+from typing import List, Tuple, Union
 
 import k2
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
@@ -115,6 +118,180 @@ class LmDataset(torch.utils.data.Dataset):
         return sentence_tokens
 
 
+class MmapLmDataset(torch.utils.data.Dataset):
+    def __init__(
+        self,
+        data_dir: Union[str, Path],
+        max_sent_len: int,
+        batch_size: int,
+    ):
+        """A drop-in replacement of :class:`LmDataset` that reads the token
+        ids from memory-mapped files instead of keeping them in memory.
+
+        The directory is created by :func:`save_lm_data_as_mmap` and contains:
+
+          - tokens.npy, a 1-D int32 array with the token ids of all sentences
+          - row_splits.npy, a 1-D int64 array of shape (num_sentences + 1,),
+            the tokens of sentence i are tokens[row_splits[i]:row_splits[i+1]]
+
+        Since the files are opened read-only, all the dataloader workers and
+        all DDP ranks on the same machine share the pages in the OS cache.
+
+        The batches are the same as the ones of :class:`LmDataset`, but their
+        boundaries are not stored. Only one entry is kept for each run of
+        sentences with the same batch size, and the boundaries of a batch
+        are computed when it is requested.
+
+        Args:
+          data_dir:
+            The directory containing tokens.npy and row_splits.npy.
+          max_sent_len:
+            See :class:`LmDataset`.
+          batch_size:
+            See :class:`LmDataset`.
+        """
+        super().__init__()
+        data_dir = Path(data_dir)
+        self.tokens = np.load(data_dir / "tokens.npy", mmap_mode="r")
+        self.row_splits = np.load(data_dir / "row_splits.npy", mmap_mode="r")
+        assert self.row_splits[-1] == self.tokens.size, (
+            self.row_splits[-1],
+            self.tokens.size,
+        )
+
+        assert batch_size > 0, batch_size
+        assert max_sent_len > 1, max_sent_len
+        self.max_sent_len = max_sent_len
+        self.batch_size = batch_size
+
+        self._compute_segments()
+
+    @property
+    def num_sentences(self) -> int:
+        return self.row_splits.size - 1
+
+    def _sentence_length(self, i: int) -> int:
+        return int(self.row_splits[i + 1] - self.row_splits[i])
+
+    def _first_shorter_than(self, begin: int, length: int) -> int:
+        """Return the index of the first sentence at or after `begin` with
+        fewer than `length` tokens. Sentences are sorted by length in
+        descending order, so it is a binary search."""
+        lo, hi = begin, self.num_sentences
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._sentence_length(mid) < length:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _compute_segments(self) -> None:
+        """Split the batches into segments, in which all batches have the same
+        number of sentences. self.segments[k] is a tuple
+        (first_batch, first_sentence, batch_size) and self.first_batches[k]
+        is self.segments[k][0], used for binary search.
+
+        The batch size only depends on the length of the first sentence of a
+        batch, see :class:`LmDataset`, so a segment covers the batches
+        starting at sentences whose length // max_sent_len is the same.
+        """
+        self.segments = []
+        num_batches = 0
+        cur = 0
+        while cur < self.num_sentences:
+            sz = self._sentence_length(cur) // self.max_sent_len + 1
+            actual_batch_size = min(self.batch_size // sz + 1, self.batch_size)
+
+            # All sentences in [cur, run_end) have the same sz
+            run_end = self._first_shorter_than(cur, (sz - 1) * self.max_sent_len)
+            n = (run_end - cur + actual_batch_size - 1) // actual_batch_size
+            self.segments.append((num_batches, cur, actual_batch_size))
+            num_batches += n
+            cur += n * actual_batch_size
+
+        self.num_batches = num_batches
+        self.first_batches = [seg[0] for seg in self.segments]
+
+    def __len__(self) -> int:
+        """Return number of batches in this dataset"""
+        return self.num_batches
+
+    def __getitem__(self, i: int) -> k2.RaggedTensor:
+        """Get the i'th batch in this dataset
+        Return a ragged tensor with 2 axes [sentence][token].
+        """
+        assert 0 <= i < len(self), i
+
+        k = bisect.bisect_right(self.first_batches, i) - 1
+        first_batch, first_sentence, batch_size = self.segments[k]
+        begin = first_sentence + (i - first_batch) * batch_size
+        end = min(begin + batch_size, self.num_sentences)
+
+        row_splits = np.array(self.row_splits[begin : end + 1])
+        tokens = np.array(self.tokens[row_splits[0] : row_splits[-1]])
+        row_splits -= row_splits[0]
+
+        shape = k2.ragged.create_ragged_shape2(
+            row_splits=torch.from_numpy(row_splits.astype(np.int32)),
+            cached_tot_size=tokens.size,
+        )
+        return k2.RaggedTensor(shape, torch.from_numpy(tokens.astype(np.int32)))
+
+
+def save_lm_data_as_mmap(
+    filename: Union[str, Path],
+    out_dir: Union[str, Path],
+    chunk_size: int = 100000,
+) -> None:
+    """Convert the LM data saved by `../local/sort_lm_training_data.py` into
+    the format used by :class:`MmapLmDataset`.
+
+    The words of each sentence are expanded into tokens, so no word table is
+    needed while training.
+
+    Args:
+      filename:
+        The sorted LM data, e.g., data/lm_training_bpe_500/sorted_lm_data.pt
+      out_dir:
+        The output directory.
+      chunk_size:
+        Number of sentences to expand at a time.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    lm_data = torch.load(filename)
+    words = lm_data["words"]
+    sentences = lm_data["sentences"]
+    sentence_lengths = lm_data["sentence_lengths"].to(torch.int64)
+
+    num_sentences = sentences.dim0
+    row_splits = np.zeros(num_sentences + 1, dtype=np.int64)
+    np.cumsum(sentence_lengths.numpy(), out=row_splits[1:])
+    np.save(out_dir / "row_splits.npy", row_splits)
+
+    tokens = np.lib.format.open_memmap(
+        out_dir / "tokens.npy",
+        mode="w+",
+        dtype=np.int32,
+        shape=(int(row_splits[-1]),),
+    )
+    for begin in range(0, num_sentences, chunk_size):
+        end = min(begin + chunk_size, num_sentences)
+        indexes = torch.arange(begin, end, dtype=torch.int32)
+        # sentence_word_tokens is a ragged tensor with 3 axes
+        # [sentence][word][token]
+        sentence_word_tokens = words.index(sentences.index(indexes, axis=0)[0])
+        values = sentence_word_tokens.values.numpy()
+        assert values.size == row_splits[end] - row_splits[begin], (
+            values.size,
+            row_splits[end] - row_splits[begin],
+        )
+        tokens[row_splits[begin] : row_splits[end]] = values
+    tokens.flush()
+
+
 class LmDatasetCollate:
     def __init__(self, sos_id: int, eos_id: int, blank_id: int):
         """
@@ -173,6 +350,8 @@ def get_dataloader(
       filename:
         Path to the file containing LM data. The file is assumed to
         be generated by `../local/sort_lm_training_data.py`.
+        It can also be a directory created by :func:`save_lm_data_as_mmap`,
+        in which case the data is memory-mapped instead of loaded.
       is_distributed:
         True if using DDP training. False otherwise.
       params:
@@ -180,19 +359,26 @@ def get_dataloader(
     Returns:
       Return a dataloader containing the LM data.
     """
-    lm_data = torch.load(filename)
+    if Path(filename).is_dir():
+        dataset = MmapLmDataset(
+            data_dir=filename,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
+    else:
+        lm_data = torch.load(filename)
 
-    words = lm_data["words"]
-    sentences = lm_data["sentences"]
-    sentence_lengths = lm_data["sentence_lengths"]
-
-    dataset = LmDataset(
-        sentences=sentences,
-        words=words,
-        sentence_lengths=sentence_lengths,
-        max_sent_len=params.max_sent_len,
-        batch_size=params.batch_size,
-    )
+        words = lm_data["words"]
+        sentences = lm_data["sentences"]
+        sentence_lengths = lm_data["sentence_lengths"]
+
+        dataset = LmDataset(
+            sentences=sentences,
+            words=words,
+            sentence_lengths=sentence_lengths,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
     if is_distributed:
         sampler = DistributedSampler(dataset, shuffle=True, drop_last=True)
     else:
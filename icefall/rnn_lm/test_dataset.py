@@ -15,9 +15,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+from pathlib import Path
+
 import k2
 import torch
-from rnn_lm.dataset import LmDataset, LmDatasetCollate
+from rnn_lm.dataset import (
+    LmDataset,
+    LmDatasetCollate,
+    MmapLmDataset,
+    save_lm_data_as_mmap,
+)
 
 
 def main():
@@ -66,6 +74,26 @@ def main():
         print(i)
     # I've checked the output manually; the output is as expected.
 
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = Path(tmp_dir) / "sorted_lm_data.pt"
+        torch.save(
+            {
+                "words": words,
+                "sentences": sentences,
+                "sentence_lengths": sentence_lengths,
+            },
+            filename,
+        )
+        save_lm_data_as_mmap(filename, Path(tmp_dir) / "mmap", chunk_size=4)
+        mmap_dataset = MmapLmDataset(
+            Path(tmp_dir) / "mmap",
+            max_sent_len=3,
+            batch_size=4,
+        )
+        assert len(mmap_dataset) == len(dataset), (len(mmap_dataset), len(dataset))
+        for i in range(len(dataset)):
+            assert mmap_dataset[i] == dataset[i], (i, mmap_dataset[i], dataset[i])
+
 
 if __name__ == "__main__":
     main()
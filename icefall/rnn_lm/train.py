@@ -135,14 +135,16 @@ def get_parser():
         "--lm-data",
         type=str,
         default="data/lm_training_bpe_500/sorted_lm_data.pt",
-        help="LM training data",
+        help="""LM training data. It can also be a directory created by
+        save_lm_data_as_mmap() in ./dataset.py, which is memory-mapped
+        instead of loaded into memory.""",
     )
 
     parser.add_argument(
         "--lm-data-valid",
         type=str,
         default="data/lm_training_bpe_500/sorted_lm_data-valid.pt",
-        help="LM validation data",
+        help="LM validation data. See also --lm-data.",
     )
 
     parser.add_argument(
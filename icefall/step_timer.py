@@ -0,0 +1,290 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-phase timing of training steps.
+
+:class:`StepTimer` measures how long each phase of a training step takes,
+e.g., waiting for data, the forward pass, the backward pass and the
+optimizer step. On CUDA, a phase is timed with a pair of CUDA events, so
+the time of the kernels it launches is measured without synchronizing the
+device after each phase. The events are read only when a summary is
+requested, e.g., every `log_interval` batches. On CPU, `time.perf_counter`
+is used.
+
+:class:`TorchProfilerWindow` runs ``torch.profiler`` for a few consecutive
+steps and exports the trace, which can be viewed with TensorBoard or
+chrome://tracing.
+
+Usage::
+
+    timer = StepTimer(device)
+    for batch in train_dl:
+        with timer.phase("forward"):
+            loss = model(batch)
+        with timer.phase("backward"):
+            loss.backward()
+        timer.step()
+        if batch_idx % log_interval == 0:
+            timer.log(tb_writer, batch_idx)
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+
+
+class StepTimer(object):
+    def __init__(
+        self,
+        device: Union[str, torch.device] = "cpu",
+        enabled: bool = True,
+    ) -> None:
+        """
+        Args:
+          device:
+            The device the training runs on. CUDA events are used if it is a
+            CUDA device.
+          enabled:
+            If False, all methods are no-ops.
+        """
+        device = torch.device(device)
+        self.enabled = enabled
+        self.use_cuda = enabled and device.type == "cuda"
+
+        # Phases whose end has been recorded but which are not read yet.
+        # Each entry is (name, start, end), where start and end are
+        # CUDA events or values of time.perf_counter().
+        self._pending: List[Tuple[str, object, object]] = []
+        # Total time in ms of each phase since the last reset
+        self._totals: Dict[str, float] = OrderedDict()
+        self._num_steps = 0
+        self._last_step_time: Optional[float] = None
+
+    def _record(self) -> object:
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed_ms(self, start: object, end: object) -> float:
+        if self.use_cuda:
+            return start.elapsed_time(end)
+        return (end - start) * 1000.0
+
+    def _add(self, name: str, ms: float) -> None:
+        self._totals[name] = self._totals.get(name, 0.0) + ms
+
+    @contextmanager
+    def phase(self, name: str):
+        """A context manager that times the code in its body as the phase
+        `name`. Phases may be nested; the time of a nested phase is also
+        part of the time of the enclosing one."""
+        if not self.enabled:
+            yield
+            return
+        # Reserve the slot now so that phases are reported in the order
+        # they start.
+        self._totals.setdefault(name, 0.0)
+        start = self._record()
+        try:
+            yield
+        finally:
+            self._pending.append((name, start, self._record()))
+
+    def add_host_time(self, name: str, seconds: float) -> None:
+        """Add a duration measured on the host, e.g., the time spent
+        waiting for the dataloader, to the phase `name`."""
+        if self.enabled:
+            self._add(name, seconds * 1000.0)
+
+    def time_method(self, obj: object, method: str, name: str) -> None:
+        """Time every call of `obj.method` as the phase `name`. This is for
+        methods of a module that are not modules themselves, e.g.,
+        `forward_transducer` of the model, which computes the loss."""
+        if not self.enabled:
+            return
+        fn = getattr(obj, method)
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+
+        setattr(obj, method, wrapper)
+
+    def _read_pending(self, block: bool) -> None:
+        """Add the time of pending phases to the totals. If block is False,
+        only phases whose end event has completed are read."""
+        if self.use_cuda and block and self._pending:
+            # Events are recorded on the same stream, so the last one
+            # completes after all others.
+            self._pending[-1][2].synchronize()
+
+        num_read = 0
+        for name, start, end in self._pending:
+            if self.use_cuda and not block and not end.query():
+                break
+            self._add(name, self._elapsed_ms(start, end))
+            num_read += 1
+        del self._pending[:num_read]
+
+    def start(self) -> None:
+        """Start the wall clock of the next step, e.g., at the start of an
+        epoch, so that the time between epochs is not counted."""
+        self._last_step_time = time.perf_counter()
+
+    @contextmanager
+    def pause(self):
+        """A context manager that excludes the code in its body, e.g.,
+        computing the validation loss, from all phases."""
+        enabled = self.enabled
+        self.enabled = False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+            if enabled:
+                self.start()
+
+    def step(self) -> None:
+        """Mark the end of a training step."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._last_step_time is not None:
+            self._add("step", (now - self._last_step_time) * 1000.0)
+        self._last_step_time = now
+        self._num_steps += 1
+        # Keep the list of pending events short without waiting for them.
+        self._read_pending(block=False)
+
+    def summary(self, reset: bool = True) -> Dict[str, float]:
+        """Return the average time in ms per step of each phase since the
+        last reset. The entry "step" is the wall time of a whole step."""
+        if not self.enabled:
+            return {}
+        self._read_pending(block=True)
+        num_steps = max(self._num_steps, 1)
+        ans = OrderedDict((k, v / num_steps) for k, v in self._totals.items())
+        if "step" in ans:
+            # Report the wall time of the whole step last
+            ans.move_to_end("step")
+        if reset:
+            self._totals = OrderedDict((k, 0.0) for k in self._totals)
+            self._num_steps = 0
+        return ans
+
+    def log(
+        self,
+        tb_writer: Optional["SummaryWriter"] = None,  # noqa
+        global_step: Optional[int] = None,
+        prefix: str = "train/time_ms_",
+    ) -> Dict[str, float]:
+        """Write the summary to the log and to tensorboard, and reset the
+        totals. Return the summary."""
+        stats = self.summary(reset=True)
+        if not stats:
+            return stats
+        s = ", ".join(f"{k}: {v:.1f}" for k, v in stats.items())
+        logging.info(f"Time per batch in ms: {s}")
+        if tb_writer is not None:
+            for k, v in stats.items():
+                tb_writer.add_scalar(prefix + k, v, global_step)
+        return stats
+
+
+class TorchProfilerWindow(object):
+    def __init__(
+        self,
+        start: int,
+        num_steps: int,
+        out_dir: Union[str, Path],
+        warmup: int = 1,
+    ) -> None:
+        """
+        Run ``torch.profiler`` for `num_steps` steps after `warmup` steps
+        starting from step `start`, and export the trace to `out_dir` in a
+        format that TensorBoard can read.
+
+        Args:
+          start:
+            The first global step to profile. If training resumes after
+            it, the next step is used instead. If it is not positive, the
+            profiler is disabled.
+          num_steps:
+            The number of steps to record.
+          out_dir:
+            The directory of the exported traces.
+          warmup:
+            The number of steps run with the profiler before recording, to
+            exclude its start-up overhead.
+        """
+        self.start = start
+        self.num_steps = num_steps
+        self.warmup = warmup
+        self.out_dir = Path(out_dir)
+        self.prof: Optional[torch.profiler.profile] = None
+        self.done = start <= 0 or num_steps <= 0
+
+    def step(self, global_step: int) -> None:
+        """Call it at the end of each step with the global step of the step
+        that has just finished."""
+        if self.done:
+            return
+
+        if self.prof is None:
+            if global_step + 1 < self.start:
+                return
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            # Steps are counted from the one after global_step
+            self.start = global_step + 1
+            logging.info(
+                f"Profiling steps {self.start} to "
+                f"{self.start + self.warmup + self.num_steps - 1}, "
+                f"traces are saved to {self.out_dir}"
+            )
+            self.prof = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    wait=0, warmup=self.warmup, active=self.num_steps, repeat=1
+                ),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    str(self.out_dir)
+                ),
+                record_shapes=True,
+                with_stack=False,
+            )
+            self.prof.start()
+            return
+
+        self.prof.step()
+        if global_step + 1 >= self.start + self.warmup + self.num_steps:
+            self.stop()
+
+    def stop(self) -> None:
+        """Stop the profiler if it is running. It is not started again."""
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
+            self.done = True
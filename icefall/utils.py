@@ -27,6 +27,7 @@ import random
 import re
 import subprocess
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
@@ -36,7 +37,6 @@ from typing import Dict, Iterable, List, Optional, TextIO, Tuple, Union
 
 import k2
 import k2.version
-import kaldialign
 import sentencepiece as spm
 import torch
 import torch.distributed as dist
@@ -47,6 +47,7 @@ from pypinyin.contrib.tone_convert import to_finals, to_finals_tone, to_initials
 from torch.utils.tensorboard import SummaryWriter
 
 from icefall.checkpoint import average_checkpoints
+from icefall.error_stats import ERR, ErrorCounts, ErrorStatsScorer
 
 Pathlike = Union[str, Path]
 
@@ -591,6 +592,7 @@ def write_error_stats(
     enable_log: bool = True,
     compute_CER: bool = False,
     sclite_mode: bool = False,
+    num_workers: int = 0,
 ) -> float:
     """Write statistics based on predicted results and reference transcripts.
 
@@ -623,19 +625,13 @@ def write_error_stats(
       enable_log:
         If True, also print detailed WER to the console.
         Otherwise, it is written only to the given file.
+      num_workers:
+        If positive, align the utterances in this number of processes.
+        See also :class:`icefall.error_stats.ErrorStatsScorer`, which
+        accepts results incrementally.
     Returns:
-      Return None.
+      Return the WER in percent.
     """
-    subs: Dict[Tuple[str, str], int] = defaultdict(int)
-    ins: Dict[str, int] = defaultdict(int)
-    dels: Dict[str, int] = defaultdict(int)
-
-    # `words` stores counts per word, as follows:
-    #   corr, ref_sub, hyp_sub, ins, dels
-    words: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0, 0, 0])
-    num_corr = 0
-    ERR = "*"
-
     if compute_CER:
         for i, res in enumerate(results):
             cut_id, ref, hyp = res
@@ -643,116 +639,14 @@ def write_error_stats(
             hyp = list("".join(hyp))
             results[i] = (cut_id, ref, hyp)
 
-    for cut_id, ref, hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR, sclite_mode=sclite_mode)
-        for ref_word, hyp_word in ali:
-            if ref_word == ERR:
-                ins[hyp_word] += 1
-                words[hyp_word][3] += 1
-            elif hyp_word == ERR:
-                dels[ref_word] += 1
-                words[ref_word][4] += 1
-            elif hyp_word != ref_word:
-                subs[(ref_word, hyp_word)] += 1
-                words[ref_word][1] += 1
-                words[hyp_word][2] += 1
-            else:
-                words[ref_word][0] += 1
-                num_corr += 1
-    ref_len = sum([len(r) for _, r, _ in results])
-    sub_errs = sum(subs.values())
-    ins_errs = sum(ins.values())
-    del_errs = sum(dels.values())
-    tot_errs = sub_errs + ins_errs + del_errs
-    tot_err_rate = "%.2f" % (100.0 * tot_errs / ref_len)
-
-    if enable_log:
-        logging.info(
-            f"[{test_set_name}] %WER {tot_errs / ref_len:.2%} "
-            f"[{tot_errs} / {ref_len}, {ins_errs} ins, "
-            f"{del_errs} del, {sub_errs} sub ]"
-        )
-
-    print(f"%WER = {tot_err_rate}", file=f)
-    print(
-        f"Errors: {ins_errs} insertions, {del_errs} deletions, "
-        f"{sub_errs} substitutions, over {ref_len} reference "
-        f"words ({num_corr} correct)",
-        file=f,
-    )
-    print(
-        "Search below for sections starting with PER-UTT DETAILS:, "
-        "SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
-        file=f,
-    )
-
-    print("", file=f)
-    print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
-    for cut_id, ref, hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR)
-        combine_successive_errors = True
-        if combine_successive_errors:
-            ali = [[[x], [y]] for x, y in ali]
-            for i in range(len(ali) - 1):
-                if ali[i][0] != ali[i][1] and ali[i + 1][0] != ali[i + 1][1]:
-                    ali[i + 1][0] = ali[i][0] + ali[i + 1][0]
-                    ali[i + 1][1] = ali[i][1] + ali[i + 1][1]
-                    ali[i] = [[], []]
-            ali = [
-                [
-                    list(filter(lambda a: a != ERR, x)),
-                    list(filter(lambda a: a != ERR, y)),
-                ]
-                for x, y in ali
-            ]
-            ali = list(filter(lambda x: x != [[], []], ali))
-            ali = [
-                [
-                    ERR if x == [] else " ".join(x),
-                    ERR if y == [] else " ".join(y),
-                ]
-                for x, y in ali
-            ]
-
-        print(
-            f"{cut_id}:\t"
-            + " ".join(
-                (
-                    ref_word if ref_word == hyp_word else f"({ref_word}->{hyp_word})"
-                    for ref_word, hyp_word in ali
-                )
-            ),
-            file=f,
-        )
-
-    print("", file=f)
-    print("SUBSTITUTIONS: count ref -> hyp", file=f)
-
-    for count, (ref, hyp) in sorted([(v, k) for k, v in subs.items()], reverse=True):
-        print(f"{count}   {ref} -> {hyp}", file=f)
-
-    print("", file=f)
-    print("DELETIONS: count ref", file=f)
-    for count, ref in sorted([(v, k) for k, v in dels.items()], reverse=True):
-        print(f"{count}   {ref}", file=f)
-
-    print("", file=f)
-    print("INSERTIONS: count hyp", file=f)
-    for count, hyp in sorted([(v, k) for k, v in ins.items()], reverse=True):
-        print(f"{count}   {hyp}", file=f)
-
-    print("", file=f)
-    print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
-    for _, word, counts in sorted(
-        [(sum(v[1:]), k, v) for k, v in words.items()], reverse=True
-    ):
-        (corr, ref_sub, hyp_sub, ins, dels) = counts
-        tot_errs = ref_sub + hyp_sub + ins + dels
-        ref_count = corr + ref_sub + dels
-        hyp_count = corr + hyp_sub + ins
-
-        print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
-    return float(tot_err_rate)
+    executor = ProcessPoolExecutor(num_workers) if num_workers > 0 else None
+    try:
+        scorer = ErrorStatsScorer(executor=executor, sclite_mode=sclite_mode)
+        scorer.add(results)
+        return scorer.write(f, test_set_name, enable_log=enable_log)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 
 def write_error_stats_with_timestamps(
@@ -808,68 +702,42 @@ def write_error_stats_with_timestamps(
     Returns:
       Return total word error rate and mean delay.
     """
-    subs: Dict[Tuple[str, str], int] = defaultdict(int)
-    ins: Dict[str, int] = defaultdict(int)
-    dels: Dict[str, int] = defaultdict(int)
-
-    # `words` stores counts per word, as follows:
-    #   corr, ref_sub, hyp_sub, ins, dels
-    words: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0, 0, 0])
-    num_corr = 0
-    ERR = "*"
+    counts = ErrorCounts()
     # Compute mean alignment delay on the correct words
     all_delay = []
     for cut_id, ref, hyp, time_ref, time_hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR)
+        ali = counts.add(cut_id, ref, hyp)
         has_time = len(time_ref) > 0 and len(time_hyp) > 0
-        if has_time:
-            # pointer to timestamp_hyp
-            p_hyp = 0
-            # pointer to timestamp_ref
-            p_ref = 0
+        if not has_time:
+            continue
+        # pointer to timestamp_hyp
+        p_hyp = 0
+        # pointer to timestamp_ref
+        p_ref = 0
         for ref_word, hyp_word in ali:
             if ref_word == ERR:
-                ins[hyp_word] += 1
-                words[hyp_word][3] += 1
-                if has_time:
-                    p_hyp += 1
+                p_hyp += 1
             elif hyp_word == ERR:
-                dels[ref_word] += 1
-                words[ref_word][4] += 1
-                if has_time:
-                    p_ref += 1
+                p_ref += 1
             elif hyp_word != ref_word:
-                subs[(ref_word, hyp_word)] += 1
-                words[ref_word][1] += 1
-                words[hyp_word][2] += 1
-                if has_time:
-                    p_hyp += 1
-                    p_ref += 1
+                p_hyp += 1
+                p_ref += 1
             else:
-                words[ref_word][0] += 1
-                num_corr += 1
-                if has_time:
-                    if with_end_time:
-                        all_delay.append(
-                            (
-                                time_hyp[p_hyp][0] - time_ref[p_ref][0],
-                                time_hyp[p_hyp][1] - time_ref[p_ref][1],
-                            )
+                if with_end_time:
+                    all_delay.append(
+                        (
+                            time_hyp[p_hyp][0] - time_ref[p_ref][0],
+                            time_hyp[p_hyp][1] - time_ref[p_ref][1],
                         )
-                    else:
-                        all_delay.append(time_hyp[p_hyp] - time_ref[p_ref])
-                    p_hyp += 1
-                    p_ref += 1
-        if has_time:
-            assert p_hyp == len(hyp), (p_hyp, len(hyp))
-            assert p_ref == len(ref), (p_ref, len(ref))
-
-    ref_len = sum([len(r) for _, r, _, _, _ in results])
-    sub_errs = sum(subs.values())
-    ins_errs = sum(ins.values())
-    del_errs = sum(dels.values())
-    tot_errs = sub_errs + ins_errs + del_errs
-    tot_err_rate = float("%.2f" % (100.0 * tot_errs / ref_len))
+                    )
+                else:
+                    all_delay.append(time_hyp[p_hyp] - time_ref[p_ref])
+                p_hyp += 1
+                p_ref += 1
+        assert p_hyp == len(hyp), (p_hyp, len(hyp))
+        assert p_ref == len(ref), (p_ref, len(ref))
+
+    tot_err_rate = float(counts.tot_err_rate)
 
     if with_end_time:
         mean_delay = (float("inf"), float("inf"))
@@ -904,24 +772,15 @@ def write_error_stats_with_timestamps(
             var_delay = float("%.3f" % var_delay)
 
     if enable_log:
-        logging.info(
-            f"[{test_set_name}] %WER {tot_errs / ref_len:.2%} "
-            f"[{tot_errs} / {ref_len}, {ins_errs} ins, "
-            f"{del_errs} del, {sub_errs} sub ]"
-        )
+        counts.log(test_set_name)
         logging.info(
             f"[{test_set_name}] %symbol-delay mean (s): "
             f"{mean_delay}, variance: {var_delay} "  # noqa
             f"computed on {num_delay} correct words"
         )
 
-    print(f"%WER = {tot_err_rate}", file=f)
-    print(
-        f"Errors: {ins_errs} insertions, {del_errs} deletions, "
-        f"{sub_errs} substitutions, over {ref_len} reference "
-        f"words ({num_corr} correct)",
-        file=f,
-    )
+    # Printed as a float, e.g., 60.0 instead of 60.00
+    counts.write_summary(f, tot_err_rate=tot_err_rate)
     print(
         "Search below for sections starting with PER-UTT DETAILS:, "
         "SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
@@ -930,70 +789,8 @@ def write_error_stats_with_timestamps(
 
     print("", file=f)
     print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
-    for cut_id, ref, hyp, _, _ in results:
-        ali = kaldialign.align(ref, hyp, ERR)
-        combine_successive_errors = True
-        if combine_successive_errors:
-            ali = [[[x], [y]] for x, y in ali]
-            for i in range(len(ali) - 1):
-                if ali[i][0] != ali[i][1] and ali[i + 1][0] != ali[i + 1][1]:
-                    ali[i + 1][0] = ali[i][0] + ali[i + 1][0]
-                    ali[i + 1][1] = ali[i][1] + ali[i + 1][1]
-                    ali[i] = [[], []]
-            ali = [
-                [
-                    list(filter(lambda a: a != ERR, x)),
-                    list(filter(lambda a: a != ERR, y)),
-                ]
-                for x, y in ali
-            ]
-            ali = list(filter(lambda x: x != [[], []], ali))
-            ali = [
-                [
-                    ERR if x == [] else " ".join(x),
-                    ERR if y == [] else " ".join(y),
-                ]
-                for x, y in ali
-            ]
-
-        print(
-            f"{cut_id}:\t"
-            + " ".join(
-                (
-                    ref_word if ref_word == hyp_word else f"({ref_word}->{hyp_word})"
-                    for ref_word, hyp_word in ali
-                )
-            ),
-            file=f,
-        )
-
-    print("", file=f)
-    print("SUBSTITUTIONS: count ref -> hyp", file=f)
-
-    for count, (ref, hyp) in sorted([(v, k) for k, v in subs.items()], reverse=True):
-        print(f"{count}   {ref} -> {hyp}", file=f)
-
-    print("", file=f)
-    print("DELETIONS: count ref", file=f)
-    for count, ref in sorted([(v, k) for k, v in dels.items()], reverse=True):
-        print(f"{count}   {ref}", file=f)
-
-    print("", file=f)
-    print("INSERTIONS: count hyp", file=f)
-    for count, hyp in sorted([(v, k) for k, v in ins.items()], reverse=True):
-        print(f"{count}   {hyp}", file=f)
-
-    print("", file=f)
-    print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
-    for _, word, counts in sorted(
-        [(sum(v[1:]), k, v) for k, v in words.items()], reverse=True
-    ):
-        (corr, ref_sub, hyp_sub, ins, dels) = counts
-        tot_errs = ref_sub + hyp_sub + ins + dels
-        ref_count = corr + ref_sub + dels
-        hyp_count = corr + hyp_sub + ins
-
-        print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
+    counts.write_utt_details(f)
+    counts.write_word_stats(f)
     return float(tot_err_rate), float(mean_delay), float(var_delay)
 
 
@@ -1021,25 +818,7 @@ def write_surt_error_stats(
     """
     from meeteval.wer import wer
 
-    subs: Dict[Tuple[str, str], int] = defaultdict(int)
-    ins: Dict[str, int] = defaultdict(int)
-    dels: Dict[str, int] = defaultdict(int)
-    ref_lens: List[int] = []
-
-    print(
-        "Search below for sections starting with PER-UTT DETAILS:, "
-        "SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
-        file=f,
-    )
-
-    print("", file=f)
-    print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
-
-    # `words` stores counts per word, as follows:
-    #   corr, ref_sub, hyp_sub, ins, dels
-    words: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0, 0, 0])
-    num_corr = 0
-    ERR = "*"
+    counts = ErrorCounts()
     for cut_id, ref, hyp in results:
         # First compute the optimal assignment of references to output channels
         orc_wer = wer.orc_word_error_rate(ref, hyp)
@@ -1051,112 +830,26 @@ def write_surt_error_stats(
         hyps = [hyp_text.split() for hyp_text in hyp]
         # Now compute the WER for each channel
         for ref_c, hyp_c in zip(refs, hyps):
-            ref_lens.append(len(ref_c))
-            ali = kaldialign.align(ref_c, hyp_c, ERR)
-            for ref_word, hyp_word in ali:
-                if ref_word == ERR:
-                    ins[hyp_word] += 1
-                    words[hyp_word][3] += 1
-                elif hyp_word == ERR:
-                    dels[ref_word] += 1
-                    words[ref_word][4] += 1
-                elif hyp_word != ref_word:
-                    subs[(ref_word, hyp_word)] += 1
-                    words[ref_word][1] += 1
-                    words[hyp_word][2] += 1
-                else:
-                    words[ref_word][0] += 1
-                    num_corr += 1
-            combine_successive_errors = True
-            if combine_successive_errors:
-                ali = [[[x], [y]] for x, y in ali]
-                for i in range(len(ali) - 1):
-                    if ali[i][0] != ali[i][1] and ali[i + 1][0] != ali[i + 1][1]:
-                        ali[i + 1][0] = ali[i][0] + ali[i + 1][0]
-                        ali[i + 1][1] = ali[i][1] + ali[i + 1][1]
-                        ali[i] = [[], []]
-                ali = [
-                    [
-                        list(filter(lambda a: a != ERR, x)),
-                        list(filter(lambda a: a != ERR, y)),
-                    ]
-                    for x, y in ali
-                ]
-                ali = list(filter(lambda x: x != [[], []], ali))
-                ali = [
-                    [
-                        ERR if x == [] else " ".join(x),
-                        ERR if y == [] else " ".join(y),
-                    ]
-                    for x, y in ali
-                ]
-
-            print(
-                f"{cut_id}:\t"
-                + " ".join(
-                    (
-                        (
-                            ref_word
-                            if ref_word == hyp_word
-                            else f"({ref_word}->{hyp_word})"
-                        )
-                        for ref_word, hyp_word in ali
-                    )
-                ),
-                file=f,
-            )
-    ref_len = sum(ref_lens)
-    sub_errs = sum(subs.values())
-    ins_errs = sum(ins.values())
-    del_errs = sum(dels.values())
-    tot_errs = sub_errs + ins_errs + del_errs
-    tot_err_rate = "%.2f" % (100.0 * tot_errs / ref_len)
+            counts.add(cut_id, ref_c, hyp_c)
 
-    if enable_log:
-        logging.info(
-            f"[{test_set_name}] %WER {tot_errs / ref_len:.2%} "
-            f"[{tot_errs} / {ref_len}, {ins_errs} ins, "
-            f"{del_errs} del, {sub_errs} sub ]"
-        )
-
-    print(f"%WER = {tot_err_rate}", file=f)
     print(
-        f"Errors: {ins_errs} insertions, {del_errs} deletions, "
-        f"{sub_errs} substitutions, over {ref_len} reference "
-        f"words ({num_corr} correct)",
+        "Search below for sections starting with PER-UTT DETAILS:, "
+        "SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
         file=f,
     )
 
     print("", file=f)
-    print("SUBSTITUTIONS: count ref -> hyp", file=f)
-
-    for count, (ref, hyp) in sorted([(v, k) for k, v in subs.items()], reverse=True):
-        print(f"{count}   {ref} -> {hyp}", file=f)
+    print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
+    counts.write_utt_details(f)
 
-    print("", file=f)
-    print("DELETIONS: count ref", file=f)
-    for count, ref in sorted([(v, k) for k, v in dels.items()], reverse=True):
-        print(f"{count}   {ref}", file=f)
+    if enable_log:
+        counts.log(test_set_name)
 
-    print("", file=f)
-    print("INSERTIONS: count hyp", file=f)
-    for count, hyp in sorted([(v, k) for k, v in ins.items()], reverse=True):
-        print(f"{count}   {hyp}", file=f)
+    counts.write_summary(f)
+    counts.write_word_stats(f)
 
-    print("", file=f)
-    print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
-    for _, word, counts in sorted(
-        [(sum(v[1:]), k, v) for k, v in words.items()], reverse=True
-    ):
-        (corr, ref_sub, hyp_sub, ins, dels) = counts
-        tot_errs = ref_sub + hyp_sub + ins + dels
-        ref_count = corr + ref_sub + dels
-        hyp_count = corr + hyp_sub + ins
-
-        print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
-
-    print(f"%WER = {tot_err_rate}", file=f)
-    return float(tot_err_rate)
+    print(f"%WER = {counts.tot_err_rate}", file=f)
+    return float(counts.tot_err_rate)
 
 
 class MetricsTracker(collections.defaultdict):
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Copyright      2024  Xiaomi Corp.
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import random
+
+import torch
+from lhotse import CutSet
+from lhotse.testing.dummies import dummy_cut
+
+from icefall.batch_tuner import (
+    BucketedDynamicBucketingSampler,
+    MemoryModel,
+    split_batch,
+    tune_max_durations,
+)
+
+
+def _make_cuts(num_cuts: int = 200) -> CutSet:
+    rng = random.Random(0)
+    return CutSet.from_cuts(
+        dummy_cut(i, duration=round(rng.uniform(1.0, 20.0), 2), with_data=False)
+        for i in range(num_cuts)
+    )
+
+
+def test_memory_model_fit():
+    expected = MemoryModel([1e9, 2e6, 1e5, 3e4])
+    probes = []
+    for seconds, length, tokens in [
+        (50, 2, 400),
+        (100, 2, 900),
+        (50, 10, 300),
+        (100, 10, 700),
+        (80, 20, 500),
+    ]:
+        probes.append((seconds, length, tokens, expected(seconds, length, tokens)))
+    model = MemoryModel.fit(probes)
+    for c, e in zip(model.coefs, expected.coefs):
+        assert abs(c - e) <= 1e-6 * abs(e), (model, expected)
+
+    # Coefficients are not negative
+    probes = [(s, l, t, p - 1e5 * t) for s, l, t, p in probes]
+    model = MemoryModel.fit(probes)
+    assert all(c >= 0 for c in model.coefs), model
+
+    budget = 2e9
+    max_duration = expected.max_duration(length=10, tokens_per_second=8, budget=budget)
+    assert abs(expected(max_duration, 10, 8 * max_duration) - budget) < 1
+
+
+def test_tune_max_durations():
+    cuts = _make_cuts()
+    duration_bins = [5.0, 10.0, 15.0]
+    expected = MemoryModel([1e9, 2e6, 1e5, 3e4])
+
+    def num_tokens(cut):
+        return int(cut.duration * 5)
+
+    def peak_memory(batch_cuts):
+        seconds = sum(c.duration for c in batch_cuts)
+        length = max(c.duration for c in batch_cuts)
+        tokens = sum(num_tokens(c) for c in batch_cuts)
+        return expected(seconds, length, tokens)
+
+    budget = 2e9
+    max_durations, model = tune_max_durations(
+        cuts,
+        duration_bins=duration_bins,
+        peak_memory_fn=peak_memory,
+        num_tokens_fn=num_tokens,
+        budget=budget,
+        probe_durations=[30.0, 60.0],
+    )
+    assert len(max_durations) == len(duration_bins) + 1
+    # Longer cuts need more memory per second
+    assert max_durations == sorted(max_durations, reverse=True), max_durations
+    for length, max_duration in zip(duration_bins, max_durations):
+        peak = expected(max_duration, length, 5 * max_duration)
+        assert abs(peak - budget) < 1e-3 * budget, (length, max_duration, peak)
+
+
+def test_bucketed_sampler():
+    cuts = _make_cuts()
+    duration_bins = [5.0, 10.0, 15.0]
+    max_durations = [40.0, 30.0, 20.0, 20.0]
+    sampler = BucketedDynamicBucketingSampler(
+        cuts,
+        duration_bins=duration_bins,
+        max_durations=max_durations,
+        shuffle=True,
+        buffer_size=1000,
+        seed=0,
+    )
+    batches = [batch for batch in sampler]
+    assert sum(len(b) for b in batches) == len(cuts)
+    for b in batches:
+        longest = max(c.duration for c in b)
+        bucket = sampler.constraint.bucket_of(longest)
+        assert sum(c.duration for c in b) <= max_durations[bucket] or len(b) == 1
+
+    # Lowering the maximum duration of a bucket affects later batches
+    sampler.constraint.back_off(longest=3.0, total=10.0, factor=0.5)
+    assert sampler.constraint.max_durations[0] == 5.0
+    for b in sampler:
+        if max(c.duration for c in b) <= 5.0:
+            assert sum(c.duration for c in b) <= 5.0 or len(b) == 1
+
+    # The maximum durations are saved with the sampler
+    sampler.set_epoch(1)
+    iter(sampler)
+    next(sampler)
+    sd = sampler.state_dict()
+    assert sd["max_durations"] == [5.0, 30.0, 20.0, 20.0]
+
+    restored = BucketedDynamicBucketingSampler(
+        cuts,
+        duration_bins=duration_bins,
+        max_durations=max_durations,
+        shuffle=True,
+        buffer_size=1000,
+        seed=0,
+    )
+    restored.load_state_dict(sd)
+    assert restored.constraint.max_durations == [5.0, 30.0, 20.0, 20.0]
+
+    def remaining_batches(s):
+        ans = []
+        while True:
+            try:
+                ans.append(list(next(s).ids))
+            except StopIteration:
+                return ans
+
+    assert remaining_batches(restored) == remaining_batches(sampler)
+
+
+def test_split_batch():
+    num_frames = torch.tensor([10, 8, 7, 3, 2])
+    batch = {
+        "inputs": torch.rand(5, 10, 4),
+        "supervisions": {
+            "sequence_idx": torch.arange(5),
+            "start_frame": torch.zeros(5, dtype=torch.int),
+            "num_frames": num_frames,
+            "text": ["a", "b", "c", "d", "e"],
+        },
+    }
+    splits = split_batch(batch, num_splits=2)
+    assert len(splits) == 2
+    assert [s["supervisions"]["text"] for s in splits] == [
+        ["a", "b"],
+        ["c", "d", "e"],
+    ]
+    assert splits[1]["inputs"].shape == (3, 7, 4)
+    assert torch.equal(splits[1]["inputs"], batch["inputs"][2:, :7])
+    assert splits[1]["supervisions"]["sequence_idx"].tolist() == [0, 1, 2]
+    assert splits[1]["supervisions"]["num_frames"].tolist() == [7, 3, 2]
+
+    # No more splits than sequences
+    assert len(split_batch(batch, num_splits=8)) == 5
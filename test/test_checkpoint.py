@@ -20,7 +20,15 @@ import pytest
 import torch
 import torch.nn as nn
 
-from icefall.checkpoint import average_checkpoints, load_checkpoint, save_checkpoint
+from icefall.checkpoint import (
+    AsyncCheckpointWriter,
+    average_checkpoints,
+    average_checkpoints_mmap,
+    load_checkpoint,
+    remove_checkpoints,
+    save_checkpoint,
+    save_checkpoint_with_global_batch_idx,
+)
 
 
 @pytest.fixture
@@ -61,3 +69,34 @@ def test_average_checkpoints(checkpoints1, checkpoints2):
     state_dict = average_checkpoints([checkpoints1, checkpoints2])
     assert torch.allclose(state_dict["p1"], torch.Tensor([30, 25.0]))
     assert torch.allclose(state_dict["p2"], torch.tensor([5, 51]))
+
+
+def test_average_checkpoints_mmap(checkpoints1, checkpoints2):
+    state_dict = average_checkpoints_mmap([checkpoints1, checkpoints2])
+    assert state_dict["p1"].dtype == torch.float32
+    assert torch.allclose(state_dict["p1"], torch.Tensor([30, 25.0]))
+    assert torch.equal(state_dict["p2"], torch.tensor([5, 51]))
+
+
+def test_async_checkpoint_writer(tmp_path):
+    m = nn.Module()
+    m.p1 = nn.Parameter(torch.tensor([10.0, 20.0]))
+
+    writer = AsyncCheckpointWriter()
+    for i in range(1, 4):
+        save_checkpoint_with_global_batch_idx(
+            tmp_path, i, m, params={"a": i}, async_writer=writer
+        )
+        # Changes after save_checkpoint() returns must not affect the file
+        with torch.no_grad():
+            m.p1.add_(1)
+        writer.submit(remove_checkpoints, out_dir=tmp_path, topk=2)
+    writer.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "checkpoint-2.pt",
+        "checkpoint-3.pt",
+    ]
+    checkpoint = torch.load(tmp_path / "checkpoint-3.pt")
+    assert torch.allclose(checkpoint["model"]["p1"], torch.Tensor([12.0, 22.0]))
+    assert checkpoint["a"] == 3
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import torch
+
+from icefall.decode import ctc_prefix_beam_search, ctc_prefix_beam_search_batch
+
+
+def test_ctc_prefix_beam_search_batch():
+    torch.manual_seed(20240101)
+    for beam in [1, 4, 8]:
+        log_probs = torch.randn(3, 20, 10).log_softmax(dim=-1)
+        log_probs_length = torch.tensor([20, 13, 1])
+
+        expected = ctc_prefix_beam_search(log_probs, log_probs_length, beam=beam)
+        hyps = ctc_prefix_beam_search_batch(log_probs, log_probs_length, beam=beam)
+        assert hyps == expected, (beam, hyps, expected)
+
+
+def test_ctc_prefix_beam_search_batch_timestamps():
+    log_probs = torch.tensor(
+        [
+            [
+                [10, 1, 2, 1],
+                [1, 10, 2, 2],
+                [1, 10, 2, 2],
+                [10, 1, 2, 1],
+                [1, 10, 2, 2],
+                [1, 1, 10, 1],
+            ],
+        ],
+        dtype=torch.float32,
+    ).log_softmax(dim=-1)
+    log_probs_length = torch.tensor([6])
+
+    hyps, timestamps = ctc_prefix_beam_search_batch(
+        log_probs, log_probs_length, beam=4, prune_beam=4, return_timestamps=True
+    )
+    assert hyps == [[1, 1, 2]], hyps
+    assert timestamps == [[1, 4, 5]], timestamps
+
+
+if __name__ == "__main__":
+    test_ctc_prefix_beam_search_batch()
+    test_ctc_prefix_beam_search_batch_timestamps()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Copyright      2024  Xiaomi Corp.
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+from icefall.error_stats import ErrorStatsScorer, format_utt_details
+from icefall.utils import write_error_stats, write_error_stats_with_timestamps
+
+
+def _get_results():
+    return [
+        (
+            "a",
+            "THE ASSOCIATION OF EDISON".split(),
+            "THE ASSOCIATION OF ADDISON".split(),
+        ),
+        ("b", "FOR THE FIRST DAY SIR".split(), "FOR THE FIRST DAY".split()),
+        ("c", "HELLO WORLD".split(), "HELLO THERE WORLD".split()),
+        ("d", "A B C".split(), "A B C".split()),
+    ]
+
+
+def test_format_utt_details():
+    ali = [("A", "A"), ("B", "*"), ("C", "D"), ("E", "E")]
+    assert format_utt_details("x", ali) == "x:\tA (B C->D) E"
+
+
+def test_error_stats_scorer():
+    results = _get_results()
+
+    f = io.StringIO()
+    wer = write_error_stats(f, "test", results, enable_log=False)
+    assert wer == 21.43  # 3 errors over 14 words
+    assert "(EDISON->ADDISON)" in f.getvalue()
+
+    with ProcessPoolExecutor(2) as executor:
+        scorer = ErrorStatsScorer(executor=executor, chunk_size=1)
+        for i in range(0, len(results), 3):
+            scorer.add(results[i : i + 3])
+        f2 = io.StringIO()
+        assert scorer.write(f2, "test", enable_log=False) == wer
+    assert f2.getvalue() == f.getvalue()
+
+
+def test_write_error_stats_with_timestamps():
+    results = [
+        (
+            "a",
+            "A B C D E".split(),
+            "A B X".split(),
+            [0.0, 0.5, 1.0, 1.5, 2.0],
+            [0.1, 0.6, 1.1],
+        )
+    ]
+    f = io.StringIO()
+    wer, mean_delay, var_delay = write_error_stats_with_timestamps(
+        f, "test", results, enable_log=False
+    )
+    assert wer == 60.0  # 1 substitution and 2 deletions over 5 words
+    assert mean_delay == 0.1, mean_delay
+    assert f.getvalue().startswith("%WER = 60.0\n"), f.getvalue()
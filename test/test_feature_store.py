@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Copyright      2024  Xiaomi Corp.
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pickle
+
+import numpy as np
+import torch
+from lhotse import CutSet, Fbank, NumpyFilesWriter
+from lhotse.dataset import PrecomputedFeatures
+from lhotse.testing.dummies import dummy_cut
+
+from icefall.feature_store import FeatureStore, FeatureStoreInput, write_feature_store
+
+
+def _make_cuts(feats_dir):
+    cuts = []
+    with NumpyFilesWriter(feats_dir) as storage:
+        for i, duration in enumerate([1.0, 2.5, 0.5, 1.5]):
+            cut = dummy_cut(
+                i, duration=duration, recording_duration=duration, with_data=True
+            )
+            cuts.append(cut.compute_and_store_features(Fbank(), storage=storage))
+    return CutSet.from_cuts(cuts)
+
+
+def test_feature_store(tmp_path):
+    cuts = _make_cuts(tmp_path / "feats")
+    store_dir = tmp_path / "store"
+    # A small shard size to get several shards
+    assert write_feature_store(cuts, store_dir, shard_size=50000) == len(cuts)
+
+    store = FeatureStore(store_dir)
+    assert store.num_shards > 1
+    assert len(store) == len(cuts)
+    assert "missing" not in store
+    for cut in cuts:
+        np.testing.assert_array_equal(store.get(cut.id), cut.load_features())
+
+    store = pickle.loads(pickle.dumps(store))
+    assert cuts[0].id in store
+
+    for pad_direction in ["right", "left"]:
+        expected, expected_lens = PrecomputedFeatures()(cuts, pad_direction)
+        features, features_lens = FeatureStoreInput(store)(cuts, pad_direction)
+        assert torch.equal(features_lens, expected_lens)
+        assert torch.allclose(features, expected)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Copyright      2024  Xiaomi Corp.
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import k2
+import torch
+
+from icefall.graph_cache import GraphCache, hash_files
+
+
+def _make_graph() -> k2.Fsa:
+    s = """
+        0 1 1 10 0.1
+        0 2 2 20 0.2
+        1 3 -1 -1 0.3
+        2 3 -1 -1 0.4
+        3
+    """
+    return k2.arc_sort(k2.Fsa.from_str(s, num_aux_labels=1))
+
+
+def test_hash_files(tmp_path):
+    a = tmp_path / "a.txt"
+    a.write_text("hello")
+    key = hash_files([a], name="HLG")
+    assert key == hash_files([a], name="HLG")
+    assert key != hash_files([a], name="LG")
+
+    a.write_text("world")
+    assert key != hash_files([a], name="HLG")
+
+
+def test_graph_cache(tmp_path):
+    lm = tmp_path / "G.fst.txt"
+    lm.write_text("0 1 1 1 0.5\n1\n")
+
+    num_calls = 0
+
+    def compile_fn():
+        nonlocal num_calls
+        num_calls += 1
+        return _make_graph()
+
+    cache = GraphCache(tmp_path / "cache")
+    for _ in range(2):
+        graph = cache.get_or_compile(name="HLG", filenames=[lm], compile_fn=compile_fn)
+        expected = _make_graph()
+        assert torch.equal(graph.as_dict()["arcs"], expected.as_dict()["arcs"])
+        assert torch.equal(graph.aux_labels, expected.aux_labels)
+        assert graph.properties == expected.properties
+    assert num_calls == 1
+
+    # Changing an input invalidates the cached graph
+    lm.write_text("0 1 2 2 0.5\n1\n")
+    cache.get_or_compile(name="HLG", filenames=[lm], compile_fn=compile_fn)
+    assert num_calls == 2
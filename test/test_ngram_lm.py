@@ -15,6 +15,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
+import tempfile
+
 import graphviz
 
 from icefall import is_module_available
@@ -24,7 +27,7 @@ if not is_module_available("kaldifst"):
 
 import kaldifst
 
-from icefall import NgramLm, NgramLmStateCost
+from icefall import CsrNgramLm, CsrNgramLmStateCost, NgramLm, NgramLmStateCost
 
 
 def generate_fst(filename: str):
@@ -49,6 +52,43 @@ def generate_fst(filename: str):
     source.render(outfile=f"{filename}.svg")
 
 
+def _check_csr_ngram_lm(filename: str):
+    ngram_lm = NgramLm(filename, backoff_id=3, is_binary=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        CsrNgramLm.from_ngram_lm(ngram_lm).save(tmp_dir)
+        csr_ngram_lm = CsrNgramLm.load(tmp_dir)
+
+        label_seqs = [[1, 2, 2], [2, 1, 4], [3, 1, 2], [5, 5, 1]]
+        state_costs = [NgramLmStateCost(ngram_lm) for _ in label_seqs]
+        csr_state_costs = CsrNgramLmStateCost.init(csr_ngram_lm, len(label_seqs))
+        for t in range(3):
+            labels = [seq[t] for seq in label_seqs]
+            state_costs = [s.forward_one_step(i) for s, i in zip(state_costs, labels)]
+            csr_state_costs = csr_state_costs.forward(labels)
+
+            for i, s in enumerate(state_costs):
+                c = csr_state_costs[i]
+                assert sorted(s.state_cost.keys()) == sorted(c.states.tolist())
+                for state, cost in zip(c.states.tolist(), c.costs.tolist()):
+                    assert math.isclose(s.state_cost[state], cost, abs_tol=1e-5)
+                assert math.isclose(s.lm_score, c.lm_score, abs_tol=1e-5)
+
+                # a single hypothesis works like NgramLmStateCost
+                assert math.isclose(
+                    s.forward_one_step(1).lm_score,
+                    c.forward_one_step(1).lm_score,
+                    abs_tol=1e-5,
+                )
+
+        # duplicated indexes
+        selected = csr_state_costs.index_select([3, 0, 3])
+        assert list(selected.lm_scores) == [
+            csr_state_costs[3].lm_score,
+            csr_state_costs[0].lm_score,
+            csr_state_costs[3].lm_score,
+        ]
+
+
 def main():
     filename = "test.fst"
     generate_fst(filename)
@@ -69,6 +109,8 @@ def main():
     s2 = s1.forward_one_step(2)
     print(s2.state_cost)
 
+    _check_csr_ngram_lm(filename)
+
 
 if __name__ == "__main__":
     main()
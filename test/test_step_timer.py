@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Copyright      2024  Xiaomi Corp.
+#
+# See ../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import torch
+
+from icefall.step_timer import StepTimer, TorchProfilerWindow
+
+
+class _Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 4)
+
+    def forward_encoder(self, x):
+        time.sleep(0.01)
+        return self.linear(x)
+
+    def forward(self, x):
+        return self.forward_encoder(x).sum()
+
+
+def test_step_timer():
+    model = _Model()
+    timer = StepTimer("cpu")
+    timer.time_method(model, "forward_encoder", "encoder")
+
+    timer.start()
+    for _ in range(3):
+        timer.add_host_time("data", 0.002)
+        with timer.phase("forward"):
+            loss = model(torch.rand(2, 4))
+        with timer.phase("backward"):
+            loss.backward()
+        timer.step()
+
+    stats = timer.summary()
+    assert list(stats.keys()) == ["data", "forward", "encoder", "backward", "step"]
+    assert abs(stats["data"] - 2.0) < 1e-6
+    assert stats["encoder"] >= 10.0
+    assert stats["forward"] >= stats["encoder"]
+    assert stats["step"] >= stats["forward"]
+
+    # The totals are reset and paused code is not timed
+    with timer.pause():
+        model(torch.rand(2, 4))
+    timer.step()
+    stats = timer.summary()
+    assert stats["encoder"] == 0.0
+    assert stats["step"] < 10.0
+
+
+def test_step_timer_disabled():
+    model = _Model()
+    timer = StepTimer("cpu", enabled=False)
+    timer.time_method(model, "forward_encoder", "encoder")
+    with timer.phase("forward"):
+        model(torch.rand(2, 4))
+    timer.step()
+    assert timer.summary() == {}
+    assert "forward_encoder" not in model.__dict__
+
+
+def test_torch_profiler_window(tmp_path):
+    window = TorchProfilerWindow(start=3, num_steps=2, out_dir=tmp_path, warmup=1)
+    x = torch.rand(8, 8)
+    for step in range(1, 10):
+        x = x @ x
+        window.step(step)
+        profiling = window.prof is not None
+        assert profiling == (3 <= step + 1 < 6), step
+    assert window.done
+    assert len(list(tmp_path.glob("*.json"))) == 1